@@ -0,0 +1,35 @@
+from django.contrib import admin
+from .models import Batch, Conversation, Message
+
+
+class MessageInline(admin.TabularInline):
+    model = Message
+    fields = ['position', 'role', 'content']
+    readonly_fields = ['position', 'role', 'content']
+    extra = 0
+    can_delete = False
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'model_name', 'message_count', 'created_at', 'updated_at']
+    list_filter = ['model_name', 'updated_at']
+    search_fields = ['id', 'user__username', 'model_name']
+    readonly_fields = ['id', 'created_at', 'updated_at', 'message_count']
+    date_hierarchy = 'updated_at'
+    inlines = [MessageInline]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user')
+
+
+@admin.register(Batch)
+class BatchAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'status', 'total_jobs', 'succeeded_jobs', 'failed_jobs', 'created_at', 'finished_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['id', 'user__username']
+    readonly_fields = ['id', 'created_at', 'started_at', 'finished_at', 'total_jobs', 'succeeded_jobs', 'failed_jobs']
+    date_hierarchy = 'created_at'
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user')
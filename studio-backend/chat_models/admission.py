@@ -0,0 +1,409 @@
+"""
+Admission control for chat generations.
+
+Requests that need a new upstream generation take a slot before anything is
+sent to Ollama. Cache hits and requests that join an in-flight generation
+need no slot. Slots are limited per model (``CHAT_ADMISSION_MODEL_CONCURRENCY``,
+overridable per model with ``CHAT_ADMISSION_MODEL_LIMITS``) and by backend
+capacity. This keeps Ollama from thrashing or queueing invisibly.
+
+The backend limit is an aggregate: ``CHAT_ADMISSION_BACKEND_CONCURRENCY``
+times the number of healthy backends, not a limit per backend. Admission
+happens before routing, so the backend a request will land on is not known
+yet; the router then sends it to the backend with the least outstanding work,
+and conversation affinity gives way once the sticky backend has more than
+``OLLAMA_AFFINITY_MAX_EXTRA_REQUESTS`` requests beyond the least-loaded one.
+Per-backend load is therefore bounded by routing, not by admission; it is
+visible as ``outstandingRequests`` under ``backends`` on the health check.
+
+Requests that cannot start wait in a bounded queue:
+
+- lanes: tenants on a plan in ``CHAT_ADMISSION_PRIORITY_PLANS`` (and staff
+  users) are served before everyone else;
+- fair share: within a lane, tenants (project, user or client IP) are served
+  round-robin, and each tenant may only hold
+  ``CHAT_ADMISSION_MAX_QUEUED_PER_TENANT`` queued requests;
+- fast rejection: when the queue (``CHAT_ADMISSION_QUEUE_SIZE``) or the
+  tenant's share is full, or a request waited ``CHAT_ADMISSION_MAX_WAIT_SECONDS``,
+  :class:`AdmissionRejected` carries a Retry-After estimated from recent
+  generation times.
+
+Every :class:`Ticket` records how long it queued; the chat views expose it as
+``X-Queue-Time-Ms`` and ``RequestLoggingMiddleware`` stores it separately from
+latency.
+
+Hedged attempts (``chat_models.resilience``) take a slot with
+:meth:`AdmissionController.try_admit`, only when one is free and nobody is
+queued, and hold it until the attempt ends; without one no hedge is sent.
+
+Background work (the batch worker pool, ``chat_models.batches``) takes slots
+through :meth:`AdmissionController.admit_background` instead: it never enters
+the queue, only starts while no interactive request is waiting, and leaves
+``headroom`` slots free, so interactive traffic is not delayed by it.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from django.conf import settings
+
+from .router import OllamaRouter, get_router
+
+logger = logging.getLogger(__name__)
+
+LANE_PRIORITY = 1
+LANE_STANDARD = 0
+LANE_BACKGROUND = -1
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request can neither start nor wait; maps to HTTP 429."""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """An admitted (or waiting) request; release it when its generation ends."""
+
+    def __init__(self, controller: "AdmissionController", model: str, tenant: str, lane: int):
+        self.controller = controller
+        self.model = model
+        self.tenant = tenant
+        self.lane = lane
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.released = False
+
+    @property
+    def queue_seconds(self) -> float:
+        return (self.admitted_at or time.monotonic()) - self.enqueued_at
+
+    def release(self) -> None:
+        self.controller.release(self)
+
+
+class _Waiter:
+    def __init__(self, ticket: Ticket, wake: Callable[[], None]):
+        self.ticket = ticket
+        self.wake = wake
+        self.granted = False
+
+
+def parse_model_limits(spec: str) -> Dict[str, int]:
+    """Parse ``model=N,model2=M`` overrides."""
+    limits = {}
+    for item in (spec or '').split(','):
+        name, sep, value = item.strip().partition('=')
+        if sep and name:
+            limits[name.strip()] = int(value)
+    return limits
+
+
+class AdmissionController:
+    """Concurrency limits plus a fair, priority-laned wait queue."""
+
+    def __init__(
+        self,
+        router: OllamaRouter,
+        model_concurrency: int = 4,
+        model_limits: Optional[Dict[str, int]] = None,
+        backend_concurrency: int = 8,
+        queue_size: int = 64,
+        max_queued_per_tenant: int = 8,
+        max_wait: float = 30.0,
+        enabled: bool = True,
+    ):
+        self.router = router
+        self.model_concurrency = model_concurrency
+        self.model_limits = model_limits or {}
+        self.backend_concurrency = backend_concurrency
+        self.queue_size = queue_size
+        self.max_queued_per_tenant = max_queued_per_tenant
+        self.max_wait = max_wait
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        # Notified whenever a slot is released, for background admission.
+        self._released = threading.Condition(self._lock)
+        self._active_by_model: Dict[str, int] = {}
+        self._active = 0
+        self._active_background = 0
+        # lane -> tenant -> waiters, tenants rotated to the back when served
+        self._lanes: Dict[int, "OrderedDict[str, Deque[_Waiter]]"] = {
+            LANE_PRIORITY: OrderedDict(),
+            LANE_STANDARD: OrderedDict(),
+        }
+        self._queued = 0
+        # Exponentially weighted mean generation time, for Retry-After.
+        self._service_seconds = 5.0
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_seconds_total = 0.0
+
+    @classmethod
+    def from_settings(cls, router: Optional[OllamaRouter] = None) -> "AdmissionController":
+        return cls(
+            router or get_router(),
+            model_concurrency=getattr(settings, 'CHAT_ADMISSION_MODEL_CONCURRENCY', 4),
+            model_limits=parse_model_limits(getattr(settings, 'CHAT_ADMISSION_MODEL_LIMITS', '')),
+            backend_concurrency=getattr(settings, 'CHAT_ADMISSION_BACKEND_CONCURRENCY', 8),
+            queue_size=getattr(settings, 'CHAT_ADMISSION_QUEUE_SIZE', 64),
+            max_queued_per_tenant=getattr(settings, 'CHAT_ADMISSION_MAX_QUEUED_PER_TENANT', 8),
+            max_wait=getattr(settings, 'CHAT_ADMISSION_MAX_WAIT_SECONDS', 30.0),
+            enabled=getattr(settings, 'CHAT_ADMISSION_ENABLED', True),
+        )
+
+    # -- capacity (lock held) --------------------------------------------
+
+    def _model_limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.model_limits.get(model.split(':')[0], self.model_concurrency))
+
+    def _has_capacity(self, model: str, headroom: int = 0) -> bool:
+        now = time.monotonic()
+        healthy = sum(1 for b in self.router.backends if b.is_available(now)) or 1
+        # Headroom never takes the last slot, so background work always progresses.
+        return (
+            self._active_by_model.get(model, 0) < max(self._model_limit(model) - headroom, 1)
+            and self._active < max(self.backend_concurrency * healthy - headroom, 1)
+        )
+
+    def _grant(self, ticket: Ticket) -> None:
+        ticket.admitted_at = time.monotonic()
+        self._active_by_model[ticket.model] = self._active_by_model.get(ticket.model, 0) + 1
+        self._active += 1
+        if ticket.lane == LANE_BACKGROUND:
+            self._active_background += 1
+        self.admitted += 1
+        self.queue_seconds_total += ticket.queue_seconds
+
+    def _retry_after(self) -> int:
+        capacity = max(self.backend_concurrency, 1)
+        return max(1, min(60, math.ceil(self._service_seconds * (self._queued + 1) / capacity)))
+
+    def _dispatch(self) -> None:
+        """Hand free slots to waiters: priority lane first, tenants round-robin."""
+        for lane in (LANE_PRIORITY, LANE_STANDARD):
+            tenants = self._lanes[lane]
+            progressed = True
+            while progressed and tenants:
+                progressed = False
+                for tenant in list(tenants):
+                    waiters = tenants[tenant]
+                    if not self._has_capacity(waiters[0].ticket.model):
+                        continue
+                    waiter = waiters.popleft()
+                    self._queued -= 1
+                    if waiters:
+                        tenants.move_to_end(tenant)
+                    else:
+                        del tenants[tenant]
+                    self._grant(waiter.ticket)
+                    waiter.granted = True
+                    waiter.wake()
+                    progressed = True
+
+    def _remove(self, waiter: _Waiter) -> None:
+        tenants = self._lanes[waiter.ticket.lane]
+        waiters = tenants.get(waiter.ticket.tenant)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self._queued -= 1
+            if not waiters:
+                del tenants[waiter.ticket.tenant]
+
+    def _reject(self, message: str) -> AdmissionRejected:
+        self.rejected += 1
+        return AdmissionRejected(message, self._retry_after())
+
+    def _enter(self, ticket: Ticket, make_wake: Callable[[], Callable[[], None]]) -> Optional[_Waiter]:
+        """Admit immediately (returns None) or enqueue (returns the waiter)."""
+        with self._lock:
+            if not any(self._lanes[lane] for lane in self._lanes) and self._has_capacity(ticket.model):
+                self._grant(ticket)
+                return None
+            if self._queued >= self.queue_size:
+                raise self._reject("The request queue is full")
+            waiters = self._lanes[ticket.lane].setdefault(ticket.tenant, deque())
+            if len(waiters) >= self.max_queued_per_tenant:
+                if not waiters:
+                    del self._lanes[ticket.lane][ticket.tenant]
+                raise self._reject("Too many queued requests for this client")
+            waiter = _Waiter(ticket, make_wake())
+            waiters.append(waiter)
+            self._queued += 1
+            # Capacity may be free for this model even though others wait.
+            self._dispatch()
+            return waiter
+
+    def _timed_out(self, waiter: _Waiter) -> None:
+        """Drop ``waiter`` after its wait expired, unless it was granted meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return
+            self._remove(waiter)
+            raise self._reject("Timed out waiting for a generation slot")
+
+    # -- public API ------------------------------------------------------
+
+    def admit(self, model: str, tenant: str, lane: int = LANE_STANDARD) -> Ticket:
+        """Block until a slot is free; raises :class:`AdmissionRejected`."""
+        ticket = Ticket(self, model, tenant, lane)
+        if not self.enabled:
+            ticket.admitted_at = ticket.enqueued_at
+            ticket.released = True
+            return ticket
+        event = threading.Event()
+        waiter = self._enter(ticket, lambda: event.set)
+        if waiter is not None and not event.wait(self.max_wait):
+            self._timed_out(waiter)
+        return ticket
+
+    async def aadmit(self, model: str, tenant: str, lane: int = LANE_STANDARD) -> Ticket:
+        """Async counterpart of :meth:`admit`; waits without blocking the loop."""
+        ticket = Ticket(self, model, tenant, lane)
+        if not self.enabled:
+            ticket.admitted_at = ticket.enqueued_at
+            ticket.released = True
+            return ticket
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def make_wake():
+            def wake():
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+            return wake
+
+        waiter = self._enter(ticket, make_wake)
+        if waiter is None:
+            return ticket
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            self._timed_out(waiter)
+        except asyncio.CancelledError:
+            # Client went away while queued: give back a slot granted meanwhile.
+            with self._lock:
+                granted = waiter.granted
+                self._remove(waiter)
+            if granted:
+                self.release(ticket)
+            raise
+        return ticket
+
+    def try_admit(self, model: str, tenant: str, lane: int = LANE_STANDARD) -> Optional[Ticket]:
+        """
+        Take a slot only if one is free now and nobody is queued, else return None.
+
+        For extra attempts worth sending only on spare capacity, such as
+        hedges (``chat_models.resilience.Hedger``).
+        """
+        ticket = Ticket(self, model, tenant, lane)
+        if not self.enabled:
+            ticket.admitted_at = ticket.enqueued_at
+            ticket.released = True
+            return ticket
+        with self._lock:
+            if self._queued or not self._has_capacity(model):
+                return None
+            self._grant(ticket)
+        return ticket
+
+    def admit_background(self, model: str, tenant: str, headroom: int = 1, timeout: Optional[float] = None) -> Optional[Ticket]:
+        """
+        Take a slot for background work, or return None after ``timeout``.
+
+        Never queues: waits until no interactive request is queued and a slot
+        is free with ``headroom`` slots to spare (for the model and overall).
+        """
+        ticket = Ticket(self, model, tenant, LANE_BACKGROUND)
+        if not self.enabled:
+            ticket.admitted_at = ticket.enqueued_at
+            ticket.released = True
+            return ticket
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while any(self._lanes[lane] for lane in self._lanes) or not self._has_capacity(model, headroom):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                # Re-check at least every second: backend health changes capacity too.
+                self._released.wait(1.0 if remaining is None else min(remaining, 1.0))
+            self._grant(ticket)
+        return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            self._active -= 1
+            if ticket.lane == LANE_BACKGROUND:
+                self._active_background -= 1
+            self._active_by_model[ticket.model] -= 1
+            if not self._active_by_model[ticket.model]:
+                del self._active_by_model[ticket.model]
+            held = time.monotonic() - (ticket.admitted_at or ticket.enqueued_at)
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * held
+            self._dispatch()
+            self._released.notify_all()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "active": self._active,
+                "activeByModel": dict(self._active_by_model),
+                "activeBackground": self._active_background,
+                "queued": self._queued,
+                "queuedByLane": {
+                    "priority": sum(len(w) for w in self._lanes[LANE_PRIORITY].values()),
+                    "standard": sum(len(w) for w in self._lanes[LANE_STANDARD].values()),
+                },
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "avgQueueMs": round(self.queue_seconds_total * 1000 / max(self.admitted, 1), 1),
+            }
+
+
+def request_tenant(request) -> Tuple[str, int]:
+    """
+    Fair-share key and lane for a request.
+
+    The tenant is the request's project when an auth layer attached one
+    (``request.project``), else the user, else the client IP. Projects whose
+    ``plan`` is in ``CHAT_ADMISSION_PRIORITY_PLANS``, and staff users, get the
+    priority lane.
+    """
+    priority_plans = {
+        p.strip().lower() for p in getattr(settings, 'CHAT_ADMISSION_PRIORITY_PLANS', '').split(',') if p.strip()
+    }
+    project = getattr(request, 'project', None)
+    if project is not None:
+        plan = (getattr(project, 'plan', '') or '').lower()
+        return f"project:{project.pk}", LANE_PRIORITY if plan in priority_plans else LANE_STANDARD
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f"user:{user.pk}", LANE_PRIORITY if user.is_staff else LANE_STANDARD
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    ip = forwarded.split(',')[0].strip() if forwarded else request.META.get('REMOTE_ADDR', '')
+    return f"ip:{ip}", LANE_STANDARD
+
+
+_controller: Optional[AdmissionController] = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> AdmissionController:
+    """Return the process-wide admission controller built from settings."""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController.from_settings()
+    return _controller
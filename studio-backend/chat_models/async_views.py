@@ -0,0 +1,405 @@
+"""
+Async chat completion view for the ASGI deployment.
+
+``ChatCompletionView`` streams through a synchronous ``ollama.Client`` iterator,
+which pins a worker thread for the whole generation. Under ASGI this view
+streams through ``ollama.AsyncClient`` instead, so a single process can hold
+hundreds of concurrent generations on one event loop.
+"""
+import json
+import logging
+import uuid
+from typing import Any, Dict, Optional
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from dashboard.usage import request_usage
+
+from .ollama_client import OllamaClient, OllamaError, OllamaConnectionError, OllamaModelError, get_ollama_client
+from .completion_cache import CacheLookup, cache_key, get_completion_cache
+from .admission import AdmissionRejected, get_admission_controller, request_tenant
+from .coalescing import acollect, get_request_coalescer
+from .context import apply_context_headers, get_context_manager
+from .embeddings import apply_embedding_headers, get_embedding_batcher
+from .conversations import ConversationNotFound, ConversationTurn, apply_conversation_headers, get_conversation_store
+from .rate_limit import apply_rate_limit_headers, get_rate_limiter, rate_limited_body
+from .encoders import create_encoder
+from .sampling import asample_completions, asample_stream, format_choices
+from .streaming import ChoiceStats, StreamStats, acoalesce_deltas, aencode_choices, aencode_stream
+from .tools import ToolTrace, apply_tool_headers, arun_tool_loop, astream_tool_loop
+from .validators import ChatRequestValidator, EmbeddingRequestValidator
+from .views import (
+    ChatCompletionView, EmbeddingsView, apply_cache_headers, apply_coalesce_headers, apply_queue_headers,
+    apply_stream_headers,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _authenticate(view: View, request) -> Optional[HttpResponse]:
+    """
+    Authenticate ``request`` the way DRF's ``APIView`` does for the sync views.
+
+    Runs ``DEFAULT_AUTHENTICATION_CLASSES`` (JWT) and the view's
+    ``permission_classes`` and sets ``request.user`` and ``request.auth``, so
+    rate limits, admission tenants, conversation ownership and the request log
+    see the same user under ASGI as under WSGI. Returns the error response
+    for credentials that fail or a permission that is denied, else None.
+    """
+    authenticators = [auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    drf_request = Request(request, authenticators=authenticators)
+    try:
+        # Sets request.user and request.auth on the Django request as well
+        drf_request.user
+        for permission in (cls() for cls in view.permission_classes):
+            if not permission.has_permission(drf_request, view):
+                if drf_request.successful_authenticator is None and authenticators:
+                    raise exceptions.NotAuthenticated()
+                raise exceptions.PermissionDenied(getattr(permission, 'message', None))
+    except (exceptions.NotAuthenticated, exceptions.AuthenticationFailed) as e:
+        header = authenticators[0].authenticate_header(drf_request) if authenticators else None
+        response = JsonResponse({"detail": e.detail}, status=e.status_code if header else status.HTTP_403_FORBIDDEN)
+        if header:
+            response['WWW-Authenticate'] = header
+        return response
+    except exceptions.APIException as e:
+        return JsonResponse({"detail": e.detail}, status=e.status_code)
+    return None
+
+
+aauthenticate = sync_to_async(_authenticate)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatCompletionView(View):
+    """Handle /v1/chat/completions natively on the event loop (ASGI only)."""
+
+    http_method_names = ['post', 'options']
+    # The sync view's, so both deployments admit the same callers
+    permission_classes = ChatCompletionView.permission_classes
+
+    async def post(self, request, *args, **kwargs) -> HttpResponse:
+        # Authenticate off the event loop once; the rate limiter and
+        # admission control read request.user synchronously.
+        denied = await aauthenticate(self, request)
+        if denied is not None:
+            return denied
+        decision = await get_rate_limiter().acheck(request)
+        if not decision.allowed:
+            logger.warning(f"Chat completion rejected by the {decision.bucket.scope} rate limit")
+            response = JsonResponse(rate_limited_body(decision), status=status.HTTP_429_TOO_MANY_REQUESTS)
+            return apply_rate_limit_headers(response, decision)
+        return apply_rate_limit_headers(await self._complete(request), decision)
+
+    async def _complete(self, request) -> HttpResponse:
+        try:
+            request_id = str(uuid.uuid4())
+            logger.info(f"[request:{request_id}] Async chat completion request received")
+            # The request log row is written with this ID and the usage recorded below
+            usage = request_usage(request)
+            usage.request_id = request_id
+
+            try:
+                data = json.loads(request.body or b"{}")
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                raise ValidationError(f"Malformed JSON body: {e}")
+            if not isinstance(data, dict):
+                raise ValidationError("Request body must be a JSON object")
+
+            cleaned_data = ChatRequestValidator.validate_request(data)
+            usage.model_name = cleaned_data['model']
+            client = get_ollama_client()
+
+            # With a stored conversation the request carries only the new turn
+            turn = await get_conversation_store().aresolve(request.user, cleaned_data)
+            if turn is not None:
+                cleaned_data['messages'] = turn.messages
+
+            # Fit the history into the model's context window before anything
+            # keys on it (cache, coalescing) or sends it.
+            fit = await get_context_manager().afit(cleaned_data)
+            cleaned_data['messages'] = fit.messages
+
+            if cleaned_data['n'] > 1:
+                # Parallel samples as indexed choices; never cached or coalesced
+                response = await self._create_sampled_response(client, cleaned_data, request_id)
+                return apply_context_headers(response, fit)
+
+            if cleaned_data['tools']:
+                # Server-side tool calls until the model answers; never cached or coalesced
+                response = await self._create_tool_response(client, cleaned_data, request_id, turn)
+                apply_conversation_headers(response, turn)
+                return apply_context_headers(response, fit)
+
+            lookup = await get_completion_cache().alookup(cleaned_data)
+
+            if cleaned_data.get('stream', True):
+                response = await self._create_streaming_response(client, cleaned_data, request_id, lookup, turn)
+            else:
+                response = await self._create_non_streaming_response(client, cleaned_data, request_id, lookup, turn)
+            apply_conversation_headers(response, turn)
+            return apply_context_headers(response, fit)
+
+        except ConversationNotFound as e:
+            logger.warning(f"Chat completion for unknown conversation: {e}")
+            return JsonResponse({
+                "error": "Conversation not found",
+                "message": str(e)
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        except ValidationError as e:
+            logger.error(f"Validation error: {e}")
+            return JsonResponse({
+                "error": "Invalid request format",
+                "message": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        except AdmissionRejected as e:
+            logger.warning(f"Chat completion rejected by admission control: {e}")
+            response = JsonResponse({
+                "error": "Too many requests",
+                "message": str(e)
+            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+
+        except OllamaConnectionError as e:
+            logger.error(f"Ollama connection error: {e}")
+            return JsonResponse({
+                "error": "Unable to connect to Ollama",
+                "message": "The AI service is currently unavailable. Please try again later."
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        except OllamaModelError as e:
+            logger.error(f"Ollama model error: {e}")
+            return JsonResponse({
+                "error": "Model not available",
+                "message": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        except OllamaError as e:
+            logger.error(f"Ollama error: {e}")
+            return JsonResponse({
+                "error": "AI service error",
+                "message": str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        except Exception as e:
+            logger.error(f"Unexpected error in async chat completion: {e}")
+            return JsonResponse({
+                "error": "Internal server error",
+                "message": "An unexpected error occurred. Please try again."
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    async def _create_streaming_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str, lookup: CacheLookup,
+                                         turn: Optional[ConversationTurn] = None) -> StreamingHttpResponse:
+        """Create a streaming response (Vercel AI SDK by default) backed by an async generator."""
+        encoder = create_encoder(self.request, cleaned_data)
+        coalesced, ticket = False, None
+        if lookup.hit:
+            stream = get_completion_cache().areplay(lookup.cached)
+        else:
+            # The upstream stream is opened by the flight's producer task, so
+            # failures are reported as error parts, matching the sync path.
+            stream, coalesced, ticket = await self._join_generation(client, cleaned_data, lookup)
+        if turn is not None:
+            stream = turn.arecord_stream(stream)
+
+        stats = StreamStats()
+        response = StreamingHttpResponse(
+            aencode_stream(acoalesce_deltas(stream, stats=stats), encoder, request_id, stats),
+            content_type=encoder.content_type,
+        )
+        # RequestLoggingMiddleware writes the log row from these once the stream ends
+        request_usage(self.request).stats = stats
+        apply_stream_headers(response, encoder)
+        apply_cache_headers(response, lookup)
+        apply_coalesce_headers(response, coalesced)
+        return apply_queue_headers(response, ticket)
+
+    async def _create_non_streaming_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str, lookup: CacheLookup,
+                                             turn: Optional[ConversationTurn] = None) -> JsonResponse:
+        """Create non-streaming response without blocking the event loop."""
+        logger.info(f"[request:{request_id}] Generating async non-streaming response...")
+        coalesced, ticket = False, None
+        if lookup.hit:
+            raw_response = lookup.cached
+        else:
+            stream, coalesced, ticket = await self._join_generation(client, cleaned_data, lookup, hedge=True)
+            raw_response = await acollect(stream)
+
+        stats = StreamStats()
+        stats.finish(raw_response)
+        request_usage(self.request).stats = stats
+        body = client._format_completion_response(raw_response)
+        if turn is not None:
+            await turn.acommit(raw_response)
+            body["conversationId"] = turn.conversation_id
+        response = JsonResponse(body)
+        apply_cache_headers(response, lookup)
+        apply_coalesce_headers(response, coalesced)
+        return apply_queue_headers(response, ticket)
+
+    async def _create_sampled_response(self, client: OllamaClient, cleaned_data: Dict[str, Any],
+                                       request_id: str) -> HttpResponse:
+        """Generate ``n`` samples concurrently on the event loop."""
+        n = cleaned_data['n']
+        logger.info(f"[request:{request_id}] Generating {n} async samples...")
+        tenant, lane = request_tenant(self.request)
+        stats = ChoiceStats(n)
+        if cleaned_data.get('stream', True):
+            encoder = create_encoder(self.request, cleaned_data)
+            response = StreamingHttpResponse(
+                aencode_choices(asample_stream(client, cleaned_data, stats, tenant, lane), encoder, request_id, stats),
+                content_type=encoder.content_type,
+            )
+            apply_stream_headers(response, encoder)
+        else:
+            responses = await asample_completions(client, cleaned_data, n, tenant, lane)
+            response = JsonResponse(format_choices(client, responses, stats))
+        # Token usage and per-choice finish reasons for the request log
+        request_usage(self.request).stats = stats
+        return apply_cache_headers(response, CacheLookup(None))
+
+    async def _create_tool_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str,
+                                    turn: Optional[ConversationTurn] = None) -> HttpResponse:
+        """Run the tool loop on the event loop; tools still run on the shared thread pool."""
+        logger.info(f"[request:{request_id}] Running async tool loop with {', '.join(cleaned_data['tools'])}...")
+        tenant, lane = request_tenant(self.request)
+        admission = get_admission_controller()
+        trace = ToolTrace()
+        usage = request_usage(self.request)
+        usage.trace = trace
+
+        def admit():
+            return admission.aadmit(cleaned_data['model'], tenant, lane)
+
+        if cleaned_data.get('stream', True):
+            encoder = create_encoder(self.request, cleaned_data)
+            stream = astream_tool_loop(client, cleaned_data, admit, trace, request_id)
+            if turn is not None:
+                stream = turn.arecord_stream(stream)
+            stats = StreamStats()
+            response = StreamingHttpResponse(
+                aencode_stream(acoalesce_deltas(stream, stats=stats), encoder, request_id, stats),
+                content_type=encoder.content_type,
+            )
+            usage.stats = stats
+            apply_stream_headers(response, encoder)
+        else:
+            raw_response = await arun_tool_loop(client, cleaned_data, admit, trace, request_id)
+            usage.stats = StreamStats()
+            usage.stats.finish(raw_response)
+            body = client._format_completion_response(raw_response)
+            if turn is not None:
+                await turn.acommit(raw_response)
+                body["conversationId"] = turn.conversation_id
+            response = JsonResponse(body)
+        apply_tool_headers(response, trace)
+        return apply_cache_headers(response, CacheLookup(None))
+
+    async def _join_generation(self, client: OllamaClient, cleaned_data: Dict[str, Any], lookup: CacheLookup,
+                               hedge: bool = False):
+        """
+        Subscribe to the upstream generation for this request, starting it if needed.
+
+        Queued requests wait on the event loop, not on a thread. Returns
+        ``(stream, coalesced, ticket)`` and hedges like the sync view.
+        """
+        cache = get_completion_cache()
+        coalescer = get_request_coalescer()
+        key = lookup.key or cache_key(cleaned_data)
+
+        async def open_stream():
+            return cache.arecord_stream(lookup, await client.araw_chat_stream(
+                model=cleaned_data['model'],
+                messages=cleaned_data['messages'],
+                temperature=cleaned_data.get('temperature', 0.7),
+                top_p=cleaned_data.get('top_p', 0.9),
+                hedge=hedge,
+            ))
+
+        stream = coalescer.ajoin_or_none(key)
+        if stream is not None:
+            return stream, True, None
+        # Every new generation takes a slot; if an identical one started while
+        # this request queued, ajoin() joins it and gives the slot back.
+        tenant, lane = request_tenant(self.request)
+        ticket = await get_admission_controller().aadmit(cleaned_data['model'], tenant, lane)
+        stream, coalesced = coalescer.ajoin(key, open_stream, on_finish=ticket.release)
+        return stream, coalesced, None if coalesced else ticket
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncEmbeddingsView(View):
+    """Handle /v1/embeddings on the event loop (ASGI only); requests still meet in shared batches."""
+
+    http_method_names = ['post', 'options']
+    permission_classes = EmbeddingsView.permission_classes
+
+    async def post(self, request, *args, **kwargs) -> HttpResponse:
+        denied = await aauthenticate(self, request)
+        if denied is not None:
+            return denied
+        decision = await get_rate_limiter().acheck(request)
+        if not decision.allowed:
+            logger.warning(f"Embeddings rejected by the {decision.bucket.scope} rate limit")
+            response = JsonResponse(rate_limited_body(decision), status=status.HTTP_429_TOO_MANY_REQUESTS)
+            return apply_rate_limit_headers(response, decision)
+        return apply_rate_limit_headers(await self._embed(request), decision)
+
+    async def _embed(self, request) -> HttpResponse:
+        try:
+            try:
+                data = json.loads(request.body or b"{}")
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                raise ValidationError(f"Malformed JSON body: {e}")
+            if not isinstance(data, dict):
+                raise ValidationError("Request body must be a JSON object")
+            cleaned_data = EmbeddingRequestValidator.validate_request(data)
+            result = await get_embedding_batcher().aembed(cleaned_data['model'], cleaned_data['input'])
+            response = HttpResponse(result.to_json(cleaned_data['encoding_format']), content_type='application/json')
+            return apply_embedding_headers(response, result)
+
+        except ValidationError as e:
+            logger.error(f"Validation error: {e}")
+            return JsonResponse({
+                "error": "Invalid request format",
+                "message": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        except OllamaConnectionError as e:
+            logger.error(f"Ollama connection error: {e}")
+            return JsonResponse({
+                "error": "Unable to connect to Ollama",
+                "message": "The AI service is currently unavailable. Please try again later."
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        except OllamaModelError as e:
+            logger.error(f"Ollama model error: {e}")
+            return JsonResponse({
+                "error": "Model not available",
+                "message": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        except OllamaError as e:
+            logger.error(f"Ollama error: {e}")
+            return JsonResponse({
+                "error": "AI service error",
+                "message": str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        except Exception as e:
+            logger.error(f"Unexpected error in async embeddings: {e}")
+            return JsonResponse({
+                "error": "Internal server error",
+                "message": "An unexpected error occurred. Please try again."
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -0,0 +1,97 @@
+"""
+Views for offline batch completions (see chat_models.batches).
+"""
+import logging
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .batches import (
+    BatchInputError,
+    batch_progress,
+    cancel_batch,
+    create_batch,
+    iter_results,
+    parse_batch_input,
+)
+from .models import Batch
+
+logger = logging.getLogger(__name__)
+
+
+class BatchListView(APIView):
+    """List the user's batches, or submit a new one as a JSONL body."""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        batches = Batch.objects.filter(user=request.user)[:100]
+        return Response({"object": "list", "data": [batch_progress(b) for b in batches]})
+
+    def post(self, request, *args, **kwargs):
+        max_jobs = getattr(settings, 'CHAT_BATCH_MAX_JOBS', 50000)
+        try:
+            jobs = parse_batch_input(request.body, max_jobs)
+        except BatchInputError as e:
+            logger.warning(f"Batch rejected: {e}")
+            return Response({
+                "error": "Invalid batch input",
+                "message": str(e),
+                "lines": [{"line": line, "message": message} for line, message in e.errors],
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        name = request.query_params.get('name')
+        batch = create_batch(request.user, jobs, metadata={"name": name} if name else None)
+        logger.info(f"Batch {batch.id} created with {len(jobs)} requests for user {request.user.pk}")
+        return Response(batch_progress(batch), status=status.HTTP_201_CREATED)
+
+
+class BatchDetailView(APIView):
+    """Progress of one batch."""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, batch_id, *args, **kwargs):
+        batch = get_object_or_404(Batch, pk=batch_id, user=request.user)
+        return Response(batch_progress(batch))
+
+
+class BatchCancelView(APIView):
+    """Cancel a batch: queued requests are dropped, running ones finish."""
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, batch_id, *args, **kwargs):
+        batch = get_object_or_404(Batch, pk=batch_id, user=request.user)
+        batch = cancel_batch(batch)
+        logger.info(f"Batch {batch.id} cancelled by user {request.user.pk} ({batch.status})")
+        return Response(batch_progress(batch))
+
+
+class BatchResultsView(APIView):
+    """
+    Stream the finished results of a batch as JSONL, in input order.
+
+    Available while the batch runs; ``?after=<line>`` resumes after the last
+    line already read.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, batch_id, *args, **kwargs):
+        batch = get_object_or_404(Batch, pk=batch_id, user=request.user)
+        try:
+            after = int(request.query_params.get('after', 0))
+        except ValueError:
+            return Response({
+                "error": "Invalid request format",
+                "message": "after must be a line number",
+            }, status=status.HTTP_400_BAD_REQUEST)
+        response = StreamingHttpResponse(iter_results(batch, after), content_type='application/x-ndjson')
+        response['X-Batch-Status'] = batch.status
+        return response
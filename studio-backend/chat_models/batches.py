@@ -0,0 +1,434 @@
+"""
+Offline batch completions.
+
+``POST /v1/batches`` takes JSONL, one chat request per line (either the
+request itself or ``{"custom_id": ..., "body": {...}}``). Every line is
+validated up front and stored as a :class:`BatchJob`; the batch and job state
+live in the database, so nothing is lost on restart.
+
+A :class:`BatchWorkerPool` drains them:
+
+- claiming is an atomic ``UPDATE ... WHERE status='queued'``, so any number of
+  pools (web processes, ``manage.py process_batches``) can share the work;
+- each worker prefers jobs for the model it ran last, so a pass over a mixed
+  batch does not make Ollama swap models back and forth;
+- generations take slots through
+  :meth:`AdmissionController.admit_background`, which yields to every
+  queued interactive request and keeps ``CHAT_BATCH_HEADROOM`` slots free. The
+  pool therefore runs at whatever throughput interactive traffic leaves over;
+- running jobs hold a lease renewed every third of
+  ``CHAT_BATCH_LEASE_SECONDS``. Jobs whose lease lapsed (their worker died)
+  are queued again, up to ``CHAT_BATCH_MAX_ATTEMPTS``, which is how batches
+  resume after a restart;
+- backend outages are retried; invalid requests fail their job only.
+
+Results are read back as JSONL (``GET /v1/batches/<id>/results``) while the
+batch runs. Cancelling drops the queued jobs and lets running ones finish.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, connection
+from django.db.models import F
+from django.utils import timezone
+
+from .admission import AdmissionController, get_admission_controller
+from .models import Batch, BatchJob
+from .validators import ChatRequestValidator
+
+logger = logging.getLogger(__name__)
+
+# Line errors reported back when a batch is rejected
+MAX_REPORTED_ERRORS = 20
+
+
+class BatchInputError(Exception):
+    """The JSONL input is invalid; ``errors`` lists ``(line, message)``."""
+
+    def __init__(self, errors: List[Tuple[int, str]]):
+        super().__init__(f"{len(errors)} invalid line(s)")
+        self.errors = errors
+
+
+def parse_batch_input(body: bytes, max_jobs: int) -> List[Dict[str, Any]]:
+    """
+    Validate JSONL input into job dicts (``line``, ``custom_id``, ``request``).
+
+    Raises:
+        BatchInputError: with the first invalid lines; nothing is stored then
+    """
+    jobs = []
+    errors: List[Tuple[int, str]] = []
+    seen_ids = set()
+    for number, raw in enumerate(body.splitlines(), start=1):
+        if not raw.strip():
+            continue
+        if len(jobs) >= max_jobs:
+            raise BatchInputError([(number, f"Too many requests (max {max_jobs})")])
+        try:
+            item = json.loads(raw)
+            if not isinstance(item, dict):
+                raise ValidationError("Each line must be a JSON object")
+            payload = item.get("body", item)
+            if not isinstance(payload, dict):
+                raise ValidationError("body must be a JSON object")
+            if payload.get("conversationId") or payload.get("store"):
+                raise ValidationError("Stored conversations are not supported in batches")
+            cleaned = ChatRequestValidator.validate_request(payload)
+            if cleaned["n"] > 1:
+                raise ValidationError("n > 1 is not supported in batches")
+            if cleaned["tools"]:
+                raise ValidationError("Tools are not supported in batches")
+            cleaned["stream"] = False
+            custom_id = str(item.get("custom_id") or number)[:128]
+            if custom_id in seen_ids:
+                raise ValidationError(f"Duplicate custom_id '{custom_id}'")
+            seen_ids.add(custom_id)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            errors.append((number, f"Malformed JSON: {e}"))
+        except ValidationError as e:
+            errors.append((number, "; ".join(e.messages)))
+        else:
+            jobs.append({"line": number, "custom_id": custom_id, "request": cleaned})
+        if len(errors) >= MAX_REPORTED_ERRORS:
+            break
+    if errors:
+        raise BatchInputError(errors)
+    if not jobs:
+        raise BatchInputError([(0, "The batch contains no requests")])
+    return jobs
+
+
+def create_batch(user, jobs: List[Dict[str, Any]], metadata: Optional[Dict[str, Any]] = None) -> Batch:
+    """Store a validated batch and its jobs."""
+    batch = Batch.objects.create(user=user, total_jobs=len(jobs), metadata=metadata)
+    BatchJob.objects.bulk_create(
+        (
+            BatchJob(
+                batch=batch,
+                line=job["line"],
+                custom_id=job["custom_id"],
+                model_name=job["request"]["model"],
+                request=job["request"],
+            )
+            for job in jobs
+        ),
+        batch_size=1000,
+    )
+    return batch
+
+
+def cancel_batch(batch: Batch) -> Batch:
+    """Drop a batch's queued jobs; running ones finish, then the batch is cancelled."""
+    if batch.status not in Batch.ACTIVE_STATUSES:
+        return batch
+    Batch.objects.filter(pk=batch.pk, status__in=Batch.ACTIVE_STATUSES).update(status=Batch.STATUS_CANCELLING)
+    batch.jobs.filter(status=BatchJob.STATUS_QUEUED).update(
+        status=BatchJob.STATUS_CANCELLED, finished_at=timezone.now()
+    )
+    finalize_batch(batch.pk)
+    batch.refresh_from_db()
+    return batch
+
+
+def finalize_batch(batch_id) -> None:
+    """Mark a batch finished once none of its jobs is queued or running."""
+    if BatchJob.objects.filter(
+        batch_id=batch_id, status__in=(BatchJob.STATUS_QUEUED, BatchJob.STATUS_RUNNING)
+    ).exists():
+        return
+    now = timezone.now()
+    Batch.objects.filter(pk=batch_id, status__in=Batch.ACTIVE_STATUSES).update(
+        status=Batch.STATUS_COMPLETED, finished_at=now
+    )
+    Batch.objects.filter(pk=batch_id, status=Batch.STATUS_CANCELLING).update(
+        status=Batch.STATUS_CANCELLED, finished_at=now
+    )
+
+
+def batch_progress(batch: Batch) -> Dict[str, Any]:
+    """API representation of a batch."""
+    finished = batch.succeeded_jobs + batch.failed_jobs
+    return {
+        "id": str(batch.id),
+        "object": "batch",
+        "status": batch.status,
+        "createdAt": batch.created_at.isoformat(),
+        "startedAt": batch.started_at.isoformat() if batch.started_at else None,
+        "finishedAt": batch.finished_at.isoformat() if batch.finished_at else None,
+        "requestCounts": {
+            "total": batch.total_jobs,
+            "succeeded": batch.succeeded_jobs,
+            "failed": batch.failed_jobs,
+        },
+        "progress": round(finished / batch.total_jobs, 4) if batch.total_jobs else 1.0,
+        "metadata": batch.metadata,
+    }
+
+
+def iter_results(batch: Batch, after_line: int = 0) -> Iterator[bytes]:
+    """JSONL result lines of a batch's finished jobs, in input order."""
+    jobs = (
+        batch.jobs.filter(status__in=BatchJob.FINISHED_STATUSES, line__gt=after_line)
+        .order_by('line')
+        .values('id', 'line', 'custom_id', 'status', 'response', 'error')
+    )
+    for job in jobs.iterator(chunk_size=500):
+        yield json.dumps({
+            "id": f"batch_req_{job['id']}",
+            "line": job['line'],
+            "custom_id": job['custom_id'],
+            "status": job['status'],
+            "response": job['response'],
+            "error": job['error'] or None,
+        }).encode('utf-8') + b'\n'
+
+
+class BatchWorkerPool:
+    """Threads draining queued batch jobs at the capacity interactive traffic leaves free."""
+
+    def __init__(
+        self,
+        workers: int = 2,
+        lease_seconds: float = 60.0,
+        poll_seconds: float = 2.0,
+        max_attempts: int = 3,
+        headroom: int = 1,
+        admission: Optional[AdmissionController] = None,
+    ):
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.headroom = headroom
+        self.admission = admission or get_admission_controller()
+        self.name = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._running: Dict[int, int] = {}  # thread ident -> job id
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+
+    @classmethod
+    def from_settings(cls) -> "BatchWorkerPool":
+        return cls(
+            workers=getattr(settings, 'CHAT_BATCH_WORKERS', 2),
+            lease_seconds=getattr(settings, 'CHAT_BATCH_LEASE_SECONDS', 60.0),
+            poll_seconds=getattr(settings, 'CHAT_BATCH_POLL_SECONDS', 2.0),
+            max_attempts=getattr(settings, 'CHAT_BATCH_MAX_ATTEMPTS', 3),
+            headroom=getattr(settings, 'CHAT_BATCH_HEADROOM', 1),
+        )
+
+    # -- lifecycle -------------------------------------------------------
+
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            self._stop.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'batch-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            keeper = threading.Thread(target=self._keep_leases, name='batch-leases', daemon=True)
+            keeper.start()
+            self._threads.append(keeper)
+        logger.info(f"Batch worker pool {self.name} started with {self.workers} workers")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def wait(self) -> None:
+        """Block until :meth:`stop` is called (for ``process_batches``)."""
+        while not self._stop.wait(1.0):
+            pass
+
+    # -- leases ----------------------------------------------------------
+
+    def recover_expired(self) -> int:
+        """Queue again (or fail) running jobs whose worker stopped renewing the lease."""
+        cutoff = timezone.now() - timedelta(seconds=self.lease_seconds)
+        expired = BatchJob.objects.filter(status=BatchJob.STATUS_RUNNING, heartbeat_at__lt=cutoff)
+        exhausted = list(expired.filter(attempts__gte=self.max_attempts).values_list('pk', 'batch_id'))
+        for job_id, batch_id in exhausted:
+            self._finish(job_id, batch_id, BatchJob.STATUS_FAILED, error="Worker lost (attempts exhausted)")
+        requeued = expired.filter(attempts__lt=self.max_attempts).update(
+            status=BatchJob.STATUS_QUEUED, worker='', heartbeat_at=None
+        )
+        if requeued or exhausted:
+            logger.warning(f"Recovered {requeued} batch jobs with expired leases, failed {len(exhausted)}")
+        return requeued
+
+    def _keep_leases(self) -> None:
+        interval = max(self.lease_seconds / 3, 0.5)
+        while not self._stop.wait(interval):
+            try:
+                close_old_connections()
+                with self._lock:
+                    running = list(self._running.values())
+                if running:
+                    BatchJob.objects.filter(pk__in=running, worker=self.name).update(heartbeat_at=timezone.now())
+                self.recover_expired()
+            except Exception as e:
+                logger.error(f"Batch lease renewal failed: {e}")
+        connection.close()
+
+    # -- claiming and running --------------------------------------------
+
+    def _claim(self, prefer_model: Optional[str]) -> Optional[BatchJob]:
+        queued = BatchJob.objects.filter(
+            status=BatchJob.STATUS_QUEUED, batch__status__in=Batch.ACTIVE_STATUSES
+        ).order_by('batch__created_at', 'line')
+        candidates = []
+        if prefer_model:
+            candidates = list(queued.filter(model_name=prefer_model).values_list('pk', flat=True)[:self.workers * 2])
+        if not candidates:
+            candidates = list(queued.values_list('pk', flat=True)[:self.workers * 2])
+        now = timezone.now()
+        for job_id in candidates:
+            claimed = BatchJob.objects.filter(pk=job_id, status=BatchJob.STATUS_QUEUED).update(
+                status=BatchJob.STATUS_RUNNING, worker=self.name, heartbeat_at=now, attempts=F('attempts') + 1
+            )
+            if claimed:
+                job = BatchJob.objects.select_related('batch').get(pk=job_id)
+                Batch.objects.filter(pk=job.batch_id, status=Batch.STATUS_QUEUED).update(
+                    status=Batch.STATUS_IN_PROGRESS, started_at=now
+                )
+                return job
+        return None
+
+    def _work(self) -> None:
+        last_model = None
+        while not self._stop.is_set():
+            try:
+                close_old_connections()
+                job = self._claim(last_model)
+                if job is None:
+                    self._stop.wait(self.poll_seconds)
+                    continue
+                last_model = job.model_name
+                with self._lock:
+                    self._running[threading.get_ident()] = job.pk
+                try:
+                    self._run(job)
+                finally:
+                    with self._lock:
+                        self._running.pop(threading.get_ident(), None)
+            except Exception as e:
+                logger.error(f"Batch worker error: {e}")
+                self._stop.wait(self.poll_seconds)
+        connection.close()
+
+    def _run(self, job: BatchJob) -> None:
+        from .completion_cache import get_completion_cache
+        from .context import get_context_manager
+        from .ollama_client import OllamaConnectionError, OllamaError, get_ollama_client
+
+        ticket = None
+        while ticket is None:
+            if self._stop.is_set():
+                self._requeue(job)
+                return
+            ticket = self.admission.admit_background(
+                job.model_name, f"batch:{job.batch_id}", headroom=self.headroom, timeout=self.poll_seconds
+            )
+        try:
+            cleaned = dict(job.request)
+            cleaned['messages'] = get_context_manager().fit(cleaned).messages
+            cache = get_completion_cache()
+            lookup = cache.lookup(cleaned)
+            if lookup.hit:
+                raw = lookup.cached
+            else:
+                client = get_ollama_client()
+                raw = client.raw_chat(
+                    cleaned['model'], cleaned['messages'],
+                    temperature=cleaned.get('temperature', 0.7), top_p=cleaned.get('top_p', 0.9),
+                )
+                cache.store(lookup, raw)
+            response = get_ollama_client()._format_completion_response(raw)
+        except OllamaConnectionError as e:
+            # Backend outage: try again later, within the attempt budget.
+            if job.attempts < self.max_attempts:
+                logger.warning(f"Batch job {job.pk} will be retried: {e}")
+                self.retried += 1
+                self._requeue(job)
+                self._stop.wait(self.poll_seconds)
+            else:
+                self._finish(job.pk, job.batch_id, BatchJob.STATUS_FAILED, error=str(e))
+            return
+        except (OllamaError, ValidationError) as e:
+            self._finish(job.pk, job.batch_id, BatchJob.STATUS_FAILED, error=str(e))
+            return
+        finally:
+            ticket.release()
+        self._finish(job.pk, job.batch_id, BatchJob.STATUS_SUCCEEDED, response=response)
+
+    def _requeue(self, job: BatchJob) -> None:
+        BatchJob.objects.filter(pk=job.pk, worker=self.name, status=BatchJob.STATUS_RUNNING).update(
+            status=BatchJob.STATUS_QUEUED, worker='', heartbeat_at=None
+        )
+
+    def _finish(self, job_id: int, batch_id, status: str, response: Optional[Dict[str, Any]] = None,
+                error: str = '') -> None:
+        updated = BatchJob.objects.filter(pk=job_id, status=BatchJob.STATUS_RUNNING).update(
+            status=status, response=response, error=error, worker='', finished_at=timezone.now()
+        )
+        if not updated:
+            return
+        counter = 'succeeded_jobs' if status == BatchJob.STATUS_SUCCEEDED else 'failed_jobs'
+        Batch.objects.filter(pk=batch_id).update(**{counter: F(counter) + 1})
+        if status == BatchJob.STATUS_SUCCEEDED:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        finalize_batch(batch_id)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            running = len(self._running)
+        return {
+            "name": self.name,
+            "workers": self.workers if self._threads else 0,
+            "running": running,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+
+_pool: Optional[BatchWorkerPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_batch_pool() -> BatchWorkerPool:
+    """Return the process-wide batch worker pool built from settings (not started)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = BatchWorkerPool.from_settings()
+    return _pool
+
+
+def ensure_batch_workers() -> None:
+    """
+    Start this process's pool when ``CHAT_BATCH_WORKERS`` is set; cheap once started.
+
+    Called by the ASGI and WSGI entry points at startup.
+    """
+    if getattr(settings, 'CHAT_BATCH_WORKERS', 2) > 0:
+        get_batch_pool().start()
@@ -0,0 +1,83 @@
+"""
+Tools shipped with the backend; enable them by listing them in ``CHAT_TOOLS``.
+"""
+import ast
+import operator
+from datetime import datetime, timezone
+
+from .tools import tool
+
+MAX_EXPRESSION_LENGTH = 200
+MAX_EXPONENT = 100
+# Largest integer (about 1200 digits) any step of a calculation may produce.
+# Checked before multiplying or raising to a power: the tool's timeout cannot
+# stop a worker thread that is computing a huge power.
+MAX_INTEGER_BITS = 4096
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+
+@tool(description="Current date and time in UTC, in ISO 8601 format.")
+def current_time() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def _bits(value) -> int:
+    """Bits of an integer operand; floats are bounded by the float type itself."""
+    return abs(value).bit_length() if isinstance(value, int) else 0
+
+
+def _check_size(op: ast.operator, left, right) -> None:
+    """Reject an operation whose integer result would exceed MAX_INTEGER_BITS, before computing it."""
+    if isinstance(op, ast.Pow):
+        if abs(right) > MAX_EXPONENT:
+            raise ValueError(f"Exponents are limited to {MAX_EXPONENT}")
+        # |left| >= 2 ** (bits - 1), so the result has at least (bits - 1) * right bits
+        if isinstance(right, int) and right > 0 and (_bits(left) - 1) * right > MAX_INTEGER_BITS:
+            raise ValueError(f"Results are limited to {MAX_INTEGER_BITS}-bit integers")
+    elif isinstance(op, ast.Mult) and _bits(left) + _bits(right) > MAX_INTEGER_BITS + 1:
+        raise ValueError(f"Results are limited to {MAX_INTEGER_BITS}-bit integers")
+
+
+def _evaluate(node: ast.AST):
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body)
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        if _bits(node.value) > MAX_INTEGER_BITS:
+            raise ValueError(f"Numbers are limited to {MAX_INTEGER_BITS}-bit integers")
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+        left, right = _evaluate(node.left), _evaluate(node.right)
+        _check_size(node.op, left, right)
+        result = _BINARY_OPERATORS[type(node.op)](left, right)
+        if _bits(result) > MAX_INTEGER_BITS:
+            raise ValueError(f"Results are limited to {MAX_INTEGER_BITS}-bit integers")
+        return result
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+        return _UNARY_OPERATORS[type(node.op)](_evaluate(node.operand))
+    raise ValueError("Only numbers, + - * / // % ** and parentheses are allowed")
+
+
+@tool(
+    description="Evaluate an arithmetic expression with + - * / // % ** and parentheses.",
+    parameters={
+        "type": "object",
+        "properties": {"expression": {"type": "string", "description": "e.g. (3 + 4) * 2.5"}},
+        "required": ["expression"],
+    },
+    timeout=1.0,
+    idempotent=True,
+)
+def calculate(expression: str):
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise ValueError(f"Expressions are limited to {MAX_EXPRESSION_LENGTH} characters")
+    return _evaluate(ast.parse(expression, mode='eval'))
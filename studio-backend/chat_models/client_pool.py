@@ -0,0 +1,151 @@
+"""
+Process-wide registry of pooled Ollama HTTP clients.
+
+Every ``ollama.Client`` owns an httpx connection pool, so building one per
+request throws away keep-alive and adds TCP setup (plus SSL context loading)
+to every call. The registry hands out one shared client per base URL instead:
+
+- sync clients are shared by all threads (httpx.Client is thread-safe);
+- async clients are shared per event loop, because httpx.AsyncClient
+  connections are bound to the loop that opened them.
+
+Pool limits and timeouts come from the ``OLLAMA_POOL_*`` / ``OLLAMA_*_TIMEOUT``
+settings.
+"""
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Any, Dict, List, Optional
+
+import httpx
+import ollama
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = 'http://localhost:11434'
+
+
+def _pool_connections(client: Any) -> List[Any]:
+    """Return httpcore connections behind an ollama client (best effort)."""
+    try:
+        return list(client._client._transport._pool.connections)
+    except AttributeError:
+        return []
+
+
+class OllamaClientRegistry:
+    """Thread- and async-safe registry of ``ollama.Client`` / ``ollama.AsyncClient``."""
+
+    def __init__(
+        self,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        # Reads stay generous: a cold model load can take a while before the
+        # first byte, and streamed chunks may be spaced out on slow hardware.
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._lock = threading.Lock()
+        self._sync_clients: Dict[str, ollama.Client] = {}
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, ollama.AsyncClient]]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    @classmethod
+    def from_settings(cls) -> "OllamaClientRegistry":
+        max_connections = getattr(settings, 'OLLAMA_POOL_MAX_CONNECTIONS', 1000)
+        return cls(
+            # 0 means "no limit", which decouple cannot express as None
+            max_connections=max_connections or None,
+            max_keepalive_connections=getattr(settings, 'OLLAMA_POOL_MAX_KEEPALIVE', 100),
+            keepalive_expiry=getattr(settings, 'OLLAMA_POOL_KEEPALIVE_EXPIRY', 30.0),
+            connect_timeout=getattr(settings, 'OLLAMA_CONNECT_TIMEOUT', 5.0),
+            read_timeout=getattr(settings, 'OLLAMA_READ_TIMEOUT', 300.0),
+        )
+
+    @staticmethod
+    def normalize(base_url: Optional[str]) -> str:
+        return (base_url or getattr(settings, 'OLLAMA_BASE_URL', DEFAULT_BASE_URL)).rstrip('/')
+
+    def sync_client(self, base_url: Optional[str] = None) -> ollama.Client:
+        """Return the shared synchronous client for ``base_url``."""
+        base_url = self.normalize(base_url)
+        client = self._sync_clients.get(base_url)
+        if client is None:
+            with self._lock:
+                client = self._sync_clients.get(base_url)
+                if client is None:
+                    client = ollama.Client(host=base_url, limits=self.limits, timeout=self.timeout)
+                    self._sync_clients[base_url] = client
+        return client
+
+    def async_client(self, base_url: Optional[str] = None) -> ollama.AsyncClient:
+        """Return the shared async client for ``base_url`` on the running loop."""
+        base_url = self.normalize(base_url)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            per_loop = self._async_clients.setdefault(loop, {})
+            client = per_loop.get(base_url)
+            if client is None:
+                client = ollama.AsyncClient(host=base_url, limits=self.limits, timeout=self.timeout)
+                per_loop[base_url] = client
+        return client
+
+    def stats(self) -> Dict[str, Any]:
+        """Open/idle connection counts per pooled client."""
+        with self._lock:
+            pools = [('sync', url, client) for url, client in self._sync_clients.items()]
+            for per_loop in list(self._async_clients.values()):
+                pools.extend(('async', url, client) for url, client in per_loop.items())
+
+        entries = []
+        for kind, url, client in pools:
+            connections = _pool_connections(client)
+            idle = sum(1 for conn in connections if conn.is_idle())
+            entries.append({
+                "kind": kind,
+                "baseUrl": url,
+                "open": len(connections),
+                "idle": idle,
+                "active": len(connections) - idle,
+            })
+        return {
+            "maxConnections": self.limits.max_connections,
+            "maxKeepaliveConnections": self.limits.max_keepalive_connections,
+            "keepaliveExpiry": self.limits.keepalive_expiry,
+            "pools": entries,
+        }
+
+    def close(self) -> None:
+        """Close the sync pools (async pools close with their event loop)."""
+        with self._lock:
+            clients = list(self._sync_clients.values())
+            self._sync_clients.clear()
+        for client in clients:
+            try:
+                client._client.close()
+            except Exception as e:
+                logger.debug(f"Error closing Ollama client pool: {e}")
+
+
+_registry: Optional[OllamaClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_client_registry() -> OllamaClientRegistry:
+    """Return the process-wide registry, creating it from settings on first use."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = OllamaClientRegistry.from_settings()
+    return _registry
@@ -0,0 +1,451 @@
+"""
+Single-flight coalescing of identical concurrent chat generations.
+
+When several clients send the same request (model, messages, sampling options
+and tools, hashed with :func:`~chat_models.completion_cache.cache_key`) while a
+generation for it is still running, only the first opens an upstream Ollama
+stream. Its raw chunks are broadcast to every subscriber:
+
+- each subscriber has a bounded buffer (``CHAT_COALESCE_BUFFER_CHUNKS``), so
+  one slow client never stalls the producer or the other subscribers;
+- a subscriber whose buffer fills up, and a late joiner, catch up from the
+  flight's chunk history and then continue with the live tail.
+
+The upstream generation is driven by a producer thread (WSGI) or task (ASGI),
+not by any one request, and it is closed once every subscriber has gone.
+"""
+import asyncio
+import logging
+import queue
+import threading
+import weakref
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Set
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_EMPTY = object()
+
+
+class _Subscriber:
+    """Read position of one consumer within a flight."""
+
+    def __init__(self, position: int = 0, lagging: bool = False):
+        self.buffer: deque = deque()
+        self.position = position
+        # While lagging, chunks are read from the flight history instead of the buffer.
+        self.lagging = lagging
+        self.wakeup: Optional[asyncio.Event] = None
+
+
+class _Flight:
+    """State shared by the subscribers of one upstream generation."""
+
+    def __init__(self, key: str, buffer_size: int):
+        self.key = key
+        self.buffer_size = buffer_size
+        self.chunks: List[Dict[str, Any]] = []
+        self.subscribers: Set[_Subscriber] = set()
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        # Closed flights accept no new subscribers (finished or abandoned).
+        self.closed = False
+        self.on_finish: Optional[Callable[[], None]] = None
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> Optional[_Subscriber]:
+        with self._lock:
+            if self.closed:
+                return None
+            subscriber = _Subscriber(lagging=bool(self.chunks))
+            self.subscribers.add(subscriber)
+            return subscriber
+
+    def _unsubscribe(self, subscriber: _Subscriber) -> int:
+        """Detach ``subscriber`` (lock held); returns the number remaining."""
+        self.subscribers.discard(subscriber)
+        if not self.subscribers and not self.finished:
+            self.closed = True
+        return len(self.subscribers)
+
+    def _publish(self, chunk: Dict[str, Any]) -> bool:
+        """Record a chunk (lock held); returns False once nobody is listening."""
+        self.chunks.append(chunk)
+        for subscriber in self.subscribers:
+            if subscriber.lagging:
+                continue
+            if len(subscriber.buffer) < self.buffer_size:
+                subscriber.buffer.append(chunk)
+            else:
+                subscriber.lagging = True
+        return bool(self.subscribers)
+
+    def _finish(self, error: Optional[BaseException] = None) -> None:
+        self.finished = True
+        self.closed = True
+        self.error = error
+
+    def _next(self, subscriber: _Subscriber) -> Any:
+        """Next chunk for ``subscriber`` (lock held), or ``_EMPTY``."""
+        if subscriber.buffer:
+            subscriber.position += 1
+            return subscriber.buffer.popleft()
+        if subscriber.position < len(self.chunks):
+            chunk = self.chunks[subscriber.position]
+            subscriber.position += 1
+            if subscriber.position == len(self.chunks):
+                subscriber.lagging = False
+            return chunk
+        return _EMPTY
+
+
+class StreamFlight(_Flight):
+    """Flight driven by a producer thread, consumed by WSGI worker threads."""
+
+    def __init__(self, key: str, buffer_size: int, open_stream: Callable[[], Iterator[Dict[str, Any]]], on_done: Callable[["StreamFlight"], None]):
+        super().__init__(key, buffer_size)
+        self._cond = threading.Condition(self._lock)
+        self._open_stream = open_stream
+        self._on_done = on_done
+
+    def start(self) -> None:
+        threading.Thread(target=self._run, name=f"coalesce-{self.key[-8:]}", daemon=True).start()
+
+    def _run(self) -> None:
+        error = None
+        stream = None
+        try:
+            stream = self._open_stream()
+            for chunk in stream:
+                with self._cond:
+                    listening = self._publish(chunk)
+                    self._cond.notify_all()
+                if not listening:
+                    logger.info(f"Coalesced generation {self.key[-8:]} abandoned by all subscribers")
+                    break
+        except Exception as e:
+            error = e
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+            with self._cond:
+                self._finish(error)
+                self._cond.notify_all()
+            self._on_done(self)
+            if self.on_finish is not None:
+                self.on_finish()
+
+    def iterate(self, subscriber: _Subscriber) -> Iterator[Dict[str, Any]]:
+        try:
+            while True:
+                with self._cond:
+                    chunk = self._next(subscriber)
+                    while chunk is _EMPTY:
+                        if self.finished:
+                            if self.error is not None:
+                                raise self.error
+                            return
+                        self._cond.wait()
+                        chunk = self._next(subscriber)
+                yield chunk
+        finally:
+            with self._lock:
+                self._unsubscribe(subscriber)
+
+
+class AsyncStreamFlight(_Flight):
+    """Flight driven by a task on the event loop (ASGI path)."""
+
+    def __init__(self, key: str, buffer_size: int, open_stream: Callable[[], Any], on_done: Callable[["AsyncStreamFlight"], None]):
+        super().__init__(key, buffer_size)
+        self.loop = asyncio.get_running_loop()
+        self._open_stream = open_stream
+        self._on_done = on_done
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> Optional[_Subscriber]:
+        subscriber = super().subscribe()
+        if subscriber is not None:
+            subscriber.wakeup = asyncio.Event()
+        return subscriber
+
+    def start(self) -> None:
+        self._task = self.loop.create_task(self._run())
+
+    def _wake_all(self) -> None:
+        for subscriber in self.subscribers:
+            subscriber.wakeup.set()
+
+    async def _run(self) -> None:
+        error = None
+        stream = None
+        try:
+            stream = await self._open_stream()
+            async for chunk in stream:
+                with self._lock:
+                    self._publish(chunk)
+                    self._wake_all()
+        except asyncio.CancelledError:
+            logger.info(f"Coalesced generation {self.key[-8:]} abandoned by all subscribers")
+        except Exception as e:
+            error = e
+        finally:
+            aclose = getattr(stream, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+            with self._lock:
+                self._finish(error)
+                self._wake_all()
+            self._on_done(self)
+            if self.on_finish is not None:
+                self.on_finish()
+
+    async def iterate(self, subscriber: _Subscriber) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            while True:
+                with self._lock:
+                    chunk = self._next(subscriber)
+                    if chunk is _EMPTY:
+                        if self.finished:
+                            if self.error is not None:
+                                raise self.error
+                            return
+                        subscriber.wakeup.clear()
+                if chunk is _EMPTY:
+                    await subscriber.wakeup.wait()
+                    continue
+                yield chunk
+        finally:
+            with self._lock:
+                remaining = self._unsubscribe(subscriber)
+            if not remaining and self._task is not None and not self.finished:
+                self._task.cancel()
+
+
+class RequestCoalescer:
+    """Registry of in-flight generations keyed by request hash."""
+
+    def __init__(self, buffer_size: int = 256, enabled: bool = True):
+        self.buffer_size = buffer_size
+        self.enabled = enabled
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "RequestCoalescer":
+        return cls(
+            buffer_size=getattr(settings, 'CHAT_COALESCE_BUFFER_CHUNKS', 256),
+            enabled=getattr(settings, 'CHAT_COALESCE_ENABLED', True),
+        )
+
+    def _done(self, flight: _Flight) -> None:
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def join_or_none(self, key: str) -> Optional[Iterator[Dict[str, Any]]]:
+        """
+        Subscribe to the running generation for ``key``, or return None.
+
+        Checking and subscribing happen under one lock, so a generation that
+        ends meanwhile is never joined; on None the caller takes an admission
+        slot and starts one with :meth:`join`.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            flight = self._flights.get(key)
+            subscriber = flight.subscribe() if isinstance(flight, StreamFlight) else None
+        return None if subscriber is None else flight.iterate(subscriber)
+
+    def ajoin_or_none(self, key: str) -> Optional[AsyncIterator[Dict[str, Any]]]:
+        """Async counterpart of :meth:`join_or_none`. Must be called on the event loop."""
+        if not self.enabled:
+            return None
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._flights.get(key)
+            subscriber = None
+            if isinstance(flight, AsyncStreamFlight) and flight.loop is loop:
+                subscriber = flight.subscribe()
+        return None if subscriber is None else flight.iterate(subscriber)
+
+    def join(
+        self,
+        key: str,
+        open_stream: Callable[[], Iterator[Dict[str, Any]]],
+        on_finish: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Subscribe to the generation for ``key``, starting it with ``open_stream`` if needed.
+
+        Returns ``(stream, coalesced)`` where ``coalesced`` is True when the
+        request attached to a generation that was already running.
+        ``on_finish`` runs once the upstream generation this request started
+        ends (immediately if it joined an existing one).
+        """
+        if not self.enabled:
+            release = _Release(on_finish)
+            try:
+                stream = open_stream()
+            except BaseException:
+                release()
+                raise
+            return _release_when_collected(_finally(stream, release), release), False
+        with self._lock:
+            flight = self._flights.get(key)
+            subscriber = flight.subscribe() if isinstance(flight, StreamFlight) else None
+            if subscriber is None:
+                flight = StreamFlight(key, self.buffer_size, open_stream, self._done)
+                flight.on_finish = on_finish
+                subscriber = flight.subscribe()
+                self._flights[key] = flight
+                flight.start()
+                return flight.iterate(subscriber), False
+        if on_finish is not None:
+            on_finish()
+        return flight.iterate(subscriber), True
+
+    def ajoin(
+        self,
+        key: str,
+        open_stream: Callable[[], Any],
+        on_finish: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Async counterpart of :meth:`join`; ``open_stream`` is a coroutine
+        function returning an async iterator. Must be called on the event loop.
+        """
+        if not self.enabled:
+            release = _Release(on_finish)
+            return _release_when_collected(_adeferred(open_stream, release), release), False
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._flights.get(key)
+            subscriber = None
+            if isinstance(flight, AsyncStreamFlight) and flight.loop is loop:
+                subscriber = flight.subscribe()
+            if subscriber is None:
+                flight = AsyncStreamFlight(key, self.buffer_size, open_stream, self._done)
+                flight.on_finish = on_finish
+                subscriber = flight.subscribe()
+                self._flights[key] = flight
+                flight.start()
+                return flight.iterate(subscriber), False
+        if on_finish is not None:
+            on_finish()
+        return flight.iterate(subscriber), True
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+
+class _Release:
+    """
+    Runs ``on_finish`` once, however the stream holding it ends.
+
+    A generator that is never iterated (the client went away before the
+    first byte, or the view failed before returning the response) never
+    runs its ``finally``; see :func:`_release_when_collected`.
+    """
+
+    def __init__(self, on_finish: Optional[Callable[[], None]]):
+        self._on_finish = on_finish
+        self._lock = threading.Lock()
+
+    def __call__(self) -> None:
+        with self._lock:
+            on_finish, self._on_finish = self._on_finish, None
+        if on_finish is not None:
+            on_finish()
+
+
+# Releases of garbage-collected streams, run by the release thread
+_collected: "queue.SimpleQueue[_Release]" = queue.SimpleQueue()
+_release_thread: Optional[threading.Thread] = None
+_release_thread_lock = threading.Lock()
+
+
+def _run_collected() -> None:
+    while True:
+        release = _collected.get()
+        try:
+            release()
+        except Exception:
+            logger.exception("Releasing a collected stream failed")
+
+
+def _release_when_collected(stream, release: _Release):
+    """
+    Run ``release`` once ``stream`` is garbage collected, on the release thread.
+
+    The collector may run on a thread that already holds the lock
+    ``on_finish`` needs (the admission controller's, for one), so the
+    finalizer only queues the release: ``SimpleQueue.put`` is reentrant
+    and takes no lock that could deadlock. A stream that ended normally
+    was already released and the queued call is a no-op.
+    """
+    global _release_thread
+    if _release_thread is None:
+        with _release_thread_lock:
+            if _release_thread is None:
+                _release_thread = threading.Thread(target=_run_collected, name="coalesce-release", daemon=True)
+                _release_thread.start()
+    weakref.finalize(stream, _collected.put, release)
+    return stream
+
+
+def _finally(stream: Iterator[Dict[str, Any]], release: _Release) -> Iterator[Dict[str, Any]]:
+    try:
+        yield from stream
+    finally:
+        release()
+
+
+async def _adeferred(open_stream: Callable[[], Any], release: _Release) -> AsyncIterator[Dict[str, Any]]:
+    try:
+        async for chunk in await open_stream():
+            yield chunk
+    finally:
+        release()
+
+
+def collect(stream: Iterator[Dict[str, Any]]) -> Dict[str, Any]:
+    """Assemble a raw chunk stream into a non-streaming Ollama response."""
+    parts = []
+    for chunk in stream:
+        if chunk.get('done'):
+            response = dict(chunk)
+            response['message'] = {"role": "assistant", "content": "".join(parts)}
+            return response
+        parts.append(chunk.get('message', {}).get('content', ''))
+    raise RuntimeError("Ollama stream ended without a final chunk")
+
+
+async def acollect(stream: AsyncIterator[Dict[str, Any]]) -> Dict[str, Any]:
+    parts = []
+    async for chunk in stream:
+        if chunk.get('done'):
+            response = dict(chunk)
+            response['message'] = {"role": "assistant", "content": "".join(parts)}
+            return response
+        parts.append(chunk.get('message', {}).get('content', ''))
+    raise RuntimeError("Ollama stream ended without a final chunk")
+
+
+_coalescer: Optional[RequestCoalescer] = None
+_coalescer_lock = threading.Lock()
+
+
+def get_request_coalescer() -> RequestCoalescer:
+    """Return the process-wide request coalescer built from settings."""
+    global _coalescer
+    if _coalescer is None:
+        with _coalescer_lock:
+            if _coalescer is None:
+                _coalescer = RequestCoalescer.from_settings()
+    return _coalescer
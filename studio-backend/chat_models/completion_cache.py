@@ -0,0 +1,335 @@
+"""
+Exact-match response cache for deterministic chat completions.
+
+Requests are keyed on a canonical SHA-256 of the model, the normalized
+messages produced by ``ChatRequestValidator.validate_request`` and the
+sampling options. Only requests at or below ``CHAT_CACHE_MAX_TEMPERATURE``
+are cached, so sampled (non-deterministic) answers are never replayed.
+
+Entries hold a final Ollama-style response (``message``, ``prompt_eval_count``,
+``eval_count``, ...). Non-streaming hits are formatted like a live response;
+streaming hits are replayed as a synthetic raw Ollama stream so they go
+through the same Vercel data-stream framing as a live generation.
+
+Backends:
+- ``memory``: per-process LRU with TTL (``CHAT_CACHE_MAX_ENTRIES``,
+  ``CHAT_CACHE_TTL_SECONDS``).
+- ``django``: any configured Django cache alias (``CHAT_CACHE_ALIAS``), e.g.
+  Redis through django-redis, shared by every worker. Recency eviction is
+  left to the cache server (``maxmemory-policy allkeys-lru`` on Redis).
+
+With ``CHAT_SEMANTIC_CACHE_ENABLED`` an exact miss falls through to the
+semantic cache (see ``chat_models.semantic_cache``).
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'chatcache:v1:'
+
+# Values for the X-Completion-Cache response header / RequestLog.cache_status
+CACHE_HIT = 'hit'
+CACHE_SEMANTIC_HIT = 'semantic'
+CACHE_MISS = 'miss'
+CACHE_BYPASS = 'bypass'
+
+
+def cache_key(cleaned_data: Dict[str, Any]) -> str:
+    """Canonical hash of everything that determines a completion."""
+    canonical = json.dumps(
+        {
+            "model": cleaned_data['model'],
+            "messages": [
+                {"role": m["role"], "content": m["content"]}
+                for m in cleaned_data['messages']
+            ],
+            "options": {
+                "temperature": cleaned_data.get('temperature', 0.7),
+                "top_p": cleaned_data.get('top_p', 0.9),
+            },
+            "tools": cleaned_data.get('tools') or [],
+        },
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False,
+    )
+    return KEY_PREFIX + hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class InProcessCacheBackend:
+    """Thread-safe LRU cache with per-entry TTL."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.get(key)
+
+    async def aset(self, key: str, value: Dict[str, Any]) -> None:
+        self.set(key, value)
+
+
+class DjangoCacheBackend:
+    """Completion cache stored in a Django cache alias (e.g. django-redis)."""
+
+    def __init__(self, alias: str = 'default', ttl: float = 3600.0):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.cache.get(key)
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        self.cache.set(key, value, timeout=self.ttl)
+
+    async def aget(self, key: str) -> Optional[Dict[str, Any]]:
+        return await self.cache.aget(key)
+
+    async def aset(self, key: str, value: Dict[str, Any]) -> None:
+        await self.cache.aset(key, value, timeout=self.ttl)
+
+
+class CacheLookup:
+    """Outcome of a cache lookup, carried through to :meth:`CompletionCache.store`."""
+
+    def __init__(self, key: Optional[str], model: str = '', cached: Optional[Dict[str, Any]] = None,
+                 status: str = CACHE_BYPASS, semantic_probe: Any = None):
+        self.key = key
+        self.model = model
+        self.cached = cached
+        self.status = status
+        self.semantic_probe = semantic_probe
+
+    @property
+    def hit(self) -> bool:
+        return self.cached is not None
+
+
+class CompletionCache:
+    """Decides cacheability, looks up entries and records finished generations.
+
+    An optional :class:`~chat_models.semantic_cache.SemanticCache` is consulted
+    after an exact miss and fed every completed generation.
+    """
+
+    def __init__(self, backend, max_temperature: float = 0.0, enabled: bool = True, semantic=None):
+        self.backend = backend
+        self.max_temperature = max_temperature
+        self.enabled = enabled
+        self.semantic = semantic
+
+    @classmethod
+    def from_settings(cls) -> "CompletionCache":
+        ttl = getattr(settings, 'CHAT_CACHE_TTL_SECONDS', 3600.0)
+        if getattr(settings, 'CHAT_CACHE_BACKEND', 'memory') == 'django':
+            backend = DjangoCacheBackend(getattr(settings, 'CHAT_CACHE_ALIAS', 'default'), ttl=ttl)
+        else:
+            backend = InProcessCacheBackend(getattr(settings, 'CHAT_CACHE_MAX_ENTRIES', 1024), ttl=ttl)
+        semantic = None
+        if getattr(settings, 'CHAT_SEMANTIC_CACHE_ENABLED', False):
+            from .semantic_cache import SemanticCache
+            semantic = SemanticCache.from_settings()
+        return cls(
+            backend,
+            max_temperature=getattr(settings, 'CHAT_CACHE_MAX_TEMPERATURE', 0.0),
+            enabled=getattr(settings, 'CHAT_CACHE_ENABLED', True),
+            semantic=semantic,
+        )
+
+    def key_for(self, cleaned_data: Dict[str, Any]) -> Optional[str]:
+        """Cache key for a request, or ``None`` when it must not be cached."""
+        if not self.enabled or cleaned_data.get('temperature', 0.7) > self.max_temperature:
+            return None
+        return cache_key(cleaned_data)
+
+    def lookup(self, cleaned_data: Dict[str, Any]) -> CacheLookup:
+        """Exact lookup, then (if enabled) a semantic lookup on the final user turn."""
+        key = self.key_for(cleaned_data)
+        if key is None:
+            return CacheLookup(None)
+        model = cleaned_data['model']
+        try:
+            cached = self.backend.get(key)
+        except Exception as e:
+            # A broken cache must never fail the request.
+            logger.warning(f"Completion cache lookup failed: {e}")
+            cached = None
+        if cached is not None:
+            return CacheLookup(key, model, cached, CACHE_HIT)
+        if self.semantic is None:
+            return CacheLookup(key, model, None, CACHE_MISS)
+        try:
+            cached, probe = self.semantic.lookup(model, cleaned_data['messages'])
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return CacheLookup(key, model, None, CACHE_MISS)
+        return CacheLookup(key, model, cached, CACHE_SEMANTIC_HIT if cached is not None else CACHE_MISS, probe)
+
+    async def alookup(self, cleaned_data: Dict[str, Any]) -> CacheLookup:
+        """Async counterpart of :meth:`lookup`; embedding runs off the event loop."""
+        key = self.key_for(cleaned_data)
+        if key is None:
+            return CacheLookup(None)
+        model = cleaned_data['model']
+        try:
+            cached = await self.backend.aget(key)
+        except Exception as e:
+            logger.warning(f"Completion cache lookup failed: {e}")
+            cached = None
+        if cached is not None:
+            return CacheLookup(key, model, cached, CACHE_HIT)
+        if self.semantic is None:
+            return CacheLookup(key, model, None, CACHE_MISS)
+        try:
+            cached, probe = await sync_to_async(self.semantic.lookup, thread_sensitive=False)(
+                model, cleaned_data['messages']
+            )
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return CacheLookup(key, model, None, CACHE_MISS)
+        return CacheLookup(key, model, cached, CACHE_SEMANTIC_HIT if cached is not None else CACHE_MISS, probe)
+
+    def store(self, lookup: CacheLookup, response: Dict[str, Any]) -> None:
+        """Record a finished generation for a missed lookup."""
+        if lookup.key is None or lookup.hit or not response.get('done'):
+            return
+        value = _cacheable(response)
+        try:
+            self.backend.set(lookup.key, value)
+            if self.semantic is not None:
+                self.semantic.store(lookup.model, lookup.semantic_probe, value)
+        except Exception as e:
+            logger.warning(f"Completion cache store failed: {e}")
+
+    async def astore(self, lookup: CacheLookup, response: Dict[str, Any]) -> None:
+        if lookup.key is None or lookup.hit or not response.get('done'):
+            return
+        value = _cacheable(response)
+        try:
+            await self.backend.aset(lookup.key, value)
+            if self.semantic is not None:
+                self.semantic.store(lookup.model, lookup.semantic_probe, value)
+        except Exception as e:
+            logger.warning(f"Completion cache store failed: {e}")
+
+    # -- streaming -------------------------------------------------------
+
+    @staticmethod
+    def replay(cached: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Replay a cached response as a raw Ollama chat stream."""
+        yield from _replay_chunks(cached)
+
+    @staticmethod
+    async def areplay(cached: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        for chunk in _replay_chunks(cached):
+            yield chunk
+
+    def record_stream(self, lookup: CacheLookup, stream: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Pass a raw stream through, caching it once it finishes normally.
+
+        Closing this generator closes ``stream`` right away, which releases
+        the upstream generation.
+        """
+        parts = []
+        try:
+            for chunk in stream:
+                if lookup.key is not None:
+                    if chunk.get('done'):
+                        self.store(lookup, _assemble(chunk, parts))
+                    else:
+                        parts.append(chunk.get('message', {}).get('content', ''))
+                yield chunk
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+
+    async def arecord_stream(self, lookup: CacheLookup, stream: AsyncIterable[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """Async counterpart of :meth:`record_stream`."""
+        parts = []
+        try:
+            async for chunk in stream:
+                if lookup.key is not None:
+                    if chunk.get('done'):
+                        await self.astore(lookup, _assemble(chunk, parts))
+                    else:
+                        parts.append(chunk.get('message', {}).get('content', ''))
+                yield chunk
+        finally:
+            aclose = getattr(stream, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+
+def _cacheable(response: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep only the fields needed to rebuild a response."""
+    return {
+        "model": response.get("model", "unknown"),
+        "message": {"role": "assistant", "content": response.get("message", {}).get("content", "")},
+        "done": True,
+        "done_reason": response.get("done_reason", "stop"),
+        "prompt_eval_count": response.get("prompt_eval_count", 0),
+        "eval_count": response.get("eval_count", 0),
+    }
+
+
+def _assemble(final_chunk: Dict[str, Any], parts) -> Dict[str, Any]:
+    response = dict(final_chunk)
+    response["message"] = {"role": "assistant", "content": "".join(parts)}
+    return response
+
+
+def _replay_chunks(cached: Dict[str, Any]):
+    content = cached.get("message", {}).get("content", "")
+    if content:
+        yield {"model": cached.get("model"), "message": {"role": "assistant", "content": content}, "done": False}
+    final = dict(cached)
+    final["message"] = {"role": "assistant", "content": ""}
+    yield final
+
+
+_cache: Optional[CompletionCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_completion_cache() -> CompletionCache:
+    """Return the process-wide completion cache built from settings."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CompletionCache.from_settings()
+    return _cache
@@ -0,0 +1,366 @@
+"""
+Context-window-aware history trimming for chat completions.
+
+``ChatRequestValidator`` accepts up to 100 messages of 50,000 characters and
+Ollama silently truncates whatever does not fit its context window, after the
+whole prompt has been sent. :class:`ContextManager` fits the history into the
+model's window before the request goes upstream:
+
+- the window is the model's ``context_length`` from the cached ``show``
+  metadata (:meth:`ModelRegistry.context_length`), capped by
+  ``CHAT_CONTEXT_WINDOW_TOKENS`` (set it to the runners' ``num_ctx``), minus
+  ``CHAT_CONTEXT_RESERVE_TOKENS`` left for the completion;
+- message sizes come from :class:`TokenEstimator`, which caches its estimate
+  per message, so earlier turns that every request resends are only counted
+  once;
+- ``CHAT_CONTEXT_POLICY`` decides what happens over budget: ``recent`` keeps
+  the system messages and as many of the latest turns as fit, ``summarize``
+  also replaces the dropped turns with a summary of them, ``off`` forwards
+  everything.
+
+Summaries are produced in the background (``CHAT_CONTEXT_SUMMARY_WORKERS``)
+and never on the request path: the first over-budget turn of a conversation is
+trimmed, and schedules a summary of what was dropped. Later turns use it and
+extend it (previous summary plus the turns dropped since), so the summary
+rolls forward with the conversation. Summaries are stored per conversation
+fingerprint in the completion cache backend, keyed to a hash of the prefix
+they cover so edited histories never reuse them.
+
+Each fit reports the prompt tokens it kept out of the request; the views
+expose them as ``X-Context-Saved-Tokens`` for ``RequestLog``.
+"""
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .completion_cache import DjangoCacheBackend, InProcessCacheBackend
+from .router import CHARS_PER_TOKEN, conversation_fingerprint
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'chatctx:v1:'
+
+POLICY_OFF = 'off'
+POLICY_RECENT = 'recent'
+POLICY_SUMMARIZE = 'summarize'
+POLICIES = (POLICY_OFF, POLICY_RECENT, POLICY_SUMMARIZE)
+
+# Role markers and separators Ollama's chat templates add per message.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Messages shorter than this are cheaper to estimate than to look up.
+MIN_CACHED_CHARS = 256
+
+# BPE vocabularies split text into short word pieces and single punctuation
+# marks; counting those tracks real token counts far better than characters
+# for code and non-English text.
+_TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_INSTRUCTIONS = (
+    "You summarize conversations between a user and an assistant. Write a concise summary of the "
+    "transcript below that keeps every fact, decision, name, number and open question needed to "
+    "continue the conversation. Reply with the summary only."
+)
+
+
+class TokenEstimator:
+    """Token estimates per message, cached by content."""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def estimate_text(text: str) -> int:
+        return len(_TOKEN_RE.findall(text))
+
+    def estimate(self, message: Dict[str, Any]) -> int:
+        content = message.get("content") or ""
+        if len(content) < MIN_CACHED_CHARS or not self.max_entries:
+            return self.estimate_text(content) + MESSAGE_OVERHEAD_TOKENS
+        with self._lock:
+            tokens = self._cache.get(content)
+            if tokens is not None:
+                self._cache.move_to_end(content)
+                self.hits += 1
+                return tokens + MESSAGE_OVERHEAD_TOKENS
+        tokens = self.estimate_text(content)
+        with self._lock:
+            self.misses += 1
+            self._cache[content] = tokens
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextFit:
+    """Outcome of :meth:`ContextManager.fit`."""
+
+    def __init__(self, messages: List[Dict[str, Any]], prompt_tokens: int, saved_tokens: int = 0,
+                 dropped: int = 0, summarized: bool = False):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.saved_tokens = saved_tokens
+        self.dropped = dropped
+        self.summarized = summarized
+
+
+def prefix_hash(messages: List[Dict[str, Any]]) -> str:
+    """Hash of a message prefix, identifying the history a summary covers."""
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(message["role"].encode('utf-8') + b'\0')
+        digest.update(message.get("content", "").encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+class ContextManager:
+    """Fits chat histories into the model's context window."""
+
+    def __init__(
+        self,
+        policy: str = POLICY_RECENT,
+        window_tokens: int = 0,
+        reserve_tokens: int = 1024,
+        estimator: Optional[TokenEstimator] = None,
+        summary_store=None,
+        summary_model: str = '',
+        summary_workers: int = 1,
+        summary_queue_size: int = 32,
+        context_length=None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"CHAT_CONTEXT_POLICY must be one of {', '.join(POLICIES)}, not '{policy}'")
+        self.policy = policy
+        self.window_tokens = window_tokens
+        self.reserve_tokens = reserve_tokens
+        self.estimator = estimator or TokenEstimator()
+        self.summary_store = summary_store or InProcessCacheBackend()
+        self.summary_model = summary_model
+        self.summary_queue_size = summary_queue_size
+        self._context_length = context_length or _registry_context_length
+        self._executor = ThreadPoolExecutor(max_workers=max(summary_workers, 1), thread_name_prefix='context-summary')
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stats = {"fitted": 0, "trimmed": 0, "summarized": 0, "savedTokens": 0,
+                       "summariesWritten": 0, "summaryFailures": 0}
+
+    @classmethod
+    def from_settings(cls) -> "ContextManager":
+        ttl = getattr(settings, 'CHAT_CONTEXT_SUMMARY_TTL_SECONDS', 86400.0)
+        if getattr(settings, 'CHAT_CACHE_BACKEND', 'memory') == 'django':
+            store = DjangoCacheBackend(getattr(settings, 'CHAT_CACHE_ALIAS', 'default'), ttl=ttl)
+        else:
+            store = InProcessCacheBackend(getattr(settings, 'CHAT_CACHE_MAX_ENTRIES', 1024), ttl=ttl)
+        return cls(
+            policy=getattr(settings, 'CHAT_CONTEXT_POLICY', POLICY_RECENT),
+            window_tokens=getattr(settings, 'CHAT_CONTEXT_WINDOW_TOKENS', 0),
+            reserve_tokens=getattr(settings, 'CHAT_CONTEXT_RESERVE_TOKENS', 1024),
+            estimator=TokenEstimator(getattr(settings, 'CHAT_CONTEXT_ESTIMATE_CACHE_SIZE', 4096)),
+            summary_store=store,
+            summary_model=getattr(settings, 'CHAT_CONTEXT_SUMMARY_MODEL', ''),
+            summary_workers=getattr(settings, 'CHAT_CONTEXT_SUMMARY_WORKERS', 1),
+            summary_queue_size=getattr(settings, 'CHAT_CONTEXT_SUMMARY_QUEUE_SIZE', 32),
+        )
+
+    def budget(self, model: str) -> Optional[int]:
+        """Prompt tokens available to ``model``, or None when its window is unknown."""
+        window = self._context_length(model)
+        if self.window_tokens:
+            window = min(window, self.window_tokens) if window else self.window_tokens
+        if not window:
+            return None
+        return max(window - self.reserve_tokens, 0)
+
+    # -- fitting ---------------------------------------------------------
+
+    def fit(self, cleaned_data: Dict[str, Any]) -> ContextFit:
+        """Trim (or summarize) ``cleaned_data['messages']`` to the model's budget."""
+        messages = cleaned_data['messages']
+        if self.policy == POLICY_OFF:
+            return ContextFit(messages, 0)
+        model = cleaned_data['model']
+        budget = self.budget(model)
+        sizes = [self.estimator.estimate(message) for message in messages]
+        total = sum(sizes)
+        self._count("fitted")
+        if budget is None or total <= budget:
+            return ContextFit(messages, total)
+
+        summary = None
+        fingerprint = None
+        if self.policy == POLICY_SUMMARIZE:
+            fingerprint = conversation_fingerprint(model, messages)
+            summary = self._load_summary(fingerprint, messages)
+        cut = self._cut(messages, sizes, budget - (summary["tokens"] if summary else 0))
+        if summary is not None and summary["upto"] > cut:
+            # The summary reaches into turns that still fit verbatim.
+            summary = None
+            cut = self._cut(messages, sizes, budget)
+
+        kept = [m for i, m in enumerate(messages) if i >= cut or m["role"] == "system"]
+        prompt_tokens = sum(size for i, size in enumerate(sizes) if i >= cut or messages[i]["role"] == "system")
+        if summary is not None:
+            position = next((i for i, m in enumerate(kept) if m["role"] != "system"), len(kept))
+            kept.insert(position, {"role": "system", "content": SUMMARY_PREFIX + summary["summary"]})
+            prompt_tokens += summary["tokens"]
+        if fingerprint is not None and cut > (summary["upto"] if summary else 0):
+            self._schedule_summary(model, fingerprint, messages[:cut], summary)
+
+        saved = max(total - prompt_tokens, 0)
+        self._count("trimmed")
+        self._count("savedTokens", saved)
+        if summary is not None:
+            self._count("summarized")
+        fit = ContextFit(kept, prompt_tokens, saved, len(messages) - len(kept) + (1 if summary else 0), summary is not None)
+        logger.info(
+            f"Context for {model}: {total} -> {prompt_tokens} estimated prompt tokens (budget {budget}), "
+            f"dropped {fit.dropped} messages{' behind a summary' if fit.summarized else ''}"
+        )
+        return fit
+
+    async def afit(self, cleaned_data: Dict[str, Any]) -> ContextFit:
+        """Async counterpart of :meth:`fit`; estimating long histories runs off the event loop."""
+        if self.policy == POLICY_OFF:
+            return ContextFit(cleaned_data['messages'], 0)
+        return await sync_to_async(self.fit, thread_sensitive=False)(cleaned_data)
+
+    @staticmethod
+    def _cut(messages: List[Dict[str, Any]], sizes: List[int], budget: int) -> int:
+        """
+        Index of the oldest non-system message kept.
+
+        System messages are always kept and the latest message even when it
+        alone exceeds the budget; the kept history never opens on an
+        assistant turn.
+        """
+        available = budget - sum(size for m, size in zip(messages, sizes) if m["role"] == "system")
+        cut = len(messages)
+        used = 0
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i]["role"] == "system":
+                continue
+            if cut < len(messages) and used + sizes[i] > available:
+                break
+            used += sizes[i]
+            cut = i
+        while cut < len(messages) - 1 and messages[cut]["role"] == "assistant":
+            cut += 1
+        return cut
+
+    # -- summaries -------------------------------------------------------
+
+    def _load_summary(self, fingerprint: Optional[str], messages: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if fingerprint is None:
+            return None
+        try:
+            summary = self.summary_store.get(KEY_PREFIX + fingerprint)
+        except Exception as e:
+            logger.warning(f"Context summary lookup failed: {e}")
+            return None
+        if not summary or summary["upto"] >= len(messages):
+            return None
+        if summary["prefix"] != prefix_hash(messages[:summary["upto"]]):
+            return None
+        return summary
+
+    def _schedule_summary(self, model: str, fingerprint: str, dropped: List[Dict[str, Any]],
+                          previous: Optional[Dict[str, Any]]) -> None:
+        job = (fingerprint, len(dropped))
+        with self._lock:
+            if job in self._pending or len(self._pending) >= self.summary_queue_size:
+                return
+            self._pending.add(job)
+        self._executor.submit(self._summarize, job, model, fingerprint, dropped, previous)
+
+    def _summarize(self, job, model: str, fingerprint: str, dropped: List[Dict[str, Any]],
+                   previous: Optional[Dict[str, Any]]) -> None:
+        from .ollama_client import get_ollama_client
+
+        try:
+            start = previous["upto"] if previous else 0
+            transcript = "\n\n".join(
+                f"{m['role']}: {m['content']}" for m in dropped[start:] if m["role"] != "system"
+            )
+            if previous:
+                transcript = f"Summary so far:\n{previous['summary']}\n\nLater turns:\n{transcript}"
+            summary_model = self.summary_model or model
+            budget = self.budget(summary_model)
+            if budget and len(transcript) > budget * CHARS_PER_TOKEN:
+                transcript = transcript[-budget * CHARS_PER_TOKEN:]
+            response = get_ollama_client().raw_chat(
+                summary_model,
+                [{"role": "system", "content": SUMMARY_INSTRUCTIONS}, {"role": "user", "content": transcript}],
+                temperature=0.2,
+            )
+            text = (response.get("message") or {}).get("content", "").strip()
+            if not text:
+                return
+            self.summary_store.set(KEY_PREFIX + fingerprint, {
+                "upto": len(dropped),
+                "prefix": prefix_hash(dropped),
+                "summary": text,
+                "tokens": self.estimator.estimate({"content": SUMMARY_PREFIX + text}),
+            })
+            self._count("summariesWritten")
+            logger.debug(f"Summarized {len(dropped)} messages of conversation {fingerprint[:12]}")
+        except Exception as e:
+            self._count("summaryFailures")
+            logger.warning(f"Context summary for {model} failed: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(job)
+
+    # -- stats -----------------------------------------------------------
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pendingSummaries"] = len(self._pending)
+        stats["policy"] = self.policy
+        stats["estimateCacheHits"] = self.estimator.hits
+        stats["estimateCacheMisses"] = self.estimator.misses
+        return stats
+
+
+def _registry_context_length(model: str) -> Optional[int]:
+    from .model_registry import get_model_registry
+    return get_model_registry().context_length(model)
+
+
+def apply_context_headers(response, fit: Optional[ContextFit]):
+    """Report prompt tokens kept out of the request; RequestLoggingMiddleware records them."""
+    if fit is not None and fit.saved_tokens:
+        response['X-Context-Saved-Tokens'] = str(fit.saved_tokens)
+        if fit.summarized:
+            response['X-Context-Summary'] = 'true'
+    return response
+
+
+_manager: Optional[ContextManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_context_manager() -> ContextManager:
+    """Return the process-wide context manager built from settings."""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ContextManager.from_settings()
+    return _manager
@@ -0,0 +1,230 @@
+"""
+Server-side conversation store for delta-only chat requests.
+
+Without it every turn re-uploads, and ``ChatRequestValidator`` re-validates,
+the whole conversation. With it a client:
+
+1. sends the first turn with ``"store": true``; the response carries the new
+   conversation's id in ``X-Conversation-Id``;
+2. continues with ``"conversationId": <id>`` and only the new message(s).
+
+Only the new messages are validated; the stored history was validated when
+it was first sent. The history is served from a cache (the completion cache
+backend, ``CHAT_CONVERSATION_CACHE_TTL_SECONDS``) and falls back to the
+database. The new messages and the assistant reply are appended together
+once the generation finishes, so a failed or cancelled turn leaves the
+history untouched.
+
+Message bodies are stored content-addressed (:class:`MessageContent`, keyed
+by SHA-256), so system prompts and repeated messages are stored once.
+Conversations belong to the user who created them; anonymous conversations
+can be continued by anyone holding their id.
+"""
+import logging
+import threading
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .completion_cache import DjangoCacheBackend, InProcessCacheBackend
+from .models import Conversation, Message, MessageContent, content_digest
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'chatconv:v1:'
+
+
+class ConversationNotFound(Exception):
+    """The conversation does not exist or belongs to another user."""
+
+
+class ConversationTurn:
+    """
+    One request against a stored conversation.
+
+    ``messages`` is the full history to send; ``new_messages`` (plus the
+    reply) is what gets appended once the generation finishes.
+    """
+
+    def __init__(self, store: "ConversationStore", conversation_id: str, user_id: Optional[int],
+                 history: List[Dict[str, str]], new_messages: List[Dict[str, str]], created: bool = False):
+        self.store = store
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.history = history
+        self.new_messages = new_messages
+        self.created = created
+
+    @property
+    def messages(self) -> List[Dict[str, str]]:
+        return self.history + self.new_messages
+
+    def commit(self, response: Dict[str, Any]) -> None:
+        """Append this turn's messages and the finished reply."""
+        if not response.get('done'):
+            return
+        reply = {"role": "assistant", "content": (response.get('message') or {}).get('content', '')}
+        self.store.append(self, self.new_messages + [reply])
+
+    async def acommit(self, response: Dict[str, Any]) -> None:
+        await sync_to_async(self.commit)(response)
+
+    def record_stream(self, stream: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Pass a raw stream through, committing the reply once it finishes normally.
+
+        Closing this generator closes ``stream`` right away, which releases
+        the upstream generation; the turn is then not stored.
+        """
+        parts = []
+        try:
+            for chunk in stream:
+                if chunk.get('done'):
+                    self.commit({**chunk, "message": {"content": "".join(parts)}})
+                else:
+                    parts.append(chunk.get('message', {}).get('content', ''))
+                yield chunk
+        finally:
+            close = getattr(stream, 'close', None)
+            if close is not None:
+                close()
+
+    async def arecord_stream(self, stream: AsyncIterable[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """Async counterpart of :meth:`record_stream`."""
+        parts = []
+        try:
+            async for chunk in stream:
+                if chunk.get('done'):
+                    await self.acommit({**chunk, "message": {"content": "".join(parts)}})
+                else:
+                    parts.append(chunk.get('message', {}).get('content', ''))
+                yield chunk
+        finally:
+            aclose = getattr(stream, 'aclose', None)
+            if aclose is not None:
+                await aclose()
+
+
+class ConversationStore:
+    """Loads, caches and appends stored conversations."""
+
+    def __init__(self, cache, enabled: bool = True):
+        self.cache = cache
+        self.enabled = enabled
+
+    @classmethod
+    def from_settings(cls) -> "ConversationStore":
+        ttl = getattr(settings, 'CHAT_CONVERSATION_CACHE_TTL_SECONDS', 3600.0)
+        if getattr(settings, 'CHAT_CACHE_BACKEND', 'memory') == 'django':
+            cache = DjangoCacheBackend(getattr(settings, 'CHAT_CACHE_ALIAS', 'default'), ttl=ttl)
+        else:
+            cache = InProcessCacheBackend(getattr(settings, 'CHAT_CONVERSATION_CACHE_SIZE', 1024), ttl=ttl)
+        return cls(cache, enabled=getattr(settings, 'CHAT_CONVERSATIONS_ENABLED', True))
+
+    def resolve(self, user, cleaned_data: Dict[str, Any]) -> Optional[ConversationTurn]:
+        """
+        The turn a request continues or starts, or None for a stateless request.
+
+        Raises:
+            ConversationNotFound: unknown id, or a conversation of another user
+            ValidationError: conversations are disabled
+        """
+        conversation_id = cleaned_data.get('conversation_id')
+        if not conversation_id and not cleaned_data.get('store'):
+            return None
+        if not self.enabled:
+            raise ValidationError("Conversation storage is disabled")
+        user_id = user.pk if user is not None and user.is_authenticated else None
+        if conversation_id:
+            history = self.history(conversation_id, user_id)
+            return ConversationTurn(self, conversation_id, user_id, history, cleaned_data['messages'])
+
+        conversation = Conversation.objects.create(user_id=user_id, model_name=cleaned_data['model'])
+        return ConversationTurn(self, str(conversation.id), user_id, [], cleaned_data['messages'], created=True)
+
+    async def aresolve(self, user, cleaned_data: Dict[str, Any]) -> Optional[ConversationTurn]:
+        if not cleaned_data.get('conversation_id') and not cleaned_data.get('store'):
+            return None
+        return await sync_to_async(self.resolve)(user, cleaned_data)
+
+    def history(self, conversation_id: str, user_id: Optional[int]) -> List[Dict[str, str]]:
+        """Validated history of a conversation, from the cache when possible."""
+        try:
+            cached = self.cache.get(KEY_PREFIX + conversation_id)
+        except Exception as e:
+            logger.warning(f"Conversation cache lookup failed: {e}")
+            cached = None
+        if cached is not None:
+            if cached['user_id'] != user_id:
+                raise ConversationNotFound(f"Conversation '{conversation_id}' not found")
+            return list(cached['messages'])
+
+        conversation = Conversation.objects.filter(pk=conversation_id).only('user_id').first()
+        if conversation is None or conversation.user_id != user_id:
+            raise ConversationNotFound(f"Conversation '{conversation_id}' not found")
+        messages = [
+            {"role": role, "content": content}
+            for role, content in conversation.messages.order_by('position').values_list('role', 'content__content')
+        ]
+        self._cache(conversation_id, user_id, messages)
+        return messages
+
+    def append(self, turn: ConversationTurn, messages: List[Dict[str, str]]) -> None:
+        """Store ``messages`` after the turn's history; a concurrent turn that got there first wins."""
+        digests = [content_digest(m['content']) for m in messages]
+        start = len(turn.history)
+        try:
+            with transaction.atomic():
+                MessageContent.objects.bulk_create(
+                    [MessageContent(digest=d, content=m['content']) for d, m in zip(digests, messages)],
+                    ignore_conflicts=True,
+                )
+                Message.objects.bulk_create([
+                    Message(conversation_id=turn.conversation_id, position=start + i, role=m['role'], content_id=d)
+                    for i, (d, m) in enumerate(zip(digests, messages))
+                ])
+                Conversation.objects.filter(pk=turn.conversation_id).update(
+                    message_count=F('message_count') + len(messages),
+                    updated_at=timezone.now(),
+                )
+        except IntegrityError:
+            logger.warning(f"Conversation {turn.conversation_id} was extended concurrently; dropping this turn")
+            return
+        except Exception as e:
+            logger.error(f"Failed to store conversation {turn.conversation_id}: {e}")
+            return
+        turn.history = turn.history + messages
+        turn.new_messages = []
+        self._cache(turn.conversation_id, turn.user_id, turn.history)
+
+    def _cache(self, conversation_id: str, user_id: Optional[int], messages: List[Dict[str, str]]) -> None:
+        try:
+            self.cache.set(KEY_PREFIX + conversation_id, {"user_id": user_id, "messages": messages})
+        except Exception as e:
+            logger.warning(f"Conversation cache store failed: {e}")
+
+
+def apply_conversation_headers(response, turn: Optional[ConversationTurn]):
+    """Tell the client which conversation to continue."""
+    if turn is not None:
+        response['X-Conversation-Id'] = turn.conversation_id
+    return response
+
+
+_store: Optional[ConversationStore] = None
+_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    """Return the process-wide conversation store built from settings."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ConversationStore.from_settings()
+    return _store
@@ -0,0 +1,244 @@
+"""
+Embeddings with server-side micro-batching.
+
+Retrieval jobs embed one text per request, and Ollama serves every
+``/api/embed`` call as a separate model invocation. :class:`EmbeddingBatcher`
+merges concurrent requests for the same model into one upstream call:
+
+- the first request for a model opens a batch and waits up to
+  ``CHAT_EMBEDDINGS_BATCH_WINDOW_MS`` for others to join it; a batch that
+  reaches ``CHAT_EMBEDDINGS_MAX_BATCH`` inputs is sent at once. A request is
+  delayed by at most the window, and only while the batch is open;
+- requests with ``CHAT_EMBEDDINGS_MAX_BATCH`` inputs or more go upstream on
+  their own, they are already a batch;
+- identical texts within a batch are embedded once;
+- vectors are kept as float32 in an LRU keyed by model and input hash
+  (``CHAT_EMBEDDINGS_CACHE_SIZE`` vectors), so re-embedded chunks of a
+  corpus cost no upstream work.
+
+Vectors are returned as float32 arrays and encoded either as JSON numbers in
+their shortest float32 form (about half the size of float64 reprs) or, with
+``encoding_format=base64``, as little-endian float32 bytes.
+"""
+import base64
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .completion_cache import InProcessCacheBackend
+from .context import TokenEstimator
+
+logger = logging.getLogger(__name__)
+
+EmbedFn = Callable[[str, List[str]], Sequence[Sequence[float]]]
+
+# Values for the X-Embedding-Cache response header / RequestLog.cache_status
+CACHE_HIT = 'hit'
+CACHE_PARTIAL = 'partial'
+CACHE_MISS = 'miss'
+
+
+def input_key(model: str, text: str) -> str:
+    return model + ':' + hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class EmbeddingResult:
+    """Vectors of one request, in input order."""
+
+    def __init__(self, model: str, vectors: np.ndarray, prompt_tokens: int, cached: int):
+        self.model = model
+        self.vectors = vectors
+        self.prompt_tokens = prompt_tokens
+        self.cached = cached
+
+    @property
+    def cache_status(self) -> str:
+        if self.cached == len(self.vectors):
+            return CACHE_HIT
+        return CACHE_PARTIAL if self.cached else CACHE_MISS
+
+    def to_json(self, encoding_format: str = 'float') -> bytes:
+        """OpenAI-compatible response body, encoded without a float64 round trip."""
+        if encoding_format == 'base64':
+            encoded = [
+                '"' + base64.b64encode(row.astype('<f4').tobytes()).decode('ascii') + '"'
+                for row in self.vectors
+            ]
+        else:
+            # str() of a float32 is its shortest round-tripping decimal form
+            encoded = ['[' + ','.join(map(str, row)) + ']' for row in self.vectors]
+        data = ','.join(
+            f'{{"object":"embedding","index":{i},"embedding":{vector}}}'
+            for i, vector in enumerate(encoded)
+        )
+        return (
+            f'{{"object":"list","data":[{data}],"model":"{self.model}",'
+            f'"usage":{{"prompt_tokens":{self.prompt_tokens},"total_tokens":{self.prompt_tokens}}}}}'
+        ).encode('utf-8')
+
+
+class _Batch:
+    """Inputs collected for one upstream call."""
+
+    def __init__(self):
+        self.texts: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.waiters: List[Tuple[List[int], Future]] = []
+        self.full = threading.Event()
+
+    def add(self, texts: List[str]) -> Future:
+        rows = []
+        for text in texts:
+            row = self.index.get(text)
+            if row is None:
+                row = self.index[text] = len(self.texts)
+                self.texts.append(text)
+            rows.append(row)
+        future: Future = Future()
+        self.waiters.append((rows, future))
+        return future
+
+
+class EmbeddingBatcher:
+    """Merges concurrent embedding requests per model into upstream batches."""
+
+    def __init__(self, embed_fn: EmbedFn, window_ms: float = 5.0, max_batch: int = 64,
+                 cache_size: int = 8192, cache_ttl: float = 86400.0):
+        self.embed_fn = embed_fn
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.cache = InProcessCacheBackend(cache_size, ttl=cache_ttl) if cache_size else None
+        self._pending: Dict[str, _Batch] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.inputs = 0
+        self.cache_hits = 0
+        self.upstream_calls = 0
+        self.upstream_inputs = 0
+        self.merged_batches = 0
+
+    @classmethod
+    def from_settings(cls) -> "EmbeddingBatcher":
+        from .ollama_client import get_ollama_client
+
+        return cls(
+            embed_fn=lambda model, texts: get_ollama_client().embed(model, texts),
+            window_ms=getattr(settings, 'CHAT_EMBEDDINGS_BATCH_WINDOW_MS', 5.0),
+            max_batch=getattr(settings, 'CHAT_EMBEDDINGS_MAX_BATCH', 64),
+            cache_size=getattr(settings, 'CHAT_EMBEDDINGS_CACHE_SIZE', 8192),
+            cache_ttl=getattr(settings, 'CHAT_EMBEDDINGS_CACHE_TTL_SECONDS', 86400.0),
+        )
+
+    def embed(self, model: str, texts: List[str]) -> EmbeddingResult:
+        """
+        Embed ``texts`` with ``model``, joining other requests' upstream batch.
+
+        Raises:
+            OllamaError: the upstream call failed (for every request in the batch)
+        """
+        vectors: List[Optional[np.ndarray]] = [None] * len(texts)
+        keys = [input_key(model, text) for text in texts]
+        if self.cache is not None:
+            for i, key in enumerate(keys):
+                vectors[i] = self.cache.get(key)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        cached = len(texts) - len(missing)
+
+        if missing:
+            fresh = self._embed_uncached(model, [texts[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                vectors[i] = vector
+                if self.cache is not None:
+                    self.cache.set(keys[i], vector)
+
+        with self._lock:
+            self.requests += 1
+            self.inputs += len(texts)
+            self.cache_hits += cached
+        prompt_tokens = sum(TokenEstimator.estimate_text(text) for text in texts)
+        return EmbeddingResult(model, np.vstack(vectors), prompt_tokens, cached)
+
+    async def aembed(self, model: str, texts: List[str]) -> EmbeddingResult:
+        # Off the event loop, on a thread of its own so concurrent requests can meet in a batch
+        return await sync_to_async(self.embed, thread_sensitive=False)(model, texts)
+
+    def _embed_uncached(self, model: str, texts: List[str]) -> np.ndarray:
+        if len(texts) >= self.max_batch or self.window <= 0:
+            return self._call(model, texts)
+
+        with self._lock:
+            batch = self._pending.get(model)
+            leader = batch is None
+            if leader:
+                batch = self._pending[model] = _Batch()
+            future = batch.add(texts)
+            if len(batch.texts) >= self.max_batch:
+                del self._pending[model]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._pending.get(model) is batch:
+                    del self._pending[model]
+            self._flush(model, batch)
+        return future.result()
+
+    def _flush(self, model: str, batch: _Batch) -> None:
+        try:
+            vectors = self._call(model, batch.texts)
+        except Exception as e:
+            for _, future in batch.waiters:
+                future.set_exception(e)
+            return
+        if len(batch.waiters) > 1:
+            with self._lock:
+                self.merged_batches += 1
+        for rows, future in batch.waiters:
+            future.set_result(vectors[rows])
+
+    def _call(self, model: str, texts: List[str]) -> np.ndarray:
+        vectors = np.asarray(self.embed_fn(model, texts), dtype=np.float32)
+        with self._lock:
+            self.upstream_calls += 1
+            self.upstream_inputs += len(texts)
+        return vectors
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "inputs": self.inputs,
+                "cacheHits": self.cache_hits,
+                "upstreamCalls": self.upstream_calls,
+                "upstreamInputs": self.upstream_inputs,
+                "mergedBatches": self.merged_batches,
+                "meanBatchSize": round(self.upstream_inputs / self.upstream_calls, 2) if self.upstream_calls else 0.0,
+            }
+
+
+def apply_embedding_headers(response, result: EmbeddingResult):
+    """Expose model, usage and cache outcome; RequestLoggingMiddleware records them."""
+    response['X-Embedding-Cache'] = result.cache_status
+    response['X-Embedding-Tokens'] = str(result.prompt_tokens)
+    return response
+
+
+_batcher: Optional[EmbeddingBatcher] = None
+_batcher_lock = threading.Lock()
+
+
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """Return the process-wide embedding batcher built from settings."""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = EmbeddingBatcher.from_settings()
+    return _batcher
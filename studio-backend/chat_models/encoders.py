@@ -0,0 +1,286 @@
+"""
+Wire protocols for streamed chat completions.
+
+A :class:`StreamEncoder` turns the raw Ollama chunks of one generation into
+the bytes of one streaming response:
+
+- ``vercel``: Vercel AI SDK data stream v1 (the default, used by ``useChat``);
+- ``openai``: OpenAI-compatible server-sent events (``data: {...}`` frames,
+  ``data: [DONE]``), with a trailing usage chunk when the request sets
+  ``stream_options.include_usage``;
+- ``ndjson``: Ollama-style newline-delimited JSON chunks.
+
+Clients pick one with the ``streamProtocol`` request field, the
+``X-Stream-Protocol`` header or, failing those, the ``Accept`` header
+(``text/event-stream`` or ``application/x-ndjson``). Everything that is
+constant for a stream (ids, timestamps, model name) is encoded once when the
+encoder is created, so a text delta costs one string escape and two byte
+concatenations. Register additional protocols with :func:`register_encoder`.
+
+Requests with ``n > 1`` stream several choices interleaved; the ``choice_*``
+methods encode a part of one choice, and :meth:`StreamEncoder.choices_finish`
+the aggregated usage once every choice has finished.
+"""
+import json
+import time
+import uuid
+from json.encoder import encode_basestring_ascii
+from typing import Any, Dict, Optional, Type
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+DEFAULT_PROTOCOL = 'vercel'
+
+_ACCEPT_PROTOCOLS = {
+    'text/event-stream': 'openai',
+    'application/x-ndjson': 'ndjson',
+}
+
+
+def _quote(text: str) -> bytes:
+    """JSON string literal for ``text``, as ``json.dumps`` would write it."""
+    return encode_basestring_ascii(text).encode('ascii')
+
+
+def _dumps(value: Any) -> bytes:
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+class StreamEncoder:
+    """Encodes one streamed generation; create one per response."""
+
+    name = ''
+    content_type = 'text/plain'
+    headers: Dict[str, str] = {}
+
+    def __init__(self, model: str = '', include_usage: bool = False):
+        self.model = model
+        self.include_usage = include_usage
+
+    def text(self, content: str) -> bytes:
+        """One text delta."""
+        raise NotImplementedError
+
+    def finish(self, chunk: Dict[str, Any]) -> bytes:
+        """The final Ollama chunk, carrying ``done`` and the token counts."""
+        raise NotImplementedError
+
+    def error(self, message: str) -> bytes:
+        """A failure part; the stream ends after it."""
+        raise NotImplementedError
+
+    def close(self) -> bytes:
+        """Trailer written after the finish or error part."""
+        return b''
+
+    def choice_text(self, index: int, content: str) -> bytes:
+        """One text delta of choice ``index`` (``n > 1``)."""
+        raise NotImplementedError
+
+    def choice_finish(self, index: int, chunk: Dict[str, Any]) -> bytes:
+        """The final Ollama chunk of choice ``index``."""
+        raise NotImplementedError
+
+    def choices_finish(self, prompt_tokens: int, completion_tokens: int) -> bytes:
+        """Written once every choice has finished, with the usage of all of them."""
+        return b''
+
+
+ENCODERS: Dict[str, Type[StreamEncoder]] = {}
+
+
+def register_encoder(cls: Type[StreamEncoder]) -> Type[StreamEncoder]:
+    """Class decorator making an encoder selectable by its ``name``."""
+    ENCODERS[cls.name] = cls
+    return cls
+
+
+@register_encoder
+class VercelDataStreamEncoder(StreamEncoder):
+    """
+    Vercel AI SDK data stream v1: ``TYPE_ID:CONTENT_JSON\\n``.
+
+    - Text parts: ``0:"text content"``
+    - Error parts: ``3:"error message"``
+    - Finish message: ``d:{"finishReason":"stop","usage":{...}}``
+
+    With ``n > 1`` choice 0 streams as text parts, so ``useChat`` renders it,
+    and every choice is also sent as data parts:
+    ``2:[{"choiceIndex":1,"text":"..."}]`` and
+    ``2:[{"choiceIndex":1,"finishReason":"stop"}]``.
+    """
+
+    name = 'vercel'
+    headers = {'x-vercel-ai-data-stream': 'v1'}
+
+    def choice_text(self, index: int, content: str) -> bytes:
+        data = b'2:[{"choiceIndex":' + str(index).encode('ascii') + b',"text":' + _quote(content) + b'}]\n'
+        return self.text(content) + data if index == 0 else data
+
+    def choice_finish(self, index: int, chunk: Dict[str, Any]) -> bytes:
+        return b'2:' + _dumps([{"choiceIndex": index, "finishReason": chunk.get('done_reason') or 'stop'}]) + b'\n'
+
+    def choices_finish(self, prompt_tokens: int, completion_tokens: int) -> bytes:
+        return finish_part("stop", prompt_tokens, completion_tokens)
+
+    def text(self, content: str) -> bytes:
+        return b'0:' + _quote(content) + b'\n'
+
+    def finish(self, chunk: Dict[str, Any]) -> bytes:
+        return finish_part("stop", chunk.get('prompt_eval_count', 0), chunk.get('eval_count', 0))
+
+    def error(self, message: str) -> bytes:
+        return error_part(message) + finish_part("error")
+
+
+@register_encoder
+class OpenAISSEEncoder(StreamEncoder):
+    """OpenAI ``chat.completion.chunk`` server-sent events."""
+
+    name = 'openai'
+    content_type = 'text/event-stream'
+
+    def __init__(self, model: str = '', include_usage: bool = False):
+        super().__init__(model, include_usage)
+        # One id and timestamp per completion, as OpenAI does.
+        head = (
+            b'data: {"id":"chatcmpl-' + uuid.uuid4().hex.encode('ascii')
+            + b'","object":"chat.completion.chunk","created":' + str(int(time.time())).encode('ascii')
+            + b',"model":' + _quote(model) + b',"system_fingerprint":null'
+        )
+        usage = b',"usage":null' if include_usage else b''
+        self._head = head
+        self._first_prefix = head + b',"choices":[{"index":0,"delta":{"role":"assistant","content":'
+        self._prefix = head + b',"choices":[{"index":0,"delta":{"content":'
+        self._suffix = b'},"logprobs":null,"finish_reason":null}]' + usage + b'}\n\n'
+        self._usage = usage
+        self._started = False
+        self._choice_prefixes: Dict[int, bytes] = {}
+
+    def text(self, content: str) -> bytes:
+        if self._started:
+            return self._prefix + _quote(content) + self._suffix
+        self._started = True
+        return self._first_prefix + _quote(content) + self._suffix
+
+    def finish(self, chunk: Dict[str, Any]) -> bytes:
+        reason = chunk.get('done_reason') or 'stop'
+        frames = (
+            self._head + b',"choices":[{"index":0,"delta":{},"logprobs":null,"finish_reason":'
+            + _quote(reason) + b'}]' + self._usage + b'}\n\n'
+        )
+        if self.include_usage:
+            prompt_tokens = chunk.get('prompt_eval_count', 0) or 0
+            completion_tokens = chunk.get('eval_count', 0) or 0
+            frames += self._head + b',"choices":[],"usage":' + _dumps({
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }) + b'}\n\n'
+        return frames
+
+    def error(self, message: str) -> bytes:
+        return b'data: ' + _dumps({"error": {"message": message, "type": "server_error"}}) + b'\n\n'
+
+    def choice_text(self, index: int, content: str) -> bytes:
+        prefix = self._choice_prefixes.get(index)
+        if prefix is None:
+            # The first delta of each choice carries the role, as OpenAI does.
+            choice = self._head + b',"choices":[{"index":' + str(index).encode('ascii')
+            self._choice_prefixes[index] = choice + b',"delta":{"content":'
+            return choice + b',"delta":{"role":"assistant","content":' + _quote(content) + self._suffix
+        return prefix + _quote(content) + self._suffix
+
+    def choice_finish(self, index: int, chunk: Dict[str, Any]) -> bytes:
+        reason = chunk.get('done_reason') or 'stop'
+        return (
+            self._head + b',"choices":[{"index":' + str(index).encode('ascii')
+            + b',"delta":{},"logprobs":null,"finish_reason":' + _quote(reason) + b'}]' + self._usage + b'}\n\n'
+        )
+
+    def choices_finish(self, prompt_tokens: int, completion_tokens: int) -> bytes:
+        if not self.include_usage:
+            return b''
+        return self._head + b',"choices":[],"usage":' + _dumps({
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }) + b'}\n\n'
+
+    def close(self) -> bytes:
+        return b'data: [DONE]\n\n'
+
+
+@register_encoder
+class NDJSONEncoder(StreamEncoder):
+    """Ollama-style chunks, one JSON object per line."""
+
+    name = 'ndjson'
+    content_type = 'application/x-ndjson'
+
+    def __init__(self, model: str = '', include_usage: bool = False):
+        super().__init__(model, include_usage)
+        self._prefix = b'{"model":' + _quote(model) + b',"message":{"role":"assistant","content":'
+        self._choice_prefix = b'{"model":' + _quote(model) + b',"index":'
+        self._suffix = b'},"done":false}\n'
+
+    def text(self, content: str) -> bytes:
+        return self._prefix + _quote(content) + self._suffix
+
+    def finish(self, chunk: Dict[str, Any]) -> bytes:
+        return _dumps(chunk) + b'\n'
+
+    def error(self, message: str) -> bytes:
+        return _dumps({"error": message, "done": True}) + b'\n'
+
+    def choice_text(self, index: int, content: str) -> bytes:
+        return (
+            self._choice_prefix + str(index).encode('ascii')
+            + b',"message":{"role":"assistant","content":' + _quote(content) + self._suffix
+        )
+
+    def choice_finish(self, index: int, chunk: Dict[str, Any]) -> bytes:
+        return _dumps(dict(chunk, index=index)) + b'\n'
+
+
+def text_part(content: str) -> bytes:
+    """Encode a text delta as a Vercel text part."""
+    return b'0:' + _quote(content) + b'\n'
+
+
+def error_part(message: str) -> bytes:
+    """Encode an error message as a Vercel error part."""
+    return b'3:' + _quote(message) + b'\n'
+
+
+def finish_part(finish_reason: str, prompt_tokens: int = 0, completion_tokens: int = 0) -> bytes:
+    """Encode the finish message part carrying the final usage."""
+    finish_message = {
+        "finishReason": finish_reason,
+        "usage": {
+            "promptTokens": prompt_tokens,
+            "completionTokens": completion_tokens
+        }
+    }
+    return f"d:{json.dumps(finish_message)}\n".encode("utf-8")
+
+
+def select_protocol(request, cleaned_data: Dict[str, Any]) -> str:
+    """Protocol name from the request body, ``X-Stream-Protocol`` or ``Accept``."""
+    name = cleaned_data.get('stream_protocol') or request.META.get('HTTP_X_STREAM_PROTOCOL', '').strip().lower()
+    if name:
+        if name not in ENCODERS:
+            raise ValidationError(f"Unknown stream protocol '{name}'; expected one of: {', '.join(sorted(ENCODERS))}")
+        return name
+    accept = request.META.get('HTTP_ACCEPT', '')
+    for media_type, protocol in _ACCEPT_PROTOCOLS.items():
+        if media_type in accept:
+            return protocol
+    return getattr(settings, 'CHAT_STREAM_PROTOCOL', DEFAULT_PROTOCOL)
+
+
+def create_encoder(request, cleaned_data: Dict[str, Any], protocol: Optional[str] = None) -> StreamEncoder:
+    """Encoder for this request's stream."""
+    cls = ENCODERS[protocol or select_protocol(request, cleaned_data)]
+    return cls(model=cleaned_data['model'], include_usage=cleaned_data.get('include_usage', False))
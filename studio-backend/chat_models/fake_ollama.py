@@ -0,0 +1,246 @@
+"""
+Minimal fake Ollama HTTP server for offline benchmarks and local debugging.
+
+Implements just enough of the Ollama REST API (``/api/tags``, ``/api/ps``,
+``/api/show``, ``/api/chat``, ``/api/generate``, ``/api/embed``) to drive the
+chat proxy without a GPU. Streaming responses emit one NDJSON chunk per token
+with a configurable inter-token delay so the proxy's concurrency behaviour can
+be measured in isolation from model speed.
+
+Models start unloaded; the first chat or preload (empty ``/api/generate``)
+waits ``load_delay`` seconds and reports it as ``load_duration``, and
+``keep_alive=0`` unloads again.
+
+``GET /_fake/stats`` reports the streams still generating and those the client
+closed early, to check that the proxy releases upstream generations, plus the
+``/api/embed`` calls and inputs, to check embedding micro-batching, and the
+chat turns answered with tool calls.
+
+A chat request offering ``tools`` is answered with one call of every tool
+(required parameters set to ``"6 * 7"``) until its last message is a tool
+result.
+
+Embeddings are hashed bags of lower-cased words, so prompts that differ only in
+case, punctuation or word order embed identically.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_MODELS = ["fake-model:latest"]
+EMBEDDING_DIM = 64
+
+
+def fake_embedding(text: str) -> List[float]:
+    vector = [0.0] * EMBEDDING_DIM
+    for word in re.findall(r"\w+", text.lower()):
+        vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % EMBEDDING_DIM] += 1.0
+    return vector
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    """Request handler; behaviour is configured through attributes on the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):  # noqa: A002 - signature from BaseHTTPRequestHandler
+        pass
+
+    def _read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, payload: Dict[str, Any], status: int = 200) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._send_json({"models": [
+                {"name": name, "model": name, "size": 1_000_000, "digest": f"sha256:{name}"}
+                for name in self.server.models
+            ]})
+        elif self.path == '/api/ps':
+            self._send_json({"models": [
+                {"name": name, "model": name, "size": 1_000_000, "size_vram": 1_000_000, "expires_at": None}
+                for name in sorted(self.server.loaded)
+            ]})
+        elif self.path == '/_fake/stats':
+            self._send_json({
+                "activeStreams": self.server.active_streams,
+                "cancelledStreams": self.server.cancelled_streams,
+                "embedCalls": self.server.embed_calls,
+                "embedInputs": self.server.embed_inputs,
+                "toolTurns": self.server.tool_turns,
+            })
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        payload = self._read_json()
+        if self.path == '/api/show':
+            self._send_json({"details": {"family": "fake"}, "model_info": {"fake.context_length": 4096}})
+        elif self.path == '/api/chat':
+            self._handle_chat(payload)
+        elif self.path == '/api/generate':
+            self._handle_generate(payload)
+        elif self.path == '/api/embed':
+            inputs = payload.get('input', [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            with self.server.stats_lock:
+                self.server.embed_calls += 1
+                self.server.embed_inputs += len(inputs)
+            self._send_json({
+                "model": payload.get('model', ''),
+                "embeddings": [fake_embedding(t) for t in inputs],
+                "prompt_eval_count": sum(len(re.findall(r"\w+", t)) for t in inputs),
+            })
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def _handle_generate(self, payload: Dict[str, Any]) -> None:
+        """Empty-prompt generate: Ollama's preload (or unload with keep_alive=0)."""
+        model = payload.get('model', '')
+        if ':' not in model:
+            model = f"{model}:latest"
+        if model not in self.server.models:
+            self._send_json({"error": f"model '{model}' not found"}, status=404)
+            return
+        load_duration = 0
+        if payload.get('keep_alive') in (0, '0', '0s'):
+            self.server.loaded.discard(model)
+        else:
+            load_duration = self._ensure_loaded(model)
+        self._send_json({"model": model, "response": "", "done": True, "load_duration": load_duration})
+
+    def _ensure_loaded(self, model: str) -> int:
+        """Simulate loading a cold model; returns load_duration in nanoseconds."""
+        if model in self.server.loaded:
+            return 0
+        time.sleep(self.server.load_delay)
+        self.server.loaded.add(model)
+        return int(self.server.load_delay * 1e9)
+
+    def _handle_chat(self, payload: Dict[str, Any]) -> None:
+        model = payload.get('model', '')
+        if ':' not in model:
+            model = f"{model}:latest"
+        if model not in self.server.models:
+            self._send_json({"error": f"model '{model}' not found"}, status=404)
+            return
+
+        load_duration = self._ensure_loaded(model)
+        tokens = self.server.tokens
+        messages = payload.get('messages') or []
+        if payload.get('tools') and not (messages and messages[-1].get('role') == 'tool'):
+            # Call every offered tool once, filling required parameters with a constant
+            time.sleep(self.server.token_delay)
+            final = self._final_chunk(model, "", load_duration)
+            final["message"]["tool_calls"] = [
+                {"function": {
+                    "name": t["function"]["name"],
+                    "arguments": {p: "6 * 7" for p in t["function"].get("parameters", {}).get("required", [])},
+                }}
+                for t in payload['tools']
+            ]
+            with self.server.stats_lock:
+                self.server.tool_turns += 1
+            self._send_json(final)
+            return
+        if not payload.get('stream', True):
+            time.sleep(self.server.token_delay * len(tokens))
+            self._send_json(self._final_chunk(model, "".join(tokens), load_duration))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        with self.server.stats_lock:
+            self.server.active_streams += 1
+        try:
+            for token in tokens:
+                time.sleep(self.server.token_delay)
+                self._write_chunk({"model": model, "message": {"role": "assistant", "content": token}, "done": False})
+            self._write_chunk(self._final_chunk(model, "", load_duration))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            with self.server.stats_lock:
+                self.server.cancelled_streams += 1
+        finally:
+            with self.server.stats_lock:
+                self.server.active_streams -= 1
+
+    def _write_chunk(self, chunk: Dict[str, Any]) -> None:
+        data = json.dumps(chunk).encode('utf-8') + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _final_chunk(self, model: str, content: str, load_duration: int = 0) -> Dict[str, Any]:
+        eval_count = len(self.server.tokens)
+        return {
+            "model": model,
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": 10,
+            "eval_count": eval_count,
+            "load_duration": load_duration,
+            "prompt_eval_duration": 1_000_000,
+            "eval_duration": int(self.server.token_delay * eval_count * 1e9),
+        }
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """Threaded fake Ollama server; ``start()`` serves from a daemon thread."""
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ('127.0.0.1', 0),
+        models: Optional[List[str]] = None,
+        tokens: int = 64,
+        token_delay: float = 0.02,
+        load_delay: float = 0.0,
+    ):
+        super().__init__(address, FakeOllamaHandler)
+        self.models = list(models or DEFAULT_MODELS)
+        self.tokens = [f"tok{i} " for i in range(tokens)]
+        self.token_delay = token_delay
+        self.load_delay = load_delay
+        self.loaded = set()
+        # Streams being generated, and streams the client hung up on.
+        self.active_streams = 0
+        self.cancelled_streams = 0
+        self.embed_calls = 0
+        self.embed_inputs = 0
+        self.tool_turns = 0
+        self.stats_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeOllamaServer":
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-ollama', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,89 @@
+"""
+Django management command timing the stream encoders per token.
+
+Every registered encoder in ``chat_models.encoders`` encodes the same
+generation: ``--tokens`` text deltas plus the final chunk, repeated
+``--rounds`` times, keeping the best round. For comparison it also times the
+per-chunk paths the encoders replaced: ``json.dumps`` for Vercel text parts
+and a fresh ``chat.completion.chunk`` dict, ``uuid4`` and ``time.time()`` per
+OpenAI chunk.
+
+Usage: python manage.py benchmark_encoders --tokens 20000 --rounds 5
+"""
+import json
+import time
+import uuid
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import BaseCommand
+
+from chat_models.encoders import ENCODERS
+
+TOKENS = [" the", " quick", " \"brown\"", " fox", " jumps", " über", " the", " lazy", " dog", ".\n"]
+
+
+def _legacy_vercel(content: str) -> bytes:
+    return f"0:{json.dumps(content)}\n".encode("utf-8")
+
+
+def _legacy_openai(content: str) -> bytes:
+    chunk = {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:8]}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "bench",
+        "choices": [{"index": 0, "delta": {"content": content}, "finishReason": None}],
+    }
+    return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+
+class Command(BaseCommand):
+    help = 'Time each stream encoder per token against the per-chunk JSON paths it replaced'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=20000, help='Text deltas per generation')
+        parser.add_argument('--rounds', type=int, default=5, help='Repetitions; the best is reported')
+
+    def handle(self, *args, **options):
+        deltas = [TOKENS[i % len(TOKENS)] for i in range(options['tokens'])]
+        final = {"model": "bench", "message": {"role": "assistant", "content": ""}, "done": True,
+                 "done_reason": "stop", "prompt_eval_count": 12, "eval_count": len(deltas)}
+
+        cases: List[tuple] = [(name, self._encoder_run(cls, final)) for name, cls in sorted(ENCODERS.items())]
+        cases.append(('vercel (json.dumps per chunk)', _legacy_vercel))
+        cases.append(('openai (dict per chunk)', _legacy_openai))
+
+        self.stdout.write(f"{'encoder':<32}{'ns/token':>10}{'bytes/token':>13}{'tokens/s':>14}")
+        for name, encode in cases:
+            best, size = self._time(encode, deltas, options['rounds'])
+            self.stdout.write(
+                f"{name:<32}{best * 1e9 / len(deltas):>10.0f}{size / len(deltas):>13.1f}{len(deltas) / best:>14,.0f}"
+            )
+
+    @staticmethod
+    def _encoder_run(cls, final: Dict[str, Any]) -> Callable[[str], bytes]:
+        """Adapter timing one encoder instance per generation, as the views use them."""
+        def run(deltas: List[str]) -> int:
+            encoder = cls(model='bench', include_usage=True)
+            text = encoder.text
+            size = 0
+            for content in deltas:
+                size += len(text(content))
+            return size + len(encoder.finish(final)) + len(encoder.close())
+        run.per_stream = True
+        return run
+
+    @staticmethod
+    def _time(encode: Callable, deltas: List[str], rounds: int):
+        best = float('inf')
+        size = 0
+        for _ in range(rounds):
+            start = time.perf_counter()
+            if getattr(encode, 'per_stream', False):
+                size = encode(deltas)
+            else:
+                size = 0
+                for content in deltas:
+                    size += len(encode(content))
+            best = min(best, time.perf_counter() - start)
+        return best, size
@@ -0,0 +1,107 @@
+"""
+Django management command measuring what stream frame coalescing saves.
+
+A synthetic token stream (one Ollama chunk per token, ``--token-interval-ms``
+apart) is encoded as Vercel data-stream frames and written to a local socket,
+one ``send`` per frame as the WSGI and ASGI servers do. It runs once with
+coalescing off and once per ``--window-ms``.
+
+For each run the command reports frames per second, write syscalls per token
+(from ``/proc/self/io`` where the kernel counts sends there, otherwise one per
+frame) and CPU time per token, plus the time to the first frame.
+
+Usage: python manage.py benchmark_frames --tokens 2000 --token-interval-ms 5 \\
+    --window-ms 10 --window-ms 25 --window-ms 50
+"""
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional
+
+from django.core.management.base import BaseCommand
+
+from chat_models.streaming import DeltaCoalescer, coalesce_deltas, vercel_ai_stream
+
+
+def _write_syscalls() -> Optional[int]:
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('syscw:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _token_stream(tokens: int, interval: float) -> Iterator[Dict[str, Any]]:
+    for i in range(tokens):
+        if interval:
+            time.sleep(interval)
+        yield {"model": "bench", "message": {"role": "assistant", "content": f" tok{i % 100}"}, "done": False}
+    yield {"model": "bench", "message": {"role": "assistant", "content": ""}, "done": True,
+           "prompt_eval_count": 10, "eval_count": tokens}
+
+
+class Command(BaseCommand):
+    help = 'Compare frames, write syscalls and CPU per token with stream coalescing on and off'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=2000, help='Tokens per generation')
+        parser.add_argument('--token-interval-ms', type=float, default=5.0, help='Milliseconds between tokens')
+        parser.add_argument(
+            '--window-ms',
+            action='append',
+            type=float,
+            default=[],
+            help='Coalescing window to compare against no coalescing (repeatable, default: 20)'
+        )
+        parser.add_argument('--max-bytes', type=int, default=1024, help='Flush a frame once it holds this many bytes')
+
+    def handle(self, *args, **options):
+        windows = options['window_ms'] or [20.0]
+        self.stdout.write(f"{'window':>8}{'frames':>9}{'frames/s':>10}{'syscalls/tok':>14}"
+                          f"{'cpu us/tok':>12}{'first frame':>13}{'wall s':>9}")
+        for window in [0.0] + windows:
+            result = self._run(DeltaCoalescer(window, options['max_bytes']), options)
+            label = 'off' if not window else f"{window:g}ms"
+            self.stdout.write(
+                f"{label:>8}{result['frames']:>9}{result['frames'] / result['wall']:>10.0f}"
+                f"{result['syscalls'] / options['tokens']:>14.3f}"
+                f"{result['cpu'] * 1e6 / options['tokens']:>12.1f}"
+                f"{result['first_frame'] * 1000:>11.2f}ms{result['wall']:>9.2f}"
+            )
+
+    def _run(self, coalescer: DeltaCoalescer, options: Dict[str, Any]) -> Dict[str, Any]:
+        writer, reader = socket.socketpair()
+
+        def drain():
+            while reader.recv(65536):
+                pass
+
+        drainer = threading.Thread(target=drain, daemon=True)
+        drainer.start()
+
+        stream = _token_stream(options['tokens'], options['token_interval_ms'] / 1000)
+        frames = 0
+        first_frame = 0.0
+        syscalls_before = _write_syscalls()
+        cpu_before = time.thread_time()
+        start = time.perf_counter()
+        for frame in vercel_ai_stream(coalesce_deltas(stream, coalescer), 'benchmark'):
+            writer.sendall(frame)
+            frames += 1
+            if frames == 1:
+                first_frame = time.perf_counter() - start
+        wall = time.perf_counter() - start
+        cpu = time.thread_time() - cpu_before
+        syscalls_after = _write_syscalls()
+
+        writer.close()
+        drainer.join()
+        reader.close()
+        syscalls = (syscalls_after or 0) - (syscalls_before or 0)
+        if syscalls <= 0:
+            # Not every kernel counts socket sends in syscw; each frame is one send.
+            syscalls = frames
+        return {'frames': frames, 'syscalls': syscalls, 'cpu': cpu, 'wall': wall, 'first_frame': first_frame}
@@ -0,0 +1,131 @@
+"""
+Django management command comparing concurrent-stream capacity of the WSGI and
+ASGI chat completion paths.
+
+Start the servers under test against the same upstream first, e.g. with the
+bundled fake Ollama (``--serve-fake-ollama 11500``). Every benchmark stream comes
+from one client, so leave ``CHAT_RATE_LIMIT_ENABLED`` off and export
+``CHAT_ADMISSION_ENABLED=False`` for the servers:
+
+    OLLAMA_BASE_URL=http://127.0.0.1:11500 gunicorn -w 1 --threads 32 studio_backend.wsgi -b :8001
+    OLLAMA_BASE_URL=http://127.0.0.1:11500 uvicorn studio_backend.asgi:application --port 8002
+
+Usage: python manage.py benchmark_streams --serve-fake-ollama 11500 \\
+    --target wsgi=http://127.0.0.1:8001 --target asgi=http://127.0.0.1:8002 \\
+    --concurrency 50 --concurrency 200 --concurrency 500
+"""
+import asyncio
+import statistics
+import time
+from typing import Any, Dict, List
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_models.fake_ollama import FakeOllamaServer
+
+
+class Command(BaseCommand):
+    help = 'Measure how many concurrent chat streams each server path sustains'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target',
+            action='append',
+            default=[],
+            help='name=base_url of a server under test (repeatable)'
+        )
+        parser.add_argument(
+            '--concurrency',
+            action='append',
+            type=int,
+            default=[],
+            help='Number of simultaneous streams to open (repeatable, default: 50, 200)'
+        )
+        parser.add_argument('--model', default='fake-model:latest', help='Model name to request')
+        parser.add_argument('--timeout', type=float, default=120.0, help='Per-stream timeout in seconds')
+        parser.add_argument(
+            '--serve-fake-ollama',
+            type=int,
+            default=None,
+            metavar='PORT',
+            help='Run the fake Ollama upstream on this port for the duration of the benchmark'
+        )
+        parser.add_argument('--tokens', type=int, default=64, help='Tokens per fake generation')
+        parser.add_argument('--token-delay', type=float, default=0.02, help='Seconds between fake tokens')
+
+    def handle(self, *args, **options):
+        targets = []
+        for raw in options['target']:
+            name, sep, url = raw.partition('=')
+            if not sep:
+                raise CommandError(f"--target must look like name=url, got {raw!r}")
+            targets.append((name, url.rstrip('/')))
+        if not targets:
+            raise CommandError('At least one --target is required')
+        levels = options['concurrency'] or [50, 200]
+
+        fake = None
+        if options['serve_fake_ollama'] is not None:
+            fake = FakeOllamaServer(
+                ('127.0.0.1', options['serve_fake_ollama']),
+                models=[options['model']],
+                tokens=options['tokens'],
+                token_delay=options['token_delay'],
+            ).start()
+            self.stdout.write(f'Fake Ollama listening on {fake.base_url}')
+
+        try:
+            self.stdout.write(f"{'target':<10}{'streams':>9}{'ok':>7}{'failed':>8}"
+                              f"{'ttft p50':>11}{'ttft p95':>11}{'wall s':>9}{'streams/s':>11}")
+            for name, url in targets:
+                for level in levels:
+                    result = asyncio.run(self._run_level(url, level, options))
+                    self.stdout.write(
+                        f"{name:<10}{level:>9}{result['ok']:>7}{result['failed']:>8}"
+                        f"{result['ttft_p50']:>10.0f}ms{result['ttft_p95']:>9.0f}ms"
+                        f"{result['wall']:>9.2f}{result['ok'] / result['wall']:>11.1f}"
+                    )
+        finally:
+            if fake is not None:
+                fake.stop()
+
+    async def _run_level(self, base_url: str, concurrency: int, options: Dict[str, Any]) -> Dict[str, Any]:
+        payload = {
+            "model": options['model'],
+            "messages": [{"role": "user", "content": "Benchmark prompt"}],
+            "stream": True,
+        }
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=options['timeout']) as http:
+            start = time.perf_counter()
+            results = await asyncio.gather(
+                *(self._one_stream(http, f"{base_url}/v1/chat/completions/", payload) for _ in range(concurrency)),
+                return_exceptions=True,
+            )
+            wall = time.perf_counter() - start
+
+        ttfts: List[float] = [r for r in results if isinstance(r, float)]
+        ttfts.sort()
+        return {
+            'ok': len(ttfts),
+            'failed': len(results) - len(ttfts),
+            'ttft_p50': statistics.median(ttfts) if ttfts else 0.0,
+            'ttft_p95': ttfts[int(len(ttfts) * 0.95) - 1] if ttfts else 0.0,
+            'wall': wall,
+        }
+
+    async def _one_stream(self, http: httpx.AsyncClient, url: str, payload: Dict[str, Any]) -> float:
+        """Consume one stream fully; return time to first text part in ms."""
+        start = time.perf_counter()
+        ttft = None
+        async with http.stream('POST', url, json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if ttft is None and line.startswith('0:'):
+                    ttft = (time.perf_counter() - start) * 1000
+                if line.startswith('3:'):
+                    raise RuntimeError(line)
+        if ttft is None:
+            raise RuntimeError('stream finished without text')
+        return ttft
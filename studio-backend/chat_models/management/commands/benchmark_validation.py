@@ -0,0 +1,115 @@
+"""
+Django management command measuring chat message validation throughput.
+
+The request in ``--payload`` (``test_chat.json`` by default) is scaled up to
+``--messages`` alternating user/assistant messages of ``--chars`` characters
+of varied prose, then validated message by message:
+
+- ``legacy``: the previous validator (a per-character dict loop for the
+  repetition check, ``re.search`` with pattern strings for the security
+  check);
+- ``rules (cold)``: the precompiled rules with an empty memo, i.e. a new
+  conversation;
+- ``rules (memo)``: the same payload again, as when a conversation resends
+  its history.
+
+The best of ``--rounds`` is reported.
+
+Usage: python manage.py benchmark_validation --messages 100 --chars 50000
+"""
+import json
+import random
+import re
+import time
+from typing import Any, Callable, Dict, List
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+
+from chat_models.validators import ChatMessageValidator
+
+WORDS = (
+    "the model returns a streamed answer for each request while the server keeps "
+    "history in cache def main(): print(value) <div class=\"card\">résumé naïve 東京 "
+    "latency throughput tokens per second 42 3.14 {\"key\": [1, 2, 3]} SELECT * FROM logs;"
+).split()
+
+
+def _legacy_validate(message: Dict[str, Any]) -> Dict[str, str]:
+    """The validator as it was before the rule engine."""
+    role = message.get("role", "").strip().lower()
+    content = message.get("content", "").strip()
+    if len(content) > ChatMessageValidator.MAX_CONTENT_LENGTH:
+        raise ValidationError("Message content too long")
+    if len(content) >= 50:
+        char_counts = {}
+        for char in content:
+            char_counts[char] = char_counts.get(char, 0) + 1
+        if max(char_counts.values()) / len(content) > 0.7:
+            raise ValidationError("Message contains excessive repetition")
+    for pattern in [r'<script[^>]*>.*?</script>', r'javascript:', r'data:text/html']:
+        if re.search(pattern, content, re.IGNORECASE | re.DOTALL):
+            raise ValidationError("Message contains potentially unsafe content")
+    return {"role": role, "content": content}
+
+
+class Command(BaseCommand):
+    help = 'Compare chat message validation throughput of the legacy validator and the rule engine'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payload', default=str(settings.BASE_DIR / 'test_chat.json'),
+                            help='Request to scale up (JSON file)')
+        parser.add_argument('--messages', type=int, default=100, help='Messages per request')
+        parser.add_argument('--chars', type=int, default=50000, help='Characters per message')
+        parser.add_argument('--rounds', type=int, default=3, help='Repetitions; the best is reported')
+
+    def handle(self, *args, **options):
+        with open(options['payload']) as f:
+            payload = json.load(f)
+        payload['messages'] = self._messages(payload['messages'], options['messages'], options['chars'])
+        messages = payload['messages']
+        total_chars = sum(len(m['content']) for m in messages)
+        self.stdout.write(f"{len(messages)} messages, {total_chars / 1e6:.1f}M characters per request")
+
+        memo = ChatMessageValidator.memo
+        cases = [
+            ('legacy', _legacy_validate, None),
+            ('rules (cold)', ChatMessageValidator.validate_message, memo.clear),
+            ('rules (memo)', ChatMessageValidator.validate_message, None),
+        ]
+        self.stdout.write(f"{'validator':<16}{'ms/request':>12}{'requests/s':>12}{'messages/s':>12}{'MB/s':>10}")
+        for name, validate, reset in cases:
+            best = self._time(validate, messages, options['rounds'], reset)
+            self.stdout.write(
+                f"{name:<16}{best * 1000:>12.2f}{1 / best:>12.1f}"
+                f"{len(messages) / best:>12,.0f}{total_chars / best / 1e6:>10.1f}"
+            )
+
+    @staticmethod
+    def _messages(seed: List[Dict[str, Any]], count: int, chars: int) -> List[Dict[str, str]]:
+        rng = random.Random(0)
+        messages = []
+        for i in range(count):
+            prefix = seed[i % len(seed)]['content'] + ' ' if i < len(seed) else ''
+            words = []
+            size = len(prefix)
+            while size < chars:
+                word = rng.choice(WORDS)
+                words.append(word)
+                size += len(word) + 1
+            role = 'user' if i % 2 == 0 else 'assistant'
+            messages.append({"role": role, "content": (prefix + ' '.join(words))[:chars]})
+        return messages
+
+    @staticmethod
+    def _time(validate: Callable, messages: List[Dict[str, Any]], rounds: int, reset=None) -> float:
+        best = float('inf')
+        for _ in range(rounds):
+            if reset is not None:
+                reset()
+            start = time.perf_counter()
+            for message in messages:
+                validate(message)
+            best = min(best, time.perf_counter() - start)
+        return best
@@ -0,0 +1,39 @@
+"""
+Django management command running the Ollama model residency manager.
+
+Keeps the most requested models loaded on every backend and unloads idle
+ones (see ``chat_models.residency``). Run one instance per deployment.
+
+Usage: python manage.py manage_residency [--interval 60] [--once]
+"""
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat_models.residency import ResidencyManager
+
+
+class Command(BaseCommand):
+    help = 'Preload hot Ollama models and unload idle ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=getattr(settings, 'OLLAMA_RESIDENCY_INTERVAL_SECONDS', 60.0),
+            help='Seconds between planning cycles (default: OLLAMA_RESIDENCY_INTERVAL_SECONDS)'
+        )
+        parser.add_argument('--once', action='store_true', help='Run a single cycle and print its report')
+
+    def handle(self, *args, **options):
+        manager = ResidencyManager.from_settings()
+        if options['once']:
+            self.stdout.write(json.dumps(manager.run_once(), indent=2, default=str))
+            return
+
+        self.stdout.write(f"Managing model residency every {options['interval']:.0f}s (Ctrl+C to stop)")
+        try:
+            manager.run_forever(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS('Residency manager stopped'))
@@ -0,0 +1,41 @@
+"""
+Django management command running a dedicated batch worker pool.
+
+Drains queued /v1/batches jobs (see ``chat_models.batches``) next to, or
+instead of, the pools web processes start themselves; set
+``CHAT_BATCH_WORKERS=0`` on the web processes to leave all batch work here.
+Jobs whose worker died are picked up again once their lease expires.
+
+Usage: python manage.py process_batches [--workers 4]
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat_models.batches import BatchWorkerPool
+
+
+class Command(BaseCommand):
+    help = 'Run batch completion workers until interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=max(getattr(settings, 'CHAT_BATCH_WORKERS', 2), 1),
+            help='Worker threads (default: CHAT_BATCH_WORKERS)'
+        )
+
+    def handle(self, *args, **options):
+        pool = BatchWorkerPool.from_settings()
+        pool.workers = options['workers']
+        recovered = pool.recover_expired()
+        pool.start()
+        self.stdout.write(
+            f"Processing batches with {pool.workers} workers as {pool.name}"
+            f" ({recovered} expired jobs requeued; Ctrl+C to stop)"
+        )
+        try:
+            pool.wait()
+        except KeyboardInterrupt:
+            pool.stop(timeout=5)
+            self.stdout.write(self.style.SUCCESS(f"Batch workers stopped: {pool.snapshot()}"))
@@ -0,0 +1,76 @@
+# Generated by Django 5.1.2 on 2026-10-17 07:17
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_models', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Batch',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('in_progress', 'In progress'), ('completed', 'Completed'), ('cancelling', 'Cancelling'), ('cancelled', 'Cancelled')], default='queued', max_length=20)),
+                ('total_jobs', models.PositiveIntegerField(default=0)),
+                ('succeeded_jobs', models.PositiveIntegerField(default=0)),
+                ('failed_jobs', models.PositiveIntegerField(default=0)),
+                ('metadata', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batches', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('line', models.PositiveIntegerField(help_text='1-based line of the input JSONL')),
+                ('custom_id', models.CharField(blank=True, max_length=128)),
+                ('model_name', models.CharField(max_length=128)),
+                ('request', models.JSONField(help_text='Validated chat request')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('response', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('worker', models.CharField(blank=True, help_text="Worker holding the job's lease", max_length=64)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='chat_models.batch')),
+            ],
+            options={
+                'ordering': ['batch', 'line'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='batch',
+            index=models.Index(fields=['user', 'created_at'], name='chat_models_user_id_24ca06_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batch',
+            index=models.Index(fields=['status'], name='chat_models_status_e61eb9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchjob',
+            index=models.Index(fields=['status', 'batch', 'line'], name='chat_models_status_c61dbd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='batchjob',
+            index=models.Index(fields=['status', 'heartbeat_at'], name='chat_models_status_de9117_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='batchjob',
+            constraint=models.UniqueConstraint(fields=('batch', 'line'), name='unique_batch_job_line'),
+        ),
+    ]
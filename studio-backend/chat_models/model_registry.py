@@ -0,0 +1,232 @@
+"""
+Cached registry of the models available across the Ollama backends.
+
+``/v1/models`` used to call ``/api/tags`` and then ``/api/show`` once per
+model on every hit. The registry keeps the listing and the trimmed ``show``
+payloads in memory instead:
+
+- ``show`` metadata is cached by model digest, so it is only fetched again
+  when a model is re-pulled; missing entries are fetched concurrently
+  (``OLLAMA_MODEL_METADATA_WORKERS``);
+- the listing is refreshed in the background once older than
+  ``OLLAMA_MODEL_REGISTRY_REFRESH_SECONDS`` while the cached copy keeps being
+  served (only the very first load blocks);
+- every listing carries an ETag so clients can revalidate with
+  ``If-None-Match``.
+
+``ChatRequestValidator`` uses :meth:`ModelRegistry.has_model` to reject
+unknown models without a round trip to Ollama, and the context manager
+(``chat_models.context``) sizes prompts with :meth:`ModelRegistry.context_length`.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from django.conf import settings
+
+from .client_pool import get_client_registry
+from .router import OllamaBackend, OllamaRouter
+
+logger = logging.getLogger(__name__)
+
+# Minimum age before a lookup of an unknown model triggers another refresh.
+MISS_REFRESH_SECONDS = 5.0
+
+
+def trim_show_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop the ``/api/show`` fields the frontend never needs."""
+    # Ensure the payload is a mutable dict so we can safely mutate it below.
+    payload = dict(payload)
+    # Drop fields we explicitly do NOT want to expose
+    payload.pop("license", None)
+    # `modelfile` often contains the full model recipe and can be several KBs,
+    # while `tensors` is enormous (one entry per model weight tensor). Neither
+    # is required by the frontend and they dramatically inflate the response.
+    payload.pop("modelfile", None)
+    payload.pop("tensors", None)
+    model_info = dict(payload.get("model_info") or {})
+    model_info.pop("digest", None)
+    if model_info:
+        payload["model_info"] = model_info
+    return payload
+
+
+class ModelRegistry:
+    """Listing and metadata of available models, refreshed in the background."""
+
+    def __init__(self, router: OllamaRouter, refresh_seconds: float = 60.0, metadata_workers: int = 8):
+        self.router = router
+        self.refresh_seconds = refresh_seconds
+        self.metadata_workers = metadata_workers
+        self._models: Optional[List[Dict[str, Any]]] = None
+        self._names: Set[str] = set()
+        # name -> context length from the show payload's model_info
+        self._context_lengths: Dict[str, int] = {}
+        self._etag = ''
+        self._refreshed_at = 0.0
+        # digest -> trimmed show payload
+        self._metadata: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    @classmethod
+    def from_settings(cls, router: OllamaRouter) -> "ModelRegistry":
+        return cls(
+            router,
+            refresh_seconds=getattr(settings, 'OLLAMA_MODEL_REGISTRY_REFRESH_SECONDS', 60.0),
+            metadata_workers=getattr(settings, 'OLLAMA_MODEL_METADATA_WORKERS', 8),
+        )
+
+    # -- fetching --------------------------------------------------------
+
+    def _show(self, backend: OllamaBackend, model_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            return trim_show_payload(get_client_registry().sync_client(backend.base_url).show(model_id))
+        except Exception as e:
+            # Non-fatal; the model is listed without metadata and retried next refresh.
+            logger.debug(f"Unable to fetch details for {model_id}: {e}")
+            return None
+
+    def refresh(self) -> None:
+        """Fetch the listing now, and any metadata not cached for its digests."""
+        from .ollama_client import OllamaConnectionError
+
+        with self._refresh_lock:
+            listing: List[Tuple[OllamaBackend, Dict[str, Any]]] = []
+            seen = set()
+            reachable = False
+            now = time.monotonic()
+            for backend in self.router.backends:
+                if not backend.is_available(now):
+                    continue
+                try:
+                    response = get_client_registry().sync_client(backend.base_url).list()
+                except Exception as e:
+                    logger.warning(f"Failed to list models on {backend.name}: {e}")
+                    self.router.record_failure(backend)
+                    continue
+                reachable = True
+                self.router.record_models(backend, response)
+                for model in response.get("models", []):
+                    if model["name"] not in seen:
+                        seen.add(model["name"])
+                        listing.append((backend, model))
+
+            if not reachable:
+                logger.error("Failed to connect to any Ollama backend")
+                raise OllamaConnectionError(f"Unable to connect to Ollama at {self.router.primary.base_url}")
+
+            missing = [(backend, model) for backend, model in listing if self._digest(model) not in self._metadata]
+            if missing:
+                with ThreadPoolExecutor(max_workers=min(self.metadata_workers, len(missing))) as pool:
+                    fetched = list(pool.map(lambda item: self._show(item[0], item[1]["name"]), missing))
+                for (_, model), metadata in zip(missing, fetched):
+                    if metadata is not None:
+                        self._metadata[self._digest(model)] = metadata
+            live = {self._digest(model) for _, model in listing}
+            self._metadata = {digest: meta for digest, meta in self._metadata.items() if digest in live}
+
+            models = [self._entry(model) for _, model in listing]
+            etag = '"' + hashlib.sha256(
+                json.dumps(models, sort_keys=True, default=str).encode('utf-8')
+            ).hexdigest()[:32] + '"'
+            context_lengths = {}
+            for _, model in listing:
+                context_length = self._context_length(self._metadata.get(self._digest(model)))
+                if context_length:
+                    context_lengths[model["name"]] = context_length
+            with self._lock:
+                self._models = models
+                self._names = {model["name"] for _, model in listing}
+                self._context_lengths = context_lengths
+                self._etag = etag
+                self._refreshed_at = time.monotonic()
+            logger.debug(f"Model registry refreshed: {len(models)} models, {len(missing)} metadata fetches")
+
+    @staticmethod
+    def _digest(model: Dict[str, Any]) -> str:
+        return model.get("digest") or model["name"]
+
+    @staticmethod
+    def _context_length(metadata: Optional[Dict[str, Any]]) -> Optional[int]:
+        """``<architecture>.context_length`` from a show payload's ``model_info``."""
+        for key, value in ((metadata or {}).get("model_info") or {}).items():
+            if key.endswith(".context_length") and isinstance(value, int):
+                return value
+        return None
+
+    def _entry(self, model: Dict[str, Any]) -> Dict[str, Any]:
+        entry = {"id": model["name"], "name": model["name"]}
+        # Attach size from /list response if available
+        if model.get("size"):
+            entry["parameterSize"] = model["size"]
+        metadata = self._metadata.get(self._digest(model))
+        if metadata is not None:
+            entry["metadata"] = metadata
+        return entry
+
+    def refresh_async(self) -> None:
+        """Start a background refresh unless one is already running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Background model registry refresh failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, name='model-registry-refresh', daemon=True).start()
+
+    # -- reading ---------------------------------------------------------
+
+    def _is_stale(self) -> bool:
+        return time.monotonic() - self._refreshed_at >= self.refresh_seconds
+
+    def listing(self) -> Tuple[List[Dict[str, Any]], str]:
+        """Return ``(models, etag)``; blocks only until the first load completes."""
+        if self._models is None:
+            self.refresh()
+        elif self._is_stale():
+            self.refresh_async()
+        with self._lock:
+            return self._models, self._etag
+
+    def has_model(self, model: str) -> Optional[bool]:
+        """
+        Whether ``model`` is available, from the cached listing only.
+
+        Returns ``None`` while nothing has been loaded yet (callers should not
+        reject then). A miss schedules a refresh so a freshly pulled model is
+        accepted as soon as the listing catches up.
+        """
+        with self._lock:
+            loaded = self._models is not None
+            known = model in self._names or f"{model}:latest" in self._names
+        age = time.monotonic() - self._refreshed_at
+        if not loaded or self._is_stale() or (not known and age >= MISS_REFRESH_SECONDS):
+            self.refresh_async()
+        return known if loaded else None
+
+    def context_length(self, model: str) -> Optional[int]:
+        """Trained context window of ``model`` from the cached metadata, if known."""
+        if self._models is None or self._is_stale():
+            self.refresh_async()
+        with self._lock:
+            return self._context_lengths.get(model) or self._context_lengths.get(f"{model}:latest")
+
+
+def get_model_registry() -> ModelRegistry:
+    """Return the registry of the process-wide routed Ollama client."""
+    from .ollama_client import get_ollama_client
+    return get_ollama_client().model_registry
@@ -0,0 +1,149 @@
+import hashlib
+import uuid
+
+from django.contrib.auth.models import User
+from django.db import models
+
+
+def content_digest(content: str) -> str:
+    """SHA-256 of a message body, the key of its MessageContent row."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class MessageContent(models.Model):
+    """
+    Content-addressed message bodies.
+    Identical texts (shared system prompts, repeated questions) are stored once.
+    """
+    digest = models.CharField(max_length=64, primary_key=True, help_text="SHA-256 of the content")
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest[:12]
+
+
+class Conversation(models.Model):
+    """
+    Server-side chat history, continued by sending its id plus the new turn.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE, related_name='conversations')
+    model_name = models.CharField(max_length=128, blank=True, help_text="Model of the first turn")
+    message_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'updated_at']),
+        ]
+        ordering = ['-updated_at']
+
+    def __str__(self):
+        return f"{self.id} ({self.message_count} messages)"
+
+
+class Message(models.Model):
+    """
+    One message of a conversation; the body lives in MessageContent.
+    """
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
+    position = models.PositiveIntegerField()
+    role = models.CharField(max_length=16)
+    content = models.ForeignKey(MessageContent, on_delete=models.PROTECT, db_column='content_digest')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'position'], name='unique_message_position'),
+        ]
+        ordering = ['conversation', 'position']
+
+    def __str__(self):
+        return f"{self.conversation_id}#{self.position} {self.role}"
+
+
+class Batch(models.Model):
+    """
+    An offline batch of chat completions, drained by the batch worker pool.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_IN_PROGRESS = 'in_progress'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CANCELLING = 'cancelling'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_IN_PROGRESS, 'In progress'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_CANCELLING, 'Cancelling'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+    ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_IN_PROGRESS)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='batches')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    total_jobs = models.PositiveIntegerField(default=0)
+    succeeded_jobs = models.PositiveIntegerField(default=0)
+    failed_jobs = models.PositiveIntegerField(default=0)
+    metadata = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['status']),
+        ]
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+
+class BatchJob(models.Model):
+    """
+    One line of a batch: a validated chat request and, once run, its result.
+    """
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+    FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED, STATUS_CANCELLED)
+
+    batch = models.ForeignKey(Batch, on_delete=models.CASCADE, related_name='jobs')
+    line = models.PositiveIntegerField(help_text="1-based line of the input JSONL")
+    custom_id = models.CharField(max_length=128, blank=True)
+    model_name = models.CharField(max_length=128)
+    request = models.JSONField(help_text="Validated chat request")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    response = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=64, blank=True, help_text="Worker holding the job's lease")
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['batch', 'line'], name='unique_batch_job_line'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'batch', 'line']),
+            models.Index(fields=['status', 'heartbeat_at']),
+        ]
+        ordering = ['batch', 'line']
+
+    def __str__(self):
+        return f"{self.batch_id}#{self.line} {self.status}"
@@ -1,16 +1,31 @@
 """
 Ollama client for chat completions with streaming support using the official ollama library.
 """
+import asyncio
 import json
 import logging
-from typing import Dict, List, Any, Optional, Iterator
-from django.conf import settings
+import threading
+from typing import Dict, List, Any, Optional, Iterable, Iterator, AsyncIterator, Awaitable, Callable, Tuple
+import httpx
 import ollama
 import uuid
 import time
 
+from .admission import get_admission_controller
+from .client_pool import get_client_registry
+from .model_registry import ModelRegistry
+from .residency import load_stats
+from .resilience import get_hedger, get_retry_policy
+from .router import (
+    CHARS_PER_TOKEN, NoBackendAvailable, OllamaBackend, OllamaRouter,
+    conversation_fingerprint, estimate_tokens, get_router,
+)
+
 logger = logging.getLogger(__name__)
 
+# Admission tenant charged for hedge attempts
+HEDGE_TENANT = 'hedge'
+
 
 class OllamaError(Exception):
     """Base exception for Ollama-related errors."""
@@ -32,15 +47,30 @@ class OllamaClient:
     Ollama client with support for chat completions and streaming.
     
     Uses the official ollama Python library for reliable communication.
+    Requests are routed through an :class:`~chat_models.router.OllamaRouter`:
+    by default the process-wide one built from ``OLLAMA_BACKENDS``, or a
+    single-backend router when ``base_url`` is given explicitly.
     """
     
-    def __init__(self, base_url: Optional[str] = None):
-        self.base_url = base_url or getattr(settings, 'OLLAMA_BASE_URL', 'http://localhost:11434')
-        # Create client with custom host if needed
-        if self.base_url != 'http://localhost:11434':
-            self.client = ollama.Client(host=self.base_url)
-        else:
-            self.client = ollama.Client()
+    def __init__(self, base_url: Optional[str] = None, router: Optional[OllamaRouter] = None):
+        if router is None:
+            router = OllamaRouter.single(base_url) if base_url else get_router()
+        self.router = router
+        self.base_url = router.primary.base_url
+        self.retry_policy = get_retry_policy()
+        self.hedger = get_hedger()
+        self._model_registry: Optional[ModelRegistry] = None
+        self._model_registry_lock = threading.Lock()
+
+    @property
+    def client(self) -> ollama.Client:
+        """Pooled synchronous ``ollama.Client`` for the primary backend."""
+        return get_client_registry().sync_client(self.base_url)
+
+    @property
+    def async_client(self) -> ollama.AsyncClient:
+        """Pooled ``ollama.AsyncClient`` for the primary backend (ASGI path)."""
+        return get_client_registry().async_client(self.base_url)
 
     def _format_messages_for_ollama(self, messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
         """
@@ -49,65 +79,406 @@ class OllamaClient:
         Frontend: [{"role": "user", "content": "Hello", "id": "...", "createdAt": "..."}]
         Ollama:   [{"role": "user", "content": "Hello"}]
         """
-        return [
-            {
-                "role": msg["role"],
-                "content": msg["content"]
-            }
-            for msg in messages
-            if msg.get("role") in ["user", "assistant", "system"] and msg.get("content")
-        ]
+        formatted = []
+        for msg in messages:
+            if msg.get("role") not in ["user", "assistant", "system", "tool"]:
+                continue
+            if msg.get("tool_calls"):
+                # Server-side tool rounds (chat_models.tools)
+                formatted.append({"role": msg["role"], "content": msg.get("content") or "", "tool_calls": msg["tool_calls"]})
+            elif msg.get("content"):
+                formatted.append({"role": msg["role"], "content": msg["content"]})
+        return formatted
 
-    def get_available_models(self) -> List[Dict[str, Any]]:
+    @staticmethod
+    def _is_backend_failure(error: Exception) -> bool:
+        """Whether ``error`` says the backend is unhealthy (vs. a bad request)."""
+        if isinstance(error, ollama.ResponseError):
+            return error.status_code >= 500
+        return isinstance(error, (httpx.TransportError, ConnectionError))
+
+    def _select_backend(
+        self,
+        model: str,
+        prompt_tokens: int,
+        tried: List[OllamaBackend],
+        refresh: bool = True,
+        affinity: Optional[str] = None,
+        exclude: Iterable[OllamaBackend] = (),
+    ) -> Tuple[OllamaBackend, str]:
         """
-        Get list of available models from Ollama.
-        
-        Returns:
-            List of models in frontend-compatible format
+        Pick a backend and affinity outcome, translating routing failures into Ollama errors.
+
+        Retries avoid the backends that already failed until all of them
+        have; ``exclude`` is always avoided.
         """
+        avoid = list(exclude)
+        if any(all(b is not t for t in tried + avoid) for b in self.router.backends):
+            avoid += tried
         try:
-            models_response = self.client.list()
-            models = []
-            
-            for model in models_response.get("models", []):
-                model_id = model["name"]
-                entry = {
-                    "id": model_id,
-                    "name": model_id,
-                }
+            return self.router.route(model, prompt_tokens, affinity=affinity, exclude=avoid, refresh=refresh)
+        except NoBackendAvailable as e:
+            if e.model_missing and not tried:
+                logger.error(f"Model not found: {model}")
+                raise OllamaModelError(f"Model '{model}' not found")
+            logger.error(f"No Ollama backend available for {model}: {e}")
+            raise OllamaConnectionError(f"Unable to connect to Ollama: {e}")
 
-                # Attach size from /list response if available
-                if model.get("size"):
-                    entry["parameterSize"] = model["size"]
+    async def _arefresh_models(self) -> None:
+        """Refresh stale backend model lists on the event loop before routing."""
+        for backend in self.router.backends:
+            await self.router.arefresh_models(backend)
 
-                # Attempt to get richer metadata via `show` for each model.
+    def _failed_attempt(self, model: str, backend: OllamaBackend, error: Exception, tried: List[OllamaBackend]) -> float:
+        """
+        Record a backend failure and return the jittered backoff before the retry.
+
+        Raises the translated error once the attempts or the retry budget
+        are used up.
+        """
+        logger.warning(f"Ollama backend {backend.name} failed: {error}")
+        self.router.record_failure(backend)
+        tried.append(backend)
+        delay = self.retry_policy.backoff(len(tried))
+        if delay is None:
+            raise self._translate_error(model, error)
+        return delay
+
+    def _translate_error(self, model: str, error: Exception) -> OllamaError:
+        if isinstance(error, OllamaError):
+            return error
+        if isinstance(error, ollama.ResponseError):
+            if error.status_code == 404:
+                logger.error(f"Model not found: {model}")
+                return OllamaModelError(f"Model '{model}' not found")
+            logger.error(f"Ollama request failed: {error}")
+            return OllamaConnectionError(f"Request to Ollama failed: {error}")
+        if self._is_backend_failure(error):
+            logger.error(f"Ollama request failed: {error}")
+            return OllamaConnectionError(f"Request to Ollama failed: {error}")
+        logger.error(f"Chat completion error: {error}")
+        return OllamaError(f"Chat completion failed: {error}")
+
+    def _record_prefill(self, backend: OllamaBackend, outcome: str, response: Dict[str, Any]) -> None:
+        """Log prefill time of a finished generation, keyed by its affinity outcome."""
+        self.router.record_prefill(outcome, response)
+        load_stats.record(response)
+        logger.info(
+            f"Prefill on {backend.name} (affinity: {outcome or 'none'}): "
+            f"{response.get('prompt_eval_count', 0)} tokens in "
+            f"{response.get('prompt_eval_duration', 0) / 1e6:.1f} ms"
+        )
+
+    def _routed_request(
+        self,
+        model: str,
+        prompt_tokens: int,
+        call: Callable[[ollama.Client], Any],
+        affinity: Optional[str] = None,
+        exclude: Iterable[OllamaBackend] = (),
+        used: Optional[List[OllamaBackend]] = None,
+        prefill: bool = False,
+    ) -> Any:
+        """
+        Run ``call`` on the least-loaded backend, retrying on backend errors.
+
+        Every backend an attempt is sent to is appended to ``used``; chat
+        calls pass ``prefill`` to record their prefill time.
+        """
+        self.retry_policy.budget.record_request()
+        tried: List[OllamaBackend] = []
+        while True:
+            backend, outcome = self._select_backend(model, prompt_tokens, tried, affinity=affinity, exclude=exclude)
+            if used is not None:
+                used.append(backend)
+            with self.router.lease(backend, prompt_tokens):
                 try:
-                    # Ensure the payload is a mutable dict so we can safely mutate it below.
-                    show_payload = dict(self.client.show(model_id))
-
-                    # Drop fields we explicitly do NOT want to expose
-                    show_payload.pop("license", None)
-                    # Remove very large or unnecessary fields before sending to the frontend
-                    # `modelfile` often contains the full model recipe and can be several KBs,
-                    # while `tensors` is enormous (one entry per model weight tensor). Neither
-                    # is required by the frontend and they dramatically inflate the response.
-                    show_payload.pop("modelfile", None)
-                    show_payload.pop("tensors", None)
-                    mi = show_payload.get("model_info", {})
-                    mi.pop("digest", None)
-
-                    entry["metadata"] = show_payload
+                    response = call(get_client_registry().sync_client(backend.base_url))
                 except Exception as e:
-                    # Non-fatal; log and continue with what we have.
-                    logger.debug(f"Unable to fetch details for {model_id}: {e}")
+                    if not self._is_backend_failure(e):
+                        raise self._translate_error(model, e)
+                    delay = self._failed_attempt(model, backend, e, tried)
+                else:
+                    delay = None
+            if delay is None:
+                self.router.record_success(backend)
+                if prefill:
+                    self._record_prefill(backend, outcome, response)
+                return response
+            time.sleep(delay)
 
-                models.append(entry)
-                
-            return models
-            
+    async def _arouted_request(
+        self,
+        model: str,
+        prompt_tokens: int,
+        call: Callable[[ollama.AsyncClient], Awaitable[Any]],
+        affinity: Optional[str] = None,
+        exclude: Iterable[OllamaBackend] = (),
+        used: Optional[List[OllamaBackend]] = None,
+        prefill: bool = False,
+    ) -> Any:
+        """Async counterpart of :meth:`_routed_request`."""
+        self.retry_policy.budget.record_request()
+        # Model lists are refreshed once per call, off the retry loop; a retry
+        # routes on what this refresh found.
+        await self._arefresh_models()
+        tried: List[OllamaBackend] = []
+        while True:
+            backend, outcome = self._select_backend(
+                model, prompt_tokens, tried, refresh=False, affinity=affinity, exclude=exclude,
+            )
+            if used is not None:
+                used.append(backend)
+            with self.router.lease(backend, prompt_tokens):
+                try:
+                    response = await call(get_client_registry().async_client(backend.base_url))
+                except Exception as e:
+                    if not self._is_backend_failure(e):
+                        raise self._translate_error(model, e)
+                    delay = self._failed_attempt(model, backend, e, tried)
+                else:
+                    delay = None
+            if delay is None:
+                self.router.record_success(backend)
+                if prefill:
+                    self._record_prefill(backend, outcome, response)
+                return response
+            await asyncio.sleep(delay)
+
+    def _can_hedge(self) -> bool:
+        return len(self.router.backends) > 1
+
+    @staticmethod
+    def _admit_hedge(model: str) -> Optional[Callable[[], None]]:
+        """Take an admission slot for a hedge attempt if one is free now; returns its release."""
+        ticket = get_admission_controller().try_admit(model, HEDGE_TENANT)
+        return None if ticket is None else ticket.release
+
+    def _routed_chat(self, model: str, messages: List[Dict[str, Any]], options: Dict[str, Any],
+                     spread: bool = False, tools: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Non-streaming chat on the least-loaded backend, hedged on a second one when slow.
+
+        ``spread`` skips conversation affinity, so the parallel samples of one
+        request (``n > 1``) go to whichever backends are least loaded.
+        ``tools`` are Ollama tool definitions the model may call.
+        """
+        ollama_messages = self._format_messages_for_ollama(messages)
+        prompt_tokens = estimate_tokens(ollama_messages)
+        used: List[OllamaBackend] = []
+
+        def call(client: ollama.Client) -> Dict[str, Any]:
+            # Type ignore: Ollama library expects its own Message sequence; our dict list is accepted at runtime.
+            return client.chat(model=model, messages=ollama_messages, tools=tools, options=options)  # type: ignore
+
+        def primary() -> Dict[str, Any]:
+            affinity = None if spread else conversation_fingerprint(model, ollama_messages)
+            return self._routed_request(model, prompt_tokens, call, affinity=affinity, used=used, prefill=True)
+
+        if not self._can_hedge():
+            return primary()
+        return self.hedger.call(
+            model, primary, lambda: self._routed_request(model, prompt_tokens, call, exclude=used[:1], prefill=True),
+            admit=lambda: self._admit_hedge(model),
+        )
+
+    async def _arouted_chat(self, model: str, messages: List[Dict[str, Any]], options: Dict[str, Any], spread: bool = False,
+                            tools: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Async counterpart of :meth:`_routed_chat`; the losing hedge attempt is cancelled."""
+        ollama_messages = self._format_messages_for_ollama(messages)
+        prompt_tokens = estimate_tokens(ollama_messages)
+        used: List[OllamaBackend] = []
+
+        def call(client: ollama.AsyncClient) -> Awaitable[Dict[str, Any]]:
+            return client.chat(model=model, messages=ollama_messages, tools=tools, options=options)  # type: ignore
+
+        def primary() -> Awaitable[Dict[str, Any]]:
+            affinity = None if spread else conversation_fingerprint(model, ollama_messages)
+            return self._arouted_request(model, prompt_tokens, call, affinity=affinity, used=used, prefill=True)
+
+        if not self._can_hedge():
+            return await primary()
+        return await self.hedger.acall(
+            model, primary, lambda: self._arouted_request(model, prompt_tokens, call, exclude=used[:1], prefill=True),
+            admit=lambda: self._admit_hedge(model),
+        )
+
+    def _routed_stream(self, model: str, messages: List[Dict[str, Any]], options: Dict[str, Any], spread: bool = False,
+                       exclude: Iterable[OllamaBackend] = (), used: Optional[List[OllamaBackend]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Raw chat stream from the least-loaded backend.
+
+        Retries on another backend only while nothing has been yielded yet;
+        the backend's outstanding-work lease is held until the stream is
+        exhausted or closed, and closing it closes the upstream response.
+        ``exclude`` and ``used`` are as for :meth:`_routed_request`.
+        """
+        ollama_messages = self._format_messages_for_ollama(messages)
+        prompt_tokens = estimate_tokens(ollama_messages)
+        affinity = None if spread else conversation_fingerprint(model, ollama_messages)
+        self.retry_policy.budget.record_request()
+        tried: List[OllamaBackend] = []
+        while True:
+            backend, outcome = self._select_backend(model, prompt_tokens, tried, affinity=affinity, exclude=exclude)
+            if used is not None:
+                used.append(backend)
+            with self.router.lease(backend, prompt_tokens):
+                started = False
+                stream = None
+                try:
+                    stream = get_client_registry().sync_client(backend.base_url).chat(  # type: ignore
+                        model=model,
+                        messages=ollama_messages,  # type: ignore[arg-type]
+                        stream=True,
+                        options=options,
+                    )
+                    for chunk in stream:
+                        started = True
+                        if chunk.get('done'):
+                            self._record_prefill(backend, outcome, chunk)
+                        yield chunk
+                except Exception as e:
+                    if started or not self._is_backend_failure(e):
+                        raise self._translate_error(model, e)
+                    delay = self._failed_attempt(model, backend, e, tried)
+                else:
+                    delay = None
+                finally:
+                    # Close the upstream response here rather than when the
+                    # generator is collected: a consumer that hung up
+                    # (GeneratorExit) releases the backend at once.
+                    if stream is not None:
+                        stream.close()
+            if delay is None:
+                self.router.record_success(backend)
+                return
+            time.sleep(delay)
+
+    async def _arouted_stream(self, model: str, messages: List[Dict[str, Any]], options: Dict[str, Any], spread: bool = False,
+                              exclude: Iterable[OllamaBackend] = (),
+                              used: Optional[List[OllamaBackend]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Async counterpart of :meth:`_routed_stream`."""
+        ollama_messages = self._format_messages_for_ollama(messages)
+        prompt_tokens = estimate_tokens(ollama_messages)
+        affinity = None if spread else conversation_fingerprint(model, ollama_messages)
+        self.retry_policy.budget.record_request()
+        await self._arefresh_models()
+        tried: List[OllamaBackend] = []
+        while True:
+            backend, outcome = self._select_backend(
+                model, prompt_tokens, tried, refresh=False, affinity=affinity, exclude=exclude,
+            )
+            if used is not None:
+                used.append(backend)
+            with self.router.lease(backend, prompt_tokens):
+                started = False
+                stream = None
+                try:
+                    stream = await get_client_registry().async_client(backend.base_url).chat(  # type: ignore
+                        model=model,
+                        messages=ollama_messages,  # type: ignore[arg-type]
+                        stream=True,
+                        options=options,
+                    )
+                    async for chunk in stream:
+                        started = True
+                        if chunk.get('done'):
+                            self._record_prefill(backend, outcome, chunk)
+                        yield chunk
+                except Exception as e:
+                    if started or not self._is_backend_failure(e):
+                        raise self._translate_error(model, e)
+                    delay = self._failed_attempt(model, backend, e, tried)
+                else:
+                    delay = None
+                finally:
+                    # On GeneratorExit or CancelledError too, without waiting
+                    # for the event loop's async generator finalizer.
+                    if stream is not None:
+                        await stream.aclose()
+            if delay is None:
+                self.router.record_success(backend)
+                return
+            await asyncio.sleep(delay)
+
+    def _hedged_stream(self, model: str, messages: List[Dict[str, Any]], options: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """
+        Raw chat stream, raced against a second backend when its first chunk is slow.
+
+        See :meth:`~chat_models.resilience.Hedger.stream`; the hedge skips
+        the backend the first attempt was routed to.
+        """
+        if not self._can_hedge():
+            return self._routed_stream(model, messages, options)
+        used: List[OllamaBackend] = []
+        return self.hedger.stream(
+            model,
+            lambda: self._routed_stream(model, messages, options, used=used),
+            lambda: self._routed_stream(model, messages, options, spread=True, exclude=used[:1]),
+            admit=lambda: self._admit_hedge(model),
+        )
+
+    def _ahedged_stream(self, model: str, messages: List[Dict[str, Any]], options: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """Async counterpart of :meth:`_hedged_stream`."""
+        if not self._can_hedge():
+            return self._arouted_stream(model, messages, options)
+        used: List[OllamaBackend] = []
+        return self.hedger.astream(
+            model,
+            lambda: self._arouted_stream(model, messages, options, used=used),
+            lambda: self._arouted_stream(model, messages, options, spread=True, exclude=used[:1]),
+            admit=lambda: self._admit_hedge(model),
+        )
+
+    @property
+    def model_registry(self) -> ModelRegistry:
+        """Cached model listing and metadata for this client's backends."""
+        if self._model_registry is None:
+            with self._model_registry_lock:
+                if self._model_registry is None:
+                    self._model_registry = ModelRegistry.from_settings(self.router)
+        return self._model_registry
+
+    def get_available_models(self) -> List[Dict[str, Any]]:
+        """
+        Get list of available models across all healthy Ollama backends.
+        
+        Served from :attr:`model_registry`, which refreshes in the background.
+        
+        Returns:
+            List of models in frontend-compatible format
+        """
+        return self.model_registry.listing()[0]
+
+    def embed(self, model: str, inputs: List[str]) -> List[List[float]]:
+        """Embed ``inputs`` with ``model`` via ``/api/embed`` on a routed backend."""
+        try:
+            response = self._routed_request(
+                model,
+                sum(len(text) for text in inputs) // CHARS_PER_TOKEN,
+                lambda client: client.embed(model=model, input=inputs),
+            )
+            return response["embeddings"]
         except Exception as e:
-            logger.error(f"Failed to connect to Ollama: {e}")
-            raise OllamaConnectionError(f"Unable to connect to Ollama at {self.base_url}")
+            raise self._translate_error(model, e)
+
+    def raw_chat(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        spread: bool = False,
+        tools: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """Send a non-streaming chat request and return Ollama's raw response."""
+        try:
+            return self._routed_chat(model, messages, {
+                "temperature": temperature,
+                "top_p": top_p,
+            }, spread=spread, tools=tools)
+        except Exception as e:
+            raise self._translate_error(model, e)
 
     def chat_completion(
         self,
@@ -122,32 +493,10 @@ class OllamaClient:
         
         Returns response in OpenAI-compatible format for frontend.
         """
-        try:
-            ollama_messages = self._format_messages_for_ollama(messages)
-            
-            # Type ignore: Ollama library expects its own Message sequence; our dict list is accepted at runtime.
-            response = self.client.chat(  # type: ignore
-                model=model,
-                messages=ollama_messages,  # type: ignore[arg-type]
-                options={
-                    "temperature": temperature,
-                    "top_p": top_p,
-                }
-            )
-            
-            # Convert Ollama response to OpenAI-compatible format
-            return self._format_completion_response(response)
-            
-        except ollama.ResponseError as e:
-            if e.status_code == 404:
-                logger.error(f"Model not found: {model}")
-                raise OllamaModelError(f"Model '{model}' not found")
-            else:
-                logger.error(f"Ollama request failed: {e}")
-                raise OllamaConnectionError(f"Request to Ollama failed: {e}")
-        except Exception as e:
-            logger.error(f"Chat completion error: {e}")
-            raise OllamaError(f"Chat completion failed: {e}")
+        response = self.raw_chat(model, messages, temperature, top_p)
+        
+        # Convert Ollama response to OpenAI-compatible format
+        return self._format_completion_response(response)
 
     def chat_completion_stream(
         self,
@@ -162,35 +511,84 @@ class OllamaClient:
         
         Yields chunks in OpenAI-compatible format for frontend SSE.
         """
+        # One id and timestamp per completion, not per chunk.
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+        created = int(time.time())
         try:
-            ollama_messages = self._format_messages_for_ollama(messages)
-            
-            # Type ignore for same reason as above.
-            stream = self.client.chat(  # type: ignore
-                model=model,
-                messages=ollama_messages,  # type: ignore[arg-type]
-                stream=True,
-                options={
-                    "temperature": temperature,
-                    "top_p": top_p,
-                }
-            )
-            
-            for chunk in stream:
-                formatted_chunk = self._format_streaming_chunk(chunk)
+            for chunk in self.raw_chat_stream(model, messages, temperature, top_p):
+                formatted_chunk = self._format_streaming_chunk(chunk, chunk_id, created)
                 if formatted_chunk:
                     yield formatted_chunk
                     
-        except ollama.ResponseError as e:
-            if e.status_code == 404:
-                logger.error(f"Model not found: {model}")
-                raise OllamaModelError(f"Model '{model}' not found")
-            else:
-                logger.error(f"Ollama streaming request failed: {e}")
-                raise OllamaConnectionError(f"Streaming request to Ollama failed: {e}")
         except Exception as e:
-            logger.error(f"Chat completion streaming error: {e}")
-            raise OllamaError(f"Chat completion streaming failed: {e}")
+            raise self._translate_error(model, e)
+
+    def raw_chat_stream(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        spread: bool = False,
+        hedge: bool = False,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Open a raw Ollama chat stream (unformatted chunks).
+
+        The underlying request is only sent once iteration starts, so errors
+        surface inside the consuming generator. ``hedge`` races a second
+        backend when the first chunk is slow, for a non-streaming request
+        read as a stream.
+        """
+        options = {"temperature": temperature, "top_p": top_p}
+        if hedge:
+            return self._hedged_stream(model, messages, options)
+        return self._routed_stream(model, messages, options, spread=spread)
+
+    async def araw_chat_stream(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        spread: bool = False,
+        hedge: bool = False,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Async counterpart of :meth:`raw_chat_stream` built on ``ollama.AsyncClient``."""
+        options = {"temperature": temperature, "top_p": top_p}
+        if hedge:
+            return self._ahedged_stream(model, messages, options)
+        return self._arouted_stream(model, messages, options, spread=spread)
+
+    async def araw_chat(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        spread: bool = False,
+        tools: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """Async counterpart of :meth:`raw_chat`."""
+        try:
+            return await self._arouted_chat(model, messages, {
+                "temperature": temperature,
+                "top_p": top_p,
+            }, spread=spread, tools=tools)
+        except Exception as e:
+            raise self._translate_error(model, e)
+
+    async def achat_completion(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """Async non-streaming chat completion in OpenAI-compatible format."""
+        response = await self.araw_chat(model, messages, temperature, top_p)
+        return self._format_completion_response(response)
 
     def _format_completion_response(self, ollama_response: Dict[str, Any]) -> Dict[str, Any]:
         """Convert Ollama response to OpenAI-compatible format."""
@@ -217,22 +615,19 @@ class OllamaClient:
             }
         }
 
-    def _format_streaming_chunk(self, ollama_chunk: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def _format_streaming_chunk(self, ollama_chunk: Dict[str, Any], chunk_id: str, created: int) -> Optional[Dict[str, Any]]:
         """Convert Ollama streaming chunk to OpenAI-compatible format."""
         if not ollama_chunk.get("message"):
             return None
             
         content = ollama_chunk["message"].get("content", "")
         
-        # Generate a unique ID for this chunk
-        chunk_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
-        
         if ollama_chunk.get("done"):
             # Final chunk
             return {
                 "id": chunk_id,
                 "object": "chat.completion.chunk",
-                "created": int(time.time()),
+                "created": created,
                 "model": ollama_chunk.get("model", "unknown"),
                 "choices": [{
                     "index": 0,
@@ -253,7 +648,7 @@ class OllamaClient:
             return {
                 "id": chunk_id,
                 "object": "chat.completion.chunk",
-                "created": int(time.time()),
+                "created": created,
                 "model": ollama_chunk.get("model", "unknown"),
                 "choices": [{
                     "index": 0,
@@ -265,9 +660,31 @@ class OllamaClient:
             }
 
     def health_check(self) -> bool:
-        """Check if Ollama is accessible."""
+        """Check if at least one Ollama backend is accessible."""
         try:
-            self.client.list()
-            return True
+            self.router.refresh_all(force=True)
+            now = time.monotonic()
+            return any(b.is_available(now) and not b.consecutive_failures for b in self.router.backends)
         except:
-            return False 
\ No newline at end of file
+            return False
+
+
+_shared_clients: Dict[Optional[str], OllamaClient] = {}
+_shared_clients_lock = threading.Lock()
+
+
+def get_ollama_client(base_url: Optional[str] = None) -> OllamaClient:
+    """Return the process-wide ``OllamaClient``.
+
+    Without ``base_url`` the client routes over every configured backend;
+    with one it is pinned to that host. Views should use this instead of
+    constructing ``OllamaClient()`` per request so connections are kept alive
+    between calls.
+    """
+    if base_url:
+        base_url = get_client_registry().normalize(base_url)
+    client = _shared_clients.get(base_url)
+    if client is None:
+        with _shared_clients_lock:
+            client = _shared_clients.setdefault(base_url, OllamaClient(base_url))
+    return client
@@ -0,0 +1,451 @@
+"""
+Token-bucket rate limiting for chat completions and embeddings.
+
+Every request to ``/v1/chat/completions`` or ``/v1/embeddings`` draws one
+token from each bucket that applies to it:
+
+- ``user``: the authenticated user (``CHAT_RATE_LIMIT_USER``);
+- ``api_key``: the key sent in ``X-API-Key`` or as a non-JWT bearer token
+  (``CHAT_RATE_LIMIT_API_KEY``), identified by its SHA-256 like
+  ``api_keys.ApiKey.key_hash``;
+- ``ip``: the client address (``CHAT_RATE_LIMIT_IP``).
+
+Rate limiting is off unless ``CHAT_RATE_LIMIT_ENABLED`` is set.
+
+Limits are written ``"<requests>/<s|m|h>"``: the bucket holds that many tokens
+and refills continuously over the period. A request is admitted only if every
+bucket has a token; otherwise nothing is consumed and the most constrained
+bucket decides the Retry-After.
+
+Buckets live in one of three backends (``CHAT_RATE_LIMIT_BACKEND``):
+
+- ``memory``: per process, for single-worker deployments;
+- ``redis``: shared through ``REDIS_URL``, checked and updated atomically by a
+  Lua script that uses the Redis clock, so every worker and node agrees;
+- ``fakeredis``: the Redis backend on an in-process ``fakeredis`` server, for
+  tests (requires the ``fakeredis`` package).
+
+Rejections are only counted on the request path. :class:`RejectionRecorder`
+flushes the counts to ``ThreatLog`` every ``CHAT_RATE_LIMIT_FLUSH_SECONDS`` as
+one ``rate_limit`` row per offending identity.
+"""
+import atexit
+import hashlib
+import logging
+import math
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'ratelimit:chat:'
+
+SCOPE_USER = 'user'
+SCOPE_API_KEY = 'api_key'
+SCOPE_IP = 'ip'
+
+_PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def parse_rate(value: str) -> Optional[Tuple[int, float]]:
+    """Parse ``"60/m"`` into ``(burst, period_seconds)``; empty means unlimited."""
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        count, period = value.split('/')
+        return int(count), float(_PERIODS[period.strip().lower()[0]])
+    except (ValueError, KeyError, IndexError):
+        raise ImproperlyConfigured(f"Invalid rate limit {value!r}; expected e.g. '60/m'")
+
+
+class Bucket:
+    """One bucket to draw from: its key and refill parameters."""
+
+    def __init__(self, scope: str, identity: str, burst: int, period: float):
+        self.scope = scope
+        self.identity = identity
+        self.burst = burst
+        self.period = period
+        self.rate = burst / period
+        self.key = f"{KEY_PREFIX}{scope}:{identity}"
+
+    @property
+    def limit(self) -> str:
+        return f"{self.burst}/{self.period:g}s"
+
+
+class RateLimitDecision:
+    """Outcome of a check; ``bucket`` is the most constrained one."""
+
+    def __init__(self, allowed: bool, bucket: Optional[Bucket] = None, remaining: int = 0, retry_after: float = 0.0):
+        self.allowed = allowed
+        self.bucket = bucket
+        self.remaining = remaining
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_seconds(self) -> int:
+        return max(1, math.ceil(self.retry_after))
+
+
+ALLOW_ALL = RateLimitDecision(True)
+
+
+class InProcessBucketBackend:
+    """Token buckets held in this process."""
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        # key -> (tokens, updated_at)
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def consume(self, buckets: Sequence[Bucket]) -> Tuple[bool, int, float, float]:
+        """
+        Take a token from every bucket, or from none.
+
+        Returns ``(allowed, index, remaining, retry_after)`` where ``index`` is
+        the most constrained bucket.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = []
+            for bucket in buckets:
+                tokens, updated_at = self._buckets.get(bucket.key, (bucket.burst, now))
+                levels.append(min(bucket.burst, tokens + (now - updated_at) * bucket.rate))
+            allowed, index, retry_after = _decide(buckets, levels)
+            if allowed:
+                for bucket, tokens in zip(buckets, levels):
+                    self._buckets[bucket.key] = (tokens - 1, now)
+                if len(self._buckets) > self.max_entries:
+                    self._prune(now)
+            return allowed, index, levels[index] - (1 if allowed else 0), retry_after
+
+    def _prune(self, now: float) -> None:
+        # A bucket idle for the longest period ("/h") has refilled completely
+        # whatever its rate, so it carries no state.
+        idle = [key for key, (_, updated_at) in self._buckets.items() if now - updated_at > 3600]
+        for key in idle:
+            del self._buckets[key]
+
+
+# KEYS: bucket keys. ARGV: rate and burst for each key, in order.
+# Returns {allowed, index (1-based), remaining, retry_after} with the numbers as
+# strings, since Redis truncates Lua numbers to integers. Writing after TIME needs
+# effects replication: the default since Redis 5, switched on explicitly before.
+CONSUME_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local levels = {}
+local index, lowest, wait = 1, math.huge, 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        local needed = (1 - tokens) / rate
+        if needed > wait then
+            wait, index = needed, i
+        end
+    elseif wait == 0 and tokens < lowest then
+        lowest, index = tokens, i
+    end
+end
+if wait > 0 then
+    return {0, index, tostring(levels[index]), tostring(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i - 1])
+    local burst = tonumber(ARGV[2 * i])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+end
+return {1, index, tostring(levels[index] - 1), '0'}
+"""
+
+
+class RedisBucketBackend:
+    """Token buckets shared through Redis."""
+
+    def __init__(self, client):
+        self.client = client
+        self._script = client.register_script(CONSUME_SCRIPT)
+
+    @classmethod
+    def from_settings(cls) -> "RedisBucketBackend":
+        redis_url = getattr(settings, 'REDIS_URL', '')
+        if not redis_url:
+            raise ImproperlyConfigured("CHAT_RATE_LIMIT_BACKEND=redis requires REDIS_URL")
+        import redis
+        return cls(redis.Redis.from_url(redis_url))
+
+    def consume(self, buckets: Sequence[Bucket]) -> Tuple[bool, int, float, float]:
+        args: List[Any] = []
+        for bucket in buckets:
+            args.extend((bucket.rate, bucket.burst))
+        allowed, index, remaining, retry_after = self._script(keys=[b.key for b in buckets], args=args)
+        return bool(allowed), int(index) - 1, float(remaining), float(retry_after)
+
+
+def _decide(buckets: Sequence[Bucket], levels: Sequence[float]) -> Tuple[bool, int, float]:
+    """``(allowed, index, retry_after)`` for the given token levels."""
+    waits = [(1 - tokens) / bucket.rate if tokens < 1 else 0.0 for bucket, tokens in zip(buckets, levels)]
+    if max(waits) > 0:
+        index = max(range(len(waits)), key=waits.__getitem__)
+        return False, index, waits[index]
+    return True, min(range(len(levels)), key=levels.__getitem__), 0.0
+
+
+class RejectionRecorder:
+    """Counts rejections in memory and writes them to ``ThreatLog`` in batches."""
+
+    def __init__(self, flush_interval: float = 10.0, max_pending: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # (scope, identity) -> aggregated context
+        self._pending: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.flushed_rows = 0
+
+    def record(self, bucket: Bucket, ip_address: str, user_id: Optional[int], user_agent: str, endpoint: str) -> None:
+        now = timezone.now()
+        with self._lock:
+            entry = self._pending.get((bucket.scope, bucket.identity))
+            if entry is None:
+                entry = self._pending[(bucket.scope, bucket.identity)] = {
+                    "count": 0,
+                    "limit": bucket.limit,
+                    "firstSeen": now,
+                    "endpoint": endpoint,
+                }
+            entry["count"] += 1
+            entry["lastSeen"] = now
+            entry["ip"] = ip_address
+            entry["userId"] = user_id
+            entry["userAgent"] = user_agent
+            full = len(self._pending) >= self.max_pending
+        self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rate-limit-threatlog', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush rate limit rejections: {e}")
+
+    def flush(self) -> int:
+        """Write pending rejections as one ``ThreatLog`` row per identity."""
+        from dashboard.models import ThreatLog
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = []
+        for (scope, identity), entry in pending.items():
+            count = entry["count"]
+            rows.append(ThreatLog(
+                threat_type='rate_limit',
+                severity='high' if count >= 100 else 'medium' if count >= 10 else 'low',
+                ip_address=entry["ip"],
+                user_agent=entry["userAgent"][:500],
+                user_id=entry["userId"],
+                description=f"{count} requests rejected by the {scope} rate limit ({entry['limit']})",
+                raw_data={
+                    "scope": scope,
+                    "identity": identity,
+                    "count": count,
+                    "limit": entry["limit"],
+                    "endpoint": entry["endpoint"],
+                    "firstSeen": entry["firstSeen"].isoformat(),
+                    "lastSeen": entry["lastSeen"].isoformat(),
+                },
+            ))
+        ThreatLog.objects.bulk_create(rows)
+        self.flushed_rows += len(rows)
+        return len(rows)
+
+
+class RateLimiter:
+    """Applies the per-user, per-key and per-IP buckets to a request."""
+
+    def __init__(self, backend, limits: Dict[str, Optional[Tuple[int, float]]], recorder: Optional[RejectionRecorder] = None, enabled: bool = True):
+        self.backend = backend
+        self.limits = limits
+        self.recorder = recorder
+        self.enabled = enabled
+        self.allowed = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_settings(cls) -> "RateLimiter":
+        name = getattr(settings, 'CHAT_RATE_LIMIT_BACKEND', 'memory')
+        if name == 'redis':
+            backend = RedisBucketBackend.from_settings()
+        elif name == 'fakeredis':
+            try:
+                import fakeredis
+            except ImportError:
+                raise ImproperlyConfigured("CHAT_RATE_LIMIT_BACKEND=fakeredis requires the fakeredis package")
+            backend = RedisBucketBackend(fakeredis.FakeRedis())
+        elif name == 'memory':
+            backend = InProcessBucketBackend()
+        else:
+            raise ImproperlyConfigured(f"Unknown CHAT_RATE_LIMIT_BACKEND {name!r}")
+        return cls(
+            backend,
+            limits={
+                SCOPE_USER: parse_rate(getattr(settings, 'CHAT_RATE_LIMIT_USER', '60/m')),
+                SCOPE_API_KEY: parse_rate(getattr(settings, 'CHAT_RATE_LIMIT_API_KEY', '60/m')),
+                SCOPE_IP: parse_rate(getattr(settings, 'CHAT_RATE_LIMIT_IP', '120/m')),
+            },
+            recorder=RejectionRecorder(
+                flush_interval=getattr(settings, 'CHAT_RATE_LIMIT_FLUSH_SECONDS', 10.0),
+            ),
+            enabled=getattr(settings, 'CHAT_RATE_LIMIT_ENABLED', False),
+        )
+
+    @property
+    def is_remote(self) -> bool:
+        return isinstance(self.backend, RedisBucketBackend)
+
+    def buckets_for(self, request) -> List[Bucket]:
+        identities = [
+            (SCOPE_USER, _user_identity(request)),
+            (SCOPE_API_KEY, _api_key_identity(request)),
+            (SCOPE_IP, client_ip(request)),
+        ]
+        buckets = []
+        for scope, identity in identities:
+            limit = self.limits.get(scope)
+            if identity and limit is not None:
+                buckets.append(Bucket(scope, identity, *limit))
+        return buckets
+
+    def check(self, request) -> RateLimitDecision:
+        """Draw a token for ``request``; rejections are queued for ``ThreatLog``."""
+        if not self.enabled:
+            return ALLOW_ALL
+        buckets = self.buckets_for(request)
+        if not buckets:
+            return ALLOW_ALL
+        try:
+            allowed, index, remaining, retry_after = self.backend.consume(buckets)
+        except Exception as e:
+            # Fail open: an unreachable Redis must not take chat down with it.
+            logger.warning(f"Rate limit check failed, allowing request: {e}")
+            return ALLOW_ALL
+        decision = RateLimitDecision(allowed, buckets[index], max(int(remaining), 0), retry_after)
+        if allowed:
+            self.allowed += 1
+            return decision
+        self.rejected += 1
+        if self.recorder is not None:
+            user = getattr(request, 'user', None)
+            self.recorder.record(
+                decision.bucket,
+                ip_address=client_ip(request) or '0.0.0.0',
+                user_id=user.pk if user is not None and user.is_authenticated else None,
+                user_agent=request.META.get('HTTP_USER_AGENT', ''),
+                endpoint=request.path,
+            )
+        return decision
+
+    async def acheck(self, request) -> RateLimitDecision:
+        """Async counterpart of :meth:`check`; Redis round trips run off the event loop."""
+        if self.is_remote:
+            return await sync_to_async(self.check, thread_sensitive=False)(request)
+        return self.check(request)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "threatLogRows": self.recorder.flushed_rows if self.recorder is not None else 0,
+        }
+
+
+def client_ip(request) -> str:
+    forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+    return forwarded.split(',')[0].strip() if forwarded else request.META.get('REMOTE_ADDR', '')
+
+
+def _user_identity(request) -> str:
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return str(user.pk)
+    return ''
+
+
+def _api_key_identity(request) -> str:
+    """SHA-256 of the presented API key; JWTs (three dot-separated parts) are not keys."""
+    key = request.META.get('HTTP_X_API_KEY', '')
+    if not key:
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        if auth.lower().startswith('bearer ') and auth.count('.') != 2:
+            key = auth[7:].strip()
+    return hashlib.sha256(key.encode('utf-8')).hexdigest() if key else ''
+
+
+def rate_limited_body(decision: RateLimitDecision) -> Dict[str, str]:
+    return {
+        "error": "Rate limit exceeded",
+        "message": f"Too many requests for this {decision.bucket.scope.replace('_', ' ')}. "
+                   f"Retry in {decision.retry_after_seconds} seconds.",
+    }
+
+
+def apply_rate_limit_headers(response, decision: RateLimitDecision):
+    """``X-RateLimit-*`` headers for the most constrained bucket (and Retry-After on 429)."""
+    if decision.bucket is None:
+        return response
+    response['X-RateLimit-Limit'] = str(decision.bucket.burst)
+    response['X-RateLimit-Remaining'] = str(decision.remaining)
+    refill = (decision.bucket.burst - decision.remaining) / decision.bucket.rate
+    response['X-RateLimit-Reset'] = str(math.ceil(time.time() + refill))
+    if not decision.allowed:
+        response['Retry-After'] = str(decision.retry_after_seconds)
+    return response
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Return the process-wide chat rate limiter built from settings."""
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter.from_settings()
+    return _limiter
@@ -0,0 +1,246 @@
+"""
+Model residency manager: keep the models people use loaded, unload the rest.
+
+The first request to a cold model pays Ollama's ``load_duration`` inside the
+user's latency. The manager ranks models by demand, using recent
+``RequestLog`` rows plus the daily ``ModelUsageStats`` history. On every
+backend it keeps the top ``OLLAMA_RESIDENCY_TOP_N`` models that fit in
+``OLLAMA_RESIDENCY_MEMORY_BUDGET_GB`` loaded. It does this by preloading them
+(an empty ``/api/generate`` with ``keep_alive=OLLAMA_RESIDENCY_KEEP_ALIVE``)
+and refreshes them every cycle. Loaded models outside that set that have not
+been requested for ``OLLAMA_RESIDENCY_IDLE_SECONDS`` are unloaded
+(``keep_alive=0``).
+
+Run it as a separate process with ``python manage.py manage_residency``. Each
+cycle's report is stored in the default Django cache so the residency endpoint
+can serve it (share it across processes by configuring ``REDIS_URL``).
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from .client_pool import get_client_registry
+from .router import OllamaBackend, OllamaRouter, get_router
+
+logger = logging.getLogger(__name__)
+
+REPORT_CACHE_KEY = 'ollama:residency:report'
+
+# A load_duration above this means the request (or preload) had to load the model.
+COLD_LOAD_SECONDS = 0.5
+
+
+def normalize_model(name: str) -> str:
+    return name if ':' in name else f"{name}:latest"
+
+
+class LoadStats:
+    """Cold vs. warm generations observed on the request path of this process."""
+
+    def __init__(self):
+        self.warm_requests = 0
+        self.cold_requests = 0
+        self.cold_load_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, response: Dict[str, Any]) -> None:
+        load_seconds = (response.get('load_duration') or 0) / 1e9
+        with self._lock:
+            if load_seconds >= COLD_LOAD_SECONDS:
+                self.cold_requests += 1
+                self.cold_load_seconds += load_seconds
+            else:
+                self.warm_requests += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "warmRequests": self.warm_requests,
+                "coldRequests": self.cold_requests,
+                "coldLoadSeconds": round(self.cold_load_seconds, 2),
+            }
+
+
+load_stats = LoadStats()
+
+
+class ResidencyManager:
+    """Plans and applies which models stay resident on each backend."""
+
+    def __init__(
+        self,
+        router: OllamaRouter,
+        top_n: int = 3,
+        memory_budget_bytes: int = 0,
+        idle_seconds: float = 600.0,
+        keep_alive: str = '30m',
+        demand_window_seconds: float = 3600.0,
+        history_days: int = 7,
+    ):
+        self.router = router
+        self.top_n = top_n
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_seconds = idle_seconds
+        self.keep_alive = keep_alive
+        self.demand_window_seconds = demand_window_seconds
+        self.history_days = history_days
+        self.preloads = 0
+        self.unloads = 0
+        # Load time spent by the manager instead of by a user request.
+        self.load_seconds_absorbed = 0.0
+
+    @classmethod
+    def from_settings(cls, router: Optional[OllamaRouter] = None) -> "ResidencyManager":
+        return cls(
+            router or get_router(),
+            top_n=getattr(settings, 'OLLAMA_RESIDENCY_TOP_N', 3),
+            memory_budget_bytes=int(getattr(settings, 'OLLAMA_RESIDENCY_MEMORY_BUDGET_GB', 0.0) * 1024 ** 3),
+            idle_seconds=getattr(settings, 'OLLAMA_RESIDENCY_IDLE_SECONDS', 600.0),
+            keep_alive=getattr(settings, 'OLLAMA_RESIDENCY_KEEP_ALIVE', '30m'),
+            demand_window_seconds=getattr(settings, 'OLLAMA_RESIDENCY_DEMAND_WINDOW_SECONDS', 3600.0),
+        )
+
+    # -- demand ----------------------------------------------------------
+
+    def demand(self) -> Tuple[Dict[str, float], Dict[str, Any]]:
+        """
+        Return ``(scores, last_used)`` per normalized model name.
+
+        The score is requests in the demand window plus the historical daily
+        average scaled to the same window, so a model that is busy every
+        afternoon stays warm through a quiet minute.
+        """
+        from dashboard.models import ModelUsageStats, RequestLog
+
+        now = timezone.now()
+        scores: Dict[str, float] = {}
+        last_used: Dict[str, Any] = {}
+        recent = (
+            RequestLog.objects
+            .filter(endpoint__startswith='/v1/chat/completions', created_at__gte=now - timedelta(seconds=self.demand_window_seconds))
+            .exclude(model_name='')
+            .values('model_name')
+            .annotate(requests=Count('id'), last_used=Max('created_at'))
+        )
+        for row in recent:
+            model = normalize_model(row['model_name'])
+            scores[model] = scores.get(model, 0.0) + row['requests']
+            last_used[model] = max(row['last_used'], last_used.get(model, row['last_used']))
+
+        windows_per_day = 86400.0 / self.demand_window_seconds
+        history = (
+            ModelUsageStats.objects
+            .filter(date__gte=now.date() - timedelta(days=self.history_days))
+            .values('model_name')
+            .annotate(requests=Sum('total_requests'))
+        )
+        for row in history:
+            model = normalize_model(row['model_name'])
+            scores[model] = scores.get(model, 0.0) + (row['requests'] or 0) / (self.history_days * windows_per_day)
+        return scores, last_used
+
+    def plan(self, scores: Dict[str, float], installed: Dict[str, int]) -> List[str]:
+        """Most-demanded installed models that fit the top-N and memory budget."""
+        targets: List[str] = []
+        used = 0
+        for model in sorted(scores, key=scores.get, reverse=True):
+            if len(targets) >= self.top_n:
+                break
+            if model not in installed or scores[model] <= 0:
+                continue
+            size = installed[model]
+            if self.memory_budget_bytes and used + size > self.memory_budget_bytes:
+                continue
+            targets.append(model)
+            used += size
+        return targets
+
+    # -- actions ---------------------------------------------------------
+
+    def preload(self, backend: OllamaBackend, model: str) -> float:
+        """Load ``model`` (or refresh its keep-alive); returns load seconds."""
+        response = get_client_registry().sync_client(backend.base_url).generate(model=model, keep_alive=self.keep_alive)
+        load_seconds = (response.get('load_duration') or 0) / 1e9
+        self.preloads += 1
+        if load_seconds >= COLD_LOAD_SECONDS:
+            self.load_seconds_absorbed += load_seconds
+            logger.info(f"Preloaded {model} on {backend.name} in {load_seconds:.1f}s")
+        return load_seconds
+
+    def unload(self, backend: OllamaBackend, model: str) -> None:
+        get_client_registry().sync_client(backend.base_url).generate(model=model, keep_alive=0)
+        self.unloads += 1
+        logger.info(f"Unloaded idle model {model} from {backend.name}")
+
+    def resident(self, backend: OllamaBackend) -> List[Dict[str, Any]]:
+        """Models currently loaded on ``backend`` according to ``/api/ps``."""
+        response = get_client_registry().sync_client(backend.base_url).ps()
+        return [
+            {
+                "name": m["name"],
+                "size": m.get("size", 0),
+                "sizeVram": m.get("size_vram", 0),
+                "expiresAt": m.get("expires_at"),
+            }
+            for m in response.get("models", [])
+        ]
+
+    def run_once(self) -> Dict[str, Any]:
+        """One planning cycle over every healthy backend; returns a report."""
+        scores, last_used = self.demand()
+        now = timezone.now()
+        report_backends = []
+        for backend in self.router.backends:
+            if not backend.is_available(time.monotonic()):
+                continue
+            entry: Dict[str, Any] = {"name": backend.name, "baseUrl": backend.base_url}
+            try:
+                tags = get_client_registry().sync_client(backend.base_url).list()
+                installed = {m["name"]: m.get("size", 0) for m in tags.get("models", [])}
+                loaded = {m["name"]: m for m in self.resident(backend)}
+                targets = self.plan(scores, installed)
+                for model in targets:
+                    self.preload(backend, model)
+                for model in loaded:
+                    if model in targets:
+                        continue
+                    used_at = last_used.get(model)
+                    if used_at is None or (now - used_at).total_seconds() >= self.idle_seconds:
+                        self.unload(backend, model)
+                entry.update(targets=targets, resident=self.resident(backend))
+            except Exception as e:
+                logger.warning(f"Residency cycle failed on {backend.name}: {e}")
+                entry["error"] = str(e)
+            report_backends.append(entry)
+
+        report = {
+            "updatedAt": now.isoformat(),
+            "demand": {model: round(score, 2) for model, score in sorted(scores.items(), key=lambda i: -i[1])},
+            "backends": report_backends,
+            "preloads": self.preloads,
+            "unloads": self.unloads,
+            "loadSecondsAbsorbed": round(self.load_seconds_absorbed, 2),
+        }
+        cache.set(REPORT_CACHE_KEY, report, timeout=None)
+        return report
+
+    def run_forever(self, interval: float, stop: Optional[threading.Event] = None) -> None:
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Residency cycle failed: {e}")
+            stop.wait(interval)
+
+
+def last_report() -> Optional[Dict[str, Any]]:
+    """Report of the most recent manager cycle, if one has run."""
+    return cache.get(REPORT_CACHE_KEY)
@@ -0,0 +1,588 @@
+"""
+Failure handling for calls to the Ollama backends.
+
+- :class:`CircuitBreaker`: one per backend (held by the router). It opens
+  after ``OLLAMA_BACKEND_MAX_FAILURES`` consecutive failures and stays open
+  for ``OLLAMA_BACKEND_EJECT_SECONDS``, doubling on every reopen up to
+  ``OLLAMA_BACKEND_MAX_EJECT_SECONDS``. It then
+  lets a single probe request through (half-open): success closes it, failure
+  reopens it. Other requests keep avoiding the backend while the probe runs,
+  instead of all of them landing on a host that may still be down.
+- :class:`RetryPolicy`: failed attempts are retried on another backend (or
+  on the same one once all have failed) after a full-jitter exponential
+  backoff, at most ``OLLAMA_RETRY_MAX_ATTEMPTS`` attempts per call. Each retry
+  is paid from a :class:`RetryBudget`: retries within the last window may not
+  exceed ``OLLAMA_RETRY_BUDGET_RATIO`` of the requests plus a small floor, so
+  an outage does not multiply the load on the backends that are left.
+- :class:`Hedger`: a non-streaming chat request still without its first
+  token after the model's observed p95 gets a second attempt on another
+  backend, and the first to answer wins. Single-choice completions are read
+  as streams (:meth:`Hedger.stream`), so the p95 is of the time to the first
+  chunk and the losing stream is closed. The raw calls made for ``n > 1``
+  samples, tool rounds and batches arrive in one piece, so their latency is
+  their time to first token (:meth:`Hedger.call`). A hedge needs a free
+  admission slot, which it holds until it ends, and is paid from the retry
+  budget; without either it is not sent.
+
+Breaker states are reported per backend under ``backends`` on the health
+check, the retry budget and hedge win rates under ``resilience``.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, TypeVar
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Takes an admission slot for a hedge: returns its release, or None when no slot is free
+Admit = Callable[[], Optional[Callable[[], None]]]
+
+# First "item" of a stream that ended without one
+_END = object()
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker for one backend.
+
+    Not thread-safe on its own; :class:`~chat_models.router.OllamaRouter`
+    calls it under its lock.
+    """
+
+    def __init__(self, max_failures: int = 3, open_seconds: float = 15.0, max_open_seconds: float = 300.0):
+        self.max_failures = max_failures
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.failures = 0
+        self.reopens = 0
+        self.opened_total = 0
+        self.open_until = 0.0
+        self.probe_until = 0.0
+
+    def state(self, now: float) -> str:
+        if now < self.open_until:
+            return BREAKER_OPEN
+        return BREAKER_HALF_OPEN if self.opened_total and self.failures >= self.max_failures else BREAKER_CLOSED
+
+    def available(self, now: float) -> bool:
+        """Whether a request may be sent: closed, or half-open with no probe running."""
+        state = self.state(now)
+        return state == BREAKER_CLOSED or (state == BREAKER_HALF_OPEN and now >= self.probe_until)
+
+    def claim(self, now: float) -> None:
+        """Note that a request was routed here; in half-open state it is the probe."""
+        if self.state(now) == BREAKER_HALF_OPEN:
+            # A probe that never reports back (e.g. its client went away)
+            # frees the slot after one open period.
+            self.probe_until = now + self.open_seconds
+
+    def success(self) -> bool:
+        """Close the breaker; returns whether it was tripped."""
+        tripped = self.failures >= self.max_failures
+        self.failures = 0
+        self.reopens = 0
+        self.open_until = 0.0
+        self.probe_until = 0.0
+        return tripped
+
+    def failure(self, now: float) -> Optional[float]:
+        """Count a failure; returns the open period when this one opens the breaker."""
+        if self.state(now) == BREAKER_OPEN:
+            # Requests that were already in flight when it opened
+            return None
+        self.failures += 1
+        if self.failures < self.max_failures:
+            return None
+        seconds = min(self.open_seconds * (2 ** self.reopens), self.max_open_seconds)
+        self.reopens += 1
+        self.opened_total += 1
+        self.open_until = now + seconds
+        self.probe_until = 0.0
+        return seconds
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        return {
+            "state": self.state(now),
+            "openForSeconds": max(0.0, round(self.open_until - now, 1)),
+            "opened": self.opened_total,
+        }
+
+
+class RetryBudget:
+    """
+    Retries allowed over a sliding window of one-second buckets.
+
+    A retry is allowed while retries in the window stay below ``ratio`` of
+    the requests in it, plus ``min_per_second`` for low traffic.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1.0, window: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = max(int(window), 1)
+        # [second, requests, retries]
+        self._buckets: Deque[List[int]] = deque()
+        self._lock = threading.Lock()
+        self.exhausted = 0
+
+    def _bucket(self) -> List[int]:
+        second = int(time.monotonic())
+        while self._buckets and self._buckets[0][0] <= second - self.window:
+            self._buckets.popleft()
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0])
+        return self._buckets[-1]
+
+    def record_request(self) -> None:
+        with self._lock:
+            self._bucket()[1] += 1
+
+    def try_spend(self) -> bool:
+        """Take one retry from the budget, or return False when it is spent."""
+        with self._lock:
+            bucket = self._bucket()
+            requests = sum(b[1] for b in self._buckets)
+            retries = sum(b[2] for b in self._buckets)
+            if retries + 1 > self.ratio * requests + self.min_per_second * self.window:
+                self.exhausted += 1
+                return False
+            bucket[2] += 1
+            return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._bucket()
+            requests = sum(b[1] for b in self._buckets)
+            retries = sum(b[2] for b in self._buckets)
+        return {
+            "windowSeconds": self.window,
+            "requests": requests,
+            "retries": retries,
+            "available": max(int(self.ratio * requests + self.min_per_second * self.window) - retries, 0),
+            "exhausted": self.exhausted,
+        }
+
+
+class RetryPolicy:
+    """Attempt limit and full-jitter exponential backoff, paid from a :class:`RetryBudget`."""
+
+    def __init__(self, budget: RetryBudget, max_attempts: int = 3, base_delay: float = 0.05, max_delay: float = 1.0):
+        self.budget = budget
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_settings(cls) -> "RetryPolicy":
+        return cls(
+            RetryBudget(
+                ratio=getattr(settings, 'OLLAMA_RETRY_BUDGET_RATIO', 0.2),
+                min_per_second=getattr(settings, 'OLLAMA_RETRY_BUDGET_MIN_PER_SECOND', 1.0),
+                window=getattr(settings, 'OLLAMA_RETRY_BUDGET_WINDOW_SECONDS', 10.0),
+            ),
+            max_attempts=getattr(settings, 'OLLAMA_RETRY_MAX_ATTEMPTS', 3),
+            base_delay=getattr(settings, 'OLLAMA_RETRY_BASE_DELAY_MS', 50.0) / 1000,
+            max_delay=getattr(settings, 'OLLAMA_RETRY_MAX_DELAY_MS', 1000.0) / 1000,
+        )
+
+    def backoff(self, failed_attempts: int) -> Optional[float]:
+        """Delay before the next attempt, or None when the call should give up."""
+        if failed_attempts >= self.max_attempts or not self.budget.try_spend():
+            return None
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (failed_attempts - 1))))
+
+
+class _ModelHedges:
+    """Latency window and hedge counters of one model."""
+
+    def __init__(self, window: int):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.failed = 0
+
+
+class Hedger:
+    """
+    Hedges slow non-streaming calls once a model has enough latency samples.
+
+    Whole calls (:meth:`call`) and streams' first chunks (:meth:`stream`) are
+    measured and counted separately.
+    """
+
+    def __init__(self, budget: RetryBudget, enabled: bool = True, quantile: float = 0.95, min_samples: int = 20,
+                 window: int = 200, min_delay: float = 0.05, max_inflight: int = 64):
+        self.budget = budget
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self._models: Dict[str, _ModelHedges] = {}
+        self._streams: Dict[str, _ModelHedges] = {}
+        self._lock = threading.Lock()
+        # Every pooled attempt holds a slot, so attempts never queue in the pool
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix='ollama-hedge')
+
+    @classmethod
+    def from_settings(cls, budget: RetryBudget) -> "Hedger":
+        return cls(
+            budget,
+            enabled=getattr(settings, 'OLLAMA_HEDGE_ENABLED', True),
+            quantile=getattr(settings, 'OLLAMA_HEDGE_QUANTILE', 0.95),
+            min_samples=getattr(settings, 'OLLAMA_HEDGE_MIN_SAMPLES', 20),
+            min_delay=getattr(settings, 'OLLAMA_HEDGE_MIN_DELAY_MS', 50.0) / 1000,
+            max_inflight=getattr(settings, 'OLLAMA_HEDGE_MAX_INFLIGHT', 64),
+        )
+
+    def _model(self, model: str, stream: bool = False) -> _ModelHedges:
+        table = self._streams if stream else self._models
+        stats = table.get(model)
+        if stats is None:
+            stats = table.setdefault(model, _ModelHedges(self.window))
+        return stats
+
+    def _percentile(self, stats: _ModelHedges) -> Optional[float]:
+        if len(stats.latencies) < self.min_samples:
+            return None
+        ordered = sorted(stats.latencies)
+        return ordered[min(int(len(ordered) * self.quantile), len(ordered) - 1)]
+
+    def delay(self, model: str, stream: bool = False) -> Optional[float]:
+        """How long to wait for the first attempt before hedging; None to not hedge."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            threshold = self._percentile(self._model(model, stream))
+        return None if threshold is None else max(threshold, self.min_delay)
+
+    def record(self, model: str, seconds: float, stream: bool = False) -> None:
+        with self._lock:
+            self._model(model, stream).latencies.append(seconds)
+
+    def _count(self, model: str, outcome: str, stream: bool = False) -> None:
+        with self._lock:
+            stats = self._model(model, stream)
+            setattr(stats, outcome, getattr(stats, outcome) + 1)
+
+    def _reserve(self, admit: Optional[Admit]) -> Optional[Callable[[], None]]:
+        """Charge a hedge to admission, then to the retry budget; None when either is spent."""
+        release = _noop if admit is None else admit()
+        if release is None:
+            return None
+        if not self.budget.try_spend():
+            release()
+            return None
+        return release
+
+    def _timed(self, model: str, fn: Callable[[], T]) -> T:
+        started = time.monotonic()
+        result = fn()
+        self.record(model, time.monotonic() - started)
+        return result
+
+    def _pooled(self, model: str, fn: Callable[[], T], release: Callable[[], None] = None) -> T:
+        try:
+            return self._timed(model, fn)
+        finally:
+            self._slots.release()
+            if release is not None:
+                release()
+
+    def call(self, model: str, primary: Callable[[], T], hedge: Callable[[], T], admit: Optional[Admit] = None) -> T:
+        """
+        Run ``primary``, and ``hedge`` too if it is slower than the model's p95.
+
+        ``admit`` charges the hedge to admission control. The losing attempt
+        cannot be interrupted from here; it runs to the end in the
+        background, holding its slot, and its result is dropped.
+        """
+        delay = self.delay(model)
+        if delay is None or not self._slots.acquire(blocking=False):
+            return self._timed(model, primary)
+        first = self._pool.submit(self._pooled, model, primary)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        if not self._slots.acquire(blocking=False):
+            return first.result()
+        release = self._reserve(admit)
+        if release is None:
+            self._slots.release()
+            return first.result()
+        self._count(model, 'hedged')
+        second = self._pool.submit(self._pooled, model, hedge, release)
+        logger.info(f"Hedging {model} call after {delay * 1000:.0f} ms")
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._count(model, 'hedge_wins' if future is second else 'primary_wins')
+                    return future.result()
+        self._count(model, 'failed')
+        return first.result()
+
+    async def acall(self, model: str, primary: Callable[[], Awaitable[T]], hedge: Callable[[], Awaitable[T]],
+                    admit: Optional[Admit] = None) -> T:
+        """Async counterpart of :meth:`call`; the losing attempt is cancelled."""
+        async def timed(fn: Callable[[], Awaitable[T]]) -> T:
+            started = time.monotonic()
+            result = await fn()
+            self.record(model, time.monotonic() - started)
+            return result
+
+        delay = self.delay(model)
+        if delay is None:
+            return await timed(primary)
+        first = asyncio.ensure_future(timed(primary))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            release = None if done else self._reserve(admit)
+            if release is None:
+                return await first
+            self._count(model, 'hedged')
+            second = asyncio.ensure_future(timed(hedge))
+            second.add_done_callback(lambda _: release())
+            tasks.append(second)
+            logger.info(f"Hedging {model} call after {delay * 1000:.0f} ms")
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._count(model, 'hedge_wins' if task is second else 'primary_wins')
+                        return task.result()
+            self._count(model, 'failed')
+            return first.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _first(self, stream: Iterator[T]) -> Any:
+        """First item of ``stream`` (``_END`` if none), read on a pool thread holding a slot."""
+        try:
+            return next(stream, _END)
+        finally:
+            self._slots.release()
+
+    def stream(self, model: str, primary: Callable[[], Iterator[T]], hedge: Callable[[], Iterator[T]],
+               admit: Optional[Admit] = None) -> Iterator[T]:
+        """
+        Iterate ``primary()``, racing ``hedge()`` if its first item is slower than the model's p95.
+
+        The stream that yields first is iterated to the end. The other is
+        closed once its pending read returns, which releases its backend and
+        the hedge's admission slot.
+        """
+        started = time.monotonic()
+        delay = self.delay(model, stream=True)
+        winner = primary()
+        try:
+            if delay is not None and self._slots.acquire(blocking=False):
+                winner, first = self._race(model, winner, hedge, delay, admit)
+            else:
+                first = next(winner, _END)
+            if first is _END:
+                return
+            self.record(model, time.monotonic() - started, stream=True)
+            yield first
+            yield from winner
+        finally:
+            winner.close()
+
+    def _race(self, model: str, primary: Iterator[T], hedge: Callable[[], Iterator[T]], delay: float,
+              admit: Optional[Admit]) -> Any:
+        """``(stream, first item)`` of whichever of ``primary`` and its hedge yields first."""
+        first = self._pool.submit(self._first, primary)
+        try:
+            return primary, first.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        if not self._slots.acquire(blocking=False):
+            return primary, first.result()
+        release = self._reserve(admit)
+        if release is None:
+            self._slots.release()
+            return primary, first.result()
+        self._count(model, 'hedged', stream=True)
+        hedged = _released(hedge(), release)
+        second = self._pool.submit(self._first, hedged)
+        logger.info(f"Hedging {model} stream after {delay * 1000:.0f} ms without a first chunk")
+        streams = {first: primary, second: hedged}
+        pending = set(streams)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._count(model, 'hedge_wins' if future is second else 'primary_wins', stream=True)
+                    loser = second if future is first else first
+                    # A read still blocked on a pool thread cannot be interrupted
+                    loser.add_done_callback(lambda _: streams[loser].close())
+                    return streams[future], future.result()
+        self._count(model, 'failed', stream=True)
+        hedged.close()
+        return primary, first.result()
+
+    async def astream(self, model: str, primary: Callable[[], AsyncIterator[T]], hedge: Callable[[], AsyncIterator[T]],
+                      admit: Optional[Admit] = None) -> AsyncIterator[T]:
+        """Async counterpart of :meth:`stream`; the losing stream's read is cancelled."""
+        started = time.monotonic()
+        delay = self.delay(model, stream=True)
+        winner = primary()
+        try:
+            if delay is None:
+                first = await _anext(winner)
+            else:
+                winner, first = await self._arace(model, winner, hedge, delay, admit)
+            if first is _END:
+                return
+            self.record(model, time.monotonic() - started, stream=True)
+            yield first
+            async for item in winner:
+                yield item
+        finally:
+            await winner.aclose()
+
+    async def _arace(self, model: str, primary: AsyncIterator[T], hedge: Callable[[], AsyncIterator[T]], delay: float,
+                     admit: Optional[Admit]) -> Any:
+        """
+        Async counterpart of :meth:`_race`.
+
+        The loser's read is cancelled and the loser closed before returning;
+        ``primary`` is left to the caller unless the hedge won.
+        """
+        first = asyncio.ensure_future(_anext(primary))
+        tasks = [first]
+        hedged = release = None
+        winner = primary
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            release = None if done else self._reserve(admit)
+            if release is None:
+                return primary, await first
+            self._count(model, 'hedged', stream=True)
+            hedged = _areleased(hedge(), release)
+            second = asyncio.ensure_future(_anext(hedged))
+            tasks.append(second)
+            logger.info(f"Hedging {model} stream after {delay * 1000:.0f} ms without a first chunk")
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._count(model, 'hedge_wins' if task is second else 'primary_wins', stream=True)
+                        winner = hedged if task is second else primary
+                        return winner, task.result()
+            self._count(model, 'failed', stream=True)
+            return primary, first.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if winner is hedged:
+                await primary.aclose()
+            elif hedged is not None:
+                await hedged.aclose()
+                # A hedge cancelled before its first step never reached its own release
+                release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            models = {model: self._stats_snapshot(stats) for model, stats in self._models.items()}
+            streams = {model: self._stats_snapshot(stats) for model, stats in self._streams.items()}
+        return {"enabled": self.enabled, "quantile": self.quantile, "models": models, "streams": streams}
+
+    def _stats_snapshot(self, stats: _ModelHedges) -> Dict[str, Any]:
+        threshold = self._percentile(stats)
+        decided = stats.hedge_wins + stats.primary_wins
+        return {
+            "samples": len(stats.latencies),
+            "hedgeAfterMs": None if threshold is None else round(max(threshold, self.min_delay) * 1000, 1),
+            "hedged": stats.hedged,
+            "hedgeWins": stats.hedge_wins,
+            "primaryWins": stats.primary_wins,
+            "bothFailed": stats.failed,
+            "hedgeWinRate": round(stats.hedge_wins / decided, 3) if decided else None,
+        }
+
+
+def _noop() -> None:
+    pass
+
+
+def _released(stream: Iterator[T], release: Callable[[], None]) -> Iterator[T]:
+    """``stream``, calling ``release`` once it ends or is closed."""
+    try:
+        yield from stream
+    finally:
+        release()
+
+
+async def _areleased(stream: AsyncIterator[T], release: Callable[[], None]) -> AsyncIterator[T]:
+    """Async counterpart of :func:`_released`; closing it closes ``stream``."""
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        try:
+            await stream.aclose()
+        finally:
+            release()
+
+
+async def _anext(stream: AsyncIterator[T]) -> Any:
+    """Next item of ``stream``, or ``_END`` when it is exhausted."""
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+
+_retry_policy: Optional[RetryPolicy] = None
+_hedger: Optional[Hedger] = None
+_resilience_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """Return the process-wide retry policy built from settings."""
+    global _retry_policy
+    if _retry_policy is None:
+        with _resilience_lock:
+            if _retry_policy is None:
+                _retry_policy = RetryPolicy.from_settings()
+    return _retry_policy
+
+
+def get_hedger() -> Hedger:
+    """Return the process-wide hedger, sharing the retry policy's budget."""
+    global _hedger
+    if _hedger is None:
+        budget = get_retry_policy().budget
+        with _resilience_lock:
+            if _hedger is None:
+                _hedger = Hedger.from_settings(budget)
+    return _hedger
+
+
+def resilience_snapshot() -> Dict[str, Any]:
+    """Retry budget and hedging counters for the health check."""
+    return {"retryBudget": get_retry_policy().budget.snapshot(), "hedging": get_hedger().snapshot()}
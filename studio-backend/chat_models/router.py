@@ -0,0 +1,395 @@
+"""
+Least-outstanding-work routing over several Ollama backends.
+
+Backends come from ``settings.OLLAMA_BACKENDS``, a comma-separated list of
+base URLs with optional ``;key=value`` attributes::
+
+    OLLAMA_BACKENDS=http://gpu1:11434,http://gpu2:11434;ctx=131072;name=big
+
+``ctx`` marks a backend whose runners are configured for a large context
+window (``OLLAMA_CONTEXT_LENGTH``/``num_ctx``). Prompts estimated above
+``OLLAMA_LARGE_CONTEXT_TOKENS`` are only sent to backends whose ``ctx`` can
+hold them (falling back to the largest one available).
+
+The router tracks which models each backend has (refreshed from ``/api/tags``),
+how many requests and estimated tokens are outstanding on each, and ejects a
+backend after ``OLLAMA_BACKEND_MAX_FAILURES`` consecutive connection failures
+through its :class:`~chat_models.resilience.CircuitBreaker`. Once the
+cool-down expires a single probe request is routed there; repeated ejections
+back off exponentially.
+
+Conversation affinity: every turn resends the whole history, and Ollama only
+skips prefilling it when the same runner still holds the prefix in its KV
+cache. Requests carrying a conversation fingerprint (model, system prompt and
+first user turn) stick to the backend that served the conversation last, for
+``OLLAMA_AFFINITY_TTL_SECONDS`` after its previous turn. They move to the
+least-loaded backend when the sticky one is unhealthy, lacks the model, or has
+more than ``OLLAMA_AFFINITY_MAX_EXTRA_REQUESTS`` requests outstanding beyond
+it. Prefill time (``prompt_eval_duration``) is aggregated per outcome so the
+gain is visible on the health endpoint.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from django.conf import settings
+
+from .client_pool import get_client_registry
+from .resilience import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+# Rough characters-per-token ratio used when no tokenizer is available.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(messages: Iterable[Dict[str, Any]]) -> int:
+    """Cheap prompt-size estimate (~4 characters per token plus role overhead)."""
+    return sum(len(m.get("content") or "") // CHARS_PER_TOKEN + 4 for m in messages)
+
+
+# Affinity outcomes reported by OllamaRouter.route()
+AFFINITY_WARM = 'warm'    # routed to the backend that served the conversation last
+AFFINITY_NEW = 'new'      # no live binding; bound to the least-loaded backend
+AFFINITY_MOVED = 'moved'  # sticky backend unusable or overloaded; rebound
+
+
+def conversation_fingerprint(model: str, messages: Iterable[Dict[str, Any]]) -> Optional[str]:
+    """Hash of the model and the conversation's opening through its first user turn.
+
+    The opening is identical on every later turn of the same conversation, so
+    it identifies the prefix a runner may still hold in its KV cache.
+    """
+    digest = hashlib.sha1(model.encode('utf-8'))
+    for message in messages:
+        digest.update(b"\0" + message["role"].encode('utf-8') + b"\0" + (message.get("content") or "").encode('utf-8'))
+        if message["role"] == "user":
+            return digest.hexdigest()
+    return None
+
+
+class NoBackendAvailable(Exception):
+    """Raised when no healthy backend can serve the requested model.
+
+    ``model_missing`` distinguishes "backends are up but none has the model"
+    from "every backend is down or ejected".
+    """
+
+    def __init__(self, message: str, model_missing: bool = False):
+        super().__init__(message)
+        self.model_missing = model_missing
+
+
+class OllamaBackend:
+    """Routing state for a single Ollama host."""
+
+    def __init__(self, base_url: str, name: Optional[str] = None, max_context: Optional[int] = None):
+        self.base_url = base_url.rstrip('/')
+        self.name = name or self.base_url
+        self.max_context = max_context
+
+        self.models: Set[str] = set()
+        self.models_refreshed_at = 0.0
+
+        self.outstanding_requests = 0
+        self.outstanding_tokens = 0
+
+        self.breaker = CircuitBreaker()
+
+    @classmethod
+    def parse(cls, spec: str) -> "OllamaBackend":
+        """Build a backend from ``url[;ctx=N][;name=label]``."""
+        url, *attrs = [part.strip() for part in spec.split(';')]
+        options = dict(attr.split('=', 1) for attr in attrs if '=' in attr)
+        max_context = int(options['ctx']) if options.get('ctx') else None
+        return cls(url, name=options.get('name'), max_context=max_context)
+
+    def is_available(self, now: float) -> bool:
+        return self.breaker.available(now)
+
+    @property
+    def consecutive_failures(self) -> int:
+        return self.breaker.failures
+
+    def has_model(self, model: str) -> bool:
+        # Before the first successful refresh we don't know; let it try.
+        if not self.models_refreshed_at:
+            return True
+        return model in self.models or f"{model}:latest" in self.models
+
+    def snapshot(self, now: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "baseUrl": self.base_url,
+            "maxContext": self.max_context,
+            "healthy": self.is_available(now),
+            "ejectedForSeconds": max(0.0, round(self.breaker.open_until - now, 1)),
+            "consecutiveFailures": self.consecutive_failures,
+            "breaker": self.breaker.snapshot(now),
+            "outstandingRequests": self.outstanding_requests,
+            "outstandingTokens": self.outstanding_tokens,
+            "models": sorted(self.models),
+        }
+
+
+class OllamaRouter:
+    """Pick the least-loaded healthy backend that serves a model."""
+
+    def __init__(
+        self,
+        backends: List[OllamaBackend],
+        large_context_tokens: int = 8192,
+        max_failures: int = 3,
+        eject_seconds: float = 15.0,
+        max_eject_seconds: float = 300.0,
+        model_refresh_seconds: float = 30.0,
+        completion_token_reserve: int = 512,
+        affinity_ttl: float = 300.0,
+        affinity_max_extra_requests: int = 2,
+        affinity_max_entries: int = 10000,
+    ):
+        if not backends:
+            raise ValueError("OllamaRouter needs at least one backend")
+        self.backends = backends
+        for backend in backends:
+            backend.breaker = CircuitBreaker(max_failures, eject_seconds, max_eject_seconds)
+        self.large_context_tokens = large_context_tokens
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.model_refresh_seconds = model_refresh_seconds
+        self.completion_token_reserve = completion_token_reserve
+        self.affinity_ttl = affinity_ttl
+        self.affinity_max_extra_requests = affinity_max_extra_requests
+        self.affinity_max_entries = affinity_max_entries
+        self._lock = threading.Lock()
+        # fingerprint -> (backend, expires_at), least recently used first
+        self._affinity: "OrderedDict[str, Tuple[OllamaBackend, float]]" = OrderedDict()
+        # outcome -> [requests, prompt tokens, prefill seconds]
+        self._prefill: Dict[str, List[float]] = {}
+
+    @classmethod
+    def from_settings(cls) -> "OllamaRouter":
+        specs = getattr(settings, 'OLLAMA_BACKENDS', '') or getattr(settings, 'OLLAMA_BASE_URL', 'http://localhost:11434')
+        backends = [OllamaBackend.parse(spec) for spec in specs.split(',') if spec.strip()]
+        return cls(
+            backends,
+            large_context_tokens=getattr(settings, 'OLLAMA_LARGE_CONTEXT_TOKENS', 8192),
+            max_failures=getattr(settings, 'OLLAMA_BACKEND_MAX_FAILURES', 3),
+            eject_seconds=getattr(settings, 'OLLAMA_BACKEND_EJECT_SECONDS', 15.0),
+            max_eject_seconds=getattr(settings, 'OLLAMA_BACKEND_MAX_EJECT_SECONDS', 300.0),
+            model_refresh_seconds=getattr(settings, 'OLLAMA_MODEL_REFRESH_SECONDS', 30.0),
+            affinity_ttl=(
+                getattr(settings, 'OLLAMA_AFFINITY_TTL_SECONDS', 300.0)
+                if getattr(settings, 'OLLAMA_AFFINITY_ENABLED', True) else 0.0
+            ),
+            affinity_max_extra_requests=getattr(settings, 'OLLAMA_AFFINITY_MAX_EXTRA_REQUESTS', 2),
+        )
+
+    @classmethod
+    def single(cls, base_url: str) -> "OllamaRouter":
+        """Router pinned to one backend (used when a base URL is given explicitly)."""
+        return cls([OllamaBackend(base_url)])
+
+    @property
+    def primary(self) -> OllamaBackend:
+        return self.backends[0]
+
+    # -- model discovery -------------------------------------------------
+
+    def _is_stale(self, backend: OllamaBackend, now: float) -> bool:
+        return now - backend.models_refreshed_at >= self.model_refresh_seconds and backend.is_available(now)
+
+    def record_models(self, backend: OllamaBackend, response: Dict[str, Any], now: Optional[float] = None) -> None:
+        """Store a ``/api/tags`` response as the backend's model list."""
+        now = time.monotonic() if now is None else now
+        backend.models = {m["name"] for m in response.get("models", [])}
+        backend.models_refreshed_at = now
+        self.record_success(backend)
+
+    def refresh_models(self, backend: OllamaBackend, force: bool = False) -> Set[str]:
+        """Refresh ``backend.models`` from ``/api/tags`` when stale."""
+        now = time.monotonic()
+        if not (force and backend.is_available(now)) and not self._is_stale(backend, now):
+            return backend.models
+        try:
+            self.record_models(backend, get_client_registry().sync_client(backend.base_url).list(), now)
+        except Exception as e:
+            logger.warning(f"Unable to refresh models on {backend.name}: {e}")
+            self.record_failure(backend)
+        return backend.models
+
+    async def arefresh_models(self, backend: OllamaBackend, force: bool = False) -> Set[str]:
+        """Async counterpart of :meth:`refresh_models` for the event loop."""
+        now = time.monotonic()
+        if not (force and backend.is_available(now)) and not self._is_stale(backend, now):
+            return backend.models
+        try:
+            self.record_models(backend, await get_client_registry().async_client(backend.base_url).list(), now)
+        except Exception as e:
+            logger.warning(f"Unable to refresh models on {backend.name}: {e}")
+            self.record_failure(backend)
+        return backend.models
+
+    def refresh_all(self, force: bool = False) -> None:
+        for backend in self.backends:
+            self.refresh_models(backend, force=force)
+
+    # -- selection -------------------------------------------------------
+
+    def select(
+        self,
+        model: str,
+        prompt_tokens: int = 0,
+        exclude: Iterable[OllamaBackend] = (),
+        refresh: bool = True,
+    ) -> OllamaBackend:
+        """Return the least-loaded healthy backend that has ``model``.
+
+        Pass ``refresh=False`` from async code after awaiting
+        :meth:`arefresh_models`, so discovery never blocks the event loop.
+        """
+        return self.route(model, prompt_tokens, exclude=exclude, refresh=refresh)[0]
+
+    def route(
+        self,
+        model: str,
+        prompt_tokens: int = 0,
+        affinity: Optional[str] = None,
+        exclude: Iterable[OllamaBackend] = (),
+        refresh: bool = True,
+    ) -> Tuple[OllamaBackend, str]:
+        """Like :meth:`select`, honouring the conversation ``affinity`` fingerprint.
+
+        Returns ``(backend, outcome)`` where outcome is one of the
+        ``AFFINITY_*`` constants, or ``''`` when no affinity applies.
+        """
+        excluded = set(id(b) for b in exclude)
+        if refresh:
+            for backend in self.backends:
+                if id(backend) not in excluded:
+                    self.refresh_models(backend)
+
+        now = time.monotonic()
+        with self._lock:
+            available = [b for b in self.backends if id(b) not in excluded and b.is_available(now)]
+            if not available:
+                raise NoBackendAvailable("No healthy Ollama backend available")
+            candidates = [b for b in available if b.has_model(model)]
+            if not candidates:
+                raise NoBackendAvailable(f"No healthy Ollama backend serves model '{model}'", model_missing=True)
+
+            if prompt_tokens >= self.large_context_tokens:
+                fitting = [b for b in candidates if (b.max_context or 0) >= prompt_tokens]
+                if fitting:
+                    candidates = fitting
+                else:
+                    largest = max(b.max_context or 0 for b in candidates)
+                    candidates = [b for b in candidates if (b.max_context or 0) == largest]
+
+            # Least outstanding work first; on ties keep large-context
+            # backends free for the prompts that actually need them.
+            best = min(
+                candidates,
+                key=lambda b: (b.outstanding_tokens, b.outstanding_requests, b.max_context or 0),
+            )
+            if affinity is None or self.affinity_ttl <= 0:
+                best.breaker.claim(now)
+                return best, ''
+
+            outcome = AFFINITY_NEW
+            binding = self._affinity.get(affinity)
+            if binding is not None and binding[1] > now:
+                sticky = binding[0]
+                if (
+                    any(sticky is b for b in candidates)
+                    and sticky.outstanding_requests <= best.outstanding_requests + self.affinity_max_extra_requests
+                ):
+                    best, outcome = sticky, AFFINITY_WARM
+                else:
+                    outcome = AFFINITY_MOVED
+            self._affinity[affinity] = (best, now + self.affinity_ttl)
+            self._affinity.move_to_end(affinity)
+            while len(self._affinity) > self.affinity_max_entries:
+                self._affinity.popitem(last=False)
+            best.breaker.claim(now)
+            return best, outcome
+
+    @contextmanager
+    def lease(self, backend: OllamaBackend, prompt_tokens: int = 0) -> Iterator[OllamaBackend]:
+        """Count a request as outstanding on ``backend`` for the duration of the block."""
+        tokens = prompt_tokens + self.completion_token_reserve
+        with self._lock:
+            backend.outstanding_requests += 1
+            backend.outstanding_tokens += tokens
+        try:
+            yield backend
+        finally:
+            with self._lock:
+                backend.outstanding_requests -= 1
+                backend.outstanding_tokens -= tokens
+
+    # -- health ----------------------------------------------------------
+
+    def record_success(self, backend: OllamaBackend) -> None:
+        with self._lock:
+            recovered = backend.breaker.success()
+        if recovered:
+            logger.info(f"Ollama backend {backend.name} recovered")
+
+    def record_failure(self, backend: OllamaBackend) -> None:
+        with self._lock:
+            cooldown = backend.breaker.failure(time.monotonic())
+        if cooldown is not None:
+            logger.warning(f"Ejecting Ollama backend {backend.name} for {cooldown:.0f}s")
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [b.snapshot(now) for b in self.backends]
+
+    # -- affinity metrics ------------------------------------------------
+
+    def record_prefill(self, outcome: str, response: Dict[str, Any]) -> None:
+        """Aggregate a final chunk's prefill time under its affinity outcome."""
+        if not response.get('prompt_eval_duration'):
+            return
+        with self._lock:
+            totals = self._prefill.setdefault(outcome or 'none', [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += response.get('prompt_eval_count', 0)
+            totals[2] += response['prompt_eval_duration'] / 1e9
+
+    def affinity_snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "enabled": self.affinity_ttl > 0,
+                "activeConversations": sum(1 for _, expires in self._affinity.values() if expires > now),
+                "prefill": {
+                    outcome: {
+                        "requests": int(requests),
+                        "avgPromptTokens": round(tokens / requests, 1),
+                        "avgPrefillMs": round(seconds * 1000 / requests, 2),
+                    }
+                    for outcome, (requests, tokens, seconds) in self._prefill.items()
+                },
+            }
+
+
+_router: Optional[OllamaRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> OllamaRouter:
+    """Return the process-wide router built from settings."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = OllamaRouter.from_settings()
+    return _router
@@ -0,0 +1,187 @@
+"""
+Parallel samples for chat completions with ``n > 1``.
+
+Instead of clients firing ``n`` identical requests, one request runs its
+samples concurrently:
+
+- each sample is a generation of its own: it takes its own admission slot
+  (so ``n`` never exceeds the model's concurrency limit, the excess waits in
+  the queue like any request) and its own upstream stream;
+- the first sample keeps the conversation's backend affinity, the others are
+  routed with ``spread=True`` to the least-loaded backends, whose outstanding
+  work already counts the samples placed before them, so samples fan out
+  across backends where more than one serves the model;
+- streamed samples are coalesced independently and interleaved as they
+  arrive, as ``(index, chunk)`` pairs for
+  :func:`~chat_models.streaming.encode_choices`.
+
+Samples never use the completion cache or request coalescing: identical
+prompts are expected to produce different answers here.
+"""
+import asyncio
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, List, Tuple
+
+from .admission import get_admission_controller
+from .ollama_client import OllamaClient
+from .streaming import ChoiceStats, acoalesce_deltas, coalesce_deltas
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def _options(cleaned_data: Dict[str, Any], index: int) -> Dict[str, Any]:
+    return {
+        "model": cleaned_data['model'],
+        "messages": cleaned_data['messages'],
+        "temperature": cleaned_data.get('temperature', 0.7),
+        "top_p": cleaned_data.get('top_p', 0.9),
+        "spread": index > 0,
+    }
+
+
+def sample_stream(client: OllamaClient, cleaned_data: Dict[str, Any], stats: ChoiceStats,
+                  tenant: str, lane: int) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Stream ``len(stats.choices)`` samples at once, one producer thread each.
+
+    Closing the iterator stops the producers, which close their upstream
+    streams and release their admission slots. The first sample error is
+    raised to the consumer.
+    """
+    n = len(stats.choices)
+    chunks: "queue.Queue[Tuple[int, Any]]" = queue.Queue()
+    stop = threading.Event()
+    admission = get_admission_controller()
+
+    def produce(index: int) -> None:
+        ticket = None
+        stream = None
+        try:
+            ticket = admission.admit(cleaned_data['model'], tenant, lane)
+            if stop.is_set():
+                return
+            stream = coalesce_deltas(client.raw_chat_stream(**_options(cleaned_data, index)), stats=stats.choices[index])
+            for chunk in stream:
+                if stop.is_set():
+                    return
+                chunks.put((index, chunk))
+            chunks.put((index, _DONE))
+        except Exception as e:
+            chunks.put((index, e))
+        finally:
+            if stream is not None:
+                stream.close()
+            if ticket is not None:
+                ticket.release()
+
+    for index in range(n):
+        threading.Thread(target=produce, args=(index,), name=f'chat-sample-{index}', daemon=True).start()
+
+    try:
+        remaining = n
+        while remaining:
+            index, item = chunks.get()
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield index, item
+    finally:
+        stop.set()
+
+
+async def asample_stream(client: OllamaClient, cleaned_data: Dict[str, Any], stats: ChoiceStats,
+                         tenant: str, lane: int) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """Async counterpart of :func:`sample_stream`, one task per sample."""
+    n = len(stats.choices)
+    chunks: "asyncio.Queue[Tuple[int, Any]]" = asyncio.Queue()
+    admission = get_admission_controller()
+
+    async def produce(index: int) -> None:
+        ticket = None
+        try:
+            ticket = await admission.aadmit(cleaned_data['model'], tenant, lane)
+            stream = acoalesce_deltas(await client.araw_chat_stream(**_options(cleaned_data, index)),
+                                      stats=stats.choices[index])
+            try:
+                async for chunk in stream:
+                    chunks.put_nowait((index, chunk))
+            finally:
+                await stream.aclose()
+            chunks.put_nowait((index, _DONE))
+        except Exception as e:
+            chunks.put_nowait((index, e))
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    tasks = [asyncio.ensure_future(produce(index)) for index in range(n)]
+    try:
+        remaining = n
+        while remaining:
+            index, item = await chunks.get()
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield index, item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def sample_completions(client: OllamaClient, cleaned_data: Dict[str, Any], n: int,
+                       tenant: str, lane: int) -> List[Dict[str, Any]]:
+    """Run ``n`` non-streaming samples concurrently; raw Ollama responses in order."""
+    admission = get_admission_controller()
+
+    def run(index: int) -> Dict[str, Any]:
+        ticket = admission.admit(cleaned_data['model'], tenant, lane)
+        try:
+            return client.raw_chat(**_options(cleaned_data, index))
+        finally:
+            ticket.release()
+
+    with ThreadPoolExecutor(max_workers=n, thread_name_prefix='chat-sample') as executor:
+        return list(executor.map(run, range(n)))
+
+
+async def asample_completions(client: OllamaClient, cleaned_data: Dict[str, Any], n: int,
+                              tenant: str, lane: int) -> List[Dict[str, Any]]:
+    """Async counterpart of :func:`sample_completions`."""
+    admission = get_admission_controller()
+
+    async def run(index: int) -> Dict[str, Any]:
+        ticket = await admission.aadmit(cleaned_data['model'], tenant, lane)
+        try:
+            return await client.araw_chat(**_options(cleaned_data, index))
+        finally:
+            ticket.release()
+
+    return list(await asyncio.gather(*(run(index) for index in range(n))))
+
+
+def format_choices(client: OllamaClient, responses: List[Dict[str, Any]], stats: ChoiceStats) -> Dict[str, Any]:
+    """One OpenAI-compatible completion holding every sample as an indexed choice."""
+    body = client._format_completion_response(responses[0])
+    choices = []
+    for index, response in enumerate(responses):
+        stats.finish(index, response)
+        choice = client._format_completion_response(response)['choices'][0]
+        choices.append(dict(choice, index=index))
+    body['choices'] = choices
+    prompt_tokens = stats.prompt_tokens or 0
+    body['usage'] = {
+        "promptTokens": prompt_tokens,
+        "completionTokens": stats.completion_tokens,
+        "totalTokens": prompt_tokens + stats.completion_tokens,
+    }
+    return body
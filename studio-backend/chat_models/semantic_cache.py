@@ -0,0 +1,189 @@
+"""
+Opt-in semantic response cache for near-paraphrased chat prompts.
+
+The final user turn is embedded through Ollama's embeddings API and compared
+(cosine similarity) against the recent prompts cached for the same model. A
+match at or above ``CHAT_SEMANTIC_CACHE_THRESHOLD`` whose preceding
+conversation (everything before the final user turn) is identical returns the
+stored answer.
+
+Vectors live in a fixed-capacity NumPy matrix per model, optionally backed by
+a memory-mapped file under ``CHAT_SEMANTIC_CACHE_MMAP_DIR``. When an index is
+full the least recently used entry is overwritten; entries older than the TTL
+are ignored and reused first.
+
+The embedding function is injectable (``embed_fn(texts) -> vectors``) so the
+cache can run offline against a stub.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from .ollama_client import get_ollama_client
+
+logger = logging.getLogger(__name__)
+
+EmbedFn = Callable[[List[str]], Sequence[Sequence[float]]]
+
+
+def split_prompt(messages: List[Dict[str, Any]]) -> Tuple[str, str]:
+    """Return (hash of the preceding conversation, final user turn text)."""
+    last_user = max((i for i, m in enumerate(messages) if m["role"] == "user"), default=None)
+    if last_user is None:
+        return "", ""
+    context = hashlib.sha256()
+    for message in messages[:last_user]:
+        context.update(message["role"].encode('utf-8') + b"\0" + message["content"].encode('utf-8') + b"\0")
+    # Trailing messages after the final user turn (e.g. a system nudge) also
+    # change the answer, so they are part of the context too.
+    for message in messages[last_user + 1:]:
+        context.update(b"after\0" + message["role"].encode('utf-8') + b"\0" + message["content"].encode('utf-8'))
+    return context.hexdigest(), messages[last_user]["content"]
+
+
+class VectorIndex:
+    """Fixed-capacity cosine-similarity index with LRU replacement."""
+
+    def __init__(self, dim: int, capacity: int, ttl: float, mmap_path: Optional[str] = None):
+        self.dim = dim
+        self.capacity = capacity
+        self.ttl = ttl
+        if mmap_path:
+            # The file only backs the vector matrix, keeping large indexes out
+            # of the Python heap; answers stay in memory, so it starts empty.
+            self.vectors = np.memmap(mmap_path, dtype=np.float32, mode='w+', shape=(capacity, dim))
+        else:
+            self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.created_at = np.zeros(capacity, dtype=np.float64)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.contexts: List[str] = [""] * capacity
+        self.values: List[Optional[Dict[str, Any]]] = [None] * capacity
+
+    def search(self, vector: np.ndarray, context: str, now: float) -> Tuple[int, float]:
+        """Best live slot for ``vector`` within ``context`` as (slot, score); slot -1 if none."""
+        live = self.used & (self.created_at >= now - self.ttl)
+        if not live.any():
+            return -1, 0.0
+        scores = self.vectors @ vector
+        scores[~live] = -np.inf
+        for slot in np.argsort(scores)[::-1]:
+            if not np.isfinite(scores[slot]):
+                break
+            if self.contexts[slot] == context:
+                return int(slot), float(scores[slot])
+        return -1, 0.0
+
+    def add(self, vector: np.ndarray, context: str, value: Dict[str, Any], now: float) -> int:
+        expired = self.used & (self.created_at < now - self.ttl)
+        if not self.used.all():
+            slot = int(np.argmin(self.used))
+        elif expired.any():
+            slot = int(np.argmax(expired))
+        else:
+            slot = int(np.argmin(self.last_used))
+        self.vectors[slot] = vector
+        self.used[slot] = True
+        self.created_at[slot] = now
+        self.last_used[slot] = now
+        self.contexts[slot] = context
+        self.values[slot] = value
+        return slot
+
+    def __len__(self) -> int:
+        return int(self.used.sum())
+
+
+class SemanticCache:
+    """Per-model vector indexes of recent prompts and their answers."""
+
+    def __init__(
+        self,
+        embed_fn: EmbedFn,
+        threshold: float = 0.95,
+        capacity: int = 2048,
+        ttl: float = 3600.0,
+        mmap_dir: Optional[str] = None,
+    ):
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self.mmap_dir = mmap_dir
+        self._indexes: Dict[str, VectorIndex] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "SemanticCache":
+        embed_model = getattr(settings, 'CHAT_SEMANTIC_CACHE_EMBED_MODEL', 'nomic-embed-text')
+        return cls(
+            embed_fn=ollama_embedder(embed_model),
+            threshold=getattr(settings, 'CHAT_SEMANTIC_CACHE_THRESHOLD', 0.95),
+            capacity=getattr(settings, 'CHAT_SEMANTIC_CACHE_CAPACITY', 2048),
+            ttl=getattr(settings, 'CHAT_SEMANTIC_CACHE_TTL_SECONDS', 3600.0),
+            mmap_dir=getattr(settings, 'CHAT_SEMANTIC_CACHE_MMAP_DIR', '') or None,
+        )
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embed_fn([text])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _index(self, model: str, dim: int) -> VectorIndex:
+        index = self._indexes.get(model)
+        if index is None or index.dim != dim:
+            mmap_path = None
+            if self.mmap_dir:
+                os.makedirs(self.mmap_dir, exist_ok=True)
+                safe = hashlib.sha1(model.encode('utf-8')).hexdigest()[:16]
+                mmap_path = os.path.join(self.mmap_dir, f"{safe}-{dim}.f32")
+            index = VectorIndex(dim, self.capacity, self.ttl, mmap_path)
+            self._indexes[model] = index
+        return index
+
+    def lookup(self, model: str, messages: List[Dict[str, Any]]) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[np.ndarray, str]]]:
+        """
+        Find a cached answer for a paraphrase of the final user turn.
+
+        Returns ``(cached_response_or_None, probe)``; pass ``probe`` back to
+        :meth:`store` on a miss so the prompt is not embedded twice.
+        """
+        context, prompt = split_prompt(messages)
+        if not prompt:
+            return None, None
+        vector = self.embed(prompt)
+        now = time.time()
+        with self._lock:
+            index = self._index(model, vector.shape[0])
+            slot, score = index.search(vector, context, now)
+            if slot >= 0 and score >= self.threshold:
+                index.last_used[slot] = now
+                logger.debug(f"Semantic cache hit for {model} (similarity {score:.3f})")
+                return index.values[slot], (vector, context)
+        return None, (vector, context)
+
+    def store(self, model: str, probe: Optional[Tuple[np.ndarray, str]], response: Dict[str, Any]) -> None:
+        if probe is None:
+            return
+        vector, context = probe
+        with self._lock:
+            self._index(model, vector.shape[0]).add(vector, context, response, time.time())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {model: len(index) for model, index in self._indexes.items()}
+
+
+def ollama_embedder(model: str) -> EmbedFn:
+    """Embedding function backed by Ollama's ``/api/embed``."""
+
+    def embed(texts: List[str]) -> Sequence[Sequence[float]]:
+        return get_ollama_client().embed(model, texts)
+
+    return embed
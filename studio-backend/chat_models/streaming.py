@@ -0,0 +1,523 @@
+"""
+Streaming response generators shared by the sync and async chat views.
+
+:func:`encode_stream` writes a raw Ollama chat stream in the wire protocol of a
+:class:`~chat_models.encoders.StreamEncoder` (Vercel AI SDK data stream by
+default, see :mod:`chat_models.encoders`).
+
+Ollama emits roughly one chunk per token. :func:`coalesce_deltas` merges
+consecutive text deltas into one chunk, and so one frame and one socket write,
+per ``CHAT_STREAM_COALESCE_MS`` window or ``CHAT_STREAM_COALESCE_BYTES``,
+whichever comes first. The first token is always passed through immediately,
+and streams slower than the window are never held back.
+
+:func:`encode_choices` writes the interleaved ``(index, chunk)`` stream of a
+request with ``n > 1`` (see :mod:`chat_models.sampling`) as indexed choices.
+
+:class:`StreamStats` also times the raw chunks as they arrive from Ollama
+(before coalescing), so the request log gets time to first token and
+inter-token latency as the upstream produced them.
+"""
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, AsyncIterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from .encoders import StreamEncoder, VercelDataStreamEncoder
+
+logger = logging.getLogger(__name__)
+
+FINISH_CLIENT_CANCELLED = 'client_cancelled'
+
+# Nanosecond timings Ollama reports on the final chunk of a generation
+OLLAMA_DURATIONS = ('load_duration', 'prompt_eval_duration', 'eval_duration')
+
+ITL_QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentiles_ms(seconds: Iterable[float], quantiles: Iterable[float] = ITL_QUANTILES) -> List[Optional[float]]:
+    """Nearest-rank percentiles of ``seconds``, in milliseconds (None when there are none)."""
+    ordered = sorted(seconds)
+    if not ordered:
+        return [None for _ in quantiles]
+    last = len(ordered) - 1
+    return [round(ordered[min(int(len(ordered) * q), last)] * 1000, 2) for q in quantiles]
+
+
+class StreamStats:
+    """
+    What one streamed response delivered, filled in while it streams.
+
+    ``completion_tokens`` counts the text deltas received from Ollama until
+    the final chunk replaces it with Ollama's own counts. ``finish_reason`` is
+    Ollama's ``done_reason``, ``error`` or ``client_cancelled``.
+
+    :meth:`observe` records when each text delta arrived
+    (``time.monotonic()``): ``first_token_at`` and the gaps between
+    consecutive deltas. The final chunk, empty deltas and tool calls are not
+    tokens and are not timed.
+    ``durations`` holds Ollama's own timings in milliseconds.
+    """
+
+    def __init__(self):
+        self.prompt_tokens: Optional[int] = None
+        self.completion_tokens = 0
+        self.finish_reason = ''
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.token_gaps: List[float] = []
+        self.durations: Dict[str, float] = {}
+
+    def token(self, now: float) -> None:
+        self.completion_tokens += 1
+        if self.last_token_at is None:
+            self.first_token_at = now
+        else:
+            self.token_gaps.append(now - self.last_token_at)
+        self.last_token_at = now
+
+    def observe(self, chunk: Dict[str, Any], now: float) -> None:
+        """Time ``chunk`` if it is a text delta."""
+        if not chunk.get('done') and (chunk.get('message') or {}).get('content'):
+            self.token(now)
+
+    def finish(self, chunk: Dict[str, Any]) -> None:
+        self.prompt_tokens = chunk.get('prompt_eval_count')
+        self.completion_tokens = chunk.get('eval_count') or self.completion_tokens
+        self.finish_reason = chunk.get('done_reason') or 'stop'
+        for key in OLLAMA_DURATIONS:
+            if chunk.get(key):
+                self.durations[key] = chunk[key] / 1e6
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Ollama's generation rate (``eval_count / eval_duration``), else the rate the deltas arrived at."""
+        eval_ms = self.durations.get('eval_duration')
+        if eval_ms and self.completion_tokens:
+            return self.completion_tokens / (eval_ms / 1000)
+        span = sum(self.token_gaps)
+        return len(self.token_gaps) / span if span > 0 else None
+
+    def itl_percentiles(self) -> List[Optional[float]]:
+        """p50, p95 and p99 inter-token latency in milliseconds."""
+        return percentiles_ms(self.token_gaps)
+
+
+class ChoiceStats:
+    """
+    What the ``n`` choices of one response delivered, one :class:`StreamStats` each.
+
+    Exposes the same totals as :class:`StreamStats` for the request log:
+    the prompt counted once, completion tokens summed, and the common
+    ``finish_reason`` (``mixed`` when the choices differ), plus the reason of
+    every choice in ``finish_reasons``.
+    """
+
+    def __init__(self, n: int):
+        self.choices = [StreamStats() for _ in range(n)]
+
+    @property
+    def prompt_tokens(self) -> Optional[int]:
+        counts = [c.prompt_tokens for c in self.choices if c.prompt_tokens is not None]
+        return max(counts) if counts else None
+
+    @property
+    def completion_tokens(self) -> int:
+        return sum(c.completion_tokens for c in self.choices)
+
+    @property
+    def finish_reasons(self) -> List[str]:
+        return [c.finish_reason for c in self.choices]
+
+    @property
+    def finish_reason(self) -> str:
+        reasons = Counter(self.finish_reasons)
+        return next(iter(reasons)) if len(reasons) == 1 else 'mixed'
+
+    @property
+    def finished(self) -> bool:
+        return all(c.finish_reason for c in self.choices)
+
+    @property
+    def first_token_at(self) -> Optional[float]:
+        starts = [c.first_token_at for c in self.choices if c.first_token_at is not None]
+        return min(starts) if starts else None
+
+    @property
+    def durations(self) -> Dict[str, float]:
+        """Ollama's timings summed over the choices."""
+        totals: Dict[str, float] = {}
+        for choice in self.choices:
+            for key, value in choice.durations.items():
+                totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Combined generation rate of the choices, which run concurrently."""
+        rates = [c.tokens_per_second for c in self.choices if c.tokens_per_second is not None]
+        return sum(rates) if rates else None
+
+    def itl_percentiles(self) -> List[Optional[float]]:
+        return percentiles_ms(gap for choice in self.choices for gap in choice.token_gaps)
+
+    def finish(self, index: int, chunk: Dict[str, Any]) -> None:
+        self.choices[index].finish(chunk)
+
+    def interrupt(self, reason: str) -> None:
+        """Mark the choices still generating as ended with ``reason``."""
+        for choice in self.choices:
+            if not choice.finish_reason:
+                choice.finish_reason = reason
+
+
+class DeltaCoalescer:
+    """
+    Merges consecutive text deltas of one raw Ollama chat stream.
+
+    A window opens with the first pending delta and is flushed once it holds
+    ``max_bytes`` or ``window_ms`` have passed. The async path waits for the
+    next chunk only until the deadline (:meth:`time_left`), so an upstream
+    stall never holds a pending delta. A synchronous iterator cannot be
+    waited on with a timeout, so the sync path flushes early instead when the
+    next delta, at the recent inter-token gap, would arrive after the
+    deadline (:meth:`due_before_next`). Once the gap between tokens reaches
+    the window, each token is flushed on arrival.
+    """
+
+    def __init__(self, window_ms: float = 20.0, max_bytes: int = 1024):
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self._parts: List[str] = []
+        self._bytes = 0
+        self._last: Optional[Dict[str, Any]] = None
+        self._opened_at = 0.0
+        self._arrived_at: Optional[float] = None
+        # Moving average of the gap between text deltas
+        self._gap: Optional[float] = None
+
+    @classmethod
+    def from_settings(cls) -> "DeltaCoalescer":
+        return cls(
+            window_ms=getattr(settings, 'CHAT_STREAM_COALESCE_MS', 20.0),
+            max_bytes=getattr(settings, 'CHAT_STREAM_COALESCE_BYTES', 1024),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_bytes > 0
+
+    def feed(self, chunk: Dict[str, Any], now: float) -> List[Dict[str, Any]]:
+        """Chunks to emit now that ``chunk`` arrived (possibly none)."""
+        message = chunk.get('message') or {}
+        content = message.get('content')
+        if chunk.get('done') or not content or message.keys() - {'role', 'content'}:
+            # Final chunks, empty deltas and tool calls pass through unmerged.
+            return self._drain() + [chunk]
+
+        first = self._arrived_at is None
+        if not first:
+            gap = now - self._arrived_at
+            self._gap = gap if self._gap is None else 0.8 * self._gap + 0.2 * gap
+        slow = not first and now - self._arrived_at >= self.window
+        self._arrived_at = now
+        if first:
+            return [chunk]
+
+        if not self._parts:
+            self._opened_at = now
+        self._parts.append(content)
+        self._bytes += len(content.encode('utf-8'))
+        self._last = chunk
+        if slow or self._bytes >= self.max_bytes or now - self._opened_at >= self.window:
+            return self._drain()
+        return []
+
+    def time_left(self, now: float) -> Optional[float]:
+        """Seconds until the pending window is due (at least 0), None when nothing is pending."""
+        if not self._parts:
+            return None
+        return max(self._opened_at + self.window - now, 0.0)
+
+    def due_before_next(self, now: float) -> bool:
+        """Whether the pending window is due before the next delta is expected."""
+        return bool(self._parts) and self._gap is not None and now + self._gap >= self._opened_at + self.window
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """Whatever is pending: at a window's deadline and when the stream ends."""
+        return self._drain()
+
+    def _drain(self) -> List[Dict[str, Any]]:
+        if not self._parts:
+            return []
+        last = self._last
+        if len(self._parts) == 1:
+            merged = last
+        else:
+            # Chunks may be shared with other subscribers of a coalesced
+            # generation, so build a new one rather than editing in place.
+            merged = dict(last)
+            merged['message'] = dict(last['message'], content=''.join(self._parts))
+        self._parts = []
+        self._bytes = 0
+        self._last = None
+        return [merged]
+
+
+def coalesce_deltas(stream: Iterable[Dict[str, Any]], coalescer: Optional[DeltaCoalescer] = None,
+                    stats: Optional[StreamStats] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Apply :class:`DeltaCoalescer` to a synchronous raw Ollama chat stream.
+
+    Closing this generator closes ``stream``, which releases the upstream
+    generation. ``stats`` counts and times the deltas received.
+    """
+    coalescer = coalescer or DeltaCoalescer.from_settings()
+    stats = stats or StreamStats()
+    try:
+        if not coalescer.enabled:
+            for chunk in stream:
+                stats.observe(chunk, time.monotonic())
+                yield chunk
+            return
+        for chunk in stream:
+            now = time.monotonic()
+            stats.observe(chunk, now)
+            yield from coalescer.feed(chunk, now)
+            if coalescer.due_before_next(now):
+                # next() cannot time out: do not hold the window until the next delta
+                yield from coalescer.flush()
+        yield from coalescer.flush()
+    finally:
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+
+
+async def acoalesce_deltas(stream: AsyncIterable[Dict[str, Any]], coalescer: Optional[DeltaCoalescer] = None,
+                           stats: Optional[StreamStats] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Async counterpart of :func:`coalesce_deltas`.
+
+    While a window is pending, the next chunk is awaited only until its
+    deadline; the pending deltas are then flushed and the read continues.
+    """
+    coalescer = coalescer or DeltaCoalescer.from_settings()
+    stats = stats or StreamStats()
+    step: Optional[asyncio.Future] = None
+    try:
+        if not coalescer.enabled:
+            async for chunk in stream:
+                stats.observe(chunk, time.monotonic())
+                yield chunk
+            return
+        iterator = stream.__aiter__()
+        while True:
+            wait = coalescer.time_left(time.monotonic())
+            if step is None and wait is None:
+                # Nothing pending: no deadline to wait for
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                # Kept across a flush, so the upstream read is never cancelled
+                step = step or asyncio.ensure_future(iterator.__anext__())
+                await asyncio.wait({step}, timeout=wait)
+                if not step.done():
+                    # The upstream stalled past the window's deadline
+                    for out in coalescer.flush():
+                        yield out
+                    continue
+                done, step = step, None
+                try:
+                    chunk = done.result()
+                except StopAsyncIteration:
+                    break
+            now = time.monotonic()
+            stats.observe(chunk, now)
+            for out in coalescer.feed(chunk, now):
+                yield out
+        for out in coalescer.flush():
+            yield out
+    finally:
+        if step is not None and not step.done():
+            # Closing a stream while it is being read raises, so stop the read first
+            step.cancel()
+            await asyncio.gather(step, return_exceptions=True)
+        aclose = getattr(stream, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+def encode_stream(stream: Iterable[Dict[str, Any]], encoder: StreamEncoder, request_id: str,
+                  stats: Optional[StreamStats] = None) -> Iterator[bytes]:
+    """
+    Translate a synchronous raw Ollama chat stream into ``encoder``'s wire format.
+
+    The WSGI server closes this generator when a write to a disconnected
+    client fails; the close reaches ``stream`` and the upstream generation,
+    and ``stats`` records ``client_cancelled``.
+    """
+    text = encoder.text
+    stats = stats or StreamStats()
+    try:
+        logger.info(f"[request:{request_id}] Starting {encoder.name} stream generation...")
+
+        for ollama_chunk in stream:
+            if ollama_chunk.get('done'):
+                stats.finish(ollama_chunk)
+                yield encoder.finish(ollama_chunk)
+                break
+            content = ollama_chunk.get('message', {}).get('content')
+            if content:
+                yield text(content)
+
+        logger.info(f"[request:{request_id}] Stream generation completed")
+
+    except GeneratorExit:
+        if not stats.finish_reason:
+            stats.finish_reason = FINISH_CLIENT_CANCELLED
+            logger.info(f"[request:{request_id}] Client disconnected after {stats.completion_tokens} tokens; releasing upstream")
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+        raise
+    except Exception as e:
+        logger.error(f"[request:{request_id}] Stream generation error: {e}")
+        stats.finish_reason = 'error'
+        yield encoder.error(str(e))
+    trailer = encoder.close()
+    if trailer:
+        yield trailer
+
+
+async def aencode_stream(stream: AsyncIterable[Dict[str, Any]], encoder: StreamEncoder, request_id: str,
+                         stats: Optional[StreamStats] = None) -> AsyncIterator[bytes]:
+    """
+    Async counterpart of :func:`encode_stream` for ``ollama.AsyncClient`` streams.
+
+    Django's ASGI handler cancels the response on ``http.disconnect``; the
+    cancellation unwinds through ``stream`` and cancels the upstream request.
+    """
+    text = encoder.text
+    stats = stats or StreamStats()
+    try:
+        logger.info(f"[request:{request_id}] Starting async {encoder.name} stream generation...")
+
+        async for ollama_chunk in stream:
+            if ollama_chunk.get('done'):
+                stats.finish(ollama_chunk)
+                yield encoder.finish(ollama_chunk)
+                break
+            content = ollama_chunk.get('message', {}).get('content')
+            if content:
+                yield text(content)
+
+        logger.info(f"[request:{request_id}] Async stream generation completed")
+
+    except (asyncio.CancelledError, GeneratorExit):
+        if not stats.finish_reason:
+            stats.finish_reason = FINISH_CLIENT_CANCELLED
+            logger.info(f"[request:{request_id}] Client disconnected after {stats.completion_tokens} tokens; releasing upstream")
+        aclose = getattr(stream, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+        raise
+    except Exception as e:
+        logger.error(f"[request:{request_id}] Async stream generation error: {e}")
+        stats.finish_reason = 'error'
+        yield encoder.error(str(e))
+    trailer = encoder.close()
+    if trailer:
+        yield trailer
+
+
+def encode_choices(stream: Iterable[Tuple[int, Dict[str, Any]]], encoder: StreamEncoder, request_id: str,
+                   stats: ChoiceStats) -> Iterator[bytes]:
+    """
+    Translate the interleaved ``(index, chunk)`` stream of ``n`` samples into indexed choices.
+
+    The per-sample streams are already coalesced. The usage of every choice
+    is written once the last one finishes.
+    """
+    text = encoder.choice_text
+    try:
+        logger.info(f"[request:{request_id}] Starting {encoder.name} stream of {len(stats.choices)} choices...")
+
+        for index, ollama_chunk in stream:
+            if ollama_chunk.get('done'):
+                stats.finish(index, ollama_chunk)
+                yield encoder.choice_finish(index, ollama_chunk)
+                continue
+            content = ollama_chunk.get('message', {}).get('content')
+            if content:
+                yield text(index, content)
+        yield encoder.choices_finish(stats.prompt_tokens or 0, stats.completion_tokens)
+
+        logger.info(f"[request:{request_id}] Stream of {len(stats.choices)} choices completed")
+
+    except GeneratorExit:
+        if not stats.finished:
+            stats.interrupt(FINISH_CLIENT_CANCELLED)
+            logger.info(f"[request:{request_id}] Client disconnected after {stats.completion_tokens} tokens; releasing upstream")
+        close = getattr(stream, 'close', None)
+        if close is not None:
+            close()
+        raise
+    except Exception as e:
+        logger.error(f"[request:{request_id}] Stream generation error: {e}")
+        stats.interrupt('error')
+        yield encoder.error(str(e))
+    trailer = encoder.close()
+    if trailer:
+        yield trailer
+
+
+async def aencode_choices(stream: AsyncIterable[Tuple[int, Dict[str, Any]]], encoder: StreamEncoder, request_id: str,
+                          stats: ChoiceStats) -> AsyncIterator[bytes]:
+    """Async counterpart of :func:`encode_choices`."""
+    text = encoder.choice_text
+    try:
+        logger.info(f"[request:{request_id}] Starting async {encoder.name} stream of {len(stats.choices)} choices...")
+
+        async for index, ollama_chunk in stream:
+            if ollama_chunk.get('done'):
+                stats.finish(index, ollama_chunk)
+                yield encoder.choice_finish(index, ollama_chunk)
+                continue
+            content = ollama_chunk.get('message', {}).get('content')
+            if content:
+                yield text(index, content)
+        yield encoder.choices_finish(stats.prompt_tokens or 0, stats.completion_tokens)
+
+        logger.info(f"[request:{request_id}] Async stream of {len(stats.choices)} choices completed")
+
+    except (asyncio.CancelledError, GeneratorExit):
+        if not stats.finished:
+            stats.interrupt(FINISH_CLIENT_CANCELLED)
+            logger.info(f"[request:{request_id}] Client disconnected after {stats.completion_tokens} tokens; releasing upstream")
+        aclose = getattr(stream, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+        raise
+    except Exception as e:
+        logger.error(f"[request:{request_id}] Async stream generation error: {e}")
+        stats.interrupt('error')
+        yield encoder.error(str(e))
+    trailer = encoder.close()
+    if trailer:
+        yield trailer
+
+
+def vercel_ai_stream(stream: Iterable[Dict[str, Any]], request_id: str) -> Iterator[bytes]:
+    """Translate a synchronous raw Ollama chat stream into Vercel data-stream parts."""
+    return encode_stream(stream, VercelDataStreamEncoder(), request_id)
+
+
+def avercel_ai_stream(stream: AsyncIterable[Dict[str, Any]], request_id: str) -> AsyncIterator[bytes]:
+    """Async counterpart of :func:`vercel_ai_stream`."""
+    return aencode_stream(stream, VercelDataStreamEncoder(), request_id)
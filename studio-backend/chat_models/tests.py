@@ -0,0 +1,2106 @@
+"""
+Tests for the chat_models app.
+
+Nothing here needs a real Ollama: embeddings come from stub functions, and
+requests that reach a backend are served by ``chat_models.fake_ollama``.
+"""
+import asyncio
+import base64
+import gc
+import importlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import unittest
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+import httpx
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .admission import AdmissionController, AdmissionRejected
+from .batches import BatchWorkerPool, create_batch, ensure_batch_workers
+from .builtin_tools import MAX_INTEGER_BITS, calculate
+from .async_views import AsyncChatCompletionView, AsyncEmbeddingsView
+from .coalescing import RequestCoalescer, acollect, collect
+from .context import (
+    KEY_PREFIX, MESSAGE_OVERHEAD_TOKENS, POLICY_OFF, POLICY_SUMMARIZE, SUMMARY_PREFIX, ContextFit, ContextManager,
+    TokenEstimator, apply_context_headers,
+)
+from .conversations import ConversationNotFound, ConversationStore, apply_conversation_headers
+from .completion_cache import (
+    CACHE_BYPASS, CACHE_HIT, CACHE_MISS, CompletionCache, InProcessCacheBackend, cache_key,
+)
+from .encoders import (
+    NDJSONEncoder, OpenAISSEEncoder, VercelDataStreamEncoder, create_encoder, error_part, select_protocol, text_part,
+)
+from .embeddings import CACHE_HIT as EMBEDDING_HIT, CACHE_MISS as EMBEDDING_MISS, CACHE_PARTIAL, EmbeddingBatcher
+from .fake_ollama import FakeOllamaServer
+from .model_registry import ModelRegistry
+from .models import Batch, BatchJob, Conversation, Message, MessageContent
+from .ollama_client import OllamaClient, OllamaConnectionError
+from .rate_limit import (
+    SCOPE_API_KEY, SCOPE_IP, SCOPE_USER, InProcessBucketBackend, RateLimiter, RedisBucketBackend, parse_rate,
+)
+from .resilience import Hedger, RetryBudget
+from .router import OllamaBackend, OllamaRouter
+from .sampling import asample_stream, format_choices, sample_completions, sample_stream
+from .semantic_cache import SemanticCache
+from .streaming import ChoiceStats, DeltaCoalescer, StreamStats, acoalesce_deltas, coalesce_deltas, encode_choices
+from .tools import Tool, ToolExecutor, ToolRegistry
+from .validators import ChatMessageValidator, PatternRule, RepetitionRule, ValidationMemo
+from .views import ChatCompletionView, ChatModelList, EmbeddingsView
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+VECTORS = {
+    "What is the capital of France?": [1.0, 0.0, 0.0],
+    "Which city is France's capital?": [0.98, 0.2, 0.0],
+    "How do I bake bread?": [0.0, 1.0, 0.0],
+    "Tell me a joke": [0.0, 0.0, 1.0],
+}
+
+
+# The ASGI deployment's routes (see chat_models.urls with CHAT_ASYNC_STREAMING)
+urlpatterns = [
+    path('v1/chat/completions/', AsyncChatCompletionView.as_view()),
+    path('v1/embeddings/', AsyncEmbeddingsView.as_view()),
+]
+
+
+def stub_embed(texts):
+    return [VECTORS[text] for text in texts]
+
+
+def user(content, *history):
+    return list(history) + [{"role": "user", "content": content}]
+
+
+class SemanticCacheTests(SimpleTestCase):
+    def make_cache(self, **kwargs):
+        options = {"threshold": 0.95, "capacity": 4, "ttl": 60.0}
+        options.update(kwargs)
+        return SemanticCache(stub_embed, **options)
+
+    def remember(self, cache, messages, answer):
+        cached, probe = cache.lookup("m", messages)
+        self.assertIsNone(cached)
+        cache.store("m", probe, {"answer": answer})
+
+    def test_paraphrase_above_threshold_hits(self):
+        cache = self.make_cache()
+        self.remember(cache, user("What is the capital of France?"), "Paris")
+        cached, _ = cache.lookup("m", user("Which city is France's capital?"))
+        self.assertEqual(cached, {"answer": "Paris"})
+
+    def test_similarity_below_threshold_misses(self):
+        cache = self.make_cache(threshold=0.99)
+        self.remember(cache, user("What is the capital of France?"), "Paris")
+        cached, probe = cache.lookup("m", user("Which city is France's capital?"))
+        self.assertIsNone(cached)
+        self.assertIsNotNone(probe)
+
+    def test_different_context_misses(self):
+        cache = self.make_cache()
+        system = {"role": "system", "content": "Answer in French."}
+        self.remember(cache, user("What is the capital of France?"), "Paris")
+        cached, _ = cache.lookup("m", user("What is the capital of France?", system))
+        self.assertIsNone(cached)
+
+    def test_other_model_misses(self):
+        cache = self.make_cache()
+        self.remember(cache, user("What is the capital of France?"), "Paris")
+        cached, _ = cache.lookup("other", user("What is the capital of France?"))
+        self.assertIsNone(cached)
+
+    def test_expired_entry_misses(self):
+        cache = self.make_cache(ttl=60.0)
+        with mock.patch('chat_models.semantic_cache.time.time', return_value=1000.0):
+            self.remember(cache, user("What is the capital of France?"), "Paris")
+        with mock.patch('chat_models.semantic_cache.time.time', return_value=1059.0):
+            self.assertIsNotNone(cache.lookup("m", user("What is the capital of France?"))[0])
+        with mock.patch('chat_models.semantic_cache.time.time', return_value=1061.0):
+            self.assertIsNone(cache.lookup("m", user("What is the capital of France?"))[0])
+
+    def test_full_index_evicts_least_recently_used(self):
+        cache = self.make_cache(capacity=2)
+        with mock.patch('chat_models.semantic_cache.time.time', return_value=1000.0):
+            self.remember(cache, user("What is the capital of France?"), "Paris")
+        with mock.patch('chat_models.semantic_cache.time.time', return_value=1001.0):
+            self.remember(cache, user("How do I bake bread?"), "Knead")
+        with mock.patch('chat_models.semantic_cache.time.time', return_value=1002.0):
+            # A hit makes France the most recently used entry
+            self.assertIsNotNone(cache.lookup("m", user("What is the capital of France?"))[0])
+        with mock.patch('chat_models.semantic_cache.time.time', return_value=1003.0):
+            self.remember(cache, user("Tell me a joke"), "Knock knock")
+            self.assertEqual(cache.stats(), {"m": 2})
+            self.assertIsNotNone(cache.lookup("m", user("What is the capital of France?"))[0])
+            self.assertIsNone(cache.lookup("m", user("How do I bake bread?"))[0])
+
+
+def chunks(*tokens):
+    for token in tokens:
+        yield {"message": {"role": "assistant", "content": token}, "done": False}
+    yield {"message": {"role": "assistant", "content": ""}, "done": True, "eval_count": len(tokens)}
+
+
+class CoalescerTests(SimpleTestCase):
+    def test_join_or_none_without_a_flight(self):
+        self.assertIsNone(RequestCoalescer().join_or_none("k"))
+        self.assertIsNone(RequestCoalescer(enabled=False).join_or_none("k"))
+
+    def test_join_or_none_subscribes_to_the_running_flight(self):
+        coalescer = RequestCoalescer()
+        gate = threading.Event()
+
+        def open_stream():
+            gate.wait(5)
+            return chunks("a", "b")
+
+        first, coalesced = coalescer.join("k", open_stream)
+        self.assertFalse(coalesced)
+        second = coalescer.join_or_none("k")
+        self.assertIsNotNone(second)
+        gate.set()
+        self.assertEqual(collect(first)["message"]["content"], "ab")
+        self.assertEqual(collect(second)["message"]["content"], "ab")
+
+    def test_finished_flight_is_not_joined(self):
+        coalescer = RequestCoalescer()
+        finished = threading.Event()
+        stream, _ = coalescer.join("k", lambda: chunks("a"), on_finish=finished.set)
+        collect(stream)
+        self.assertTrue(finished.wait(5))
+        self.assertIsNone(coalescer.join_or_none("k"))
+
+    def test_join_after_a_flight_started_releases_the_slot(self):
+        coalescer = RequestCoalescer()
+        gate = threading.Event()
+        coalescer.join("k", lambda: gate.wait(5) and chunks("a"))
+        released = mock.Mock()
+        _, coalesced = coalescer.join("k", lambda: chunks("b"), on_finish=released)
+        gate.set()
+        self.assertTrue(coalesced)
+        released.assert_called_once_with()
+
+    def test_disabled_stream_never_iterated_releases(self):
+        released = threading.Event()
+        stream, _ = RequestCoalescer(enabled=False).join("k", lambda: chunks("a"), on_finish=released.set)
+        self.assertFalse(released.is_set())
+        del stream
+        self.assertTrue(released.wait(5))
+
+    def test_collecting_a_stream_under_the_admission_lock_does_not_deadlock(self):
+        controller = AdmissionController(OllamaRouter.single("http://127.0.0.1:1"))
+        ticket = controller.admit("m", "a")
+        stream, _ = RequestCoalescer(enabled=False).join("k", lambda: chunks("a"), on_finish=ticket.release)
+
+        def collect_under_lock():
+            nonlocal stream
+            # The collector can run on any thread, including one inside the controller
+            with controller._lock:
+                del stream
+                gc.collect()
+
+        collector = threading.Thread(target=collect_under_lock, daemon=True)
+        collector.start()
+        collector.join(5)
+        self.assertFalse(collector.is_alive())
+        for _ in range(100):
+            if not controller.snapshot()["active"]:
+                break
+            time.sleep(0.01)
+        self.assertEqual(controller.snapshot()["active"], 0)
+
+    def test_disabled_stream_releases_once(self):
+        released = mock.Mock()
+        stream, _ = RequestCoalescer(enabled=False).join("k", lambda: chunks("a"), on_finish=released)
+        collect(stream)
+        stream.close()
+        del stream
+        released.assert_called_once_with()
+
+    def test_disabled_open_failure_releases(self):
+        released = mock.Mock()
+
+        def open_stream():
+            raise ConnectionError("down")
+
+        with self.assertRaises(ConnectionError):
+            RequestCoalescer(enabled=False).join("k", open_stream, on_finish=released)
+        released.assert_called_once_with()
+
+    def test_disabled_async_stream_never_iterated_releases(self):
+        released = threading.Event()
+
+        async def open_stream():
+            raise AssertionError("never opened")
+
+        async def main():
+            stream, _ = RequestCoalescer(enabled=False).ajoin("k", open_stream, on_finish=released.set)
+            del stream
+
+        asyncio.run(main())
+        self.assertTrue(released.wait(5))
+
+
+class CoalescedFanOutTests(SimpleTestCase):
+    """Late joiners and lagging subscribers see every chunk; one subscriber leaving never stops the others."""
+
+    def gated_upstream(self, gate, closed):
+        def open_stream():
+            try:
+                for index, chunk in enumerate(chunks("a", "b", "c")):
+                    if index == 2:
+                        gate.wait(5)
+                    yield chunk
+            finally:
+                closed.set()
+
+        return open_stream
+
+    def test_late_joiner_catches_up_from_history(self):
+        coalescer = RequestCoalescer()
+        gate, closed = threading.Event(), threading.Event()
+        first, _ = coalescer.join("k", self.gated_upstream(gate, closed))
+        self.assertEqual(texts(next(first) for _ in range(2)), ["a", "b"])
+        second = coalescer.join_or_none("k")
+        gate.set()
+        self.assertEqual(collect(first)["message"]["content"], "c")
+        self.assertEqual(collect(second)["message"]["content"], "abc")
+
+    def test_slow_subscriber_overflowing_its_buffer_reads_from_history(self):
+        coalescer = RequestCoalescer(buffer_size=2)
+        tokens = [str(index) for index in range(20)]
+        finished = threading.Event()
+        gate = threading.Event()
+        fast, _ = coalescer.join("k", lambda: gate.wait(5) and chunks(*tokens), on_finish=finished.set)
+        slow = coalescer.join_or_none("k")
+        gate.set()
+        self.assertEqual(collect(fast)["message"]["content"], "".join(tokens))
+        # The producer was never held back by the subscriber that read nothing
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(collect(slow)["message"]["content"], "".join(tokens))
+
+    def test_leader_closing_early_leaves_followers_streaming(self):
+        coalescer = RequestCoalescer()
+        gate, closed = threading.Event(), threading.Event()
+        leader, _ = coalescer.join("k", self.gated_upstream(gate, closed))
+        follower = coalescer.join_or_none("k")
+        self.assertEqual(texts([next(leader)]), ["a"])
+        leader.close()
+        gate.set()
+        self.assertEqual(collect(follower)["message"]["content"], "abc")
+        self.assertTrue(closed.wait(5))
+
+    def test_upstream_is_closed_once_every_subscriber_left(self):
+        coalescer = RequestCoalescer()
+        gate, closed = threading.Event(), threading.Event()
+        leader, _ = coalescer.join("k", self.gated_upstream(gate, closed))
+        follower = coalescer.join_or_none("k")
+        next(leader)
+        next(follower)
+        leader.close()
+        follower.close()
+        self.assertIsNone(coalescer.join_or_none("k"))
+        gate.set()
+        self.assertTrue(closed.wait(5))
+
+    def test_async_leader_cancelled_leaves_followers_streaming(self):
+        coalescer = RequestCoalescer()
+        upstream_closed = []
+
+        async def open_stream():
+            async def stream():
+                try:
+                    for chunk in chunks("a", "b", "c"):
+                        await asyncio.sleep(0.01)
+                        yield chunk
+                finally:
+                    upstream_closed.append(True)
+
+            return stream()
+
+        async def main():
+            leader, _ = coalescer.ajoin("k", open_stream)
+            follower = coalescer.ajoin_or_none("k")
+            started = asyncio.Event()
+
+            async def consume():
+                async for _ in leader:
+                    started.set()
+
+            task = asyncio.create_task(consume())
+            await started.wait()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(upstream_closed, [])
+            return await acollect(follower)
+
+        self.assertEqual(asyncio.run(main())["message"]["content"], "abc")
+        self.assertEqual(upstream_closed, [True])
+
+class AdmissionControllerTests(SimpleTestCase):
+    def make_controller(self, **kwargs):
+        options = {"model_concurrency": 1, "backend_concurrency": 8, "queue_size": 4, "max_wait": 5.0}
+        options.update(kwargs)
+        return AdmissionController(OllamaRouter.single("http://127.0.0.1:1"), **options)
+
+    def test_queued_request_starts_when_a_slot_is_released(self):
+        controller = self.make_controller()
+        first = controller.admit("m", "a")
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(controller.admit("m", "b")))
+        waiter.start()
+        for _ in range(100):
+            if controller.snapshot()["queued"]:
+                break
+            time.sleep(0.01)
+        self.assertEqual(controller.snapshot()["queued"], 1)
+        first.release()
+        waiter.join(5)
+        self.assertEqual(len(admitted), 1)
+        self.assertEqual(controller.snapshot()["activeByModel"], {"m": 1})
+
+    def test_full_queue_rejects_with_retry_after(self):
+        controller = self.make_controller(queue_size=0)
+        controller.admit("m", "a")
+        with self.assertRaises(AdmissionRejected) as raised:
+            controller.admit("m", "b")
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+
+    def test_release_is_idempotent(self):
+        controller = self.make_controller()
+        ticket = controller.admit("m", "a")
+        ticket.release()
+        ticket.release()
+        self.assertEqual(controller.snapshot()["active"], 0)
+
+
+class RoutingTests(SimpleTestCase):
+    @override_settings(OLLAMA_BACKENDS='http://127.0.0.1:1', OLLAMA_BACKEND_EJECT_SECONDS=5.0,
+                       OLLAMA_BACKEND_MAX_EJECT_SECONDS=42.0)
+    def test_from_settings_caps_the_eject_backoff(self):
+        breaker = OllamaRouter.from_settings().primary.breaker
+        self.assertEqual((breaker.open_seconds, breaker.max_open_seconds), (5.0, 42.0))
+
+    def test_async_retry_refreshes_models_once(self):
+        server = FakeOllamaServer().start()
+        self.addCleanup(server.stop)
+        client = OllamaClient(router=OllamaRouter.single(server.base_url))
+        attempts = []
+
+        async def call(ollama_client):
+            attempts.append(ollama_client)
+            if len(attempts) == 1:
+                raise ConnectionError("connection reset")
+            return {"done": True}
+
+        with mock.patch.object(client.router, 'arefresh_models', wraps=client.router.arefresh_models) as refresh:
+            self.assertEqual(asyncio.run(client._arouted_request("fake-model", 10, call)), {"done": True})
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(refresh.call_count, 1)
+
+
+def gated(gate, *items, closed=None):
+    """Yields ``items`` once ``gate`` is set; sets ``closed`` when it ends or is closed."""
+    try:
+        gate.wait(5)
+        yield from items
+    finally:
+        if closed is not None:
+            closed.set()
+
+
+class HedgerTests(SimpleTestCase):
+    def make_hedger(self):
+        hedger = Hedger(RetryBudget(), min_samples=1, min_delay=0.05)
+        hedger.record("m", 0.05, stream=True)
+        return hedger
+
+    def test_fast_first_chunk_is_not_hedged(self):
+        hedge = mock.Mock()
+        items = self.make_hedger().stream("m", lambda: (item for item in "ab"), hedge)
+        self.assertEqual(list(items), ["a", "b"])
+        hedge.assert_not_called()
+
+    def test_slow_primary_loses_to_the_hedge_and_is_closed(self):
+        hedger = self.make_hedger()
+        gate, closed, released = threading.Event(), threading.Event(), mock.Mock()
+        items = hedger.stream("m", lambda: gated(gate, "slow", closed=closed), lambda: iter(["fast", "!"]),
+                              admit=lambda: released)
+        self.assertEqual(list(items), ["fast", "!"])
+        released.assert_called_once_with()
+        self.assertFalse(closed.is_set())
+        # The primary's read cannot be interrupted; it is closed once it returns
+        gate.set()
+        self.assertTrue(closed.wait(5))
+        self.assertEqual(hedger.snapshot()["streams"]["m"]["hedgeWins"], 1)
+
+    def test_primary_that_answers_first_wins(self):
+        hedger = self.make_hedger()
+        primary_gate, hedge_gate, hedge_closed = threading.Event(), threading.Event(), threading.Event()
+        released = mock.Mock()
+        items = hedger.stream("m", lambda: gated(primary_gate, "primary"),
+                              lambda: gated(hedge_gate, "hedge", closed=hedge_closed), admit=lambda: released)
+        threading.Timer(0.2, primary_gate.set).start()
+        self.assertEqual(list(items), ["primary"])
+        hedge_gate.set()
+        self.assertTrue(hedge_closed.wait(5))
+        released.assert_called_once_with()
+        self.assertEqual(hedger.snapshot()["streams"]["m"]["primaryWins"], 1)
+
+    def test_no_hedge_without_an_admission_slot(self):
+        hedger = self.make_hedger()
+        gate, hedge = threading.Event(), mock.Mock()
+        threading.Timer(0.2, gate.set).start()
+        items = hedger.stream("m", lambda: gated(gate, "primary"), hedge, admit=lambda: None)
+        self.assertEqual(list(items), ["primary"])
+        hedge.assert_not_called()
+        self.assertEqual(hedger.budget.snapshot()["retries"], 0)
+
+    def test_async_loser_is_cancelled_at_once(self):
+        hedger = self.make_hedger()
+        closed, released = asyncio.Event(), mock.Mock()
+
+        async def slow():
+            try:
+                await asyncio.sleep(5)
+                yield "slow"
+            finally:
+                closed.set()
+
+        async def fast():
+            yield "fast"
+
+        async def main():
+            items = [item async for item in hedger.astream("m", slow, fast, admit=lambda: released)]
+            self.assertEqual(items, ["fast"])
+            self.assertTrue(closed.is_set())
+
+        asyncio.run(main())
+        released.assert_called_once_with()
+
+
+class HedgedClientTests(SimpleTestCase):
+    """Single-choice non-streaming generations, hedged across two fake backends."""
+
+    def setUp(self):
+        # The router prefers the first of two idle backends, so the slow one is tried first
+        self.slow = FakeOllamaServer(tokens=3, token_delay=1.0).start()
+        self.fast = FakeOllamaServer(tokens=3, token_delay=0.01).start()
+        self.addCleanup(self.slow.stop)
+        self.addCleanup(self.fast.stop)
+        router = OllamaRouter([OllamaBackend(self.slow.base_url), OllamaBackend(self.fast.base_url)])
+        router.refresh_all()
+        self.client = OllamaClient(router=router)
+        self.client.hedger = Hedger(RetryBudget(), min_samples=1, min_delay=0.05)
+        self.client.hedger.record("fake-model", 0.05, stream=True)
+        self.admission = AdmissionController(router)
+        patcher = mock.patch('chat_models.admission._controller', self.admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_slow_backend_released(self):
+        for _ in range(150):
+            stats = httpx.get(f"{self.slow.base_url}/_fake/stats").json()
+            if stats["cancelledStreams"] == 1 and stats["activeStreams"] == 0:
+                break
+            time.sleep(0.02)
+        self.assertEqual((stats["cancelledStreams"], stats["activeStreams"]), (1, 0))
+        self.assertEqual(self.admission.snapshot()["active"], 0)
+        self.assertEqual(self.client.hedger.snapshot()["streams"]["fake-model"]["hedgeWins"], 1)
+
+    def test_sync_stream_is_answered_by_the_hedge(self):
+        started = time.monotonic()
+        stream = self.client.raw_chat_stream("fake-model", user("Hello"), hedge=True)
+        self.assertEqual(collect(stream)["message"]["content"], "tok0 tok1 tok2 ")
+        self.assertLess(time.monotonic() - started, 0.9)
+        # As the coalescer's flight does once the generation is read
+        stream.close()
+        self.assert_slow_backend_released()
+
+    def test_async_stream_is_answered_by_the_hedge(self):
+        async def main():
+            started = time.monotonic()
+            stream = await self.client.araw_chat_stream("fake-model", user("Hello"), hedge=True)
+            self.assertEqual((await acollect(stream))["message"]["content"], "tok0 tok1 tok2 ")
+            self.assertLess(time.monotonic() - started, 0.9)
+            await stream.aclose()
+            # The slow backend only notices the disconnect at its first write
+            await asyncio.to_thread(self.assert_slow_backend_released)
+
+        asyncio.run(main())
+
+
+class RateLimiterTests(SimpleTestCase):
+    """The token-bucket limits, against the in-process backend."""
+
+    def make_backend(self):
+        return InProcessBucketBackend()
+
+    def make_limiter(self, backend=None, user="2/m", api_key="", ip="3/m"):
+        return RateLimiter(
+            backend or self.make_backend(),
+            limits={SCOPE_USER: parse_rate(user), SCOPE_API_KEY: parse_rate(api_key), SCOPE_IP: parse_rate(ip)},
+        )
+
+    def request(self, user_id=None, ip="10.0.0.1"):
+        request = RequestFactory().post('/v1/chat/completions', REMOTE_ADDR=ip)
+        request.user = mock.Mock(pk=user_id, is_authenticated=True) if user_id else AnonymousUser()
+        return request
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate("60/m"), (60, 60.0))
+        self.assertEqual(parse_rate("5/second"), (5, 1.0))
+        self.assertIsNone(parse_rate(""))
+        with self.assertRaises(ImproperlyConfigured):
+            parse_rate("60 per minute")
+
+    def test_burst_then_reject_with_retry_after(self):
+        limiter = self.make_limiter()
+        self.assertTrue(limiter.check(self.request(user_id=1)).allowed)
+        self.assertTrue(limiter.check(self.request(user_id=1)).allowed)
+        decision = limiter.check(self.request(user_id=1))
+        self.assertFalse(decision.allowed)
+        self.assertEqual(decision.bucket.scope, SCOPE_USER)
+        self.assertEqual(decision.remaining, 0)
+        self.assertEqual(decision.retry_after_seconds, 30)
+        self.assertEqual((limiter.allowed, limiter.rejected), (2, 1))
+
+    def test_rejection_consumes_no_other_bucket(self):
+        limiter = self.make_limiter()
+        limiter.check(self.request(user_id=1))
+        limiter.check(self.request(user_id=1))
+        # User 1 is out of tokens: the shared IP keeps its third token for user 2
+        self.assertFalse(limiter.check(self.request(user_id=1)).allowed)
+        self.assertTrue(limiter.check(self.request(user_id=2)).allowed)
+        self.assertFalse(limiter.check(self.request(user_id=3)).allowed)
+
+    def test_clients_have_their_own_buckets(self):
+        limiter = self.make_limiter(ip="1/m")
+        self.assertTrue(limiter.check(self.request(ip="10.0.0.1")).allowed)
+        self.assertTrue(limiter.check(self.request(ip="10.0.0.2")).allowed)
+        self.assertFalse(limiter.check(self.request(ip="10.0.0.1")).allowed)
+
+    def test_disabled_allows_everything(self):
+        limiter = self.make_limiter(ip="1/m")
+        limiter.enabled = False
+        for _ in range(3):
+            self.assertTrue(limiter.check(self.request()).allowed)
+
+    def test_backend_failure_fails_open(self):
+        backend = mock.Mock()
+        backend.consume.side_effect = ConnectionError("redis down")
+        with self.assertLogs('chat_models.rate_limit', 'WARNING'):
+            self.assertTrue(self.make_limiter(backend).check(self.request()).allowed)
+
+    def test_concurrent_requests_never_exceed_the_burst(self):
+        limiter = self.make_limiter(user="", ip="20/h")
+        results = []
+        lock = threading.Lock()
+
+        def client():
+            for _ in range(10):
+                allowed = limiter.check(self.request()).allowed
+                with lock:
+                    results.append(allowed)
+
+        threads = [threading.Thread(target=client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(True), 20)
+
+
+@unittest.skipIf(fakeredis is None, "requires fakeredis[lua]")
+class RedisRateLimiterTests(RateLimiterTests):
+    """The same limits through the Lua token-bucket script, on an in-process Redis."""
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+
+    def make_backend(self):
+        return RedisBucketBackend(fakeredis.FakeRedis(server=self.server))
+
+    def test_buckets_are_shared_between_workers(self):
+        first, second = self.make_limiter(), self.make_limiter()
+        self.assertTrue(first.check(self.request(user_id=1)).allowed)
+        self.assertTrue(second.check(self.request(user_id=1)).allowed)
+        self.assertFalse(first.check(self.request(user_id=1)).allowed)
+        self.assertFalse(second.check(self.request(user_id=1)).allowed)
+
+    def test_bucket_refills_and_expires(self):
+        limiter = self.make_limiter(user="", ip="1/s")
+        client = fakeredis.FakeRedis(server=self.server)
+        self.assertTrue(limiter.check(self.request()).allowed)
+        self.assertFalse(limiter.check(self.request()).allowed)
+        key = limiter.buckets_for(self.request())[0].key
+        self.assertGreater(client.pttl(key), 0)
+        time.sleep(1.1)
+        self.assertTrue(limiter.check(self.request()).allowed)
+
+
+class ClientDisconnectTests(SimpleTestCase):
+    """A client that hangs up mid-stream releases the upstream generation."""
+
+    RELEASE_SECONDS = 2.0
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Long enough (5 s) that only a cancellation can end it within RELEASE_SECONDS
+        cls.server = FakeOllamaServer(tokens=500, token_delay=0.01).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        # The views reach Ollama through the process-wide router, client and
+        # admission controller; point them at the fake server for this test.
+        for target, value in (
+            ('chat_models.router._router', OllamaRouter.single(self.server.base_url)),
+            ('chat_models.ollama_client._shared_clients', {}),
+            ('chat_models.admission._controller', None),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fake_stats(self):
+        return httpx.get(f"{self.server.base_url}/_fake/stats").json()
+
+    def chat_request(self, prompt):
+        body = {"model": "fake-model", "messages": [{"role": "user", "content": prompt}], "stream": True}
+        request = RequestFactory().post('/v1/chat/completions/', json.dumps(body), content_type='application/json')
+        request.user = AnonymousUser()
+        return request
+
+    def assert_released(self, before):
+        deadline = time.monotonic() + self.RELEASE_SECONDS
+        while True:
+            stats = self.fake_stats()
+            if stats["cancelledStreams"] > before["cancelledStreams"] and stats["activeStreams"] == 0:
+                return
+            if time.monotonic() > deadline:
+                self.fail(f"Upstream generation still running {self.RELEASE_SECONDS}s after disconnect: {stats}")
+            time.sleep(0.02)
+
+    def test_sync_view_releases_upstream(self):
+        before = self.fake_stats()
+        response = ChatCompletionView.as_view()(self.chat_request("sync disconnect"))
+        self.assertEqual(response.status_code, 200)
+        body = iter(response)
+        next(body)
+        next(body)
+        self.assertEqual(self.fake_stats()["activeStreams"], 1)
+        # What the WSGI server does once a write to the client fails
+        response.close()
+        self.assert_released(before)
+
+    def test_async_view_releases_upstream(self):
+        before = self.fake_stats()
+
+        async def main():
+            request = self.chat_request("async disconnect")
+            response = await AsyncChatCompletionView.as_view()(request)
+            self.assertEqual(response.status_code, 200)
+            streaming = asyncio.Event()
+
+            async def send_body():
+                async for _ in response:
+                    streaming.set()
+
+            task = asyncio.create_task(send_body())
+            await asyncio.wait_for(streaming.wait(), 5)
+            self.assertEqual((await asyncio.to_thread(self.fake_stats))["activeStreams"], 1)
+            # What Django's ASGI handler does on http.disconnect
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # Poll from a thread so the loop can run the upstream's cleanup
+            await asyncio.to_thread(self.assert_released, before)
+
+        asyncio.run(main())
+
+
+class CalculateToolTests(SimpleTestCase):
+    def test_arithmetic(self):
+        self.assertEqual(calculate(expression="(3 + 4) * 2.5"), 17.5)
+        self.assertEqual(calculate(expression="7 // 2 + 7 % 2 - -1"), 5)
+        self.assertEqual(calculate(expression="2 ** 10"), 1024)
+
+    def test_rejects_anything_but_arithmetic(self):
+        for expression in ("__import__('os')", "[1, 2]", "'a' * 3", "x + 1", "2 << 3"):
+            with self.subTest(expression=expression), self.assertRaises(ValueError):
+                calculate(expression=expression)
+
+    def test_rejects_huge_results_before_computing_them(self):
+        for expression in (
+            "((((9**99)**99)**99)**99)**99",
+            "(2**100)**41",
+            "9**99*9**99*9**99*9**99*9**99*9**99*9**99*9**99*9**99*9**99*9**99*9**99*9**99*9**99",
+            "1" * 1300,
+            "10**101",
+        ):
+            with self.subTest(expression=expression):
+                started = time.monotonic()
+                with self.assertRaises(ValueError):
+                    calculate(expression=expression)
+                self.assertLess(time.monotonic() - started, 0.1)
+
+    def test_results_up_to_the_limit_are_allowed(self):
+        self.assertEqual(calculate(expression="(2**100)**40").bit_length(), 4001)
+        self.assertEqual(calculate(expression="2**64 * 2**64"), 2 ** 128)
+        self.assertLessEqual(calculate(expression="(2**99*2**99)**20").bit_length(), MAX_INTEGER_BITS)
+
+
+def tool_call(name, **arguments):
+    return {"function": {"name": name, "arguments": arguments}}
+
+
+class ToolExecutorTests(SimpleTestCase):
+    def make_executor(self, *tools, **kwargs):
+        executor = ToolExecutor(ToolRegistry(list(tools)), workers=4, timeout=5.0, **kwargs)
+        self.addCleanup(executor._pool.shutdown, wait=False)
+        return executor
+
+    def sleeper(self, seconds=0.2, timeout=None):
+        def sleep(label):
+            time.sleep(seconds)
+            return label
+        return Tool(sleep, timeout=timeout)
+
+    def test_calls_run_concurrently_in_call_order(self):
+        executor = self.make_executor(self.sleeper(0.2))
+        started = time.monotonic()
+        results = executor.run([tool_call("sleep", label=str(i)) for i in range(4)])
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual([r.content for r in results], ["0", "1", "2", "3"])
+
+    def test_async_calls_run_concurrently(self):
+        executor = self.make_executor(self.sleeper(0.2))
+        started = time.monotonic()
+        results = asyncio.run(executor.arun([tool_call("sleep", label=str(i)) for i in range(4)]))
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual([r.content for r in results], ["0", "1", "2", "3"])
+
+    def test_slow_call_times_out_as_an_error_result(self):
+        executor = self.make_executor(self.sleeper(1.0, timeout=0.1), Tool(lambda: "ok", name="fast"))
+        for run in (executor.run, lambda calls: asyncio.run(executor.arun(calls))):
+            started = time.monotonic()
+            slow, fast = run([tool_call("sleep", label="x"), tool_call("fast")])
+            self.assertLess(time.monotonic() - started, 0.5)
+            self.assertTrue(slow.error)
+            self.assertIn("Timed out", json.loads(slow.content)["error"])
+            self.assertEqual((fast.content, fast.error), ("ok", False))
+        self.assertEqual(executor.snapshot()["timeouts"], 2)
+
+    def test_failures_and_bad_calls_are_reported_to_the_model(self):
+        def boom():
+            raise RuntimeError("broken")
+
+        executor = self.make_executor(Tool(boom))
+        failed, unknown, malformed = executor.run(
+            [tool_call("boom"), tool_call("missing"), {"function": {"name": "boom", "arguments": "not json"}}]
+        )
+        self.assertEqual(json.loads(failed.content), {"error": "broken"})
+        self.assertIn("Unknown tool", json.loads(unknown.content)["error"])
+        self.assertIn("JSON object", json.loads(malformed.content)["error"])
+        self.assertEqual(executor.snapshot()["errors"], 3)
+
+    def test_idempotent_results_are_cached_by_arguments(self):
+        calls = []
+
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        executor = self.make_executor(Tool(double, idempotent=True), Tool(lambda: len(calls), name="count"))
+        first = executor.run([tool_call("double", x=2)])[0]
+        again = executor.run([{"function": {"name": "double", "arguments": '{"x": 2}'}}])[0]
+        other = executor.run([tool_call("double", x=3)])[0]
+        self.assertEqual((first.content, first.cached), ("4", False))
+        self.assertEqual((again.content, again.cached), ("4", True))
+        self.assertEqual(other.content, "6")
+        self.assertEqual(calls, [2, 3])
+        # Tools that are not idempotent are always run
+        executor.run([tool_call("count")])
+        self.assertFalse(executor.run([tool_call("count")])[0].cached)
+        self.assertEqual(executor.snapshot()["cacheHits"], 1)
+
+    def test_cached_results_expire(self):
+        calls = []
+        executor = self.make_executor(Tool(lambda: calls.append(1) or len(calls), name="n", idempotent=True),
+                                      cache_ttl=0.05)
+        self.assertEqual(executor.run([tool_call("n")])[0].content, "1")
+        self.assertTrue(executor.run([tool_call("n")])[0].cached)
+        time.sleep(0.1)
+        self.assertEqual(executor.run([tool_call("n")])[0].content, "2")
+
+    def test_errors_are_not_cached(self):
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise RuntimeError("first call fails")
+            return "ok"
+
+        executor = self.make_executor(Tool(flaky, idempotent=True))
+        self.assertTrue(executor.run([tool_call("flaky")])[0].error)
+        self.assertEqual(executor.run([tool_call("flaky")])[0].content, "ok")
+
+
+@override_settings(ROOT_URLCONF='chat_models.tests')
+class AsyncAuthenticationTests(TransactionTestCase):
+    """Under ASGI, Bearer tokens authenticate the caller as DRF does for the sync views."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('jwt-user', password='unused')
+        self.limiter = RateLimiter(
+            InProcessBucketBackend(), limits={SCOPE_USER: parse_rate("1/m"), SCOPE_API_KEY: None, SCOPE_IP: None},
+        )
+        for target, value in (
+            ('chat_models.rate_limit._limiter', self.limiter),
+            ('dashboard.middleware.get_log_writer', mock.Mock(return_value=mock.Mock())),
+        ):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, path, token=None):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        # An invalid body: the view answers 400 once the caller got past authentication and rate limits
+        return asyncio.run(AsyncClient().post(path, {}, content_type='application/json', headers=headers))
+
+    def test_bearer_token_authenticates_the_user(self):
+        token = str(AccessToken.for_user(self.user))
+        for url in ('/v1/chat/completions/', '/v1/embeddings/'):
+            self.limiter.backend = InProcessBucketBackend()
+            with self.subTest(url=url):
+                first = self.post(url, token)
+                self.assertEqual(first.status_code, 400)
+                self.assertEqual(first['X-RateLimit-Limit'], '1')
+                # The per-user bucket applies, so the caller was not anonymous
+                self.assertEqual(self.post(url, token).status_code, 429)
+
+    def test_anonymous_callers_are_allowed_like_the_sync_views(self):
+        response = self.post('/v1/chat/completions/')
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('X-RateLimit-Limit', response)
+
+    def test_invalid_token_is_rejected(self):
+        for url in ('/v1/chat/completions/', '/v1/embeddings/'):
+            with self.subTest(url=url):
+                response = self.post(url, 'not-a-jwt')
+                self.assertEqual(response.status_code, 401)
+                self.assertIn('Bearer', response['WWW-Authenticate'])
+                self.assertIn('detail', response.json())
+
+    def test_view_permissions_are_enforced(self):
+        with mock.patch.object(AsyncChatCompletionView, 'permission_classes', [IsAuthenticated]):
+            self.assertEqual(self.post('/v1/chat/completions/').status_code, 401)
+            self.assertEqual(self.post('/v1/chat/completions/', str(AccessToken.for_user(self.user))).status_code, 400)
+
+
+class StreamTimingTests(SimpleTestCase):
+    """TTFT and inter-token latency come from text deltas only."""
+
+    # (arrival time, chunk): a role-only chunk, a tool-call chunk, three tokens
+    # after gaps of 100 and 200 ms, then the final chunk two seconds later
+    SCRIPT = [
+        (1.0, {"message": {"role": "assistant", "content": ""}, "done": False}),
+        (1.1, {"message": {"role": "assistant", "content": "", "tool_calls": [{"function": {"name": "f"}}]},
+               "done": False}),
+        (1.2, {"message": {"role": "assistant", "content": "a"}, "done": False}),
+        (1.3, {"message": {"role": "assistant", "content": "b"}, "done": False}),
+        (1.5, {"message": {"role": "assistant", "content": "c"}, "done": False}),
+        (3.5, {"message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "stop"}),
+    ]
+
+    def setUp(self):
+        self.clock = [0.0]
+        patcher = mock.patch('chat_models.streaming.time.monotonic', lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scripted(self, script):
+        for at, chunk in script:
+            self.clock[0] = at
+            yield chunk
+
+    async def ascripted(self, script):
+        for chunk in self.scripted(script):
+            yield chunk
+
+    def assert_timings(self, stats):
+        self.assertAlmostEqual(stats.first_token_at, 1.2)
+        self.assertEqual(stats.completion_tokens, 3)
+        self.assertEqual(stats.itl_percentiles(), [200.0, 200.0, 200.0])
+        self.assertEqual([round(gap, 3) for gap in stats.token_gaps], [0.1, 0.2])
+        self.assertAlmostEqual(stats.tokens_per_second, 2 / 0.3)
+
+    def test_sync_stream_timings(self):
+        for window_ms in (0, 20):
+            with self.subTest(window_ms=window_ms):
+                stats = StreamStats()
+                list(coalesce_deltas(self.scripted(self.SCRIPT), DeltaCoalescer(window_ms=window_ms), stats))
+                self.assert_timings(stats)
+
+    def test_async_stream_timings(self):
+        async def consume(stats):
+            return [c async for c in acoalesce_deltas(self.ascripted(self.SCRIPT), DeltaCoalescer(), stats)]
+
+        stats = StreamStats()
+        asyncio.run(consume(stats))
+        self.assert_timings(stats)
+
+    def test_cancelled_stream_counts_only_text_deltas(self):
+        stats = StreamStats()
+        stream = coalesce_deltas(self.scripted(self.SCRIPT[:4]), DeltaCoalescer(window_ms=0), stats)
+        for _ in range(4):
+            next(stream)
+        stream.close()
+        self.assertEqual(stats.completion_tokens, 2)
+        self.assertAlmostEqual(stats.first_token_at, 1.2)
+
+
+def delta(content, **extra):
+    return dict({"message": {"role": "assistant", "content": content}, "done": False}, **extra)
+
+
+def texts(chunks):
+    return [c["message"]["content"] for c in chunks]
+
+
+class DeltaCoalescerTests(SimpleTestCase):
+    def test_first_token_passes_then_deltas_merge_per_window(self):
+        coalescer = DeltaCoalescer(window_ms=20, max_bytes=1024)
+        self.assertEqual(texts(coalescer.feed(delta("a"), 0.000)), ["a"])
+        self.assertEqual(coalescer.feed(delta("b"), 0.001), [])
+        self.assertEqual(coalescer.feed(delta("c"), 0.010), [])
+        self.assertEqual(texts(coalescer.feed(delta("d"), 0.021)), ["bcd"])
+        self.assertEqual(coalescer.time_left(0.021), None)
+
+    def test_max_bytes_closes_the_window(self):
+        coalescer = DeltaCoalescer(window_ms=1000, max_bytes=4)
+        coalescer.feed(delta("a"), 0.0)
+        self.assertEqual(coalescer.feed(delta("bc"), 0.001), [])
+        self.assertEqual(texts(coalescer.feed(delta("de"), 0.002)), ["bcde"])
+
+    def test_final_and_tool_chunks_flush_and_pass_through(self):
+        coalescer = DeltaCoalescer(window_ms=20)
+        coalescer.feed(delta("a"), 0.0)
+        coalescer.feed(delta("b"), 0.001)
+        tool = {"message": {"role": "assistant", "content": "", "tool_calls": [{"function": {"name": "f"}}]},
+                "done": False}
+        self.assertEqual(coalescer.feed(tool, 0.002), [delta("b"), tool])
+        coalescer.feed(delta("c"), 0.003)
+        done = {"message": {"role": "assistant", "content": ""}, "done": True}
+        out = coalescer.feed(done, 0.004)
+        self.assertEqual(texts(out), ["c", ""])
+        self.assertIs(out[-1], done)
+
+    def test_merging_does_not_edit_shared_chunks(self):
+        coalescer = DeltaCoalescer(window_ms=20)
+        coalescer.feed(delta("a"), 0.0)
+        second, third = delta("b"), delta("c")
+        coalescer.feed(second, 0.001)
+        coalescer.feed(third, 0.002)
+        self.assertEqual(texts(coalescer.flush()), ["bc"])
+        self.assertEqual(texts([second, third]), ["b", "c"])
+
+    def test_time_left_counts_down_to_the_deadline(self):
+        coalescer = DeltaCoalescer(window_ms=20)
+        coalescer.feed(delta("a"), 0.0)
+        coalescer.feed(delta("b"), 0.005)
+        self.assertAlmostEqual(coalescer.time_left(0.010), 0.015)
+        self.assertEqual(coalescer.time_left(0.100), 0.0)
+
+    def test_slow_streams_are_never_held(self):
+        def slow():
+            for token in "abc":
+                time.sleep(0.03)
+                yield delta(token)
+
+        arrivals = []
+        for chunk in coalesce_deltas(slow(), DeltaCoalescer(window_ms=20)):
+            arrivals.append(texts([chunk]))
+        self.assertEqual(arrivals, [["a"], ["b"], ["c"]])
+
+    def test_async_stall_flushes_pending_deltas_at_the_deadline(self):
+        async def stalling():
+            yield delta("a")
+            yield delta("b")
+            await asyncio.sleep(0.5)
+            yield delta("c")
+
+        async def consume():
+            started, out = time.monotonic(), []
+            async for chunk in acoalesce_deltas(stalling(), DeltaCoalescer(window_ms=20)):
+                out.append((texts([chunk])[0], time.monotonic() - started))
+            return out
+
+        out = asyncio.run(consume())
+        self.assertEqual([text for text, _ in out], ["a", "b", "c"])
+        # "b" went out at its window's deadline, not when "c" ended the stall
+        self.assertLess(out[1][1], 0.2)
+        self.assertGreaterEqual(out[2][1], 0.5)
+
+    def test_async_close_during_a_timed_read_closes_the_upstream(self):
+        closed = []
+
+        async def stalling():
+            try:
+                yield delta("a")
+                yield delta("b")
+                await asyncio.sleep(60)
+                yield delta("c")
+            finally:
+                closed.append(True)
+
+        async def consume():
+            stream = acoalesce_deltas(stalling(), DeltaCoalescer(window_ms=20))
+            self.assertEqual(texts([await stream.__anext__(), await stream.__anext__()]), ["a", "b"])
+            await asyncio.wait_for(stream.aclose(), 1)
+
+        asyncio.run(consume())
+        self.assertEqual(closed, [True])
+
+    def test_sync_flushes_when_the_next_delta_is_due_after_the_deadline(self):
+        coalescer = DeltaCoalescer(window_ms=20)
+        coalescer.feed(delta("a"), 0.000)
+        coalescer.feed(delta("b"), 0.008)
+        # The next delta is expected 8 ms later, before the deadline at 28 ms
+        self.assertFalse(coalescer.due_before_next(0.008))
+        coalescer.feed(delta("c"), 0.016)
+        self.assertFalse(coalescer.due_before_next(0.016))
+        # Expected at 32 ms, after the deadline: flush now rather than hold "bcd" until it arrives
+        self.assertEqual(coalescer.feed(delta("d"), 0.024), [])
+        self.assertTrue(coalescer.due_before_next(0.024))
+
+    def test_sync_stream_flushes_before_a_gap_that_passes_the_deadline(self):
+        def paced():
+            for token, pause in (("a", 0), ("b", 0.012), ("c", 0.012), ("d", 0.3)):
+                time.sleep(pause)
+                yield delta(token)
+
+        started, out = time.monotonic(), []
+        for chunk in coalesce_deltas(paced(), DeltaCoalescer(window_ms=20)):
+            out.append((texts([chunk])[0], time.monotonic() - started))
+        self.assertEqual("".join(text for text, _ in out), "abcd")
+        # At 12 ms per token "c" is due after the window's deadline, so "b" and
+        # "c" were not held through the 300 ms gap before "d"
+        self.assertLess(next(at for text, at in out if "c" in text), 0.2)
+
+
+def answer_stream(*tokens, closed=None):
+    """A raw Ollama stream answering ``tokens``; appends to ``closed`` when closed."""
+    try:
+        for token in tokens:
+            yield {"model": "m", "message": {"role": "assistant", "content": token}, "done": False}
+        yield {"model": "m", "message": {"role": "assistant", "content": ""}, "done": True,
+               "done_reason": "stop", "prompt_eval_count": 3, "eval_count": len(tokens)}
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+
+async def aanswer_stream(*tokens, closed=None):
+    for chunk in answer_stream(*tokens, closed=closed):
+        yield chunk
+
+
+class CompletionCacheTests(SimpleTestCase):
+    def make_cache(self, **kwargs):
+        return CompletionCache(InProcessCacheBackend(**kwargs))
+
+    def request(self, content="Hi", **options):
+        return dict({"model": "m", "messages": [{"role": "user", "content": content}], "temperature": 0.0}, **options)
+
+    def test_miss_then_hit_after_a_finished_stream(self):
+        cache = self.make_cache()
+        lookup = cache.lookup(self.request())
+        self.assertEqual((lookup.status, lookup.hit), (CACHE_MISS, False))
+        self.assertEqual(len(list(cache.record_stream(lookup, answer_stream("Hel", "lo")))), 3)
+        hit = cache.lookup(self.request())
+        self.assertEqual(hit.status, CACHE_HIT)
+        self.assertEqual(hit.cached["message"]["content"], "Hello")
+        self.assertEqual((hit.cached["prompt_eval_count"], hit.cached["eval_count"]), (3, 2))
+        replayed = list(CompletionCache.replay(hit.cached))
+        self.assertEqual(collect(iter(replayed))["message"]["content"], "Hello")
+        self.assertTrue(replayed[-1]["done"])
+
+    def test_async_miss_then_hit(self):
+        cache = self.make_cache()
+
+        async def main():
+            lookup = await cache.alookup(self.request())
+            self.assertEqual(lookup.status, CACHE_MISS)
+            [chunk async for chunk in cache.arecord_stream(lookup, aanswer_stream("a", "b"))]
+            return await cache.alookup(self.request())
+
+        self.assertEqual(asyncio.run(main()).cached["message"]["content"], "ab")
+
+    def test_unfinished_streams_are_not_cached(self):
+        cache = self.make_cache()
+        lookup = cache.lookup(self.request())
+        stream = cache.record_stream(lookup, answer_stream("a", "b"))
+        next(stream)
+        stream.close()
+        self.assertEqual(cache.lookup(self.request()).status, CACHE_MISS)
+
+    def test_entries_expire(self):
+        cache = self.make_cache(ttl=0.05)
+        cache.store(cache.lookup(self.request()), collect(answer_stream("x")))
+        self.assertEqual(cache.lookup(self.request()).status, CACHE_HIT)
+        time.sleep(0.1)
+        self.assertEqual(cache.lookup(self.request()).status, CACHE_MISS)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = self.make_cache(max_entries=2)
+        for content in ("a", "b"):
+            cache.store(cache.lookup(self.request(content)), collect(answer_stream(content)))
+        cache.lookup(self.request("a"))
+        cache.store(cache.lookup(self.request("c")), collect(answer_stream("c")))
+        self.assertEqual([cache.lookup(self.request(c)).status for c in "abc"], [CACHE_HIT, CACHE_MISS, CACHE_HIT])
+
+    def test_sampled_requests_bypass_the_cache(self):
+        cache = self.make_cache()
+        lookup = cache.lookup(self.request(temperature=0.7))
+        self.assertEqual((lookup.key, lookup.status), (None, CACHE_BYPASS))
+        list(cache.record_stream(lookup, answer_stream("x")))
+        self.assertEqual(cache.lookup(self.request(temperature=0.7)).status, CACHE_BYPASS)
+
+    def test_key_depends_only_on_what_determines_the_completion(self):
+        base = self.request()
+        same = {"temperature": 0.0, "messages": [{"content": "Hi", "role": "user", "name": "ignored"}],
+                "model": "m", "stream": True}
+        self.assertEqual(cache_key(base), cache_key(same))
+        self.assertEqual(cache_key(self.request(top_p=0.9)), cache_key(base))
+        for changed in (self.request("Hi "), self.request(top_p=0.5), self.request(tools=["calculate"]),
+                        dict(base, model="other"), dict(base, temperature=0.1)):
+            self.assertNotEqual(cache_key(changed), cache_key(base))
+
+    def test_closing_early_closes_the_wrapped_stream(self):
+        cache = self.make_cache()
+        for request in (self.request(), self.request(temperature=0.7)):
+            closed = []
+            # Still referenced here, so only an explicit close can end it
+            upstream = answer_stream("a", "b", closed=closed)
+            stream = cache.record_stream(cache.lookup(request), upstream)
+            next(stream)
+            stream.close()
+            self.assertEqual(closed, [True])
+
+    def test_async_closing_early_closes_the_wrapped_stream(self):
+        cache = self.make_cache()
+        closed = []
+
+        async def main():
+            upstream = aanswer_stream("a", "b", closed=closed)
+            stream = cache.arecord_stream(await cache.alookup(self.request()), upstream)
+            await stream.__anext__()
+            await stream.aclose()
+            self.assertEqual(closed, [True])
+
+        asyncio.run(main())
+
+
+def legacy_violation(content, max_ratio=0.7):
+    """The message content checks as they were before the rule engine."""
+    if len(content) >= 50:
+        counts = {}
+        for char in content:
+            counts[char] = counts.get(char, 0) + 1
+        if max(counts.values()) / len(content) > max_ratio:
+            return "Message contains excessive repetition"
+    for pattern in [r'<script[^>]*>.*?</script>', r'javascript:', r'data:text/html']:
+        if re.search(pattern, content, re.IGNORECASE | re.DOTALL):
+            return "Message contains potentially unsafe content"
+    return None
+
+
+def violation(content):
+    try:
+        ChatMessageValidator._validate_content_security(content)
+    except ValidationError as e:
+        return e.message
+    return None
+
+
+class ContentRuleTests(SimpleTestCase):
+    """The precompiled rules accept and reject exactly what the legacy checks did."""
+
+    CASES = [
+        "Hello, how are you?",
+        "a" * 49,
+        "a" * 50,
+        "a" * 70 + "b" * 30,
+        "a" * 71 + "b" * 29,
+        "ab" * 40,
+        "😀" * 60,
+        "😀" * 36 + "x" * 14,
+        "\ud800" * 60,
+        "see <script>alert(1)</script>",
+        "<SCRIPT type='x'>\nalert(1)\n</ScRiPt>",
+        "<script> without a closing tag",
+        "JavaScript:void(0)",
+        "open data:TEXT/HTML,<b>hi</b>",
+        # Non-ASCII letters re.IGNORECASE equates with ASCII ones
+        "javaſcript:alert(1)",
+        "JAVASCRİPT:alert(1)",
+        "javascrıpt:alert(1)",
+        "<ſcript>x</ſcript>",
+        "\u212aelvin says data:text/html",
+        "İstanbul and ıstanbul are not scripts",
+        "ᴊavascript: is a small capital, not a J",
+    ]
+
+    def test_matches_the_legacy_checks(self):
+        for content in self.CASES:
+            with self.subTest(content=content[:40]):
+                self.assertEqual(violation(content), legacy_violation(content))
+
+    def test_matches_the_legacy_checks_on_generated_content(self):
+        generator = random.Random(17)
+        alphabet = "aab<>:/ sſıİ\u212a" + "javascript" + "😀"
+        for _ in range(500):
+            content = "".join(generator.choice(alphabet) for _ in range(generator.randint(1, 120)))
+            if generator.random() < 0.3:
+                content = generator.choice(["javascript:", "JAVAſCRIPT:", "<script>x</script>"]) + content
+            with self.subTest(content=content):
+                self.assertEqual(violation(content), legacy_violation(content))
+
+    def test_ratios_below_one_half_count_every_character(self):
+        rule = RepetitionRule(max_ratio=0.3)
+        for content in ("abc" * 20, "a" * 20 + "bc" * 15, "a" * 19 + "bcd" * 14):
+            with self.subTest(content=content):
+                self.assertEqual(rule.violates(content), legacy_violation(content, max_ratio=0.3) is not None)
+
+    def test_case_equivalents_reach_the_pattern(self):
+        rule = PatternRule([(r'kill', ('kill',))])
+        self.assertTrue(rule.violates("\u212aILL"))
+        self.assertTrue(rule.violates("KILL"))
+        self.assertFalse(rule.violates("skil l"))
+
+
+class ValidationMemoTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ChatMessageValidator, 'memo', ValidationMemo(max_entries=2))
+        self.memo = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(
+            ChatMessageValidator, '_validate_content_security', wraps=ChatMessageValidator._validate_content_security,
+        )
+        self.checks = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def validate(self, content, role="user"):
+        return ChatMessageValidator.validate_message({"role": role, "content": content})
+
+    def test_repeated_message_skips_the_rules(self):
+        self.validate("hello")
+        self.validate("  hello ")
+        self.assertEqual(self.checks.call_count, 1)
+
+    def test_the_role_is_part_of_the_key(self):
+        self.validate("hello")
+        self.validate("hello", role="assistant")
+        self.assertEqual(self.checks.call_count, 2)
+
+    def test_rejected_messages_are_not_remembered(self):
+        for _ in range(2):
+            with self.assertRaises(ValidationError):
+                self.validate("javascript:alert(1)")
+        self.assertEqual(self.checks.call_count, 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.validate("a")
+        self.validate("b")
+        self.validate("a")
+        self.validate("c")
+        self.assertEqual(self.checks.call_count, 3)
+        self.validate("a")
+        self.assertEqual(self.checks.call_count, 3)
+        self.validate("b")
+        self.assertEqual(self.checks.call_count, 4)
+
+    def test_clear_forgets_every_message(self):
+        self.validate("hello")
+        self.memo.clear()
+        self.validate("hello")
+        self.assertEqual(self.checks.call_count, 2)
+
+    def test_zero_size_disables_the_memo(self):
+        self.memo.max_entries = 0
+        self.validate("hello")
+        self.validate("hello")
+        self.assertEqual(self.checks.call_count, 2)
+
+
+class BatchLeaseTests(TransactionTestCase):
+    """Jobs of a worker that stopped renewing its lease are queued again, or failed once out of attempts."""
+
+    def setUp(self):
+        owner = get_user_model().objects.create_user("batcher")
+        request = {"model": "m", "messages": [{"role": "user", "content": "hi"}], "stream": False}
+        self.batch = create_batch(owner, [{"line": 1, "custom_id": "1", "request": request}])
+
+    def make_pool(self, **kwargs):
+        return BatchWorkerPool(admission=mock.Mock(), **kwargs)
+
+    def job(self):
+        return BatchJob.objects.get(batch=self.batch)
+
+    def age_lease(self, seconds):
+        BatchJob.objects.filter(batch=self.batch).update(heartbeat_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_expired_lease_is_claimed_again(self):
+        dead = self.make_pool(lease_seconds=60)
+        self.assertEqual(dead._claim(None).worker, dead.name)
+        self.age_lease(61)
+        survivor = self.make_pool(lease_seconds=60)
+        self.assertEqual(survivor.recover_expired(), 1)
+        self.assertEqual((self.job().status, self.job().worker), (BatchJob.STATUS_QUEUED, ""))
+        job = survivor._claim(None)
+        self.assertEqual((job.worker, job.attempts), (survivor.name, 2))
+
+    def test_live_lease_is_kept(self):
+        pool = self.make_pool(lease_seconds=60)
+        pool._claim(None)
+        self.age_lease(30)
+        self.assertEqual(pool.recover_expired(), 0)
+        self.assertEqual(self.job().status, BatchJob.STATUS_RUNNING)
+
+    def test_expired_lease_out_of_attempts_fails_the_job(self):
+        pool = self.make_pool(lease_seconds=60, max_attempts=1)
+        pool._claim(None)
+        self.age_lease(61)
+        self.assertEqual(pool.recover_expired(), 0)
+        job = self.job()
+        self.assertEqual((job.status, job.error), (BatchJob.STATUS_FAILED, "Worker lost (attempts exhausted)"))
+        self.batch.refresh_from_db()
+        self.assertEqual((self.batch.status, self.batch.failed_jobs), (Batch.STATUS_COMPLETED, 1))
+
+    def test_running_jobs_have_their_lease_renewed(self):
+        pool = self.make_pool(lease_seconds=1.5)
+        job = pool._claim(None)
+        pool._running[threading.get_ident()] = job.pk
+        self.age_lease(1)
+        aged = self.job().heartbeat_at
+        keeper = threading.Thread(target=pool._keep_leases)
+        keeper.start()
+        try:
+            for _ in range(100):
+                if self.job().heartbeat_at > aged:
+                    break
+                time.sleep(0.02)
+        finally:
+            pool._stop.set()
+            keeper.join(5)
+        self.assertGreater(self.job().heartbeat_at, aged)
+        self.assertEqual(self.job().status, BatchJob.STATUS_RUNNING)
+
+
+class BatchWorkerStartupTests(SimpleTestCase):
+    def test_pool_starts_unless_disabled(self):
+        with mock.patch('chat_models.batches.get_batch_pool') as get_pool:
+            with override_settings(CHAT_BATCH_WORKERS=0):
+                ensure_batch_workers()
+            get_pool.assert_not_called()
+            with override_settings(CHAT_BATCH_WORKERS=2):
+                ensure_batch_workers()
+            get_pool.return_value.start.assert_called_once_with()
+
+    def test_server_entry_points_start_the_pool(self):
+        for module in ('studio_backend.asgi', 'studio_backend.wsgi'):
+            with self.subTest(module=module), mock.patch.dict(os.environ), mock.patch.dict(sys.modules):
+                sys.modules.pop(module, None)
+                with mock.patch('dashboard.log_writer.install_signal_handlers'), \
+                        mock.patch('chat_models.batches.ensure_batch_workers') as ensure:
+                    importlib.import_module(module)
+                ensure.assert_called_once_with()
+
+
+class ModelRegistryTests(SimpleTestCase):
+    """The listing is cached and revalidated by ETag; show metadata is fetched once per digest."""
+
+    def setUp(self):
+        self.server = FakeOllamaServer(models=["llama3.2:latest", "qwen2.5:7b"]).start()
+        self.addCleanup(self.server.stop)
+        self.registry = ModelRegistry(OllamaRouter.single(self.server.base_url))
+        patcher = mock.patch.object(ModelRegistry, '_show', autospec=True, side_effect=ModelRegistry._show)
+        self.show = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail("condition not reached")
+
+    def test_first_listing_loads_models_and_metadata(self):
+        self.assertIsNone(self.registry.has_model("llama3.2"))
+        models, etag = self.registry.listing()
+        self.assertEqual([model["id"] for model in models], ["llama3.2:latest", "qwen2.5:7b"])
+        self.assertEqual(models[0]["metadata"]["model_info"], {"fake.context_length": 4096})
+        self.assertRegex(etag, r'^"[0-9a-f]{32}"$')
+        self.assertTrue(self.registry.has_model("llama3.2"))
+        self.assertFalse(self.registry.has_model("mistral"))
+        self.assertEqual(self.registry.context_length("qwen2.5:7b"), 4096)
+
+    def test_refresh_fetches_metadata_only_for_new_digests(self):
+        _, etag = self.registry.listing()
+        self.registry.refresh()
+        self.assertEqual(self.registry.listing()[1], etag)
+        self.assertEqual(self.show.call_count, 2)
+        self.server.models.append("mistral:latest")
+        self.registry.refresh()
+        models, new_etag = self.registry.listing()
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(len(models), 3)
+        self.assertEqual(self.show.call_count, 3)
+
+    def test_stale_listing_is_served_while_refreshing_in_the_background(self):
+        self.registry.listing()
+        self.registry.refresh_seconds = 0
+        self.server.models.append("mistral:latest")
+        models, _ = self.registry.listing()
+        self.assertEqual(len(models), 2)
+        self.wait_for(lambda: len(self.registry.listing()[0]) == 3)
+
+    def test_unreachable_backends_fail_the_first_load(self):
+        self.server.stop()
+        with self.assertRaises(OllamaConnectionError):
+            self.registry.listing()
+
+    def get(self, registry, **headers):
+        client = mock.Mock(model_registry=registry)
+        with mock.patch('chat_models.views.get_ollama_client', return_value=client):
+            request = RequestFactory().get('/v1/models/', **headers)
+            return ChatModelList.as_view()(request)
+
+    def test_listing_carries_its_etag(self):
+        response = self.get(self.registry)
+        _, etag = self.registry.listing()
+        self.assertEqual((response.status_code, response['ETag']), (200, etag))
+        self.assertEqual(len(response.data), 2)
+
+    def test_matching_if_none_match_is_not_modified(self):
+        _, etag = self.registry.listing()
+        response = self.get(self.registry, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+        self.assertEqual(self.get(self.registry, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_listing_without_an_etag_sends_none(self):
+        registry = mock.Mock()
+        registry.listing.return_value = ([], '')
+        response = self.get(registry, HTTP_IF_NONE_MATCH='')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+
+def sse_frames(data):
+    """JSON payloads of the ``data:`` frames in ``data``."""
+    frames = data.decode('utf-8').split('\n\n')
+    assert frames[-1] == '', data
+    return [frame[len('data: '):] for frame in frames[:-1]]
+
+
+class StreamEncoderTests(SimpleTestCase):
+    """The hand-built frames are the JSON the per-chunk json.dumps paths wrote."""
+
+    TEXTS = ["Hello", "", 'say "hi"\n\tthen \\ leave', "naïve 東京 😀", "\x00\x1f\u2028", "</script>"]
+    FINAL = {"model": "llama3.2", "done": True, "done_reason": "length", "prompt_eval_count": 7, "eval_count": 3}
+
+    def test_vercel_parts_match_json_dumps(self):
+        encoder = VercelDataStreamEncoder(model="llama3.2")
+        for content in self.TEXTS:
+            with self.subTest(content=content):
+                expected = f"0:{json.dumps(content)}\n".encode("utf-8")
+                self.assertEqual(encoder.text(content), expected)
+                self.assertEqual(text_part(content), expected)
+                self.assertEqual(error_part(content), f"3:{json.dumps(content)}\n".encode("utf-8"))
+        self.assertEqual(
+            encoder.finish(self.FINAL),
+            b'd:{"finishReason": "stop", "usage": {"promptTokens": 7, "completionTokens": 3}}\n',
+        )
+        self.assertEqual(encoder.close(), b'')
+
+    def test_openai_chunks(self):
+        encoder = OpenAISSEEncoder(model='llama"3', include_usage=True)
+        frames = [json.loads(frame) for frame in sse_frames(b''.join(encoder.text(t) for t in self.TEXTS))]
+        self.assertEqual(len({(frame["id"], frame["created"]) for frame in frames}), 1)
+        for frame, content in zip(frames, self.TEXTS):
+            self.assertEqual(frame["object"], "chat.completion.chunk")
+            self.assertEqual((frame["model"], frame["system_fingerprint"], frame["usage"]), ('llama"3', None, None))
+            [choice] = frame["choices"]
+            self.assertEqual((choice["index"], choice["finish_reason"], choice["logprobs"]), (0, None, None))
+            self.assertEqual(choice["delta"]["content"], content)
+        self.assertEqual(frames[0]["choices"][0]["delta"]["role"], "assistant")
+        self.assertNotIn("role", frames[1]["choices"][0]["delta"])
+
+        finish, usage = [json.loads(frame) for frame in sse_frames(encoder.finish(self.FINAL))]
+        self.assertEqual(finish["choices"], [{"index": 0, "delta": {}, "logprobs": None, "finish_reason": "length"}])
+        self.assertEqual(usage["choices"], [])
+        self.assertEqual(usage["usage"], {"prompt_tokens": 7, "completion_tokens": 3, "total_tokens": 10})
+        self.assertEqual(sse_frames(encoder.close()), ["[DONE]"])
+        error = json.loads(sse_frames(encoder.error("boom"))[0])
+        self.assertEqual(error, {"error": {"message": "boom", "type": "server_error"}})
+
+    def test_openai_chunks_without_usage(self):
+        encoder = OpenAISSEEncoder(model="llama3.2")
+        frame = json.loads(sse_frames(encoder.text("hi"))[0])
+        self.assertNotIn("usage", frame)
+        self.assertEqual(len(sse_frames(encoder.finish(self.FINAL))), 1)
+        self.assertEqual(encoder.choices_finish(7, 3), b'')
+
+    def test_openai_choices(self):
+        encoder = OpenAISSEEncoder(model="llama3.2", include_usage=True)
+        parts = [encoder.choice_text(1, "a"), encoder.choice_text(0, "b"), encoder.choice_text(1, "c")]
+        frames = [json.loads(sse_frames(part)[0]) for part in parts]
+        self.assertEqual([frame["choices"][0]["index"] for frame in frames], [1, 0, 1])
+        self.assertEqual([frame["choices"][0]["delta"] for frame in frames], [
+            {"role": "assistant", "content": "a"}, {"role": "assistant", "content": "b"}, {"content": "c"},
+        ])
+        finish = json.loads(sse_frames(encoder.choice_finish(1, self.FINAL))[0])
+        self.assertEqual(finish["choices"][0], {"index": 1, "delta": {}, "logprobs": None, "finish_reason": "length"})
+        usage = json.loads(sse_frames(encoder.choices_finish(14, 6))[0])
+        self.assertEqual(usage["usage"], {"prompt_tokens": 14, "completion_tokens": 6, "total_tokens": 20})
+
+    def test_ndjson_chunks_match_ollama(self):
+        encoder = NDJSONEncoder(model="llama3.2")
+        for content in self.TEXTS:
+            with self.subTest(content=content):
+                line = encoder.text(content)
+                self.assertTrue(line.endswith(b'\n'))
+                self.assertEqual(json.loads(line), {
+                    "model": "llama3.2", "message": {"role": "assistant", "content": content}, "done": False,
+                })
+        self.assertEqual(json.loads(encoder.finish(self.FINAL)), self.FINAL)
+        self.assertEqual(json.loads(encoder.choice_text(2, "x"))["index"], 2)
+        self.assertEqual(json.loads(encoder.choice_finish(2, self.FINAL)), dict(self.FINAL, index=2))
+        self.assertEqual(json.loads(encoder.error("boom")), {"error": "boom", "done": True})
+
+    def test_vercel_choices(self):
+        encoder = VercelDataStreamEncoder()
+        self.assertEqual(encoder.choice_text(0, "a"), b'0:"a"\n2:[{"choiceIndex":0,"text":"a"}]\n')
+        self.assertEqual(encoder.choice_text(1, "b"), b'2:[{"choiceIndex":1,"text":"b"}]\n')
+        self.assertEqual(encoder.choice_finish(1, self.FINAL), b'2:[{"choiceIndex":1,"finishReason":"length"}]\n')
+
+    def test_protocol_selection(self):
+        factory = RequestFactory()
+        cases = [
+            ({"stream_protocol": "ndjson"}, {"HTTP_X_STREAM_PROTOCOL": "openai"}, "ndjson"),
+            ({}, {"HTTP_X_STREAM_PROTOCOL": " OpenAI "}, "openai"),
+            ({}, {"HTTP_ACCEPT": "text/event-stream"}, "openai"),
+            ({}, {"HTTP_ACCEPT": "application/x-ndjson, */*"}, "ndjson"),
+            ({}, {"HTTP_ACCEPT": "*/*"}, "vercel"),
+        ]
+        for cleaned, headers, expected in cases:
+            with self.subTest(cleaned=cleaned, headers=headers):
+                self.assertEqual(select_protocol(factory.get('/', **headers), cleaned), expected)
+        with self.assertRaises(ValidationError):
+            select_protocol(factory.get('/'), {"stream_protocol": "xml"})
+        encoder = create_encoder(factory.get('/'), {"model": "m", "include_usage": True}, protocol="openai")
+        self.assertIsInstance(encoder, OpenAISSEEncoder)
+        self.assertTrue(encoder.include_usage)
+
+
+def turn(role, tokens, word="aaaa"):
+    """A message the estimator counts as ``tokens`` content tokens (``word`` is one token)."""
+    return {"role": role, "content": " ".join([word] * tokens)}
+
+
+class ContextManagerTests(SimpleTestCase):
+    """Histories are trimmed to the model's window and the saved prompt tokens are reported."""
+
+    SIZE = 100 + MESSAGE_OVERHEAD_TOKENS
+
+    def make_manager(self, window=1000, **kwargs):
+        options = {"reserve_tokens": 200, "context_length": lambda model: window}
+        options.update(kwargs)
+        manager = ContextManager(**options)
+        self.addCleanup(manager._executor.shutdown)
+        return manager
+
+    def history(self, turns):
+        messages = [turn("system", 100)]
+        for index in range(turns):
+            messages.append(turn("user" if index % 2 == 0 else "assistant", 100, word=f"w{index:03}"))
+        return messages
+
+    def fit(self, manager, messages, model="m"):
+        return manager.fit({"model": model, "messages": messages})
+
+    def test_history_within_the_budget_is_untouched(self):
+        messages = self.history(5)
+        fit = self.fit(self.make_manager(), messages)
+        self.assertIs(fit.messages, messages)
+        self.assertEqual((fit.prompt_tokens, fit.saved_tokens, fit.dropped), (6 * self.SIZE, 0, 0))
+
+    def test_recent_policy_keeps_the_system_message_and_latest_turns(self):
+        messages = self.history(11)
+        manager = self.make_manager()
+        fit = self.fit(manager, messages)
+        # 800 tokens of budget: the system message and the 6 latest turns, minus the leading assistant turn
+        self.assertEqual(fit.messages, [messages[0]] + messages[-5:])
+        self.assertEqual(fit.prompt_tokens, 6 * self.SIZE)
+        self.assertEqual(fit.saved_tokens, 6 * self.SIZE)
+        self.assertEqual(fit.dropped, 6)
+        self.assertFalse(fit.summarized)
+        snapshot = manager.snapshot()
+        self.assertEqual((snapshot["trimmed"], snapshot["savedTokens"]), (1, 6 * self.SIZE))
+
+    def test_latest_message_is_kept_even_over_budget(self):
+        messages = [turn("user", 10), turn("assistant", 10), turn("user", 2000)]
+        fit = self.fit(self.make_manager(), messages)
+        self.assertEqual(fit.messages, messages[-1:])
+        self.assertEqual(fit.saved_tokens, 2 * (10 + MESSAGE_OVERHEAD_TOKENS))
+
+    def test_window_setting_caps_the_model_window(self):
+        self.assertEqual(self.make_manager(window=8192, window_tokens=2048).budget("m"), 1848)
+        self.assertEqual(self.make_manager(window=None, window_tokens=2048).budget("m"), 1848)
+        self.assertEqual(self.make_manager(window=100).budget("m"), 0)
+        self.assertIsNone(self.make_manager(window=None).budget("m"))
+
+    def test_unknown_window_or_off_policy_forwards_everything(self):
+        messages = self.history(30)
+        for manager in (self.make_manager(window=None), self.make_manager(policy=POLICY_OFF)):
+            fit = self.fit(manager, messages)
+            self.assertIs(fit.messages, messages)
+            self.assertEqual(fit.saved_tokens, 0)
+
+    def test_summarize_policy_replaces_dropped_turns_with_a_summary(self):
+        client = mock.Mock()
+        client.raw_chat.return_value = {"message": {"content": "They talked."}}
+        manager = self.make_manager(policy=POLICY_SUMMARIZE)
+        messages = self.history(11)
+        with mock.patch('chat_models.ollama_client.get_ollama_client', return_value=client):
+            first = self.fit(manager, messages)
+            self.assertFalse(first.summarized)
+            for _ in range(200):
+                if manager.snapshot()["summariesWritten"]:
+                    break
+                time.sleep(0.01)
+            messages = messages + [turn("assistant", 100, word="next"), turn("user", 100, word="last")]
+            fit = self.fit(manager, messages)
+            manager._executor.shutdown(wait=True)
+        transcript = client.raw_chat.call_args_list[0].args[1][1]["content"]
+        self.assertIn(messages[1]["content"], transcript)
+        self.assertNotIn(messages[0]["content"], transcript)
+        # The summary rolls forward: the turns dropped since are added to it
+        rolled = client.raw_chat.call_args_list[1].args[1][1]["content"]
+        self.assertTrue(rolled.startswith("Summary so far:\nThey talked."))
+        summary = {"role": "system", "content": SUMMARY_PREFIX + "They talked."}
+        summary_tokens = manager.estimator.estimate(summary)
+        self.assertTrue(fit.summarized)
+        self.assertEqual(fit.messages[:2], [messages[0], summary])
+        self.assertEqual(fit.prompt_tokens, (len(fit.messages) - 1) * self.SIZE + summary_tokens)
+        self.assertEqual(fit.saved_tokens, len(messages) * self.SIZE - fit.prompt_tokens)
+
+    def test_summary_of_an_edited_history_is_not_used(self):
+        manager = self.make_manager(policy=POLICY_SUMMARIZE)
+        messages = self.history(11)
+        fingerprint = "f"
+        manager.summary_store.set(KEY_PREFIX + fingerprint, {
+            "upto": 6, "prefix": "not the prefix", "summary": "stale", "tokens": 10,
+        })
+        with mock.patch('chat_models.context.conversation_fingerprint', return_value=fingerprint), \
+                mock.patch.object(manager, '_schedule_summary'):
+            fit = self.fit(manager, messages)
+        self.assertFalse(fit.summarized)
+        self.assertEqual(fit.messages, [messages[0]] + messages[-5:])
+
+    def test_estimates_of_long_messages_are_cached(self):
+        estimator = TokenEstimator()
+        long, short = turn("user", 100), turn("user", 3)
+        self.assertEqual(estimator.estimate(long), self.SIZE)
+        self.assertEqual(estimator.estimate(long), self.SIZE)
+        self.assertEqual(estimator.estimate(short), 3 + MESSAGE_OVERHEAD_TOKENS)
+        self.assertEqual((estimator.hits, estimator.misses), (1, 1))
+        self.assertEqual(TokenEstimator.estimate_text("def f(x): return x+1"), 11)
+
+    def test_saved_tokens_are_reported_in_headers(self):
+        response = {}
+        apply_context_headers(response, ContextFit([], 10, saved_tokens=0))
+        self.assertEqual(response, {})
+        apply_context_headers(response, ContextFit([], 10, saved_tokens=42, summarized=True))
+        self.assertEqual(response, {"X-Context-Saved-Tokens": "42", "X-Context-Summary": "true"})
+
+
+class ConversationStoreTests(TransactionTestCase):
+    """Stored conversations continue from their history, belong to their creator and only grow on finished turns."""
+
+    def setUp(self):
+        self.store = ConversationStore(InProcessCacheBackend())
+        users = get_user_model().objects
+        self.alice = users.create_user("alice")
+        self.bob = users.create_user("bob")
+
+    def request(self, content, **options):
+        return dict({"model": "m", "messages": [{"role": "user", "content": content}]}, **options)
+
+    def finish(self, turn, *tokens):
+        return collect(turn.record_stream(answer_stream(*tokens)))
+
+    def start(self, user, content="Hi"):
+        turn = self.store.resolve(user, self.request(content, store=True))
+        self.finish(turn, "Hello", "!")
+        return turn.conversation_id
+
+    def test_stateless_requests_have_no_turn(self):
+        self.assertIsNone(self.store.resolve(self.alice, self.request("Hi")))
+        self.assertIsNone(apply_conversation_headers({}, None).get('X-Conversation-Id'))
+
+    def test_first_turn_creates_and_stores_the_conversation(self):
+        turn = self.store.resolve(self.alice, self.request("Hi", store=True))
+        self.assertTrue(turn.created)
+        self.assertEqual(apply_conversation_headers({}, turn), {'X-Conversation-Id': turn.conversation_id})
+        self.assertEqual(self.finish(turn, "Hello", "!")["message"]["content"], "Hello!")
+        conversation = Conversation.objects.get(pk=turn.conversation_id)
+        self.assertEqual((conversation.user, conversation.message_count), (self.alice, 2))
+        self.assertEqual(self.store.history(turn.conversation_id, self.alice.pk), [
+            {"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello!"},
+        ])
+
+    def test_continuation_sends_the_history_plus_the_new_turn(self):
+        conversation_id = self.start(self.alice)
+        turn = self.store.resolve(self.alice, self.request("And then?", conversation_id=conversation_id))
+        self.assertFalse(turn.created)
+        self.assertEqual([m["content"] for m in turn.messages], ["Hi", "Hello!", "And then?"])
+        self.finish(turn, "The end.")
+        expected = ["Hi", "Hello!", "And then?", "The end."]
+        with self.assertNumQueries(0):
+            self.assertEqual([m["content"] for m in self.store.history(conversation_id, self.alice.pk)], expected)
+        # The database holds the same history once the cache has forgotten it
+        self.store.cache = InProcessCacheBackend()
+        self.assertEqual([m["content"] for m in self.store.history(conversation_id, self.alice.pk)], expected)
+        self.assertEqual(
+            list(Message.objects.filter(conversation_id=conversation_id).values_list('position', flat=True)),
+            [0, 1, 2, 3],
+        )
+
+    def test_conversations_belong_to_their_creator(self):
+        conversation_id = self.start(self.alice)
+        anonymous_id = self.start(AnonymousUser())
+        for cache in (self.store.cache, InProcessCacheBackend()):
+            self.store.cache = cache
+            for user, other in ((self.bob, conversation_id), (AnonymousUser(), conversation_id), (self.bob, anonymous_id)):
+                with self.subTest(user=user, conversation=other), self.assertRaises(ConversationNotFound):
+                    self.store.resolve(user, self.request("Mine now", conversation_id=other))
+        # Anonymous conversations can be continued by anyone holding the id, as long as they are anonymous
+        self.assertIsNotNone(self.store.resolve(AnonymousUser(), self.request("Hi", conversation_id=anonymous_id)))
+
+    def test_unknown_conversation_is_not_found(self):
+        with self.assertRaises(ConversationNotFound):
+            self.store.resolve(self.alice, self.request("Hi", conversation_id=str(uuid.uuid4())))
+
+    def test_unfinished_turn_is_not_stored_and_closes_upstream(self):
+        conversation_id = self.start(self.alice)
+        turn = self.store.resolve(self.alice, self.request("More", conversation_id=conversation_id))
+        closed = []
+        upstream = answer_stream("a", "b", closed=closed)
+        stream = turn.record_stream(upstream)
+        next(stream)
+        stream.close()
+        self.assertEqual(closed, [True])
+        self.assertEqual(Conversation.objects.get(pk=conversation_id).message_count, 2)
+
+    def test_async_unfinished_turn_closes_upstream(self):
+        conversation_id = self.start(self.alice)
+        closed = []
+
+        async def main():
+            turn = await self.store.aresolve(self.alice, self.request("More", conversation_id=conversation_id))
+            stream = turn.arecord_stream(aanswer_stream("a", "b", closed=closed))
+            await stream.__anext__()
+            await stream.aclose()
+            self.assertEqual(closed, [True])
+
+        asyncio.run(main())
+        self.assertEqual(Conversation.objects.get(pk=conversation_id).message_count, 2)
+
+    def test_concurrent_continuations_keep_the_first_to_finish(self):
+        conversation_id = self.start(self.alice)
+        first = self.store.resolve(self.alice, self.request("One", conversation_id=conversation_id))
+        second = self.store.resolve(self.alice, self.request("Two", conversation_id=conversation_id))
+        self.finish(first, "1")
+        self.finish(second, "2")
+        self.assertEqual(
+            [m["content"] for m in self.store.history(conversation_id, self.alice.pk)], ["Hi", "Hello!", "One", "1"],
+        )
+        self.assertEqual(Conversation.objects.get(pk=conversation_id).message_count, 4)
+
+    def test_repeated_content_is_stored_once(self):
+        self.start(self.alice)
+        self.start(self.bob)
+        self.assertEqual(MessageContent.objects.count(), 2)
+        self.assertEqual(Message.objects.count(), 4)
+
+    def test_disabled_store_rejects_stored_conversations(self):
+        self.store.enabled = False
+        self.assertIsNone(self.store.resolve(self.alice, self.request("Hi")))
+        with self.assertRaises(ValidationError):
+            self.store.resolve(self.alice, self.request("Hi", store=True))
+
+
+@override_settings(CHAT_VALIDATE_MODELS=False)
+class EmbeddingsErrorTests(SimpleTestCase):
+    """Unexpected embedding failures answer with the JSON error envelope, as chat completions do."""
+
+    BODY = '{"model": "m", "input": ["a", "b"]}'
+
+    def test_sync_view(self):
+        batcher = mock.Mock()
+        batcher.embed.side_effect = RuntimeError("vectors of the wrong shape")
+        request = Request(RequestFactory().post('/v1/embeddings', self.BODY, content_type='application/json'),
+                          parsers=[JSONParser()])
+        with mock.patch('chat_models.views.get_embedding_batcher', return_value=batcher):
+            response = EmbeddingsView()._embed(request)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data["error"], "Internal server error")
+
+    def test_async_view(self):
+        batcher = mock.Mock()
+        batcher.aembed = mock.AsyncMock(side_effect=RuntimeError("vectors of the wrong shape"))
+        request = RequestFactory().post('/v1/embeddings', self.BODY, content_type='application/json')
+        with mock.patch('chat_models.async_views.get_embedding_batcher', return_value=batcher):
+            response = asyncio.run(AsyncEmbeddingsView()._embed(request))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(json.loads(response.content)["error"], "Internal server error")
+
+
+def vector_of(text):
+    return [float(len(text)), float(ord(text[0])), 0.1]
+
+
+class EmbeddingBatcherTests(SimpleTestCase):
+    """Concurrent requests share one upstream call; every request gets its own vectors in input order."""
+
+    def make_batcher(self, **kwargs):
+        self.calls = []
+
+        def embed_fn(model, texts):
+            self.calls.append((model, list(texts)))
+            return [vector_of(text) for text in texts]
+
+        options = {"window_ms": 500, "max_batch": 64, "cache_size": 0}
+        options.update(kwargs)
+        return EmbeddingBatcher(embed_fn, **options)
+
+    def assert_vectors(self, result, texts):
+        np.testing.assert_array_equal(result.vectors, np.asarray([vector_of(t) for t in texts], dtype=np.float32))
+
+    def embed_concurrently(self, batcher, requests):
+        results = [None] * len(requests)
+        barrier = threading.Barrier(len(requests))
+
+        def run(index, model, texts):
+            barrier.wait()
+            results[index] = batcher.embed(model, texts)
+
+        threads = [threading.Thread(target=run, args=(i, *request)) for i, request in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return results
+
+    def test_concurrent_requests_merge_into_one_deduplicated_call(self):
+        batcher = self.make_batcher()
+        requests = [("m", ["alpha", "beta"]), ("m", ["beta", "gamma", "alpha"]), ("m", ["delta"])]
+        results = self.embed_concurrently(batcher, requests)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(sorted(self.calls[0][1]), ["alpha", "beta", "delta", "gamma"])
+        for result, (_, texts) in zip(results, requests):
+            self.assert_vectors(result, texts)
+        snapshot = batcher.snapshot()
+        self.assertEqual((snapshot["mergedBatches"], snapshot["upstreamInputs"], snapshot["inputs"]), (1, 4, 6))
+
+    def test_models_are_batched_separately(self):
+        batcher = self.make_batcher()
+        self.embed_concurrently(batcher, [("m", ["a"]), ("other", ["a"]), ("m", ["b"])])
+        self.assertEqual(sorted((model, sorted(texts)) for model, texts in self.calls),
+                         [("m", ["a", "b"]), ("other", ["a"])])
+
+    def test_full_batch_is_sent_without_waiting_for_the_window(self):
+        batcher = self.make_batcher(window_ms=10000, max_batch=4)
+        started = time.monotonic()
+        results = self.embed_concurrently(batcher, [("m", ["a", "b"]), ("m", ["c", "d"])])
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(len(self.calls), 1)
+        self.assert_vectors(results[1], ["c", "d"])
+
+    def test_large_and_unbatched_requests_go_upstream_alone(self):
+        for options, texts in (({"max_batch": 2}, ["a", "b", "a"]), ({"window_ms": 0}, ["a"])):
+            result = self.make_batcher(**options).embed("m", texts)
+            self.assertEqual(self.calls, [("m", texts)])
+            self.assert_vectors(result, texts)
+
+    def test_duplicates_within_a_request_are_embedded_once(self):
+        batcher = self.make_batcher(window_ms=1)
+        result = batcher.embed("m", ["a", "bb", "a", "a"])
+        self.assertEqual(self.calls, [("m", ["a", "bb"])])
+        self.assert_vectors(result, ["a", "bb", "a", "a"])
+
+    def test_cached_vectors_skip_the_upstream_call(self):
+        batcher = self.make_batcher(window_ms=1, cache_size=16)
+        self.assertEqual(batcher.embed("m", ["a", "b"]).cache_status, EMBEDDING_MISS)
+        partial = batcher.embed("m", ["b", "c"])
+        self.assertEqual((partial.cache_status, partial.cached), (CACHE_PARTIAL, 1))
+        self.assertEqual(batcher.embed("m", ["c", "a"]).cache_status, EMBEDDING_HIT)
+        self.assertEqual([texts for _, texts in self.calls], [["a", "b"], ["c"]])
+        self.assert_vectors(partial, ["b", "c"])
+
+    def test_upstream_failure_reaches_every_request_of_the_batch(self):
+        batcher = self.make_batcher()
+        batcher.embed_fn = mock.Mock(side_effect=ConnectionError("down"))
+        errors = []
+
+        def run(texts):
+            try:
+                batcher.embed("m", texts)
+            except ConnectionError as e:
+                errors.append(e)
+
+        barrier = threading.Barrier(2)
+        threads = [threading.Thread(target=lambda t=t: (barrier.wait(), run(t))) for t in (["a"], ["b"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(len(errors), 2)
+        batcher.embed_fn.assert_called_once()
+
+    def test_json_body_round_trips_the_float32_vectors(self):
+        result = self.make_batcher(window_ms=0).embed("m", ["hello", "a"])
+        body = json.loads(result.to_json())
+        self.assertEqual([item["index"] for item in body["data"]], [0, 1])
+        np.testing.assert_array_equal(
+            np.asarray([item["embedding"] for item in body["data"]], dtype=np.float32), result.vectors,
+        )
+        encoded = json.loads(result.to_json('base64'))["data"][1]["embedding"]
+        np.testing.assert_array_equal(np.frombuffer(base64.b64decode(encoded), dtype='<f4'), result.vectors[1])
+        self.assertEqual(body["usage"], {"prompt_tokens": 3, "total_tokens": 3})
+
+
+@override_settings(CHAT_STREAM_COALESCE_MS=0)
+class SamplingTests(SimpleTestCase):
+    """Requests with n > 1 run their samples concurrently, each under its own admission slot."""
+
+    TOKENS = 5
+    EXPECTED = "".join(f"tok{i} " for i in range(TOKENS))
+
+    def setUp(self):
+        self.server = FakeOllamaServer(tokens=self.TOKENS, token_delay=0.05).start()
+        self.addCleanup(self.server.stop)
+        router = OllamaRouter.single(self.server.base_url)
+        self.client = OllamaClient(router=router)
+        self.admission = AdmissionController(router, model_concurrency=3)
+        patcher = mock.patch('chat_models.admission._controller', self.admission)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cleaned = {"model": "fake-model", "messages": [{"role": "user", "content": "Hi"}], "n": 3}
+
+    def released(self):
+        for _ in range(200):
+            if not self.admission.snapshot()["active"]:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_streamed_samples_are_interleaved_choices(self):
+        stats = ChoiceStats(3)
+        items = list(sample_stream(self.client, self.cleaned, stats, "t", 0))
+        contents = {index: "" for index in range(3)}
+        for index, chunk in items:
+            contents[index] += chunk["message"]["content"]
+        self.assertEqual(contents, {index: self.EXPECTED for index in range(3)})
+        # Concurrent, not one after the other: every sample has started before the first one finishes
+        self.assertEqual({index for index, _ in items[:self.TOKENS]}, {0, 1, 2})
+        self.assertEqual([done.get("done") for _, done in items if done.get("done")], [True] * 3)
+        self.assertTrue(self.released())
+
+    def test_samples_beyond_the_concurrency_limit_wait_for_a_slot(self):
+        self.admission.model_concurrency = 2
+        stats = ChoiceStats(3)
+        items = list(sample_stream(self.client, self.cleaned, stats, "t", 0))
+        self.assertEqual(sum(1 for _, chunk in items if chunk.get("done")), 3)
+        self.assertTrue(self.released())
+
+    def test_closing_the_stream_releases_every_sample(self):
+        stream = sample_stream(self.client, self.cleaned, ChoiceStats(3), "t", 0)
+        next(stream)
+        stream.close()
+        self.assertTrue(self.released())
+
+    def test_async_streamed_samples(self):
+        stats = ChoiceStats(3)
+
+        async def main():
+            return [item async for item in asample_stream(self.client, self.cleaned, stats, "t", 0)]
+
+        items = asyncio.run(main())
+        contents = {index: "" for index in range(3)}
+        for index, chunk in items:
+            contents[index] += chunk["message"]["content"]
+        self.assertEqual(contents, {index: self.EXPECTED for index in range(3)})
+        self.assertTrue(self.released())
+
+    def test_non_streaming_samples_are_indexed_choices_with_summed_usage(self):
+        responses = sample_completions(self.client, self.cleaned, 3, "t", 0)
+        stats = ChoiceStats(3)
+        body = format_choices(self.client, responses, stats)
+        self.assertEqual([choice["index"] for choice in body["choices"]], [0, 1, 2])
+        self.assertEqual({choice["message"]["content"] for choice in body["choices"]}, {self.EXPECTED})
+        self.assertEqual(body["usage"], {
+            "promptTokens": 10, "completionTokens": 3 * self.TOKENS, "totalTokens": 10 + 3 * self.TOKENS,
+        })
+        self.assertEqual((stats.finish_reason, stats.finish_reasons), ("stop", ["stop"] * 3))
+        self.assertTrue(self.released())
+
+    def test_choices_encode_with_aggregated_usage(self):
+        final = {"done": True, "prompt_eval_count": 10, "eval_count": 2}
+        stream = [(1, delta("b")), (0, delta("a")), (0, dict(final, done_reason="stop")),
+                  (1, dict(final, done_reason="length"))]
+        stats = ChoiceStats(2)
+        body = b"".join(encode_choices(iter(stream), OpenAISSEEncoder(model="m", include_usage=True), "r", stats))
+        frames = [json.loads(frame) for frame in sse_frames(body)[:-1]]
+        self.assertEqual([frame["choices"][0]["index"] for frame in frames[:4]], [1, 0, 0, 1])
+        self.assertEqual(frames[-1]["usage"], {"prompt_tokens": 10, "completion_tokens": 4, "total_tokens": 14})
+        self.assertEqual((stats.finish_reason, stats.finish_reasons), ("mixed", ["stop", "length"]))
+
+    def test_client_leaving_marks_unfinished_choices_cancelled(self):
+        stats = ChoiceStats(2)
+        stream = [(0, delta("a")), (0, {"done": True, "eval_count": 1}), (1, delta("b")), (1, delta("c"))]
+        encoded = encode_choices(iter(stream), VercelDataStreamEncoder(), "r", stats)
+        for _ in range(3):
+            next(encoded)
+        encoded.close()
+        self.assertEqual(stats.finish_reasons, ["stop", "client_cancelled"])
@@ -0,0 +1,437 @@
+"""
+Server-side tool calling for chat completions.
+
+A request names the tools the model may call in ``tools``, either by name or
+as OpenAI function definitions whose ``function.name`` is a tool registered
+here (``CHAT_TOOLS``). The proxy then runs the conversation to its answer:
+
+- every model turn is a non-streaming generation with its own admission
+  slot, released while tools run, so slow tools do not hold generation
+  capacity;
+- all tool calls of one turn run concurrently on a bounded thread pool
+  (``CHAT_TOOL_WORKERS``), each bounded by its tool's timeout. A failed or
+  timed-out call is reported to the model as an ``{"error": ...}`` result
+  rather than failing the request;
+- results of tools marked ``idempotent`` are cached by tool name and
+  arguments (``CHAT_TOOL_CACHE_SIZE``, ``CHAT_TOOL_CACHE_TTL_SECONDS``);
+- after ``CHAT_TOOL_MAX_ROUNDS`` rounds of calls the model is asked once more
+  without tools, so it has to answer.
+
+A timed-out call cannot be interrupted: its thread finishes in the background
+and occupies a pool worker until then.
+
+Model and tool time of every round are logged, and the totals are kept in a
+:class:`ToolTrace` that ``RequestLoggingMiddleware`` stores on the request log.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils.module_loading import import_string
+
+from .completion_cache import CompletionCache, InProcessCacheBackend
+
+logger = logging.getLogger(__name__)
+
+
+class Tool:
+    """A Python callable the model may call, with its JSON-schema parameters."""
+
+    def __init__(self, fn: Callable[..., Any], name: Optional[str] = None, description: str = '',
+                 parameters: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None,
+                 idempotent: bool = False):
+        self.fn = fn
+        self.name = name or fn.__name__
+        self.description = description or (fn.__doc__ or '').strip()
+        self.parameters = parameters or {"type": "object", "properties": {}}
+        self.timeout = timeout
+        self.idempotent = idempotent
+
+    def to_ollama(self) -> Dict[str, Any]:
+        """Definition in the format of Ollama's ``tools`` field."""
+        return {
+            "type": "function",
+            "function": {"name": self.name, "description": self.description, "parameters": self.parameters},
+        }
+
+    def __call__(self, **arguments) -> Any:
+        return self.fn(**arguments)
+
+
+def tool(name: Optional[str] = None, description: str = '', parameters: Optional[Dict[str, Any]] = None,
+         timeout: Optional[float] = None, idempotent: bool = False) -> Callable[[Callable[..., Any]], Tool]:
+    """Decorator turning a function into a :class:`Tool` for ``CHAT_TOOLS``."""
+    def wrap(fn: Callable[..., Any]) -> Tool:
+        return Tool(fn, name, description, parameters, timeout, idempotent)
+    return wrap
+
+
+class ToolRegistry:
+    """The tools requests may use, by name."""
+
+    def __init__(self, tools: List[Tool]):
+        self.tools = {t.name: t for t in tools}
+
+    @classmethod
+    def from_settings(cls) -> "ToolRegistry":
+        paths = getattr(settings, 'CHAT_TOOLS', '')
+        tools = []
+        for path in (p.strip() for p in paths.split(',')):
+            if not path:
+                continue
+            obj = import_string(path)
+            tools.append(obj if isinstance(obj, Tool) else Tool(obj))
+        return cls(tools)
+
+    def resolve(self, requested: List[Any]) -> List[str]:
+        """
+        Names of the tools a request asks for.
+
+        Raises:
+            ValidationError: an entry is malformed or names an unknown tool
+        """
+        names = []
+        for entry in requested:
+            if isinstance(entry, dict):
+                entry = (entry.get("function") or {}).get("name", entry.get("name"))
+            if not isinstance(entry, str) or not entry:
+                raise ValidationError("Each tool must be a tool name or a function definition with a name")
+            if entry not in self.tools:
+                available = ', '.join(sorted(self.tools)) or 'none'
+                raise ValidationError(f"Unknown tool '{entry}' (available: {available})")
+            if entry not in names:
+                names.append(entry)
+        return names
+
+
+class ToolResult:
+    """Outcome of one tool call, as sent back to the model."""
+
+    def __init__(self, name: str, content: str, ms: float, cached: bool = False, error: bool = False):
+        self.name = name
+        self.content = content
+        self.ms = ms
+        self.cached = cached
+        self.error = error
+
+    def to_message(self) -> Dict[str, str]:
+        return {"role": "tool", "content": self.content}
+
+
+def _encode(value: Any) -> str:
+    return value if isinstance(value, str) else json.dumps(value, default=str)
+
+
+def _error(message: str) -> str:
+    return json.dumps({"error": message})
+
+
+class ToolExecutor:
+    """Runs the tool calls of one model turn concurrently on a bounded pool."""
+
+    def __init__(self, registry: ToolRegistry, workers: int = 8, timeout: float = 10.0,
+                 cache_size: int = 1024, cache_ttl: float = 300.0):
+        self.registry = registry
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='chat-tool')
+        self.cache = InProcessCacheBackend(cache_size, ttl=cache_ttl) if cache_size else None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    @classmethod
+    def from_settings(cls, registry: ToolRegistry) -> "ToolExecutor":
+        return cls(
+            registry,
+            workers=getattr(settings, 'CHAT_TOOL_WORKERS', 8),
+            timeout=getattr(settings, 'CHAT_TOOL_TIMEOUT_SECONDS', 10.0),
+            cache_size=getattr(settings, 'CHAT_TOOL_CACHE_SIZE', 1024),
+            cache_ttl=getattr(settings, 'CHAT_TOOL_CACHE_TTL_SECONDS', 300.0),
+        )
+
+    def run(self, calls: List[Dict[str, Any]]) -> List[ToolResult]:
+        """Run Ollama ``tool_calls`` concurrently; results in call order."""
+        started = time.monotonic()
+        pending = [self._start(call) for call in calls]
+        results = []
+        for tool, arguments, key, future in pending:
+            if not isinstance(future, Future):
+                results.append(future)
+                continue
+            remaining = max(started + self._timeout(tool) - time.monotonic(), 0.0)
+            try:
+                value = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                future.cancel()
+                results.append(self._timed_out(tool, started))
+            except Exception as e:
+                results.append(self._failed(tool, e, started))
+            else:
+                results.append(self._succeeded(tool, key, value, started))
+        return results
+
+    async def arun(self, calls: List[Dict[str, Any]]) -> List[ToolResult]:
+        """Async counterpart of :meth:`run`; waits on the event loop."""
+        started = time.monotonic()
+        pending = [self._start(call) for call in calls]
+
+        async def wait(tool: Tool, key: Optional[str], future: Future) -> ToolResult:
+            try:
+                value = await asyncio.wait_for(asyncio.wrap_future(future), self._timeout(tool))
+            except asyncio.TimeoutError:
+                future.cancel()
+                return self._timed_out(tool, started)
+            except Exception as e:
+                return self._failed(tool, e, started)
+            return self._succeeded(tool, key, value, started)
+
+        async def done(result: ToolResult) -> ToolResult:
+            return result
+
+        waits: List[Awaitable[ToolResult]] = [
+            wait(tool, key, future) if isinstance(future, Future) else done(future)
+            for tool, arguments, key, future in pending
+        ]
+        return list(await asyncio.gather(*waits))
+
+    def _timeout(self, tool: Tool) -> float:
+        return tool.timeout if tool.timeout is not None else self.timeout
+
+    def _start(self, call: Dict[str, Any]):
+        """Submit one call; ``future`` is a ready :class:`ToolResult` when nothing needs running."""
+        with self._lock:
+            self.calls += 1
+        function = call.get("function") or {}
+        name = function.get("name", "")
+        arguments = function.get("arguments") or {}
+        if isinstance(arguments, str):
+            try:
+                arguments = json.loads(arguments)
+            except json.JSONDecodeError:
+                arguments = None
+        tool = self.registry.tools.get(name)
+        if tool is None or not isinstance(arguments, dict):
+            with self._lock:
+                self.errors += 1
+            message = f"Unknown tool '{name}'" if tool is None else "Arguments must be a JSON object"
+            return tool, arguments, None, ToolResult(name, _error(message), 0.0, error=True)
+
+        key = None
+        if tool.idempotent and self.cache is not None:
+            key = 'tool:' + hashlib.blake2b(
+                json.dumps([name, arguments], sort_keys=True, default=str).encode('utf-8'), digest_size=16,
+            ).hexdigest()
+            cached = self.cache.get(key)
+            if cached is not None:
+                with self._lock:
+                    self.cache_hits += 1
+                return tool, arguments, key, ToolResult(name, cached["content"], 0.0, cached=True)
+        return tool, arguments, key, self._pool.submit(tool, **arguments)
+
+    def _succeeded(self, tool: Tool, key: Optional[str], value: Any, started: float) -> ToolResult:
+        content = _encode(value)
+        if key is not None:
+            self.cache.set(key, {"content": content})
+        return ToolResult(tool.name, content, (time.monotonic() - started) * 1000)
+
+    def _failed(self, tool: Tool, error: Exception, started: float) -> ToolResult:
+        logger.warning(f"Tool '{tool.name}' failed: {error}")
+        with self._lock:
+            self.errors += 1
+        return ToolResult(tool.name, _error(str(error)), (time.monotonic() - started) * 1000, error=True)
+
+    def _timed_out(self, tool: Tool, started: float) -> ToolResult:
+        timeout = self._timeout(tool)
+        logger.warning(f"Tool '{tool.name}' timed out after {timeout}s")
+        with self._lock:
+            self.timeouts += 1
+        return ToolResult(tool.name, _error(f"Timed out after {timeout}s"), (time.monotonic() - started) * 1000, error=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "tools": sorted(self.registry.tools),
+                "calls": self.calls,
+                "cacheHits": self.cache_hits,
+                "errors": self.errors,
+                "timeouts": self.timeouts,
+            }
+
+
+class ToolTrace:
+    """Model and tool time of one request's rounds."""
+
+    def __init__(self):
+        self.rounds = 0
+        self.calls = 0
+        self.model_ms = 0.0
+        self.tool_ms = 0.0
+        self.queue_ms = 0.0
+
+    def record(self, request_id: str, model_ms: float, queue_ms: float, results: List[ToolResult],
+               tool_ms: float) -> None:
+        self.rounds += 1
+        self.calls += len(results)
+        self.model_ms += model_ms
+        self.queue_ms += queue_ms
+        self.tool_ms += tool_ms
+        if results:
+            names = ', '.join(r.name + (' (cached)' if r.cached else ' (error)' if r.error else '') for r in results)
+            logger.info(
+                f"[request:{request_id}] Tool round {self.rounds}: model {model_ms:.1f} ms, "
+                f"{len(results)} tool calls in {tool_ms:.1f} ms: {names}"
+            )
+        else:
+            logger.info(f"[request:{request_id}] Tool round {self.rounds}: model {model_ms:.1f} ms, answered")
+
+
+def _round_messages(response: Dict[str, Any], results: List[ToolResult]) -> List[Dict[str, Any]]:
+    """The assistant's tool-call turn and one tool message per result."""
+    message = response.get("message") or {}
+    assistant = {"role": "assistant", "content": message.get("content") or "", "tool_calls": message.get("tool_calls")}
+    return [assistant] + [result.to_message() for result in results]
+
+
+def run_tool_loop(client, cleaned_data: Dict[str, Any], admit: Callable[[], Any], trace: ToolTrace,
+                  request_id: str) -> Dict[str, Any]:
+    """
+    Alternate model turns and tool calls until the model answers.
+
+    ``admit`` returns an admission ticket for one model turn. Returns the
+    final raw Ollama response, with usage summed over every turn.
+    """
+    registry = get_tool_registry()
+    executor = get_tool_executor()
+    specs = [registry.tools[name].to_ollama() for name in cleaned_data['tools']]
+    max_rounds = getattr(settings, 'CHAT_TOOL_MAX_ROUNDS', 5)
+    messages = list(cleaned_data['messages'])
+    usage = {"prompt_eval_count": 0, "eval_count": 0}
+    while True:
+        offered = specs if trace.rounds < max_rounds else None
+        started = time.monotonic()
+        ticket = admit()
+        try:
+            response = client.raw_chat(
+                model=cleaned_data['model'],
+                messages=messages,
+                temperature=cleaned_data.get('temperature', 0.7),
+                top_p=cleaned_data.get('top_p', 0.9),
+                tools=offered,
+            )
+        finally:
+            ticket.release()
+        queue_ms = ticket.queue_seconds * 1000
+        model_ms = (time.monotonic() - started) * 1000 - queue_ms
+        _add_usage(usage, response)
+        calls = (response.get("message") or {}).get("tool_calls") if offered else None
+        if not calls:
+            trace.record(request_id, model_ms, queue_ms, [], 0.0)
+            return dict(response, **usage)
+        started = time.monotonic()
+        results = executor.run(calls)
+        trace.record(request_id, model_ms, queue_ms, results, (time.monotonic() - started) * 1000)
+        messages += _round_messages(response, results)
+
+
+async def arun_tool_loop(client, cleaned_data: Dict[str, Any], admit: Callable[[], Awaitable[Any]],
+                         trace: ToolTrace, request_id: str) -> Dict[str, Any]:
+    """Async counterpart of :func:`run_tool_loop`."""
+    registry = get_tool_registry()
+    executor = get_tool_executor()
+    specs = [registry.tools[name].to_ollama() for name in cleaned_data['tools']]
+    max_rounds = getattr(settings, 'CHAT_TOOL_MAX_ROUNDS', 5)
+    messages = list(cleaned_data['messages'])
+    usage = {"prompt_eval_count": 0, "eval_count": 0}
+    while True:
+        offered = specs if trace.rounds < max_rounds else None
+        started = time.monotonic()
+        ticket = await admit()
+        try:
+            response = await client.araw_chat(
+                model=cleaned_data['model'],
+                messages=messages,
+                temperature=cleaned_data.get('temperature', 0.7),
+                top_p=cleaned_data.get('top_p', 0.9),
+                tools=offered,
+            )
+        finally:
+            ticket.release()
+        queue_ms = ticket.queue_seconds * 1000
+        model_ms = (time.monotonic() - started) * 1000 - queue_ms
+        _add_usage(usage, response)
+        calls = (response.get("message") or {}).get("tool_calls") if offered else None
+        if not calls:
+            trace.record(request_id, model_ms, queue_ms, [], 0.0)
+            return dict(response, **usage)
+        started = time.monotonic()
+        results = await executor.arun(calls)
+        trace.record(request_id, model_ms, queue_ms, results, (time.monotonic() - started) * 1000)
+        messages += _round_messages(response, results)
+
+
+def stream_tool_loop(client, cleaned_data: Dict[str, Any], admit: Callable[[], Any], trace: ToolTrace,
+                     request_id: str) -> Iterator[Dict[str, Any]]:
+    """Run :func:`run_tool_loop` once iteration starts; the answer as a raw Ollama stream."""
+    yield from CompletionCache.replay(run_tool_loop(client, cleaned_data, admit, trace, request_id))
+
+
+async def astream_tool_loop(client, cleaned_data: Dict[str, Any], admit: Callable[[], Awaitable[Any]],
+                            trace: ToolTrace, request_id: str) -> AsyncIterator[Dict[str, Any]]:
+    """Async counterpart of :func:`stream_tool_loop`."""
+    async for chunk in CompletionCache.areplay(await arun_tool_loop(client, cleaned_data, admit, trace, request_id)):
+        yield chunk
+
+
+def _add_usage(usage: Dict[str, int], response: Dict[str, Any]) -> None:
+    usage["prompt_eval_count"] += response.get("prompt_eval_count", 0) or 0
+    usage["eval_count"] += response.get("eval_count", 0) or 0
+
+
+def apply_tool_headers(response, trace: ToolTrace):
+    """
+    Report a finished trace in headers.
+
+    Streams are still running when their headers go out, so only the log row
+    (written when the response closes, see ``dashboard.usage``) gets their totals.
+    """
+    if trace.rounds:
+        response['X-Tool-Calls'] = str(trace.calls)
+        response['X-Tool-Time-Ms'] = f"{trace.tool_ms:.1f}"
+        response['X-Queue-Time-Ms'] = f"{trace.queue_ms:.1f}"
+    return response
+
+
+_registry: Optional[ToolRegistry] = None
+_executor: Optional[ToolExecutor] = None
+_tools_lock = threading.Lock()
+
+
+def get_tool_registry() -> ToolRegistry:
+    """Return the process-wide tool registry built from ``CHAT_TOOLS``."""
+    global _registry
+    if _registry is None:
+        with _tools_lock:
+            if _registry is None:
+                _registry = ToolRegistry.from_settings()
+    return _registry
+
+
+def get_tool_executor() -> ToolExecutor:
+    """Return the process-wide tool executor built from settings."""
+    global _executor
+    if _executor is None:
+        registry = get_tool_registry()
+        with _tools_lock:
+            if _executor is None:
+                _executor = ToolExecutor.from_settings(registry)
+    return _executor
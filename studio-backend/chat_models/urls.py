@@ -1,8 +1,30 @@
+from django.conf import settings
 from django.urls import path
-from .views import ChatModelList, ChatCompletionView, HealthCheckView
+from .views import ChatModelList, ChatCompletionView, EmbeddingsView, HealthCheckView, ModelResidencyView
+from .async_views import AsyncChatCompletionView, AsyncEmbeddingsView
+from .batch_views import BatchCancelView, BatchDetailView, BatchListView, BatchResultsView
+
+# Under ASGI (see studio_backend/asgi.py) completions and embeddings are served by the async
+# views; WSGI deployments keep the original thread-per-request views.
+chat_completion_view = (
+    AsyncChatCompletionView.as_view()
+    if getattr(settings, 'CHAT_ASYNC_STREAMING', False)
+    else ChatCompletionView.as_view()
+)
+embeddings_view = (
+    AsyncEmbeddingsView.as_view()
+    if getattr(settings, 'CHAT_ASYNC_STREAMING', False)
+    else EmbeddingsView.as_view()
+)
 
 urlpatterns = [
     path('models/', ChatModelList.as_view(), name='chat-models-list'),
-    path('chat/completions/', ChatCompletionView.as_view(), name='chat-completions'),
+    path('chat/completions/', chat_completion_view, name='chat-completions'),
+    path('embeddings/', embeddings_view, name='embeddings'),
     path('health/', HealthCheckView.as_view(), name='health-check'),
-] 
\ No newline at end of file
+    path('residency/', ModelResidencyView.as_view(), name='model-residency'),
+    path('batches/', BatchListView.as_view(), name='batch-list'),
+    path('batches/<uuid:batch_id>/', BatchDetailView.as_view(), name='batch-detail'),
+    path('batches/<uuid:batch_id>/cancel/', BatchCancelView.as_view(), name='batch-cancel'),
+    path('batches/<uuid:batch_id>/results/', BatchResultsView.as_view(), name='batch-results'),
+]
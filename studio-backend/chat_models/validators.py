@@ -1,11 +1,138 @@
 """
 Validation utilities for chat completion requests and responses.
 """
+import hashlib
 import re
-from typing import Dict, List, Any, Optional, Union
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from typing import Dict, List, Any, Optional, Tuple, Union
+
+import numpy as np
 from rest_framework import serializers
+from django.conf import settings
 from django.core.exceptions import ValidationError
 
+from .model_registry import get_model_registry
+from .tools import get_tool_registry
+
+
+class ContentRule:
+    """
+    One precompiled check on message content.
+
+    Rules are built once at import; ``violates`` must be safe to call from
+    many threads at once.
+    """
+
+    message = "Message contains invalid content"
+
+    def violates(self, content: str) -> bool:
+        raise NotImplementedError
+
+
+class RepetitionRule(ContentRule):
+    """Rejects content dominated by a single character (potential DoS)."""
+
+    message = "Message contains excessive repetition"
+
+    def __init__(self, max_ratio: float = 0.7, min_length: int = 50):
+        self.max_ratio = max_ratio
+        self.min_length = min_length
+
+    def violates(self, content: str) -> bool:
+        if len(content) < self.min_length:  # Skip check for short content
+            return False
+        return most_common_count(content, self.max_ratio) / len(content) > self.max_ratio
+
+
+def most_common_count(content: str, min_ratio: float = 0.0) -> int:
+    """
+    Occurrences of the most frequent character, counted in C.
+
+    Only exact when that character exceeds ``min_ratio``; for ratios of 0.5
+    and above the answer is found without a histogram, since a character
+    holding more than half of the text is its median code point.
+    """
+    if min_ratio >= 0.5:
+        codepoints = np.frombuffer(content.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        median = np.partition(codepoints, len(codepoints) // 2)[len(codepoints) // 2]
+        return content.count(chr(median))
+    return max(Counter(content).values())
+
+
+class PatternRule(ContentRule):
+    """
+    Rejects content matching any of a set of case-insensitive patterns.
+
+    Each pattern is compiled once and paired with ASCII lowercase literals
+    that any match must contain. Content is screened for those literals in
+    its lowercased form first, which skips the regex scan for almost every
+    message. The screen is exact unless the content holds one of the few
+    non-ASCII characters that ``re.IGNORECASE`` equates with ASCII letters;
+    such content goes straight to the patterns.
+    """
+
+    message = "Message contains potentially unsafe content"
+
+    # Every non-ASCII character re.IGNORECASE matches against an ASCII letter
+    ASCII_CASE_EQUIVALENTS = ('\u0130', '\u0131', '\u017f', '\u212a')  # İ ı ſ K (Kelvin)
+
+    def __init__(self, patterns: List[Tuple[str, Tuple[str, ...]]]):
+        self.patterns = [
+            (re.compile(pattern, re.IGNORECASE | re.DOTALL), literals)
+            for pattern, literals in patterns
+        ]
+
+    def violates(self, content: str) -> bool:
+        if content.isascii() or not any(ch in content for ch in self.ASCII_CASE_EQUIVALENTS):
+            lowered = content.lower()
+            return any(
+                all(literal in lowered for literal in literals) and pattern.search(content)
+                for pattern, literals in self.patterns
+            )
+        return any(pattern.search(content) for pattern, _ in self.patterns)
+
+
+class ValidationMemo:
+    """
+    Digests of messages that already passed the content rules.
+
+    Conversations resend their history every turn; remembered messages skip
+    the rules. Only 16-byte digests are kept, not the content.
+    """
+
+    def __init__(self, max_entries: int = 16384):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(role: str, content: str) -> bytes:
+        digest = hashlib.blake2b(role.encode('utf-8'), digest_size=16)
+        digest.update(b'\0')
+        digest.update(content.encode('utf-8', 'surrogatepass'))
+        return digest.digest()
+
+    def __contains__(self, key: bytes) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return True
+        return False
+
+    def add(self, key: bytes) -> None:
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = None
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
 
 class ChatMessageValidator:
     """Validator for individual chat messages."""
@@ -13,6 +140,18 @@ class ChatMessageValidator:
     ALLOWED_ROLES = {"user", "assistant", "system"}
     MAX_CONTENT_LENGTH = 50000  # Characters
     
+    # Content checks, in order; the first violation is reported
+    CONTENT_RULES: Tuple[ContentRule, ...] = (
+        RepetitionRule(max_ratio=0.7, min_length=50),
+        PatternRule([
+            (r'<script[^>]*>.*?</script>', ('<script', '</script>')),  # Script tags
+            (r'javascript:', ('javascript:',)),                         # JavaScript URLs
+            (r'data:text/html', ('data:text/html',)),                   # Data URLs with HTML
+        ]),
+    )
+    
+    memo = ValidationMemo(getattr(settings, 'CHAT_VALIDATION_MEMO_SIZE', 16384))
+    
     @classmethod
     def validate_message(cls, message: Dict[str, Any]) -> Dict[str, str]:
         """
@@ -31,7 +170,10 @@ class ChatMessageValidator:
             raise ValidationError("Message must be a dictionary")
         
         # Validate role
-        role = message.get("role", "").strip().lower()
+        role = message.get("role", "")
+        if not isinstance(role, str):
+            raise ValidationError("Message role must be a string")
+        role = role.strip().lower()
         if not role:
             raise ValidationError("Message role is required")
         if role not in cls.ALLOWED_ROLES:
@@ -49,8 +191,11 @@ class ChatMessageValidator:
         if len(content) > cls.MAX_CONTENT_LENGTH:
             raise ValidationError(f"Message content too long (max {cls.MAX_CONTENT_LENGTH} characters)")
         
-        # Check for potential security issues
-        cls._validate_content_security(content)
+        # Check for potential security issues, unless this exact message passed before
+        key = cls.memo.key(role, content)
+        if key not in cls.memo:
+            cls._validate_content_security(content)
+            cls.memo.add(key)
         
         return {
             "role": role,
@@ -59,36 +204,15 @@ class ChatMessageValidator:
     
     @classmethod
     def _validate_content_security(cls, content: str) -> None:
-        """Basic security validation for message content."""
-        # Check for excessive repetition (potential DoS)
-        if cls._has_excessive_repetition(content):
-            raise ValidationError("Message contains excessive repetition")
-        
-        # Check for suspicious patterns
-        suspicious_patterns = [
-            r'<script[^>]*>.*?</script>',  # Script tags
-            r'javascript:',               # JavaScript URLs
-            r'data:text/html',           # Data URLs with HTML
-        ]
-        
-        for pattern in suspicious_patterns:
-            if re.search(pattern, content, re.IGNORECASE | re.DOTALL):
-                raise ValidationError("Message contains potentially unsafe content")
+        """Run the content rules, raising on the first violation."""
+        for rule in cls.CONTENT_RULES:
+            if rule.violates(content):
+                raise ValidationError(rule.message)
     
     @classmethod
     def _has_excessive_repetition(cls, content: str, max_ratio: float = 0.7) -> bool:
         """Check if content has excessive character repetition."""
-        if len(content) < 50:  # Skip check for short content
-            return False
-        
-        char_counts = {}
-        for char in content:
-            char_counts[char] = char_counts.get(char, 0) + 1
-        
-        max_count = max(char_counts.values())
-        repetition_ratio = max_count / len(content)
-        
-        return repetition_ratio > max_ratio
+        return RepetitionRule(max_ratio=max_ratio).violates(content)
 
 
 class ChatRequestValidator:
@@ -124,8 +248,10 @@ class ChatRequestValidator:
         if not model:
             raise ValidationError("Model is required")
         
-        # For now, accept any model name (Ollama might have custom models)
-        # In production, you might want to validate against actual available models
+        # Fail fast on models no backend has, using the cached registry (no
+        # round trip to Ollama); unknown until the registry's first load.
+        if getattr(settings, 'CHAT_VALIDATE_MODELS', True) and get_model_registry().has_model(model) is False:
+            raise ValidationError(f"Model '{model}' is not available")
         validated["model"] = model
         
         # Validate messages
@@ -170,11 +296,56 @@ class ChatRequestValidator:
         if not isinstance(stream, bool):
             raise ValidationError("Stream must be a boolean")
         validated["stream"] = stream
-        
-        # Validate tools (optional)
+
+        # Validate stream protocol (optional; see chat_models.encoders)
+        stream_protocol = data.get("streamProtocol", "")
+        if not isinstance(stream_protocol, str):
+            raise ValidationError("Stream protocol must be a string")
+        validated["stream_protocol"] = stream_protocol.strip().lower()
+
+        # Validate stream_options (OpenAI-compatible)
+        stream_options = data.get("stream_options") or {}
+        if not isinstance(stream_options, dict):
+            raise ValidationError("stream_options must be an object")
+        include_usage = stream_options.get("include_usage", False)
+        if not isinstance(include_usage, bool):
+            raise ValidationError("stream_options.include_usage must be a boolean")
+        validated["include_usage"] = include_usage
+
+        # Validate conversation storage (optional; see chat_models.conversations).
+        # With a conversationId, messages holds only the new turn.
+        conversation_id = data.get("conversationId") or ""
+        if not isinstance(conversation_id, str):
+            raise ValidationError("conversationId must be a string")
+        if conversation_id:
+            try:
+                conversation_id = str(uuid.UUID(conversation_id))
+            except ValueError:
+                raise ValidationError("conversationId must be a UUID")
+        validated["conversation_id"] = conversation_id
+        store = data.get("store", False)
+        if not isinstance(store, bool):
+            raise ValidationError("Store must be a boolean")
+        validated["store"] = store
+
+        # Validate n: parallel samples returned as indexed choices (see chat_models.sampling)
+        n = data.get("n", 1)
+        max_choices = getattr(settings, 'CHAT_MAX_CHOICES', 8)
+        if not isinstance(n, int) or isinstance(n, bool):
+            raise ValidationError("n must be an integer")
+        if not 1 <= n <= max_choices:
+            raise ValidationError(f"n must be between 1 and {max_choices}")
+        if n > 1 and (conversation_id or store):
+            raise ValidationError("n > 1 cannot be used with stored conversations")
+        validated["n"] = n
+
+        # Validate tools (optional): names of server-side tools, see chat_models.tools
         tools = data.get("tools", [])
         if not isinstance(tools, list):
             raise ValidationError("Tools must be a list")
+        tools = get_tool_registry().resolve(tools) if tools else []
+        if tools and n > 1:
+            raise ValidationError("n > 1 cannot be used with tools")
         validated["tools"] = tools
         
         return validated
@@ -207,6 +378,48 @@ class ChatRequestValidator:
             raise ValidationError("Conversation should end with user or system message")
 
 
+class EmbeddingRequestValidator:
+    """Validator for /v1/embeddings requests (OpenAI-compatible)."""
+
+    MAX_INPUTS = 2048
+    MAX_INPUT_LENGTH = 50000  # Characters
+    ENCODING_FORMATS = {"float", "base64"}
+
+    @classmethod
+    def validate_request(cls, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Validate an embeddings request.
+
+        Returns:
+            ``model``, ``input`` (always a list of strings) and ``encoding_format``
+
+        Raises:
+            ValidationError: If request is invalid
+        """
+        model = ModelValidator.validate_model_name(data.get("model", ""))
+        if getattr(settings, 'CHAT_VALIDATE_MODELS', True) and get_model_registry().has_model(model) is False:
+            raise ValidationError(f"Model '{model}' is not available")
+
+        inputs = data.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        if not isinstance(inputs, list) or not inputs:
+            raise ValidationError("Input must be a string or a non-empty list of strings")
+        if len(inputs) > cls.MAX_INPUTS:
+            raise ValidationError(f"Too many inputs (max {cls.MAX_INPUTS})")
+        for i, text in enumerate(inputs):
+            if not isinstance(text, str) or not text:
+                raise ValidationError(f"Input {i + 1}: must be a non-empty string")
+            if len(text) > cls.MAX_INPUT_LENGTH:
+                raise ValidationError(f"Input {i + 1}: too long (max {cls.MAX_INPUT_LENGTH} characters)")
+
+        encoding_format = data.get("encoding_format", "float")
+        if encoding_format not in cls.ENCODING_FORMATS:
+            raise ValidationError("encoding_format must be 'float' or 'base64'")
+
+        return {"model": model, "input": inputs, "encoding_format": encoding_format}
+
+
 class ModelValidator:
     """Validator for model-related requests."""
     
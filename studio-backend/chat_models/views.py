@@ -2,26 +2,78 @@
 Views for chat completion and model management.
 """
 import logging
-import json
-import time
 import uuid
-from typing import Iterator, Dict, Any
+from typing import Dict, Any, Optional
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework import status
-from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.core.exceptions import ValidationError
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
-from .ollama_client import OllamaClient, OllamaError, OllamaConnectionError, OllamaModelError
-from .validators import ChatRequestValidator
-import ollama
+from dashboard.usage import request_usage
+
+from .ollama_client import OllamaClient, OllamaError, OllamaConnectionError, OllamaModelError, get_ollama_client
+from .validators import ChatRequestValidator, EmbeddingRequestValidator
+from .encoders import StreamEncoder, VercelDataStreamEncoder, create_encoder
+from .streaming import ChoiceStats, StreamStats, coalesce_deltas, encode_choices, encode_stream
+from .client_pool import get_client_registry
+from .completion_cache import CacheLookup, cache_key, get_completion_cache
+from .admission import AdmissionRejected, Ticket, get_admission_controller, request_tenant
+from .batches import get_batch_pool
+from .coalescing import collect, get_request_coalescer
+from .context import apply_context_headers, get_context_manager
+from .embeddings import apply_embedding_headers, get_embedding_batcher
+from .conversations import ConversationNotFound, ConversationTurn, apply_conversation_headers, get_conversation_store
+from .rate_limit import apply_rate_limit_headers, get_rate_limiter, rate_limited_body
+from .residency import ResidencyManager, last_report, load_stats, normalize_model
+from .resilience import resilience_snapshot
+from .router import get_router
+from .sampling import format_choices, sample_completions, sample_stream
+from .tools import ToolTrace, apply_tool_headers, get_tool_executor, run_tool_loop, stream_tool_loop
 
 logger = logging.getLogger(__name__)
 
 
+def apply_stream_headers(response: StreamingHttpResponse, encoder: Optional[StreamEncoder] = None) -> StreamingHttpResponse:
+    """Set the headers streaming clients expect, plus the encoder's own (e.g. Vercel's data-stream marker)."""
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
+    for header, value in (encoder or VercelDataStreamEncoder).headers.items():
+        response[header] = value
+    response['Access-Control-Allow-Origin'] = '*'  # Configure properly for production
+    response['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+    response['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+    return response
+
+
+def apply_cache_headers(response, lookup: CacheLookup):
+    """Expose the completion-cache outcome; RequestLoggingMiddleware records it."""
+    response['X-Completion-Cache'] = lookup.status
+    if lookup.hit:
+        # Generation work the cache saved, for RequestLog.cached_completion_tokens
+        response['X-Completion-Cache-Tokens'] = str(lookup.cached.get('eval_count', 0))
+    return response
+
+
+def apply_coalesce_headers(response, coalesced: bool):
+    """Mark responses that were served by joining an identical in-flight generation."""
+    if coalesced:
+        response['X-Completion-Coalesced'] = 'true'
+    return response
+
+
+def apply_queue_headers(response, ticket: Optional[Ticket]):
+    """Expose admission queue wait; RequestLoggingMiddleware records it apart from latency."""
+    if ticket is not None:
+        response['X-Queue-Time-Ms'] = f"{ticket.queue_seconds * 1000:.1f}"
+    return response
+
+
 class ChatModelList(APIView):
     """Return the list of chat-completion models available in Ollama.
 
@@ -34,9 +86,14 @@ class ChatModelList(APIView):
 
     def get(self, request, *args, **kwargs):
         try:
-            client = OllamaClient()
-            models = client.get_available_models()
-            return Response(models)
+            models, etag = get_ollama_client().model_registry.listing()
+            if etag and request.META.get('HTTP_IF_NONE_MATCH') == etag:
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                response = Response(models)
+            if etag:
+                response['ETag'] = etag
+            return response
         except Exception as e:
             logger.error(f"Error fetching models: {e}")
             return Response(
@@ -52,12 +109,22 @@ class HealthCheckView(APIView):
     
     def get(self, request, *args, **kwargs):
         try:
-            client = OllamaClient()
+            client = get_ollama_client()
             is_connected = client.health_check()
             
             return Response({
                 "status": "healthy" if is_connected else "unhealthy",
                 "ollamaConnected": is_connected,
+                "backends": client.router.snapshot(),
+                "affinity": client.router.affinity_snapshot(),
+                "resilience": resilience_snapshot(),
+                "admission": get_admission_controller().snapshot(),
+                "rateLimit": get_rate_limiter().snapshot(),
+                "context": get_context_manager().snapshot(),
+                "batches": get_batch_pool().snapshot(),
+                "embeddings": get_embedding_batcher().snapshot(),
+                "tools": get_tool_executor().snapshot(),
+                "connectionPool": get_client_registry().stats(),
                 "timestamp": "2024-01-01T00:00:00Z"  # Simplified timestamp
             })
         except Exception as e:
@@ -70,38 +137,153 @@ class HealthCheckView(APIView):
             }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
+class ModelResidencyView(APIView):
+    """
+    Which models are loaded on each backend, and manual preload/unload.
+    
+    GET returns the live ``/api/ps`` view per backend, the last report of the
+    residency manager (``manage.py manage_residency``) and the cold/warm load
+    counts seen by this process. POST ``{"model": ..., "action": "preload" |
+    "unload", "backend": <name, optional>}`` applies an action right away.
+    """
+    
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request, *args, **kwargs):
+        router = get_router()
+        manager = ResidencyManager.from_settings(router)
+        backends = []
+        for backend in router.backends:
+            entry = {"name": backend.name, "baseUrl": backend.base_url}
+            try:
+                entry["resident"] = manager.resident(backend)
+            except Exception as e:
+                entry["error"] = str(e)
+            backends.append(entry)
+        
+        return Response({
+            "backends": backends,
+            "manager": last_report(),
+            "requestLoads": load_stats.snapshot(),
+        })
+    
+    def post(self, request, *args, **kwargs):
+        model = request.data.get('model')
+        action = request.data.get('action')
+        if not model or action not in ('preload', 'unload'):
+            return Response({
+                "error": "Invalid request format",
+                "message": "Provide 'model' and an 'action' of 'preload' or 'unload'"
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        router = get_router()
+        name = request.data.get('backend')
+        backends = [b for b in router.backends if not name or b.name == name]
+        if not backends:
+            return Response({"error": f"Unknown backend '{name}'"}, status=status.HTTP_404_NOT_FOUND)
+        
+        manager = ResidencyManager.from_settings(router)
+        results = []
+        for backend in backends:
+            try:
+                if action == 'preload':
+                    load_seconds = manager.preload(backend, normalize_model(model))
+                    results.append({"backend": backend.name, "loadSeconds": round(load_seconds, 3)})
+                else:
+                    manager.unload(backend, normalize_model(model))
+                    results.append({"backend": backend.name})
+            except Exception as e:
+                logger.error(f"Residency {action} of {model} on {backend.name} failed: {e}")
+                results.append({"backend": backend.name, "error": str(e)})
+        return Response({"model": model, "action": action, "results": results})
+
+
+class StreamingContentNegotiation(DefaultContentNegotiation):
+    """
+    Accept stream media types (``text/event-stream``, ``application/x-ndjson``).
+
+    Streaming responses bypass DRF renderers, and the Accept header selects
+    the stream encoder instead, so fall back to the default renderer rather
+    than answering 406.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            return renderers[0], renderers[0].media_type
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class ChatCompletionView(APIView):
     """Handle /v1/chat/completions endpoint that proxies to Ollama."""
 
     permission_classes = [AllowAny]
+    content_negotiation_class = StreamingContentNegotiation
 
     def post(self, request, *args, **kwargs):
+        decision = get_rate_limiter().check(request)
+        if not decision.allowed:
+            logger.warning(f"Chat completion rejected by the {decision.bucket.scope} rate limit")
+            response = Response(rate_limited_body(decision), status=status.HTTP_429_TOO_MANY_REQUESTS)
+            return apply_rate_limit_headers(response, decision)
+        return apply_rate_limit_headers(self._complete(request), decision)
+
+    def _complete(self, request):
         try:
             request_id = str(uuid.uuid4())
             logger.info(f"[request:{request_id}] Chat completion request received")
+            # The request log row is written with this ID and the usage recorded below
+            usage = request_usage(request)
+            usage.request_id = request_id
             
             # Validate and clean request data
             validator = ChatRequestValidator()
             cleaned_data = validator.validate_request(request.data)
+            usage.model_name = cleaned_data['model']
             
             logger.info(f"[request:{request_id}] Cleaned request data: {cleaned_data}")
             
+            # With a stored conversation the request carries only the new turn
+            turn = get_conversation_store().resolve(request.user, cleaned_data)
+            if turn is not None:
+                cleaned_data['messages'] = turn.messages
+            
+            # Fit the history into the model's context window before anything
+            # keys on it (cache, coalescing) or sends it.
+            fit = get_context_manager().fit(cleaned_data)
+            cleaned_data['messages'] = fit.messages
+            
             # Create Ollama client
-            client = OllamaClient()
+            client = get_ollama_client()
             
             # Check if streaming is requested - default to True for useChat compatibility
             # The AI SDK useChat hook expects streaming by default
             is_streaming = cleaned_data.get('stream', True)
             logger.info(f"[request:{request_id}] Streaming requested: {is_streaming}")
             
-            if is_streaming:
+            if cleaned_data['n'] > 1:
+                # Parallel samples as indexed choices
+                response = self._create_sampled_response(client, cleaned_data, request_id, is_streaming)
+            elif cleaned_data['tools']:
+                # Server-side tool calls until the model answers
+                response = self._create_tool_response(client, cleaned_data, request_id, is_streaming, turn)
+            elif is_streaming:
                 # Return OpenAI-compatible streaming response
-                return self._create_streaming_response(client, cleaned_data, request_id)
+                response = self._create_streaming_response(client, cleaned_data, request_id, turn)
             else:
                 # Non-streaming response
-                return self._create_non_streaming_response(client, cleaned_data, request_id)
+                response = self._create_non_streaming_response(client, cleaned_data, request_id, turn)
+            apply_conversation_headers(response, turn)
+            return apply_context_headers(response, fit)
                 
+        except ConversationNotFound as e:
+            logger.warning(f"Chat completion for unknown conversation: {e}")
+            return Response({
+                "error": "Conversation not found",
+                "message": str(e)
+            }, status=status.HTTP_404_NOT_FOUND)
+            
         except ValidationError as e:
             logger.error(f"Validation error: {e}")
             return Response({
@@ -109,6 +291,13 @@ class ChatCompletionView(APIView):
                 "message": str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
             
+        except AdmissionRejected as e:
+            logger.warning(f"Chat completion rejected by admission control: {e}")
+            return Response({
+                "error": "Too many requests",
+                "message": str(e)
+            }, status=status.HTTP_429_TOO_MANY_REQUESTS, headers={"Retry-After": str(e.retry_after)})
+            
         except OllamaConnectionError as e:
             logger.error(f"Ollama connection error: {e}")
             return Response({
@@ -137,111 +326,224 @@ class ChatCompletionView(APIView):
                 "message": "An unexpected error occurred. Please try again."
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    def _create_streaming_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str) -> StreamingHttpResponse:
-        """Create Vercel AI SDK compatible streaming response."""
+    def _create_streaming_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str,
+                                   turn: Optional[ConversationTurn] = None) -> StreamingHttpResponse:
+        """Create a streaming response in the protocol the client asked for (Vercel AI SDK by default)."""
+        encoder = create_encoder(self.request, cleaned_data)
         try:
-            logger.info(f"[request:{request_id}] Creating streaming response...")
+            logger.info(f"[request:{request_id}] Creating {encoder.name} streaming response...")
             
-            def vercel_ai_stream_generator() -> Iterator[bytes]:
-                """
-                Generator that yields Vercel AI SDK compatible data stream.
-                
-                Format: TYPE_ID:CONTENT_JSON\n
-                - Text parts: 0:"text content"\n
-                - Finish message: d:{"finishReason":"stop","usage":{"promptTokens":10,"completionTokens":20}}\n
-                """
-                try:
-                    logger.info(f"[request:{request_id}] Starting stream generation...")
-                    
-                    prompt_tokens = 0
-                    completion_tokens = 0
-                    
-                    # Stream content chunks from Ollama (raw stream)
-                    ollama_messages = client._format_messages_for_ollama(cleaned_data['messages'])
-                    
-                    # Use the raw Ollama stream directly
-                    stream = client.client.chat(  # type: ignore
-                        model=cleaned_data['model'],
-                        messages=ollama_messages,  # type: ignore[arg-type]
-                        stream=True,
-                        options={
-                            "temperature": cleaned_data.get('temperature', 0.7),
-                            "top_p": cleaned_data.get('top_p', 0.9),
-                        }
-                    )
-                    
-                    for chunk_idx, ollama_chunk in enumerate(stream):
-                        logger.debug(f"[request:{request_id}] Processing chunk {chunk_idx}: {ollama_chunk}")
-                        
-                        if ollama_chunk.get('done'):
-                            # Store final usage stats
-                            prompt_tokens = ollama_chunk.get('prompt_eval_count', 0)
-                            completion_tokens = ollama_chunk.get('eval_count', 0)
-                            
-                            # Send finish message part
-                            finish_message = {
-                                "finishReason": "stop",
-                                "usage": {
-                                    "promptTokens": prompt_tokens,
-                                    "completionTokens": completion_tokens
-                                }
-                            }
-                            yield f"d:{json.dumps(finish_message)}\n".encode("utf-8")
-                            break
-                        else:
-                            # Content chunk - send as text part
-                            content = ollama_chunk.get('message', {}).get('content', '')
-                            if content:
-                                # Text part format: 0:"content"
-                                yield f"0:{json.dumps(content)}\n".encode("utf-8")
-                    
-                    logger.info(f"[request:{request_id}] Stream generation completed")
-                    
-                except Exception as e:
-                    logger.error(f"[request:{request_id}] Stream generation error: {e}")
-                    # Send error part
-                    yield f"3:{json.dumps(str(e))}\n".encode("utf-8")
-                    # Send finish message with error
-                    finish_message = {
-                        "finishReason": "error",
-                        "usage": {
-                            "promptTokens": 0,
-                            "completionTokens": 0
-                        }
-                    }
-                    yield f"d:{json.dumps(finish_message)}\n".encode("utf-8")
+            cache = get_completion_cache()
+            lookup = cache.lookup(cleaned_data)
+            
+            if lookup.hit:
+                logger.info(f"[request:{request_id}] Replaying cached completion ({lookup.status})")
+                stream = cache.replay(lookup.cached)
+                coalesced, ticket = False, None
+            else:
+                # Identical in-flight requests share one upstream generation;
+                # upstream errors surface as error parts while iterating.
+                stream, coalesced, ticket = self._join_generation(client, cleaned_data, lookup)
+                if coalesced:
+                    logger.info(f"[request:{request_id}] Joined in-flight generation")
+            if turn is not None:
+                stream = turn.record_stream(stream)
             
             # Create streaming response with proper headers
+            stats = StreamStats()
             response = StreamingHttpResponse(
-                vercel_ai_stream_generator(),
-                content_type='text/plain'
+                encode_stream(coalesce_deltas(stream, stats=stats), encoder, request_id, stats),
+                content_type=encoder.content_type
             )
-            
-            # Critical headers for Vercel AI SDK streaming
-            response['Cache-Control'] = 'no-cache'
-            response['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
-            response['x-vercel-ai-data-stream'] = 'v1'  # Required for Vercel AI SDK
-            response['Access-Control-Allow-Origin'] = '*'  # Configure properly for production
-            response['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-            response['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+            # RequestLoggingMiddleware writes the log row from these once the stream ends
+            request_usage(self.request).stats = stats
+            apply_stream_headers(response, encoder)
+            apply_cache_headers(response, lookup)
+            apply_coalesce_headers(response, coalesced)
+            apply_queue_headers(response, ticket)
             
             logger.info(f"[request:{request_id}] Streaming response created successfully")
             return response
             
+        except AdmissionRejected:
+            raise
         except Exception as stream_error:
             logger.error(f"[request:{request_id}] Streaming setup error: {stream_error}")
             raise OllamaError(f"Streaming setup failed: {stream_error}")
 
-    def _create_non_streaming_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str) -> Response:
+    def _create_non_streaming_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str,
+                                       turn: Optional[ConversationTurn] = None) -> Response:
         """Create non-streaming response."""
         logger.info(f"[request:{request_id}] Generating non-streaming response...")
         
-        ollama_response = client.chat_completion(
-            model=cleaned_data['model'],
-            messages=cleaned_data['messages'],
-            temperature=cleaned_data.get('temperature', 0.7),
-            top_p=cleaned_data.get('top_p', 0.9)
-        )
+        cache = get_completion_cache()
+        lookup = cache.lookup(cleaned_data)
+        
+        coalesced, ticket = False, None
+        if lookup.hit:
+            raw_response = lookup.cached
+        else:
+            stream, coalesced, ticket = self._join_generation(client, cleaned_data, lookup, hedge=True)
+            raw_response = collect(stream)
         
         logger.info(f"[request:{request_id}] Non-streaming response generated successfully")
-        return Response(ollama_response) 
\ No newline at end of file
+        stats = StreamStats()
+        stats.finish(raw_response)
+        request_usage(self.request).stats = stats
+        body = client._format_completion_response(raw_response)
+        if turn is not None:
+            turn.commit(raw_response)
+            body["conversationId"] = turn.conversation_id
+        response = Response(body)
+        apply_cache_headers(response, lookup)
+        apply_coalesce_headers(response, coalesced)
+        return apply_queue_headers(response, ticket)
+
+    def _create_sampled_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str,
+                                 is_streaming: bool):
+        """Generate ``n`` samples concurrently, bypassing the completion cache and coalescing."""
+        n = cleaned_data['n']
+        logger.info(f"[request:{request_id}] Generating {n} samples...")
+        tenant, lane = request_tenant(self.request)
+        stats = ChoiceStats(n)
+        if is_streaming:
+            encoder = create_encoder(self.request, cleaned_data)
+            response = StreamingHttpResponse(
+                encode_choices(sample_stream(client, cleaned_data, stats, tenant, lane), encoder, request_id, stats),
+                content_type=encoder.content_type,
+            )
+            apply_stream_headers(response, encoder)
+        else:
+            responses = sample_completions(client, cleaned_data, n, tenant, lane)
+            response = JsonResponse(format_choices(client, responses, stats))
+        # Token usage and per-choice finish reasons for the request log
+        request_usage(self.request).stats = stats
+        return apply_cache_headers(response, CacheLookup(None))
+
+    def _create_tool_response(self, client: OllamaClient, cleaned_data: Dict[str, Any], request_id: str,
+                              is_streaming: bool, turn: Optional[ConversationTurn] = None):
+        """Run the tool loop (never cached or coalesced); the answer is streamed or returned as usual."""
+        logger.info(f"[request:{request_id}] Running tool loop with {', '.join(cleaned_data['tools'])}...")
+        tenant, lane = request_tenant(self.request)
+        admission = get_admission_controller()
+        trace = ToolTrace()
+        usage = request_usage(self.request)
+        usage.trace = trace
+
+        def admit():
+            return admission.admit(cleaned_data['model'], tenant, lane)
+
+        if is_streaming:
+            encoder = create_encoder(self.request, cleaned_data)
+            stream = stream_tool_loop(client, cleaned_data, admit, trace, request_id)
+            if turn is not None:
+                stream = turn.record_stream(stream)
+            stats = StreamStats()
+            response = StreamingHttpResponse(
+                encode_stream(coalesce_deltas(stream, stats=stats), encoder, request_id, stats),
+                content_type=encoder.content_type,
+            )
+            usage.stats = stats
+            apply_stream_headers(response, encoder)
+        else:
+            raw_response = run_tool_loop(client, cleaned_data, admit, trace, request_id)
+            usage.stats = StreamStats()
+            usage.stats.finish(raw_response)
+            body = client._format_completion_response(raw_response)
+            if turn is not None:
+                turn.commit(raw_response)
+                body["conversationId"] = turn.conversation_id
+            response = Response(body)
+        apply_tool_headers(response, trace)
+        return apply_cache_headers(response, CacheLookup(None))
+
+    def _join_generation(self, client: OllamaClient, cleaned_data: Dict[str, Any], lookup: CacheLookup,
+                         hedge: bool = False):
+        """
+        Subscribe to the upstream generation for this request, starting it if needed.
+        
+        Starting a generation first takes an admission slot (waiting in the
+        queue if necessary), released when the generation ends. A new
+        generation for a non-streaming request is ``hedge``d. Returns
+        ``(stream, coalesced, ticket)``; ``ticket`` is None when joining.
+        """
+        cache = get_completion_cache()
+        coalescer = get_request_coalescer()
+        key = lookup.key or cache_key(cleaned_data)
+
+        def open_stream():
+            return cache.record_stream(lookup, client.raw_chat_stream(
+                model=cleaned_data['model'],
+                messages=cleaned_data['messages'],
+                temperature=cleaned_data.get('temperature', 0.7),
+                top_p=cleaned_data.get('top_p', 0.9),
+                hedge=hedge,
+            ))
+
+        stream = coalescer.join_or_none(key)
+        if stream is not None:
+            return stream, True, None
+        # Every new generation takes a slot; if an identical one started while
+        # this request queued, join() joins it and gives the slot back.
+        tenant, lane = request_tenant(self.request)
+        ticket = get_admission_controller().admit(cleaned_data['model'], tenant, lane)
+        stream, coalesced = coalescer.join(key, open_stream, on_finish=ticket.release)
+        return stream, coalesced, None if coalesced else ticket
+
+
+class EmbeddingsView(APIView):
+    """Handle /v1/embeddings; concurrent requests share upstream batches."""
+
+    permission_classes = [AllowAny]
+
+    def post(self, request, *args, **kwargs):
+        decision = get_rate_limiter().check(request)
+        if not decision.allowed:
+            logger.warning(f"Embeddings rejected by the {decision.bucket.scope} rate limit")
+            response = Response(rate_limited_body(decision), status=status.HTTP_429_TOO_MANY_REQUESTS)
+            return apply_rate_limit_headers(response, decision)
+        return apply_rate_limit_headers(self._embed(request), decision)
+
+    def _embed(self, request):
+        try:
+            if not isinstance(request.data, dict):
+                raise ValidationError("Request body must be a JSON object")
+            cleaned_data = EmbeddingRequestValidator.validate_request(request.data)
+            result = get_embedding_batcher().embed(cleaned_data['model'], cleaned_data['input'])
+            response = HttpResponse(result.to_json(cleaned_data['encoding_format']), content_type='application/json')
+            return apply_embedding_headers(response, result)
+
+        except ValidationError as e:
+            logger.error(f"Validation error: {e}")
+            return Response({
+                "error": "Invalid request format",
+                "message": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        except OllamaConnectionError as e:
+            logger.error(f"Ollama connection error: {e}")
+            return Response({
+                "error": "Unable to connect to Ollama",
+                "message": "The AI service is currently unavailable. Please try again later."
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        except OllamaModelError as e:
+            logger.error(f"Ollama model error: {e}")
+            return Response({
+                "error": "Model not available",
+                "message": str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        except OllamaError as e:
+            logger.error(f"Ollama error: {e}")
+            return Response({
+                "error": "AI service error",
+                "message": str(e)
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        except Exception as e:
+            logger.error(f"Unexpected error in embeddings: {e}")
+            return Response({
+                "error": "Internal server error",
+                "message": "An unexpected error occurred. Please try again."
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import RequestLog, UserSession, FeedbackLog, ThreatLog, ModelUsageStats
+from .models import RequestLog, UserSession, FeedbackLog, ThreatLog, ModelUsageStats, ModelPrice
 
 
 @admin.register(RequestLog)
@@ -11,9 +11,9 @@ class RequestLogAdmin(admin.ModelAdmin):
     ]
     list_filter = [
         'endpoint', 'method', 'status_code', 'model_name', 
-        'created_at', 'country_code'
+        'created_at', 'country_code', 'cache_status'
     ]
-    search_fields = ['endpoint', 'model_name', 'user__username', 'ip_address']
+    search_fields = ['endpoint', 'model_name', 'user__username', 'ip_address', 'request_id']
     readonly_fields = ['created_at', 'latency_ms', 'ip_address', 'user_agent']
     date_hierarchy = 'created_at'
     ordering = ['-created_at']
@@ -185,6 +185,15 @@ class ModelUsageStatsAdmin(admin.ModelAdmin):
     avg_latency_display.short_description = "Avg Latency"
 
 
+@admin.register(ModelPrice)
+class ModelPriceAdmin(admin.ModelAdmin):
+    list_display = ['model_name', 'prompt_usd_per_million', 'completion_usd_per_million', 'effective_from']
+    list_filter = ['model_name']
+    search_fields = ['model_name']
+    date_hierarchy = 'effective_from'
+    ordering = ['model_name', '-effective_from']
+
+
 # Customize admin site headers
 admin.site.site_header = "AI Studio Dashboard Admin"
 admin.site.site_title = "Dashboard Admin"
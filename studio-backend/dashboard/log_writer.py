@@ -0,0 +1,259 @@
+"""
+Batched, asynchronous writes of RequestLog rows.
+
+An INSERT into ``RequestLog`` (and its indexes) on every API response makes
+each request wait for the database; on SQLite every request also queues
+behind the single write lock. :class:`RequestLogWriter` takes the row off the
+request path: :meth:`~RequestLogWriter.write` appends it to an in-memory queue
+and a background thread writes the queue with ``bulk_create`` every
+``DASHBOARD_LOG_FLUSH_MS`` or as soon as ``DASHBOARD_LOG_BATCH_SIZE`` rows are
+waiting.
+
+The queue holds at most ``DASHBOARD_LOG_MAX_QUEUE`` rows. When it is full
+(the database cannot keep up) ``DASHBOARD_LOG_FULL_POLICY`` decides:
+
+- ``drop``: the row is discarded and counted in ``dropped``; requests never
+  wait for the log;
+- ``block``: the request waits up to ``DASHBOARD_LOG_BLOCK_MS`` for room,
+  then drops the row.
+
+Queued rows are written when the process exits normally (``atexit``) and
+when it receives SIGTERM or SIGINT: uvicorn re-raises those with the default
+handler after its graceful shutdown, which kills the process without running
+``atexit``, so :func:`install_signal_handlers` (installed by
+``studio_backend.asgi`` and ``studio_backend.wsgi``, not by management
+commands) closes the writer first. Rows of requests still finishing after that
+are inserted directly. With
+``DASHBOARD_LOG_ASYNC=False`` rows are inserted synchronously, one by one, as
+before.
+"""
+import atexit
+import functools
+import logging
+import signal
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import RequestLog
+
+logger = logging.getLogger(__name__)
+
+POLICY_DROP = 'drop'
+POLICY_BLOCK = 'block'
+POLICIES = (POLICY_DROP, POLICY_BLOCK)
+
+# Longest a stop signal waits for the queue to be written
+SIGNAL_FLUSH_TIMEOUT = 10.0
+
+
+class RequestLogWriter:
+    """Bounded queue of RequestLog rows, written in batches by a background thread."""
+
+    def __init__(self, flush_interval: float = 0.2, batch_size: int = 500, max_queue: int = 10000,
+                 policy: str = POLICY_DROP, block_timeout: float = 1.0, enabled: bool = True):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown request log queue policy {policy!r} (expected one of {', '.join(POLICIES)})")
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self.max_queue = max(1, max_queue)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.enabled = enabled
+        self._rows: Deque[RequestLog] = deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        # Serializes flushes from the thread and from close()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_depth = 0
+
+    @classmethod
+    def from_settings(cls) -> "RequestLogWriter":
+        return cls(
+            flush_interval=getattr(settings, 'DASHBOARD_LOG_FLUSH_MS', 200.0) / 1000,
+            batch_size=getattr(settings, 'DASHBOARD_LOG_BATCH_SIZE', 500),
+            max_queue=getattr(settings, 'DASHBOARD_LOG_MAX_QUEUE', 10000),
+            policy=getattr(settings, 'DASHBOARD_LOG_FULL_POLICY', POLICY_DROP),
+            block_timeout=getattr(settings, 'DASHBOARD_LOG_BLOCK_MS', 1000.0) / 1000,
+            enabled=getattr(settings, 'DASHBOARD_LOG_ASYNC', True),
+        )
+
+    @property
+    def depth(self) -> int:
+        return len(self._rows)
+
+    def write(self, row: RequestLog) -> bool:
+        """Queue ``row`` for the next batch; False when it was dropped."""
+        if not self.enabled:
+            # Synchronous mode
+            return self._save(row)
+        self._ensure_thread()
+        with self._not_full:
+            if len(self._rows) >= self.max_queue and self.policy == POLICY_BLOCK and not self._closed:
+                self._wakeup.set()
+                self._not_full.wait_for(lambda: self._closed or len(self._rows) < self.max_queue,
+                                        timeout=self.block_timeout)
+            # Checked under the lock: close() flushes every row queued before it set _closed
+            closed = self._closed
+            if not closed:
+                if len(self._rows) >= self.max_queue:
+                    self.dropped += 1
+                    dropped = self.dropped
+                else:
+                    self._rows.append(row)
+                    self.enqueued += 1
+                    dropped = 0
+                    depth = len(self._rows)
+                    if depth > self.max_depth:
+                        self.max_depth = depth
+        if closed:
+            # Logged while the process shuts down
+            return self._save(row)
+        if dropped:
+            # Once per power of two, so a stuck database does not flood the log too
+            if dropped & (dropped - 1) == 0:
+                logger.warning(f"Request log queue full ({self.max_queue} rows); {dropped} rows dropped so far")
+            return False
+        if depth >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _save(self, row: RequestLog) -> bool:
+        row.save()
+        self.written += 1
+        return True
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='request-log-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush request logs: {e}")
+            finally:
+                # The thread lives as long as the process: honour CONN_MAX_AGE
+                # and drop connections that broke, like a request would.
+                close_old_connections()
+
+    def _take(self) -> List[RequestLog]:
+        with self._not_full:
+            batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+            if batch:
+                self._not_full.notify_all()
+        return batch
+
+    def flush(self) -> int:
+        """Write every queued row, ``batch_size`` rows per INSERT; returns the rows written."""
+        written = 0
+        with self._flush_lock:
+            batch = self._take()
+            while batch:
+                try:
+                    RequestLog.objects.bulk_create(batch)
+                    count = len(batch)
+                except Exception as e:
+                    logger.error(f"Failed to write {len(batch)} request logs in one batch, retrying one by one: {e}")
+                    count = self._write_each(batch)
+                written += count
+                self.written += count
+                self.batches += 1
+                batch = self._take()
+        return written
+
+    def _write_each(self, batch: List[RequestLog]) -> int:
+        """Insert rows separately so one bad row does not lose its whole batch."""
+        count = 0
+        for row in batch:
+            try:
+                row.save()
+                count += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Failed to write request log for {row.endpoint}: {e}")
+        return count
+
+    def close(self) -> int:
+        """Write what is queued and stop batching; later rows are inserted directly."""
+        with self._not_full:
+            self._closed = True
+            self._not_full.notify_all()
+        self._wakeup.set()
+        written = self.flush()
+        if written:
+            logger.info(f"Wrote {written} queued request logs on shutdown")
+        return written
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "async": self.enabled,
+            "policy": self.policy,
+            "queueDepth": self.depth,
+            "maxQueueDepth": self.max_depth,
+            "queueLimit": self.max_queue,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "batches": self.batches,
+        }
+
+
+_writer: Optional[RequestLogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_log_writer() -> RequestLogWriter:
+    """Process-wide request log writer."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = RequestLogWriter.from_settings()
+    return _writer
+
+
+def _close_on_signal(signum, frame, previous) -> None:
+    writer = _writer
+    if writer is not None and writer.enabled:
+        # The signal may interrupt a running event loop, where the ORM refuses
+        # to run, so the queue is written from another thread.
+        closer = threading.Thread(target=writer.close, name='request-log-close', daemon=True)
+        closer.start()
+        closer.join(SIGNAL_FLUSH_TIMEOUT)
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        signal.raise_signal(signum)
+
+
+def install_signal_handlers() -> None:
+    """Close the request log writer on SIGTERM and SIGINT, then run the previous handlers."""
+    if threading.current_thread() is not threading.main_thread():
+        return  # signal handlers can only be set from the main thread
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(signum)
+        if getattr(previous, 'func', None) is _close_on_signal:
+            continue
+        signal.signal(signum, functools.partial(_close_on_signal, previous=previous))
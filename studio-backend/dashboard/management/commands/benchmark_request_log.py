@@ -0,0 +1,176 @@
+"""
+Django management command measuring what logging a request costs the request.
+
+``--rows`` chat-completion-like ``RequestLog`` rows are logged from
+``--threads`` concurrent threads, the way the web server's threads log their
+responses, first with a synchronous ``RequestLog.objects.create()`` per row,
+then through :class:`~dashboard.log_writer.RequestLogWriter`. The time each
+call holds its request is reported as p50/p95/p99/max, with the inserts that
+failed (on SQLite, concurrent synchronous inserts fail with "database is
+locked" once they wait out the lock timeout; the middleware loses those rows).
+
+It then checks that nothing is lost:
+
+- the writer is closed (as on shutdown) and every queued row must be in the
+  database;
+- a child process queues ``--shutdown-rows`` rows with a flush interval far
+  longer than its lifetime and exits normally; its ``atexit`` flush must have
+  written them all.
+
+The command fails when rows are missing or when the writer's p99 exceeds
+``--max-p99-ms``. Rows are written to the configured database under the
+endpoint ``/benchmark/request-log`` and deleted afterwards.
+
+Usage: python manage.py benchmark_request_log --rows 2000 --threads 8 [--max-queue 100]
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Callable, List, Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, close_old_connections
+
+from dashboard.log_writer import RequestLogWriter
+from dashboard.models import RequestLog
+
+ENDPOINT = '/benchmark/request-log'
+
+CHILD_SCRIPT = """
+import os, sys
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'studio_backend.settings')
+sys.path.insert(0, {base_dir!r})
+import django
+django.setup()
+from dashboard.log_writer import RequestLogWriter
+from dashboard.models import RequestLog
+writer = RequestLogWriter(flush_interval=3600)
+for i in range({rows}):
+    writer.write(RequestLog(endpoint={endpoint!r}, status_code=200, latency_ms=1.0, model_name='shutdown'))
+# Exits with the rows still queued; the atexit flush must write them
+"""
+
+
+def _row(index: int) -> RequestLog:
+    return RequestLog(
+        endpoint=ENDPOINT,
+        method='POST',
+        status_code=200,
+        latency_ms=412.5,
+        ttft_ms=35.2,
+        model_name='llama3.2',
+        prompt_tokens=120,
+        completion_tokens=240,
+        total_tokens=360,
+        finish_reason='stop',
+        cache_status='miss',
+        request_id=f"benchmark-{index}",
+        user_agent='benchmark_request_log',
+    )
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Compare per-request RequestLog overhead of synchronous inserts and the batched writer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000, help='Rows logged per mode')
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent logging threads')
+        parser.add_argument('--max-queue', type=int, default=None,
+                            help='Writer queue limit (default: room for every row; smaller shows drops)')
+        parser.add_argument('--shutdown-rows', type=int, default=1000, help='Rows queued by the shutdown check')
+        parser.add_argument('--max-p99-ms', type=float, default=5.0, help="Fail when the writer's p99 is higher")
+
+    def handle(self, *args, **options):
+        rows, threads = options['rows'], options['threads']
+        self.stdout.write(f"{rows} rows from {threads} threads ({settings.DATABASES['default']['ENGINE']})")
+        self.stdout.write(
+            f"{'mode':<10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'rows/s':>10}{'errors':>8}"
+        )
+        try:
+            latencies, errors = self._run(lambda row: row.save(), rows, threads)
+            self._report('sync', latencies, errors)
+
+            writer = RequestLogWriter.from_settings()
+            writer.enabled = True
+            writer.max_queue = options['max_queue'] or max(writer.max_queue, rows)
+            latencies, _ = self._run(writer.write, rows, threads)
+            writer.close()
+            p99 = self._report('batched', latencies, writer.dropped + writer.failed)
+            snapshot = writer.snapshot()
+            self.stdout.write(
+                f"writer: {snapshot['batches']} batches, max queue depth {snapshot['maxQueueDepth']}, "
+                f"{snapshot['dropped']} dropped, {snapshot['failed']} failed"
+            )
+
+            expected = 2 * rows - errors - writer.dropped
+            stored = RequestLog.objects.filter(endpoint=ENDPOINT).exclude(model_name='shutdown').count()
+            if stored != expected:
+                raise CommandError(f"{expected - stored} of {expected} rows were not written")
+            self.stdout.write(f"close: all {expected} rows written")
+
+            self._check_shutdown(options['shutdown_rows'])
+
+            if p99 > options['max_p99_ms']:
+                raise CommandError(f"Batched p99 {p99:.3f} ms exceeds {options['max_p99_ms']} ms")
+        finally:
+            deleted, _ = RequestLog.objects.filter(endpoint=ENDPOINT).delete()
+            self.stdout.write(f"Deleted {deleted} benchmark rows")
+
+    def _run(self, log: Callable[[RequestLog], object], rows: int, threads: int) -> Tuple[List[float], int]:
+        latencies: List[float] = []
+        errors = 0
+        lock = threading.Lock()
+
+        def worker(offset: int):
+            nonlocal errors
+            local, failed = [], 0
+            try:
+                for index in range(offset, rows, threads):
+                    row = _row(index)
+                    start = time.perf_counter()
+                    try:
+                        log(row)
+                    except DatabaseError:
+                        failed += 1
+                    local.append(time.perf_counter() - start)
+            finally:
+                close_old_connections()
+            with lock:
+                latencies.extend(local)
+                errors += failed
+
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker, args=(offset,)) for offset in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        self._elapsed = time.perf_counter() - started
+        return latencies, errors
+
+    def _report(self, mode: str, latencies: List[float], errors: int) -> float:
+        ordered = sorted(latencies)
+        p50, p95, p99 = (_percentile(ordered, q) * 1000 for q in (0.5, 0.95, 0.99))
+        self.stdout.write(
+            f"{mode:<10}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}{ordered[-1] * 1000:>10.2f}"
+            f"{len(ordered) / self._elapsed:>10,.0f}{errors:>8}"
+        )
+        return p99
+
+    def _check_shutdown(self, rows: int) -> None:
+        script = CHILD_SCRIPT.format(base_dir=str(settings.BASE_DIR), rows=rows, endpoint=ENDPOINT)
+        env = dict(os.environ, DASHBOARD_LOG_ASYNC='True')
+        result = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise CommandError(f"Shutdown check process failed:\n{result.stderr}")
+        stored = RequestLog.objects.filter(endpoint=ENDPOINT, model_name='shutdown').count()
+        if stored != rows:
+            raise CommandError(f"{rows - stored} of {rows} rows queued at exit were not written")
+        self.stdout.write(f"exit: all {rows} rows queued at exit written")
@@ -1,12 +1,17 @@
 import time
 import json
 import logging
-from decimal import Decimal
+from asgiref.sync import sync_to_async
 from django.utils.deprecation import MiddlewareMixin
-from django.contrib.auth.models import User
 from django.contrib.gis.geoip2 import GeoIP2
 from django.core.exceptions import ImproperlyConfigured
+from .log_writer import get_log_writer
 from .models import RequestLog
+from .pricing import get_pricing_table
+from .usage import RequestUsage
+
+# Completion cache outcomes served without generating anything
+CACHE_HITS = ('hit', 'semantic')
 
 logger = logging.getLogger(__name__)
 
@@ -17,6 +22,9 @@ class RequestLoggingMiddleware(MiddlewareMixin):
     Captures timing, model usage, costs, and geographic data.
     """
     
+    # Endpoints whose body names a model and whose responses carry usage headers
+    AI_ENDPOINTS = ('/v1/chat/completions', '/v1/embeddings')
+    
     def __init__(self, get_response):
         self.get_response = get_response
         # Initialize GeoIP2 (optional, fails gracefully if not configured)
@@ -28,8 +36,13 @@ class RequestLoggingMiddleware(MiddlewareMixin):
         super().__init__(get_response)
     
     def process_request(self, request):
-        """Store request start time."""
-        request._request_start_time = time.time()
+        """Store request start time and the request's usage record."""
+        request._request_start_time = time.monotonic()
+        request.usage = RequestUsage()
+        if request.path.startswith(self.AI_ENDPOINTS):
+            # Buffer the body now: once DRF consumes the stream, request.body
+            # raises RawPostDataException and the log row would be lost.
+            request.body
         return None
     
     def process_response(self, request, response):
@@ -40,41 +53,113 @@ class RequestLoggingMiddleware(MiddlewareMixin):
         
         try:
             # Calculate latency
-            start_time = getattr(request, '_request_start_time', time.time())
-            latency_ms = (time.time() - start_time) * 1000
+            start_time = getattr(request, '_request_start_time', time.monotonic())
+            latency_ms = (time.monotonic() - start_time) * 1000
             
-            # Extract basic request info
-            endpoint = request.path
-            method = request.method
-            status_code = response.status_code
-            user = request.user if request.user.is_authenticated else None
+            # Extract AI-specific data from response (for chat completions)
+            ai_data = self._extract_ai_data(request, response)
             
             # Get IP and geographic info
             ip_address = self._get_client_ip(request)
-            country_code = self._get_country_code(ip_address)
             
-            # Extract AI-specific data from response (for chat completions)
-            ai_data = self._extract_ai_data(request, response)
-            
-            # Create log entry
-            RequestLog.objects.create(
-                endpoint=endpoint,
-                method=method,
-                status_code=status_code,
+            fields = dict(
+                endpoint=request.path,
+                method=request.method,
+                status_code=response.status_code,
                 latency_ms=latency_ms,
-                user=user,
+                user=request.user if request.user.is_authenticated else None,
                 ip_address=ip_address,
-                country_code=country_code,
+                country_code=self._get_country_code(ip_address),
                 user_agent=request.META.get('HTTP_USER_AGENT', '')[:500],
                 **ai_data
             )
             
+            usage = getattr(request, 'usage', None) or RequestUsage()
+            if usage.request_id:
+                fields['request_id'] = usage.request_id
+                response['X-Request-Id'] = usage.request_id
+            
+            if response.streaming and usage.recorded:
+                # Streamed completions finish after this returns: write the row
+                # with token counts, finish_reason (e.g. client_cancelled) and
+                # timings once the stream ends or the client goes away.
+                self._log_after_stream(response, lambda: self._create_log(fields, usage, start_time))
+            else:
+                self._create_log(fields, usage, start_time)
+            
         except Exception as e:
             # Don't break the request if logging fails
             logger.error(f"Failed to log request: {e}")
         
         return response
     
+    def _log_after_stream(self, response, log):
+        """Wrap the response's content so ``log`` runs once it is exhausted or closed."""
+        content = response.streaming_content
+        if response.is_async:
+            async def logged():
+                try:
+                    async for chunk in content:
+                        yield chunk
+                finally:
+                    # Not on the event loop: the row may be inserted directly
+                    await sync_to_async(log, thread_sensitive=False)()
+        else:
+            def logged():
+                try:
+                    yield from content
+                finally:
+                    log()
+        response.streaming_content = logged()
+    
+    def _create_log(self, fields, usage, start_time):
+        """Queue the RequestLog row with the request's usage, timings and cost."""
+        try:
+            if usage.stats is not None:
+                fields.update(self._stats_fields(usage.stats, start_time))
+            
+            # Server-side tool rounds (chat_models.tools)
+            trace = usage.trace
+            if trace is not None and trace.rounds:
+                fields.update(tool_calls=trace.calls, tool_ms=trace.tool_ms, queue_ms=trace.queue_ms)
+            
+            if fields['model_name'] and fields['total_tokens'] is not None:
+                if fields['cache_status'] in CACHE_HITS:
+                    # Replayed from the completion cache: nothing was generated
+                    fields['cost_usd'] = get_pricing_table().cost(fields['model_name'], 0, 0)
+                else:
+                    fields['cost_usd'] = get_pricing_table().cost(
+                        fields['model_name'], fields['prompt_tokens'], fields['completion_tokens']
+                    )
+            
+            # Written in batches off the request path (dashboard.log_writer)
+            get_log_writer().write(RequestLog(**fields))
+        except Exception as e:
+            logger.error(f"Failed to log request: {e}")
+    
+    def _stats_fields(self, stats, start_time):
+        """Usage and timings of a finished completion (chat_models.streaming stats)."""
+        prompt_tokens = stats.prompt_tokens
+        durations = stats.durations
+        fields = dict(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=stats.completion_tokens,
+            total_tokens=(prompt_tokens or 0) + stats.completion_tokens,
+            finish_reason=stats.finish_reason,
+            # Requests with n > 1 (chat_models.streaming.ChoiceStats)
+            choice_finish_reasons=getattr(stats, 'finish_reasons', None),
+            load_ms=durations.get('load_duration'),
+            prompt_eval_ms=durations.get('prompt_eval_duration'),
+            eval_ms=durations.get('eval_duration'),
+            tokens_per_second=stats.tokens_per_second,
+        )
+        if stats.first_token_at is not None:
+            # The response was streamed: it ends now, not when the view returned
+            fields['latency_ms'] = (time.monotonic() - start_time) * 1000
+            fields['ttft_ms'] = (stats.first_token_at - start_time) * 1000
+            fields['itl_p50_ms'], fields['itl_p95_ms'], fields['itl_p99_ms'] = stats.itl_percentiles()
+        return fields
+    
     def _should_log_request(self, request):
         """Determine if this request should be logged."""
         path = request.path
@@ -121,69 +206,52 @@ class RequestLoggingMiddleware(MiddlewareMixin):
             'total_tokens': None,
             'cost_usd': None,
             'finish_reason': '',
+            'cache_status': '',
+            'cached_completion_tokens': None,
+            'queue_ms': None,
+            'context_saved_tokens': None,
         }
         
-        # Only process chat completion endpoints
-        if not request.path.startswith('/v1/chat/completions'):
+        # Only process chat completion and embedding endpoints
+        if not request.path.startswith(self.AI_ENDPOINTS):
             return ai_data
         
         try:
-            # Extract model from request body
-            if hasattr(request, 'body') and request.body:
+            # The model the view recorded, else the one named in the request body
+            usage = getattr(request, 'usage', None)
+            if usage is not None and usage.model_name:
+                ai_data['model_name'] = usage.model_name
+            elif hasattr(request, 'body') and request.body:
                 request_data = json.loads(request.body.decode('utf-8'))
                 ai_data['model_name'] = request_data.get('model', '')
             
-            # Extract token usage from response (for successful requests)
-            if response.status_code == 200 and hasattr(response, 'content'):
-                # For streaming responses, this might be empty
-                # In practice, we'd need to capture this data during the chat view
-                # For now, we'll populate basic model info
-                pass
-                
-        except (json.JSONDecodeError, AttributeError, KeyError):
+            # Embeddings report their (estimated) input tokens and cache outcome
+            embedding_tokens = response.get('X-Embedding-Tokens')
+            if embedding_tokens:
+                ai_data['prompt_tokens'] = ai_data['total_tokens'] = int(embedding_tokens)
+                ai_data['completion_tokens'] = 0
+                ai_data['cache_status'] = response.get('X-Embedding-Cache', '')
+                return ai_data
+            
+            # Completion cache outcome, set by the chat views
+            ai_data['cache_status'] = response.get('X-Completion-Cache', '')
+            cached_tokens = response.get('X-Completion-Cache-Tokens')
+            if cached_tokens:
+                ai_data['cached_completion_tokens'] = int(cached_tokens)
+            
+            # Admission queue wait, set when the request started a generation
+            queue_time = response.get('X-Queue-Time-Ms')
+            if queue_time:
+                ai_data['queue_ms'] = float(queue_time)
+            
+            # Prompt tokens the context manager kept out of the request
+            context_saved = response.get('X-Context-Saved-Tokens')
+            if context_saved:
+                ai_data['context_saved_tokens'] = int(context_saved)
+            
+        except (json.JSONDecodeError, AttributeError, KeyError, ValueError):
             # If we can't parse the data, that's ok - log what we can
             pass
         
         return ai_data
 
-
-class TokenUsageTracker:
-    """
-    Helper class to track token usage in chat views.
-    Call this from chat_models views to enhance logging.
-    """
-    
-    @staticmethod
-    def log_chat_completion(request, model_name, usage_data, cost_usd=None, finish_reason=''):
-        """
-        Update the most recent RequestLog entry with chat completion data.
-        Call this from the chat completion view after getting Ollama response.
-        """
-        try:
-            # Find the most recent log entry for this request
-            # We identify it by user, endpoint, and timestamp (within last 30 seconds)
-            from django.utils import timezone
-            from datetime import timedelta
-            
-            recent_time = timezone.now() - timedelta(seconds=30)
-            log_entry = RequestLog.objects.filter(
-                user=request.user if request.user.is_authenticated else None,
-                endpoint='/v1/chat/completions',
-                created_at__gte=recent_time
-            ).order_by('-created_at').first()
-            
-            if log_entry:
-                # Update with AI-specific data
-                log_entry.model_name = model_name
-                log_entry.prompt_tokens = usage_data.get('prompt_tokens')
-                log_entry.completion_tokens = usage_data.get('completion_tokens')
-                log_entry.total_tokens = usage_data.get('total_tokens')
-                log_entry.finish_reason = finish_reason
-                
-                if cost_usd:
-                    log_entry.cost_usd = Decimal(str(cost_usd))
-                
-                log_entry.save()
-                
-        except Exception as e:
-            logger.error(f"Failed to update request log with chat data: {e}") 
\ No newline at end of file
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-17 06:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='cache_status',
+            field=models.CharField(blank=True, help_text='Completion cache outcome: hit, miss or bypass', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='cached_completion_tokens',
+            field=models.PositiveIntegerField(blank=True, help_text='Completion tokens served from cache instead of generated', null=True),
+        ),
+    ]
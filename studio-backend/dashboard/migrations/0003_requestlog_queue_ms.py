@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-17 06:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0002_requestlog_cache_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='queue_ms',
+            field=models.FloatField(blank=True, help_text='Time spent waiting in the admission queue in milliseconds', null=True),
+        ),
+        migrations.AlterField(
+            model_name='requestlog',
+            name='latency_ms',
+            field=models.FloatField(help_text='Request processing time in milliseconds, excluding admission queue wait'),
+        ),
+    ]
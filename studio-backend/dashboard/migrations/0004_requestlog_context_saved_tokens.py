@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-17 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0003_requestlog_queue_ms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='context_saved_tokens',
+            field=models.PositiveIntegerField(blank=True, help_text='Estimated prompt tokens trimmed or summarized out of the history', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-17 07:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0004_requestlog_context_saved_tokens'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='choice_finish_reasons',
+            field=models.JSONField(blank=True, help_text='Finish reason of each choice when n > 1 samples were requested', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-17 07:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0005_requestlog_choice_finish_reasons'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='tool_calls',
+            field=models.PositiveIntegerField(blank=True, help_text='Server-side tool calls made for the request', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='tool_ms',
+            field=models.FloatField(blank=True, help_text='Time spent running server-side tool calls in milliseconds', null=True),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.2 on 2026-10-17 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0006_requestlog_tool_ms_tool_calls'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='requestlog',
+            name='eval_ms',
+            field=models.FloatField(blank=True, help_text='Generation time reported by Ollama (eval_duration) in milliseconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='itl_p50_ms',
+            field=models.FloatField(blank=True, help_text='Median gap between streamed tokens in milliseconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='itl_p95_ms',
+            field=models.FloatField(blank=True, help_text='95th percentile gap between streamed tokens in milliseconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='itl_p99_ms',
+            field=models.FloatField(blank=True, help_text='99th percentile gap between streamed tokens in milliseconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='load_ms',
+            field=models.FloatField(blank=True, help_text='Model load time reported by Ollama (load_duration) in milliseconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='prompt_eval_ms',
+            field=models.FloatField(blank=True, help_text='Prompt processing time reported by Ollama (prompt_eval_duration) in milliseconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='tokens_per_second',
+            field=models.FloatField(blank=True, help_text='Completion tokens generated per second', null=True),
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='ttft_ms',
+            field=models.FloatField(blank=True, help_text='Time to first streamed token in milliseconds, excluding admission queue wait', null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.2 on 2026-10-17 07:43
+
+import django.utils.timezone
+from decimal import Decimal
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0007_requestlog_stream_timings'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModelPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_name', models.CharField(help_text="Model as requested (e.g. 'llama3.2' or 'llama3.2:1b'); '*' prices every model without its own row", max_length=128)),
+                ('prompt_usd_per_million', models.DecimalField(decimal_places=6, default=Decimal('0'), max_digits=12)),
+                ('completion_usd_per_million', models.DecimalField(decimal_places=6, default=Decimal('0'), max_digits=12)),
+                ('effective_from', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['model_name', '-effective_from'],
+            },
+        ),
+        migrations.AddField(
+            model_name='requestlog',
+            name='request_id',
+            field=models.CharField(blank=True, help_text='ID the chat view logged the request under', max_length=36),
+        ),
+        migrations.AddIndex(
+            model_name='requestlog',
+            index=models.Index(fields=['request_id'], name='dashboard_r_request_888b4f_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='modelprice',
+            unique_together={('model_name', 'effective_from')},
+        ),
+    ]
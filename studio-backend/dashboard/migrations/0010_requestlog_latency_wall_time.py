@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-17 07:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0009_requestlog_created_at_default'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='requestlog',
+            name='latency_ms',
+            field=models.FloatField(help_text='Request processing time in milliseconds, including any admission queue wait (queue_ms)'),
+        ),
+        migrations.AlterField(
+            model_name='requestlog',
+            name='ttft_ms',
+            field=models.FloatField(blank=True, help_text='Time to first streamed token in milliseconds, including any admission queue wait', null=True),
+        ),
+    ]
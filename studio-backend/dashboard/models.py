@@ -1,6 +1,7 @@
 from django.db import models
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils import timezone
 from decimal import Decimal
 
 
@@ -11,13 +12,28 @@ class RequestLog(models.Model):
     """
     # Primary identification
     id = models.BigAutoField(primary_key=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Set when the row is built, not when the batched log writer inserts it
+    created_at = models.DateTimeField(default=timezone.now)
+    request_id = models.CharField(max_length=36, blank=True, help_text="ID the chat view logged the request under")
     
     # Request details
     endpoint = models.CharField(max_length=64, help_text="API endpoint like '/v1/chat/completions'")
     method = models.CharField(max_length=10, default='POST')
     status_code = models.PositiveSmallIntegerField()
-    latency_ms = models.FloatField(help_text="Request processing time in milliseconds")
+    latency_ms = models.FloatField(help_text="Request processing time in milliseconds, including any admission queue wait (queue_ms)")
+    queue_ms = models.FloatField(null=True, blank=True, help_text="Time spent waiting in the admission queue in milliseconds")
+    tool_ms = models.FloatField(null=True, blank=True, help_text="Time spent running server-side tool calls in milliseconds")
+    tool_calls = models.PositiveIntegerField(null=True, blank=True, help_text="Server-side tool calls made for the request")
+    
+    # Streaming latency (latency_ms of a stream covers it until the last token)
+    ttft_ms = models.FloatField(null=True, blank=True, help_text="Time to first streamed token in milliseconds, including any admission queue wait")
+    itl_p50_ms = models.FloatField(null=True, blank=True, help_text="Median gap between streamed tokens in milliseconds")
+    itl_p95_ms = models.FloatField(null=True, blank=True, help_text="95th percentile gap between streamed tokens in milliseconds")
+    itl_p99_ms = models.FloatField(null=True, blank=True, help_text="99th percentile gap between streamed tokens in milliseconds")
+    load_ms = models.FloatField(null=True, blank=True, help_text="Model load time reported by Ollama (load_duration) in milliseconds")
+    prompt_eval_ms = models.FloatField(null=True, blank=True, help_text="Prompt processing time reported by Ollama (prompt_eval_duration) in milliseconds")
+    eval_ms = models.FloatField(null=True, blank=True, help_text="Generation time reported by Ollama (eval_duration) in milliseconds")
+    tokens_per_second = models.FloatField(null=True, blank=True, help_text="Completion tokens generated per second")
     
     # AI-specific metrics
     model_name = models.CharField(max_length=128, blank=True, help_text="AI model used (e.g., 'gpt-4')")
@@ -36,6 +52,18 @@ class RequestLog(models.Model):
     # Additional context
     user_agent = models.CharField(max_length=500, blank=True)
     finish_reason = models.CharField(max_length=50, blank=True, help_text="AI completion finish reason")
+    choice_finish_reasons = models.JSONField(
+        null=True, blank=True, help_text="Finish reason of each choice when n > 1 samples were requested"
+    )
+    
+    # Completion cache
+    cache_status = models.CharField(max_length=10, blank=True, help_text="Completion cache outcome: hit, miss or bypass")
+    cached_completion_tokens = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Completion tokens served from cache instead of generated"
+    )
+    context_saved_tokens = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Estimated prompt tokens trimmed or summarized out of the history"
+    )
     
     class Meta:
         indexes = [
@@ -44,6 +72,7 @@ class RequestLog(models.Model):
             models.Index(fields=['user', 'created_at']),
             models.Index(fields=['status_code']),
             models.Index(fields=['endpoint']),
+            models.Index(fields=['request_id']),
         ]
         ordering = ['-created_at']
     
@@ -175,6 +204,30 @@ class ThreatLog(models.Model):
         return f"{self.threat_type} ({self.severity}) - {self.created_at}"
 
 
+class ModelPrice(models.Model):
+    """
+    Per-model token prices used to cost RequestLog rows (see dashboard.pricing).
+
+    Prices are versioned: a price change is a new row with a later
+    ``effective_from``, so earlier requests keep the price they were costed at.
+    """
+    model_name = models.CharField(
+        max_length=128,
+        help_text="Model as requested (e.g. 'llama3.2' or 'llama3.2:1b'); '*' prices every model without its own row",
+    )
+    prompt_usd_per_million = models.DecimalField(max_digits=12, decimal_places=6, default=Decimal('0'))
+    completion_usd_per_million = models.DecimalField(max_digits=12, decimal_places=6, default=Decimal('0'))
+    effective_from = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['model_name', '-effective_from']
+        unique_together = ['model_name', 'effective_from']
+    
+    def __str__(self):
+        return f"{self.model_name} from {self.effective_from:%Y-%m-%d %H:%M}"
+
+
 class ModelUsageStats(models.Model):
     """
     Aggregated daily stats per model for faster dashboard queries.
@@ -0,0 +1,146 @@
+"""
+Cached, versioned per-model prices for costing RequestLog rows.
+
+:class:`PricingTable` holds every :class:`~dashboard.models.ModelPrice` row in
+memory, so costing a request does not query prices. A request is costed
+at the price in effect when it was made: the model's own row, else the row of
+its ``:latest`` alias, else the ``*`` default. Models without a price are not
+costed (``cost_usd`` stays null).
+
+The table is versioned by its row count and latest ``updated_at``. Every
+process compares that with the version it loaded at most once per
+``DASHBOARD_PRICING_CHECK_SECONDS`` (one aggregate query) and reloads the table
+when it changed; the process that saved or deleted a price reloads at once.
+"""
+import bisect
+import logging
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import ModelPrice
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = '*'
+MILLION = Decimal(1_000_000)
+# RequestLog.cost_usd has four decimal places
+COST_QUANTUM = Decimal('0.0001')
+
+_UNLOADED = object()
+
+
+class _History:
+    """Prices of one model, ordered by ``effective_from``."""
+
+    def __init__(self):
+        self.starts: List[datetime] = []
+        self.rates: List[Tuple[Decimal, Decimal]] = []
+
+    def at(self, when: datetime) -> Optional[Tuple[Decimal, Decimal]]:
+        index = bisect.bisect_right(self.starts, when) - 1
+        return self.rates[index] if index >= 0 else None
+
+
+def _aliases(model: str) -> List[str]:
+    if model.endswith(':latest'):
+        return [model, model[:-len(':latest')]]
+    if ':' not in model:
+        return [model, f"{model}:latest"]
+    return [model]
+
+
+class PricingTable:
+    """Per-model prompt and completion prices, reloaded when their version changes."""
+
+    def __init__(self, check_seconds: float = 30.0):
+        self.check_seconds = check_seconds
+        self._histories: Dict[str, _History] = {}
+        self._version = _UNLOADED
+        self._checked_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "PricingTable":
+        return cls(check_seconds=getattr(settings, 'DASHBOARD_PRICING_CHECK_SECONDS', 30.0))
+
+    @property
+    def version(self):
+        return None if self._version is _UNLOADED else self._version
+
+    def invalidate(self) -> None:
+        """Reload on next use (called in the process that changed a price)."""
+        with self._lock:
+            self._version = _UNLOADED
+            self._checked_at = None
+
+    def _refresh(self) -> None:
+        checked_at = self._checked_at
+        if checked_at is not None and time.monotonic() - checked_at < self.check_seconds:
+            return
+        with self._lock:
+            if self._checked_at is not checked_at:
+                return  # another thread just checked
+            version = tuple(ModelPrice.objects.aggregate(rows=Count('id'), updated=Max('updated_at')).values())
+            if version != self._version:
+                histories: Dict[str, _History] = {}
+                rows = ModelPrice.objects.order_by('effective_from').values_list(
+                    'model_name', 'effective_from', 'prompt_usd_per_million', 'completion_usd_per_million'
+                )
+                for model_name, effective_from, prompt_rate, completion_rate in rows:
+                    history = histories.setdefault(model_name, _History())
+                    history.starts.append(effective_from)
+                    history.rates.append((prompt_rate, completion_rate))
+                self._histories = histories
+                self._version = version
+                logger.info(f"Loaded {version[0]} prices for {len(histories)} models")
+            self._checked_at = time.monotonic()
+
+    def rates(self, model: str, when: Optional[datetime] = None) -> Optional[Tuple[Decimal, Decimal]]:
+        """USD per million prompt and completion tokens of ``model`` at ``when`` (default now)."""
+        self._refresh()
+        when = when or timezone.now()
+        histories = self._histories
+        for name in _aliases(model) + [DEFAULT_MODEL]:
+            history = histories.get(name)
+            rates = history.at(when) if history is not None else None
+            if rates is not None:
+                return rates
+        return None
+
+    def cost(self, model: str, prompt_tokens: Optional[int], completion_tokens: Optional[int],
+             when: Optional[datetime] = None) -> Optional[Decimal]:
+        """Cost in USD of a request, or None when ``model`` has no price."""
+        rates = self.rates(model, when)
+        if rates is None:
+            return None
+        prompt_rate, completion_rate = rates
+        cost = (Decimal(prompt_tokens or 0) * prompt_rate + Decimal(completion_tokens or 0) * completion_rate) / MILLION
+        return cost.quantize(COST_QUANTUM)
+
+
+@receiver([post_save, post_delete], sender=ModelPrice)
+def _price_changed(sender, **kwargs):
+    get_pricing_table().invalidate()
+
+
+_pricing_table: Optional[PricingTable] = None
+_pricing_table_lock = threading.Lock()
+
+
+def get_pricing_table() -> PricingTable:
+    """Process-wide pricing table."""
+    global _pricing_table
+    if _pricing_table is None:
+        with _pricing_table_lock:
+            if _pricing_table is None:
+                _pricing_table = PricingTable.from_settings()
+    return _pricing_table
@@ -217,21 +217,31 @@ class DashboardService:
     
     @staticmethod
     def _get_latency_over_time(queryset, grain: str) -> List[Dict[str, Any]]:
-        """Get average latency over time."""
+        """Get average latency over time, with time to first token and token pacing of streams."""
         trunc_func = TruncHour('created_at') if grain == 'hour' else TruncDay('created_at')
         
         results = (
             queryset
             .annotate(period=trunc_func)
             .values('period')
-            .annotate(latency=Avg('latency_ms'))
+            .annotate(
+                latency=Avg('latency_ms'),
+                ttft=Avg('ttft_ms'),
+                itl_p50=Avg('itl_p50_ms'),
+                itl_p95=Avg('itl_p95_ms'),
+                tokens_per_second=Avg('tokens_per_second'),
+            )
             .order_by('period')
         )
         
         return [
             {
                 'timestamp': result['period'].isoformat(),
-                'latency': round(float(result['latency'] or 0) / 1000, 3)  # Convert to seconds
+                'latency': round(float(result['latency'] or 0) / 1000, 3),  # Convert to seconds
+                'ttft': round(float(result['ttft'] or 0) / 1000, 3),
+                'itlP50Ms': round(result['itl_p50'] or 0, 2),
+                'itlP95Ms': round(result['itl_p95'] or 0, 2),
+                'tokensPerSecond': round(result['tokens_per_second'] or 0, 2),
             }
             for result in results
         ]
@@ -243,8 +253,15 @@ class DashboardService:
             total_requests=Count('id'),
             successful_requests=Count(Case(When(status_code__lt=400, then=1))),
             avg_latency_ms=Avg('latency_ms'),
+            avg_queue_ms=Avg('queue_ms'),
+            avg_ttft_ms=Avg('ttft_ms'),
+            avg_tokens_per_second=Avg('tokens_per_second'),
             total_cost=Sum('cost_usd'),
             sum_total_tokens=Sum('total_tokens'),
+            cache_hits=Count(Case(When(cache_status__in=['hit', 'semantic'], then=1))),
+            cache_lookups=Count(Case(When(cache_status__in=['hit', 'semantic', 'miss'], then=1))),
+            cached_tokens=Sum('cached_completion_tokens'),
+            context_saved_tokens=Sum('context_saved_tokens'),
         )
         
         # Calculate average tokens per request separately to avoid aggregate conflicts
@@ -256,10 +273,17 @@ class DashboardService:
             'totalRequests': summary['total_requests'] or 0,
             'successfulRequests': summary['successful_requests'] or 0,
             'avgLatencyMs': round(summary['avg_latency_ms'] or 0, 2),
+            'avgQueueMs': round(summary['avg_queue_ms'] or 0, 2),
+            'avgTtftMs': round(summary['avg_ttft_ms'] or 0, 2),
+            'avgTokensPerSecond': round(summary['avg_tokens_per_second'] or 0, 2),
             'totalCost': float(summary['total_cost'] or 0),
             'totalTokens': summary['sum_total_tokens'] or 0,
             'avgTokensPerRequest': round(avg_tokens, 2),
             'avgCostPerRequest': round(float(summary['total_cost'] or 0) / max(summary['total_requests'] or 1, 1), 6),
+            'cacheHits': summary['cache_hits'] or 0,
+            'cacheHitRate': round((summary['cache_hits'] or 0) / max(summary['cache_lookups'] or 1, 1), 4),
+            'cachedTokensSaved': summary['cached_tokens'] or 0,
+            'contextTokensSaved': summary['context_saved_tokens'] or 0,
         }
     
     @staticmethod
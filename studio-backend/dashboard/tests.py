@@ -1,3 +1,335 @@
-from django.test import TestCase
+import asyncio
+import statistics
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser
+from django.http import JsonResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+
+from chat_models.streaming import StreamStats
+
+from .log_writer import POLICY_BLOCK, RequestLogWriter
+from .middleware import RequestLoggingMiddleware
+from .models import ModelPrice, RequestLog
+from .pricing import PricingTable
+from .usage import request_usage
+
+
+class StreamedRequestLogTests(SimpleTestCase):
+    """A streamed completion is logged once its stream ends or is closed, with the final stats."""
+
+    def setUp(self):
+        self.writer = mock.Mock()
+        pricing = mock.Mock()
+        pricing.cost.return_value = None
+        for target, value in (('get_log_writer', self.writer), ('get_pricing_table', pricing)):
+            patcher = mock.patch(f'dashboard.middleware.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def respond(self, content):
+        """The response the middleware returns for a view streaming ``content``."""
+        middleware = RequestLoggingMiddleware(lambda request: None)
+        request = RequestFactory().post('/v1/chat/completions', '{"model": "llama3.2"}', content_type='application/json')
+        request.user = AnonymousUser()
+        middleware.process_request(request)
+        self.stats = request_usage(request).stats = StreamStats()
+        return middleware.process_response(request, StreamingHttpResponse(content))
+
+    def logged(self):
+        return [call.args[0] for call in self.writer.write.call_args_list]
+
+    def finish(self):
+        self.stats.finish({'done': True, 'prompt_eval_count': 5, 'eval_count': 2, 'done_reason': 'stop'})
+
+    def test_sync_stream_is_logged_when_exhausted(self):
+        def content():
+            yield 'a'
+            yield 'b'
+            self.finish()
+
+        response = self.respond(content())
+        self.assertEqual(self.logged(), [])
+        self.assertEqual(b''.join(response), b'ab')
+        [row] = self.logged()
+        self.assertEqual((row.model_name, row.total_tokens, row.finish_reason), ('llama3.2', 7, 'stop'))
+        response.close()
+        self.assertEqual(len(self.logged()), 1)
+
+    def test_sync_stream_is_logged_when_closed_early(self):
+        def content():
+            try:
+                yield 'a'
+                yield 'b'
+            finally:
+                self.stats.finish_reason = 'client_cancelled'
+
+        response = self.respond(content())
+        self.assertEqual(next(iter(response)), b'a')
+        response.close()
+        [row] = self.logged()
+        self.assertEqual(row.finish_reason, 'client_cancelled')
+
+    def test_async_stream_is_logged_when_exhausted(self):
+        async def content():
+            yield 'a'
+            yield 'b'
+            self.finish()
+
+        async def consume(response):
+            return [chunk async for chunk in response]
+
+        response = self.respond(content())
+        self.assertEqual(asyncio.run(consume(response)), [b'a', b'b'])
+        [row] = self.logged()
+        self.assertEqual((row.total_tokens, row.finish_reason), (7, 'stop'))
+
+    def test_async_stream_is_logged_when_cancelled(self):
+        async def content():
+            try:
+                yield 'a'
+                await asyncio.sleep(60)
+                yield 'b'
+            finally:
+                self.stats.finish_reason = 'client_cancelled'
+
+        async def consume(response):
+            # As the ASGI handler does when the client disconnects
+            started = asyncio.Event()
+
+            async def send():
+                async for _ in response:
+                    started.set()
+
+            task = asyncio.create_task(send())
+            await started.wait()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(consume(self.respond(content())))
+        [row] = self.logged()
+        self.assertEqual(row.finish_reason, 'client_cancelled')
+
+
+class RequestLogWriterTests(TransactionTestCase):
+    """Rows are queued, written in batches, dropped or waited for when the queue is full, and never lost on close."""
+
+    def make_writer(self, **kwargs):
+        writer = RequestLogWriter(flush_interval=3600, **kwargs)
+        # Flush explicitly: no background thread racing the assertions
+        patcher = mock.patch.object(writer, '_ensure_thread')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return writer
+
+    def row(self, index=0):
+        return RequestLog(endpoint='/v1/chat/completions', status_code=200, latency_ms=1.0, request_id=f"row-{index}")
+
+    def test_rows_are_queued_until_flushed_in_batches(self):
+        writer = self.make_writer(batch_size=2)
+        for index in range(5):
+            self.assertTrue(writer.write(self.row(index)))
+        self.assertEqual((writer.depth, RequestLog.objects.count()), (5, 0))
+        self.assertEqual(writer.flush(), 5)
+        self.assertEqual(RequestLog.objects.count(), 5)
+        self.assertEqual(writer.snapshot()["batches"], 3)
+        self.assertEqual(writer.depth, 0)
+
+    def test_drop_policy_discards_rows_when_full(self):
+        writer = self.make_writer(max_queue=2)
+        results = [writer.write(self.row(index)) for index in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(writer.dropped, 1)
+        writer.flush()
+        self.assertEqual(
+            list(RequestLog.objects.order_by('request_id').values_list('request_id', flat=True)), ['row-0', 'row-1']
+        )
+
+    def test_block_policy_waits_for_room(self):
+        writer = self.make_writer(max_queue=1, policy=POLICY_BLOCK, block_timeout=10)
+        writer.write(self.row(0))
+        results = []
+        blocked = threading.Thread(target=lambda: results.append(writer.write(self.row(1))))
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+        writer.flush()
+        blocked.join(5)
+        self.assertEqual(results, [True])
+        writer.flush()
+        self.assertEqual(RequestLog.objects.count(), 2)
+        self.assertEqual(writer.dropped, 0)
+
+    def test_block_policy_drops_after_the_timeout(self):
+        writer = self.make_writer(max_queue=1, policy=POLICY_BLOCK, block_timeout=0.05)
+        writer.write(self.row(0))
+        self.assertFalse(writer.write(self.row(1)))
+        self.assertEqual(writer.dropped, 1)
+
+    def test_close_writes_queued_rows_and_inserts_later_ones(self):
+        writer = self.make_writer()
+        for index in range(3):
+            writer.write(self.row(index))
+        self.assertEqual(writer.close(), 3)
+        self.assertEqual(RequestLog.objects.count(), 3)
+        self.assertTrue(writer.write(self.row(3)))
+        self.assertEqual((writer.depth, RequestLog.objects.count()), (0, 4))
+
+    def test_close_wakes_blocked_writers(self):
+        writer = self.make_writer(max_queue=1, policy=POLICY_BLOCK, block_timeout=10)
+        writer.write(self.row(0))
+        results = []
+        blocked = threading.Thread(target=lambda: results.append(writer.write(self.row(1))))
+        blocked.start()
+        blocked.join(0.1)
+        writer.close()
+        blocked.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(RequestLog.objects.count(), 2)
+
+    def test_close_loses_no_row_written_concurrently(self):
+        writer = self.make_writer()
+        accepted, inserted = [], []
+        stop = threading.Event()
+
+        def log(offset):
+            index = offset
+            while not stop.is_set():
+                if writer.write(self.row(index)):
+                    accepted.append(index)
+                index += 4
+
+        # Rows logged after close() are inserted directly; keep those off
+        # SQLite so only close() writes to it
+        with mock.patch.object(writer, '_save', side_effect=lambda row: inserted.append(row) or True):
+            threads = [threading.Thread(target=log, args=(offset,)) for offset in range(4)]
+            for thread in threads:
+                thread.start()
+            while len(accepted) < 50:
+                pass
+            writer.close()
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(writer.depth, 0)
+        self.assertEqual(RequestLog.objects.count() + len(inserted), len(accepted))
+
+
+class PricingTableTests(TransactionTestCase):
+    """Requests are costed at the price in effect when they were made, falling back to aliases and the default."""
+
+    def price(self, model_name, prompt, completion, **kwargs):
+        return ModelPrice.objects.create(model_name=model_name, prompt_usd_per_million=Decimal(prompt),
+                                         completion_usd_per_million=Decimal(completion), **kwargs)
+
+    def test_cost_is_quantized_to_the_log_column(self):
+        self.price('llama3.2', '2', '6')
+        table = PricingTable()
+        self.assertEqual(table.cost('llama3.2', 1000, 500), Decimal('0.0050'))
+        self.assertEqual(table.cost('llama3.2', 1, 1), Decimal('0.0000'))
+        self.assertEqual(table.cost('llama3.2', None, None), Decimal('0.0000'))
+
+    def test_unpriced_models_are_not_costed(self):
+        self.price('llama3.2', '2', '6')
+        self.assertIsNone(PricingTable().cost('mistral', 1000, 500))
+
+    def test_latest_alias_and_default_prices(self):
+        self.price('llama3.2:latest', '2', '6')
+        self.price('qwen2.5', '1', '1')
+        self.price('*', '10', '10')
+        table = PricingTable()
+        self.assertEqual(table.rates('llama3.2'), (Decimal('2'), Decimal('6')))
+        self.assertEqual(table.rates('qwen2.5:latest'), (Decimal('1'), Decimal('1')))
+        self.assertEqual(table.rates('qwen2.5:7b'), (Decimal('10'), Decimal('10')))
+        self.assertEqual(table.cost('mistral', 1000, 0), Decimal('0.0100'))
+
+    def test_requests_keep_the_price_in_effect_when_made(self):
+        now = timezone.now()
+        self.price('llama3.2', '2', '6', effective_from=now - timedelta(days=2))
+        self.price('llama3.2', '4', '12', effective_from=now - timedelta(days=1))
+        table = PricingTable()
+        self.assertIsNone(table.cost('llama3.2', 1000, 500, when=now - timedelta(days=3)))
+        self.assertEqual(table.cost('llama3.2', 1000, 500, when=now - timedelta(hours=36)), Decimal('0.0050'))
+        self.assertEqual(table.cost('llama3.2', 1000, 500, when=now), Decimal('0.0100'))
+
+    def test_saving_a_price_reloads_the_table(self):
+        table = PricingTable(check_seconds=3600)
+        with mock.patch('dashboard.pricing.get_pricing_table', return_value=table):
+            self.assertIsNone(table.cost('llama3.2', 1000, 500))
+            price = self.price('llama3.2', '2', '6')
+            self.assertEqual(table.cost('llama3.2', 1000, 500), Decimal('0.0050'))
+            price.delete()
+            self.assertIsNone(table.cost('llama3.2', 1000, 500))
+
+
+class RequestCostTests(TransactionTestCase):
+    """The middleware costs generated tokens; completions replayed from the cache are free."""
+
+    def setUp(self):
+        ModelPrice.objects.create(model_name='llama3.2', prompt_usd_per_million=Decimal('2'),
+                                  completion_usd_per_million=Decimal('6'))
+        self.writer = mock.Mock()
+        for target, value in (('get_log_writer', self.writer), ('get_pricing_table', PricingTable())):
+            patcher = mock.patch(f'dashboard.middleware.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def logged_cost(self, cache_status):
+        middleware = RequestLoggingMiddleware(lambda request: None)
+        request = RequestFactory().post('/v1/chat/completions', '{"model": "llama3.2"}', content_type='application/json')
+        request.user = AnonymousUser()
+        middleware.process_request(request)
+        stats = request_usage(request).stats = StreamStats()
+        stats.finish({'done': True, 'prompt_eval_count': 1000, 'eval_count': 500, 'done_reason': 'stop'})
+        middleware.process_response(request, JsonResponse({}, headers={'X-Completion-Cache': cache_status}))
+        [row] = [call.args[0] for call in self.writer.write.call_args_list]
+        self.assertEqual((row.cache_status, row.total_tokens), (cache_status, 1500))
+        return row.cost_usd
+
+    def test_generated_tokens_are_costed(self):
+        self.assertEqual(self.logged_cost('miss'), Decimal('0.0050'))
+        self.writer.reset_mock()
+        self.assertEqual(self.logged_cost('bypass'), Decimal('0.0050'))
+
+    def test_cache_hits_cost_nothing(self):
+        self.assertEqual(self.logged_cost('hit'), Decimal('0'))
+        self.writer.reset_mock()
+        self.assertEqual(self.logged_cost('semantic'), Decimal('0'))
+
+
+class RequestLogOverheadTests(TransactionTestCase):
+    """Logging a response, with the writer flushing in the background, adds little to the request."""
+
+    REQUESTS = 1000
+    # Generous: a few milliseconds is typical here, even on a loaded test machine
+    MAX_P99_MS = 20.0
+
+    def test_p99_overhead_of_middleware_and_writer(self):
+        ModelPrice.objects.create(model_name='llama3.2', prompt_usd_per_million=Decimal('0.1'),
+                                  completion_usd_per_million=Decimal('0.4'))
+        writer = RequestLogWriter(flush_interval=0.05, batch_size=100)
+        middleware = RequestLoggingMiddleware(lambda request: None)
+        factory = RequestFactory()
+        durations = []
+        with mock.patch('dashboard.middleware.get_log_writer', return_value=writer), \
+                mock.patch('dashboard.middleware.get_pricing_table', return_value=PricingTable()):
+            for index in range(self.REQUESTS):
+                request = factory.post('/v1/chat/completions', '{"model": "llama3.2"}', content_type='application/json')
+                request.user = AnonymousUser()
+                response = JsonResponse({'id': index}, headers={'X-Completion-Cache': 'miss'})
+                started = time.perf_counter()
+                middleware.process_request(request)
+                stats = request_usage(request).stats = StreamStats()
+                stats.finish({'done': True, 'prompt_eval_count': 12, 'eval_count': 40, 'done_reason': 'stop'})
+                middleware.process_response(request, response)
+                durations.append((time.perf_counter() - started) * 1000)
+        writer.close()
+        p99 = statistics.quantiles(durations, n=100)[98]
+        self.assertLess(p99, self.MAX_P99_MS, f"p99 {p99:.2f} ms over {self.REQUESTS} requests")
+        self.assertEqual(RequestLog.objects.filter(cost_usd__isnull=False).count(), self.REQUESTS)
@@ -0,0 +1,39 @@
+"""
+Request-scoped usage accounting for the request log.
+
+:class:`~dashboard.middleware.RequestLoggingMiddleware` attaches a
+:class:`RequestUsage` to every request as ``request.usage``. Views record
+what they know on it: the ``request_id`` they log under, the model, and the
+stats of the completion they return (a ``chat_models.streaming.StreamStats``
+or ``ChoiceStats``, plus a ``chat_models.tools.ToolTrace`` for tool loops).
+The middleware writes all of it, with the cost from
+:mod:`dashboard.pricing`, in the single insert of the request's
+``RequestLog`` row. For streamed responses the insert waits until the
+stream ends or the client goes away, when the stats are final.
+"""
+from typing import Any, Optional
+
+
+class RequestUsage:
+    """What one request used, correlated with its log lines by ``request_id``."""
+
+    def __init__(self):
+        self.request_id = ''
+        self.model_name = ''
+        self.stats: Optional[Any] = None
+        self.trace: Optional[Any] = None
+
+    @property
+    def recorded(self) -> bool:
+        return self.stats is not None or self.trace is not None
+
+
+def request_usage(request) -> RequestUsage:
+    """
+    The :class:`RequestUsage` of ``request`` (a Django or DRF request).
+
+    Without the middleware (e.g. in management commands) a detached record
+    is returned, so callers never need to check.
+    """
+    usage = getattr(request, 'usage', None)
+    return usage if isinstance(usage, RequestUsage) else RequestUsage()
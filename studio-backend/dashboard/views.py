@@ -7,6 +7,7 @@ from django.utils import timezone
 from datetime import datetime
 import logging
 
+from .log_writer import get_log_writer
 from .services import DashboardService
 
 logger = logging.getLogger(__name__)
@@ -108,7 +109,8 @@ class DashboardHealthView(APIView):
                     'connected': True,
                     'totalLogs': total_logs_count,
                     'recentLogs': recent_logs_count
-                }
+                },
+                'logWriter': get_log_writer().snapshot(),
             }, status=status.HTTP_200_OK)
             
         except Exception as e:
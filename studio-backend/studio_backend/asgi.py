@@ -12,5 +12,22 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'studio_backend.settings')
+# Route chat completions to the async view so streams run on the event loop
+# instead of pinning one worker thread each. Run with e.g.:
+#   uvicorn studio_backend.asgi:application --host 0.0.0.0 --port 8000
+os.environ.setdefault('CHAT_ASYNC_STREAMING', 'True')
 
 application = get_asgi_application()
+
+# Write queued request logs before the server's stop signal ends the process
+# (management commands rely on the writer's atexit flush instead)
+from dashboard.log_writer import install_signal_handlers  # noqa: E402
+
+install_signal_handlers()
+
+# Drain queued /v1/batches jobs from startup, so batches created before a
+# restart resume without waiting for a request (CHAT_BATCH_WORKERS=0 leaves
+# them to manage.py process_batches)
+from chat_models.batches import ensure_batch_workers  # noqa: E402
+
+ensure_batch_workers()
@@ -121,6 +121,20 @@ DATABASES = {
 # Production can override with PostgreSQL via environment variables:
 # POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT
 
+# Optional shared cache (django-redis). Without REDIS_URL Django's default
+# per-process local-memory cache is used.
+REDIS_URL = config('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': REDIS_URL,
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            },
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -227,6 +241,222 @@ CSRF_TRUSTED_ORIGINS = [
 # Ollama integration (used by chat_models app)
 OLLAMA_BASE_URL = config('OLLAMA_BASE_URL', default='http://localhost:11434')
 
+# Backends routed by chat_models.router: comma-separated base URLs, each with
+# optional ";ctx=<tokens>" (large context window) and ";name=<label>".
+# Defaults to OLLAMA_BASE_URL alone.
+OLLAMA_BACKENDS = config('OLLAMA_BACKENDS', default=OLLAMA_BASE_URL)
+OLLAMA_LARGE_CONTEXT_TOKENS = config('OLLAMA_LARGE_CONTEXT_TOKENS', default=8192, cast=int)
+# Circuit breaker per backend (chat_models.resilience): opens after
+# OLLAMA_BACKEND_MAX_FAILURES consecutive failures for OLLAMA_BACKEND_EJECT_SECONDS
+# (doubling on every reopen, up to OLLAMA_BACKEND_MAX_EJECT_SECONDS), then lets one
+# probe request through.
+OLLAMA_BACKEND_MAX_FAILURES = config('OLLAMA_BACKEND_MAX_FAILURES', default=3, cast=int)
+OLLAMA_BACKEND_EJECT_SECONDS = config('OLLAMA_BACKEND_EJECT_SECONDS', default=15.0, cast=float)
+OLLAMA_BACKEND_MAX_EJECT_SECONDS = config('OLLAMA_BACKEND_MAX_EJECT_SECONDS', default=300.0, cast=float)
+# Failed calls are retried after a full-jitter exponential backoff, at most
+# OLLAMA_RETRY_MAX_ATTEMPTS attempts, while the retries of the last
+# OLLAMA_RETRY_BUDGET_WINDOW_SECONDS stay within OLLAMA_RETRY_BUDGET_RATIO of the
+# requests (plus OLLAMA_RETRY_BUDGET_MIN_PER_SECOND).
+OLLAMA_RETRY_MAX_ATTEMPTS = config('OLLAMA_RETRY_MAX_ATTEMPTS', default=3, cast=int)
+OLLAMA_RETRY_BASE_DELAY_MS = config('OLLAMA_RETRY_BASE_DELAY_MS', default=50.0, cast=float)
+OLLAMA_RETRY_MAX_DELAY_MS = config('OLLAMA_RETRY_MAX_DELAY_MS', default=1000.0, cast=float)
+OLLAMA_RETRY_BUDGET_RATIO = config('OLLAMA_RETRY_BUDGET_RATIO', default=0.2, cast=float)
+OLLAMA_RETRY_BUDGET_MIN_PER_SECOND = config('OLLAMA_RETRY_BUDGET_MIN_PER_SECOND', default=1.0, cast=float)
+OLLAMA_RETRY_BUDGET_WINDOW_SECONDS = config('OLLAMA_RETRY_BUDGET_WINDOW_SECONDS', default=10.0, cast=float)
+# Hedging: a non-streaming completion whose first chunk (or, for n > 1, tool
+# rounds and batches, whose whole call) is slower than the model's observed
+# OLLAMA_HEDGE_QUANTILE (once OLLAMA_HEDGE_MIN_SAMPLES were seen) is also sent
+# to another backend; the first answer wins and the other is closed. A hedge
+# needs a free admission slot and is paid from the retry budget.
+OLLAMA_HEDGE_ENABLED = config('OLLAMA_HEDGE_ENABLED', default=True, cast=bool)
+OLLAMA_HEDGE_QUANTILE = config('OLLAMA_HEDGE_QUANTILE', default=0.95, cast=float)
+OLLAMA_HEDGE_MIN_SAMPLES = config('OLLAMA_HEDGE_MIN_SAMPLES', default=20, cast=int)
+OLLAMA_HEDGE_MIN_DELAY_MS = config('OLLAMA_HEDGE_MIN_DELAY_MS', default=50.0, cast=float)
+OLLAMA_HEDGE_MAX_INFLIGHT = config('OLLAMA_HEDGE_MAX_INFLIGHT', default=64, cast=int)
+OLLAMA_MODEL_REFRESH_SECONDS = config('OLLAMA_MODEL_REFRESH_SECONDS', default=30.0, cast=float)
+# /v1/models registry (chat_models.model_registry): listing refresh interval,
+# concurrent /api/show fetches, and whether chat requests for models no backend
+# lists are rejected up front.
+OLLAMA_MODEL_REGISTRY_REFRESH_SECONDS = config('OLLAMA_MODEL_REGISTRY_REFRESH_SECONDS', default=60.0, cast=float)
+OLLAMA_MODEL_METADATA_WORKERS = config('OLLAMA_MODEL_METADATA_WORKERS', default=8, cast=int)
+CHAT_VALIDATE_MODELS = config('CHAT_VALIDATE_MODELS', default=True, cast=bool)
+# Conversation affinity: keep routing a conversation to the backend whose runner
+# still holds its prefix in the KV cache (Ollama's default keep_alive is 5m).
+OLLAMA_AFFINITY_ENABLED = config('OLLAMA_AFFINITY_ENABLED', default=True, cast=bool)
+OLLAMA_AFFINITY_TTL_SECONDS = config('OLLAMA_AFFINITY_TTL_SECONDS', default=300.0, cast=float)
+OLLAMA_AFFINITY_MAX_EXTRA_REQUESTS = config('OLLAMA_AFFINITY_MAX_EXTRA_REQUESTS', default=2, cast=int)
+
+# Model residency manager (python manage.py manage_residency): keep the
+# OLLAMA_RESIDENCY_TOP_N most requested models loaded on every backend within
+# OLLAMA_RESIDENCY_MEMORY_BUDGET_GB (0 = no budget), unload idle ones.
+OLLAMA_RESIDENCY_TOP_N = config('OLLAMA_RESIDENCY_TOP_N', default=3, cast=int)
+OLLAMA_RESIDENCY_MEMORY_BUDGET_GB = config('OLLAMA_RESIDENCY_MEMORY_BUDGET_GB', default=0.0, cast=float)
+OLLAMA_RESIDENCY_IDLE_SECONDS = config('OLLAMA_RESIDENCY_IDLE_SECONDS', default=600.0, cast=float)
+OLLAMA_RESIDENCY_KEEP_ALIVE = config('OLLAMA_RESIDENCY_KEEP_ALIVE', default='30m')
+OLLAMA_RESIDENCY_DEMAND_WINDOW_SECONDS = config('OLLAMA_RESIDENCY_DEMAND_WINDOW_SECONDS', default=3600.0, cast=float)
+OLLAMA_RESIDENCY_INTERVAL_SECONDS = config('OLLAMA_RESIDENCY_INTERVAL_SECONDS', default=60.0, cast=float)
+
+# Exact-match completion cache (chat_models.completion_cache). Only requests
+# with temperature <= CHAT_CACHE_MAX_TEMPERATURE are cached. CHAT_CACHE_BACKEND
+# is "memory" (per-process LRU) or "django" (the CHAT_CACHE_ALIAS cache, e.g.
+# Redis when REDIS_URL is set).
+CHAT_CACHE_ENABLED = config('CHAT_CACHE_ENABLED', default=True, cast=bool)
+CHAT_CACHE_BACKEND = config('CHAT_CACHE_BACKEND', default='memory')
+CHAT_CACHE_ALIAS = config('CHAT_CACHE_ALIAS', default='default')
+CHAT_CACHE_MAX_ENTRIES = config('CHAT_CACHE_MAX_ENTRIES', default=1024, cast=int)
+CHAT_CACHE_TTL_SECONDS = config('CHAT_CACHE_TTL_SECONDS', default=3600.0, cast=float)
+CHAT_CACHE_MAX_TEMPERATURE = config('CHAT_CACHE_MAX_TEMPERATURE', default=0.0, cast=float)
+
+# Semantic cache (chat_models.semantic_cache): on an exact miss, the final user
+# turn is embedded with CHAT_SEMANTIC_CACHE_EMBED_MODEL and matched against
+# recent prompts for the same model. Off by default: a paraphrase is not always
+# the same question, so tune the threshold on real traffic before enabling.
+CHAT_SEMANTIC_CACHE_ENABLED = config('CHAT_SEMANTIC_CACHE_ENABLED', default=False, cast=bool)
+CHAT_SEMANTIC_CACHE_EMBED_MODEL = config('CHAT_SEMANTIC_CACHE_EMBED_MODEL', default='nomic-embed-text')
+CHAT_SEMANTIC_CACHE_THRESHOLD = config('CHAT_SEMANTIC_CACHE_THRESHOLD', default=0.95, cast=float)
+CHAT_SEMANTIC_CACHE_CAPACITY = config('CHAT_SEMANTIC_CACHE_CAPACITY', default=2048, cast=int)
+CHAT_SEMANTIC_CACHE_TTL_SECONDS = config('CHAT_SEMANTIC_CACHE_TTL_SECONDS', default=3600.0, cast=float)
+CHAT_SEMANTIC_CACHE_MMAP_DIR = config('CHAT_SEMANTIC_CACHE_MMAP_DIR', default='')
+
+# Single-flight coalescing (chat_models.coalescing): identical concurrent chat
+# requests share one upstream generation. Each subscriber buffers up to
+# CHAT_COALESCE_BUFFER_CHUNKS chunks before falling back to the flight history.
+CHAT_COALESCE_ENABLED = config('CHAT_COALESCE_ENABLED', default=True, cast=bool)
+CHAT_COALESCE_BUFFER_CHUNKS = config('CHAT_COALESCE_BUFFER_CHUNKS', default=256, cast=int)
+
+# Stream frame coalescing (chat_models.streaming): consecutive text deltas are
+# merged into one frame per CHAT_STREAM_COALESCE_MS window or
+# CHAT_STREAM_COALESCE_BYTES, whichever comes first. The first token is never
+# delayed. Set either to 0 to send one frame per Ollama chunk.
+CHAT_STREAM_COALESCE_MS = config('CHAT_STREAM_COALESCE_MS', default=20.0, cast=float)
+CHAT_STREAM_COALESCE_BYTES = config('CHAT_STREAM_COALESCE_BYTES', default=1024, cast=int)
+# Stream protocol when the request names none: "vercel", "openai" or "ndjson"
+# (chat_models.encoders).
+CHAT_STREAM_PROTOCOL = config('CHAT_STREAM_PROTOCOL', default='vercel')
+
+# Context window fitting (chat_models.context): histories over the model's
+# context_length (capped by CHAT_CONTEXT_WINDOW_TOKENS, e.g. the runners'
+# num_ctx; 0 = no cap) minus CHAT_CONTEXT_RESERVE_TOKENS are cut down by
+# CHAT_CONTEXT_POLICY: "recent" keeps system messages and the latest turns,
+# "summarize" also swaps dropped turns for a background summary (generated with
+# CHAT_CONTEXT_SUMMARY_MODEL, default the request's model), "off" disables it.
+CHAT_CONTEXT_POLICY = config('CHAT_CONTEXT_POLICY', default='recent')
+CHAT_CONTEXT_WINDOW_TOKENS = config('CHAT_CONTEXT_WINDOW_TOKENS', default=0, cast=int)
+CHAT_CONTEXT_RESERVE_TOKENS = config('CHAT_CONTEXT_RESERVE_TOKENS', default=1024, cast=int)
+CHAT_CONTEXT_ESTIMATE_CACHE_SIZE = config('CHAT_CONTEXT_ESTIMATE_CACHE_SIZE', default=4096, cast=int)
+CHAT_CONTEXT_SUMMARY_MODEL = config('CHAT_CONTEXT_SUMMARY_MODEL', default='')
+CHAT_CONTEXT_SUMMARY_WORKERS = config('CHAT_CONTEXT_SUMMARY_WORKERS', default=1, cast=int)
+CHAT_CONTEXT_SUMMARY_QUEUE_SIZE = config('CHAT_CONTEXT_SUMMARY_QUEUE_SIZE', default=32, cast=int)
+CHAT_CONTEXT_SUMMARY_TTL_SECONDS = config('CHAT_CONTEXT_SUMMARY_TTL_SECONDS', default=86400.0, cast=float)
+
+# Stored conversations (chat_models.conversations): requests may send a
+# conversationId plus only the new turn. Histories are cached for
+# CHAT_CONVERSATION_CACHE_TTL_SECONDS in the completion cache backend
+# (CHAT_CONVERSATION_CACHE_SIZE entries when it is the in-process one).
+CHAT_CONVERSATIONS_ENABLED = config('CHAT_CONVERSATIONS_ENABLED', default=True, cast=bool)
+CHAT_CONVERSATION_CACHE_TTL_SECONDS = config('CHAT_CONVERSATION_CACHE_TTL_SECONDS', default=3600.0, cast=float)
+CHAT_CONVERSATION_CACHE_SIZE = config('CHAT_CONVERSATION_CACHE_SIZE', default=1024, cast=int)
+
+# Largest n (parallel samples per chat completion, chat_models.sampling). Each
+# sample takes its own admission slot.
+CHAT_MAX_CHOICES = config('CHAT_MAX_CHOICES', default=8, cast=int)
+
+# Server-side tools (chat_models.tools): dotted paths of the tools requests may
+# name in "tools". Tool calls of one model turn run concurrently on a pool of
+# CHAT_TOOL_WORKERS threads, each bounded by its own timeout (default
+# CHAT_TOOL_TIMEOUT_SECONDS); results of idempotent tools are cached
+# (CHAT_TOOL_CACHE_SIZE results, 0 disables). After CHAT_TOOL_MAX_ROUNDS
+# rounds of tool calls the model must answer without tools.
+CHAT_TOOLS = config('CHAT_TOOLS', default='chat_models.builtin_tools.current_time,chat_models.builtin_tools.calculate')
+CHAT_TOOL_WORKERS = config('CHAT_TOOL_WORKERS', default=8, cast=int)
+CHAT_TOOL_TIMEOUT_SECONDS = config('CHAT_TOOL_TIMEOUT_SECONDS', default=10.0, cast=float)
+CHAT_TOOL_CACHE_SIZE = config('CHAT_TOOL_CACHE_SIZE', default=1024, cast=int)
+CHAT_TOOL_CACHE_TTL_SECONDS = config('CHAT_TOOL_CACHE_TTL_SECONDS', default=300.0, cast=float)
+CHAT_TOOL_MAX_ROUNDS = config('CHAT_TOOL_MAX_ROUNDS', default=5, cast=int)
+
+# Digests of chat messages that already passed the content rules
+# (chat_models.validators.ValidationMemo); resent history skips the rescan.
+# 0 disables the memo.
+CHAT_VALIDATION_MEMO_SIZE = config('CHAT_VALIDATION_MEMO_SIZE', default=16384, cast=int)
+
+# /v1/embeddings (chat_models.embeddings): concurrent requests for a model are
+# merged into one upstream call, waiting at most CHAT_EMBEDDINGS_BATCH_WINDOW_MS
+# (0 disables merging) for up to CHAT_EMBEDDINGS_MAX_BATCH inputs. Vectors are
+# cached per process by input hash (CHAT_EMBEDDINGS_CACHE_SIZE vectors, 0 disables).
+CHAT_EMBEDDINGS_BATCH_WINDOW_MS = config('CHAT_EMBEDDINGS_BATCH_WINDOW_MS', default=5.0, cast=float)
+CHAT_EMBEDDINGS_MAX_BATCH = config('CHAT_EMBEDDINGS_MAX_BATCH', default=64, cast=int)
+CHAT_EMBEDDINGS_CACHE_SIZE = config('CHAT_EMBEDDINGS_CACHE_SIZE', default=8192, cast=int)
+CHAT_EMBEDDINGS_CACHE_TTL_SECONDS = config('CHAT_EMBEDDINGS_CACHE_TTL_SECONDS', default=86400.0, cast=float)
+
+# Admission control (chat_models.admission): at most CHAT_ADMISSION_MODEL_CONCURRENCY
+# generations per model (override per model with "llama3:2,mistral:6") and
+# CHAT_ADMISSION_BACKEND_CONCURRENCY times the number of healthy backends in
+# total (routing, not admission, spreads them across backends). Excess requests wait in a
+# bounded queue, fair across tenants, with paying plans in a priority lane;
+# requests that cannot be served within CHAT_ADMISSION_MAX_WAIT_SECONDS get a
+# 429 with Retry-After.
+CHAT_ADMISSION_ENABLED = config('CHAT_ADMISSION_ENABLED', default=True, cast=bool)
+CHAT_ADMISSION_MODEL_CONCURRENCY = config('CHAT_ADMISSION_MODEL_CONCURRENCY', default=4, cast=int)
+CHAT_ADMISSION_MODEL_LIMITS = config('CHAT_ADMISSION_MODEL_LIMITS', default='')
+CHAT_ADMISSION_BACKEND_CONCURRENCY = config('CHAT_ADMISSION_BACKEND_CONCURRENCY', default=8, cast=int)
+CHAT_ADMISSION_QUEUE_SIZE = config('CHAT_ADMISSION_QUEUE_SIZE', default=64, cast=int)
+CHAT_ADMISSION_MAX_QUEUED_PER_TENANT = config('CHAT_ADMISSION_MAX_QUEUED_PER_TENANT', default=8, cast=int)
+CHAT_ADMISSION_MAX_WAIT_SECONDS = config('CHAT_ADMISSION_MAX_WAIT_SECONDS', default=30.0, cast=float)
+CHAT_ADMISSION_PRIORITY_PLANS = config('CHAT_ADMISSION_PRIORITY_PLANS', default='Pro,Team,Enterprise')
+
+# Offline batches (chat_models.batches): CHAT_BATCH_WORKERS threads per process
+# drain /v1/batches jobs (0 leaves it to `manage.py process_batches`). They only
+# take admission slots no interactive request waits for, keeping
+# CHAT_BATCH_HEADROOM of them free. A job whose lease is not renewed within
+# CHAT_BATCH_LEASE_SECONDS is retried, up to CHAT_BATCH_MAX_ATTEMPTS runs.
+CHAT_BATCH_WORKERS = config('CHAT_BATCH_WORKERS', default=2, cast=int)
+CHAT_BATCH_MAX_JOBS = config('CHAT_BATCH_MAX_JOBS', default=50000, cast=int)
+CHAT_BATCH_HEADROOM = config('CHAT_BATCH_HEADROOM', default=1, cast=int)
+CHAT_BATCH_LEASE_SECONDS = config('CHAT_BATCH_LEASE_SECONDS', default=60.0, cast=float)
+CHAT_BATCH_MAX_ATTEMPTS = config('CHAT_BATCH_MAX_ATTEMPTS', default=3, cast=int)
+CHAT_BATCH_POLL_SECONDS = config('CHAT_BATCH_POLL_SECONDS', default=2.0, cast=float)
+
+# Token-bucket rate limits for chat completions (chat_models.rate_limit), written
+# "<requests>/<s|m|h>"; leave one empty to disable that scope. CHAT_RATE_LIMIT_BACKEND
+# is "memory" (per process), "redis" (shared via REDIS_URL) or "fakeredis" (tests).
+# Rejections are written to ThreatLog in batches every CHAT_RATE_LIMIT_FLUSH_SECONDS.
+# Off by default so existing deployments keep serving every request; set
+# CHAT_RATE_LIMIT_ENABLED=True to apply the limits below.
+CHAT_RATE_LIMIT_ENABLED = config('CHAT_RATE_LIMIT_ENABLED', default=False, cast=bool)
+CHAT_RATE_LIMIT_BACKEND = config('CHAT_RATE_LIMIT_BACKEND', default='redis' if REDIS_URL else 'memory')
+CHAT_RATE_LIMIT_USER = config('CHAT_RATE_LIMIT_USER', default='60/m')
+CHAT_RATE_LIMIT_API_KEY = config('CHAT_RATE_LIMIT_API_KEY', default='60/m')
+CHAT_RATE_LIMIT_IP = config('CHAT_RATE_LIMIT_IP', default='120/m')
+CHAT_RATE_LIMIT_FLUSH_SECONDS = config('CHAT_RATE_LIMIT_FLUSH_SECONDS', default=10.0, cast=float)
+
+# Shared httpx connection pools for Ollama clients (see chat_models.client_pool).
+# OLLAMA_POOL_MAX_CONNECTIONS=0 removes the cap; each open stream holds one connection.
+OLLAMA_POOL_MAX_CONNECTIONS = config('OLLAMA_POOL_MAX_CONNECTIONS', default=1000, cast=int)
+OLLAMA_POOL_MAX_KEEPALIVE = config('OLLAMA_POOL_MAX_KEEPALIVE', default=100, cast=int)
+OLLAMA_POOL_KEEPALIVE_EXPIRY = config('OLLAMA_POOL_KEEPALIVE_EXPIRY', default=30.0, cast=float)
+OLLAMA_CONNECT_TIMEOUT = config('OLLAMA_CONNECT_TIMEOUT', default=5.0, cast=float)
+OLLAMA_READ_TIMEOUT = config('OLLAMA_READ_TIMEOUT', default=300.0, cast=float)
+
+# Request log costing (dashboard.pricing): each process checks at most this often
+# whether the ModelPrice table changed in another process.
+DASHBOARD_PRICING_CHECK_SECONDS = config('DASHBOARD_PRICING_CHECK_SECONDS', default=30.0, cast=float)
+# RequestLog rows are queued and inserted in batches by a background thread
+# (dashboard.log_writer) every DASHBOARD_LOG_FLUSH_MS or DASHBOARD_LOG_BATCH_SIZE
+# rows. With DASHBOARD_LOG_MAX_QUEUE rows waiting, DASHBOARD_LOG_FULL_POLICY
+# "drop" discards new rows and "block" makes the request wait up to
+# DASHBOARD_LOG_BLOCK_MS for room first. DASHBOARD_LOG_ASYNC=False inserts
+# every row on the request path.
+DASHBOARD_LOG_ASYNC = config('DASHBOARD_LOG_ASYNC', default=True, cast=bool)
+DASHBOARD_LOG_FLUSH_MS = config('DASHBOARD_LOG_FLUSH_MS', default=200.0, cast=float)
+DASHBOARD_LOG_BATCH_SIZE = config('DASHBOARD_LOG_BATCH_SIZE', default=500, cast=int)
+DASHBOARD_LOG_MAX_QUEUE = config('DASHBOARD_LOG_MAX_QUEUE', default=10000, cast=int)
+DASHBOARD_LOG_FULL_POLICY = config('DASHBOARD_LOG_FULL_POLICY', default='drop')
+DASHBOARD_LOG_BLOCK_MS = config('DASHBOARD_LOG_BLOCK_MS', default=1000.0, cast=float)
+
+# Serve /v1/chat/completions from the native async view (ollama.AsyncClient).
+# asgi.py turns this on; the WSGI entry point keeps the thread-per-stream view.
+CHAT_ASYNC_STREAMING = config('CHAT_ASYNC_STREAMING', default=False, cast=bool)
+
 # Development: allow any origin when DEBUG is True to simplify LAN testing.
 if DEBUG:
     CORS_ALLOW_ALL_ORIGINS = True
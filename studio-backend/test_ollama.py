@@ -13,14 +13,15 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'studio_backend.settings')
 django.setup()
 
-from chat_models.ollama_client import OllamaClient
+from chat_models.client_pool import get_client_registry
+from chat_models.ollama_client import get_ollama_client
 
 def test_ollama_client():
     print("Testing Ollama client...")
     
     try:
-        # Create client
-        client = OllamaClient()
+        # Get the shared pooled client
+        client = get_ollama_client()
         print("✅ Client created successfully")
         
         # Test health check
@@ -41,6 +42,9 @@ def test_ollama_client():
             messages=test_messages
         )
         print(f"✅ Chat completion successful: {response}")
+
+        # Connections should be kept alive for reuse between the calls above
+        print(f"✅ Connection pool: {get_client_registry().stats()}")
         
     except Exception as e:
         print(f"❌ Error: {e}")